@@ -23,6 +23,7 @@ import os
 import sys
 import argparse
 import locale
+import itertools
 from pkg_resources import resource_exists, resource_filename
 
 from astropy.modeling import models, fitting
@@ -31,6 +32,7 @@ from astropy.table import Table, Column, vstack
 from astropy.io import fits
 
 from desispec.util import set_backend
+from desispec.jit import njit
 set_backend()
 
 from matplotlib import pyplot as plt
@@ -317,67 +319,19 @@ def id_remainder(id_dict, llist, deg=4, tolerance=1., verbose=False) :
 
 def compute_triplets(wave) :
 
-    triplets=[]
     wave=np.sort(wave)
-    for i1,w1 in enumerate(wave[:-1]) :
-        for i2,w2 in enumerate(wave[i1+1:]) :
-            for i3,w3 in enumerate(wave[i1+i2+2:]) :
-                triplet=[w1,w2,w3,i1,i1+1+i2,i1+i2+2+i3,w2-w1,w3-w1,w2**2-w1**2,w3**2-w1**2]
-                #print(triplet)
-                #print(wave[i1],wave[i1+1+i2],wave[i1+i2+2+i3])
-                triplets.append(triplet)
-    return np.array(triplets)
-
-def id_arc_lines_using_triplets(id_dict,w,dwdy_prior,d2wdy2_prior=1.5e-5,toler=0.2,ntrack=50,nmax=40):
-    """Match (as best possible), a set of the input list of expected arc lines to the detected list
-
-    Parameters
-    ----------
-    id_dict : dictionnary with Pixel locations of detected arc lines in "pixpk" and fluxes in "flux"
-    w : ndarray
-      array of expected arc lines to be detected and identified
-    dwdy : float
-      Average dispersion in the spectrum
-    d2wdy2_prior : float
-      Prior on second derivative
-    toler : float, optional
-      Tolerance for matching (20%)
-    ntrack : max. number of solutions to be tracked
-
-    Returns
-    -------
-    id_dict : dict
-      dict of identified lines
-    """
-
-    log=get_logger()
-    #log.info("y=%s"%str(y))
-    #log.info("w=%s"%str(w))
-
-
-    y = id_dict["pixpk"]
-
-    log.info("ny=%d nw=%d"%(len(y),len(w)))
-
-    if nmax<10 :
-        nmax=10
-        log.warning("force nmax=10 (arg was too small: {:d})".format(nmax))
-
-    if len(y)>nmax :
-        # log.info("down-selecting the number of detected lines from {:d} to {:d}".format(len(y),nmax))
-        # keep at least the edges
-        margin=3
-        new_y=np.append(y[:margin],y[-margin:])
-        # now look at the flux to select the other ones
-        flux=id_dict["flux"][margin:-margin]
-        ii=np.argsort(flux)
-        new_y=np.append(new_y,y[margin:-margin][ii[-(nmax-2*margin):]])
-        y = np.sort(new_y)
+    #- all (i1,i2,i3) with i1<i2<i3, in lexicographic order
+    index=np.array(list(itertools.combinations(range(wave.size),3)),dtype=int).reshape(-1,3)
+    w1=wave[index[:,0]]
+    w2=wave[index[:,1]]
+    w3=wave[index[:,2]]
+    #triplet=[w1,w2,w3,i1,i1+1+i2,i1+i2+2+i3,w2-w1,w3-w1,w2**2-w1**2,w3**2-w1**2]
+    return np.column_stack([w1,w2,w3,index,w2-w1,w3-w1,w2**2-w1**2,w3**2-w1**2])
 
-    # compute triplets of waves of y positions
-    y_triplets = compute_triplets(y)
-    w_triplets = compute_triplets(w)
 
+def _triplet_coefs(y_triplets) :
+    """Coefficients used to compute the 2nd order polynomials w(y) defined
+    by the y triplets and any w triplet"""
     # each pair of triplet defines a 2nd order polynomial (chosen centered on y=2000)
     # w = a*(y-2000)**2+b*(y-2000)+c
     # w = a*y**2-4000*a*y+b*y+cst
@@ -393,14 +347,85 @@ def id_arc_lines_using_triplets(id_dict,w,dwdy_prior,d2wdy2_prior=1.5e-5,toler=0
     # b = idet*(-cdy2_13*dw_12+cdy2_12*dw_13)
 
     #triplet=[w1,w2,w3,i1,i1+1+i2,i1+i2+2+i3,w2-w1,w3-w1,w2**2-w1**2,w3**2-w1**2]
-    dy_12=y_triplets[:,6]
-    dy_13=y_triplets[:,7]
+    dy_12=np.ascontiguousarray(y_triplets[:,6])
+    dy_13=np.ascontiguousarray(y_triplets[:,7])
     #dy2_12=y_triplets[:,8]
     #dy2_13=y_triplets[:,9]
     # centered version
     cdy2_12=y_triplets[:,8]-4000.*y_triplets[:,6]
     cdy2_13=y_triplets[:,9]-4000.*y_triplets[:,7]
-    idet=1./(dy_13*cdy2_12-dy_12*cdy2_13)
+    with np.errstate(divide='ignore') :
+        idet=1./(dy_13*cdy2_12-dy_12*cdy2_13)
+    return dy_12,dy_13,cdy2_12,cdy2_13,idet
+
+
+def _triplet_bins(y_triplets,w_triplets,dwdy_min,dwdy_step,d2wdy2_min,d2wdy2_step) :
+    """Bins of dw/dy and d2w/dy2 of the polynomials w(y) defined by all pairs
+    of triplets, as 2D arrays [len(y_triplets),len(w_triplets)]
+    """
+    dy_12,dy_13,cdy2_12,cdy2_13,idet=[c[:,None] for c in _triplet_coefs(y_triplets)]
+    dw_12=w_triplets[None,:,6]
+    dw_13=w_triplets[None,:,7]
+    dwdy_bin   = ((idet*(-cdy2_13*dw_12+cdy2_12*dw_13)-dwdy_min)/dwdy_step).astype(int)
+    d2wdy2_bin = ((idet*(dy_13*dw_12-dy_12*dw_13)-d2wdy2_min)/d2wdy2_step).astype(int)
+    return dwdy_bin,d2wdy2_bin
+
+
+@njit(nogil=True, signatures=["(float64[::1], float64[::1], float64[::1], float64[::1], float64[::1], int64[::1], float64[::1], float64[::1], int64[::1], float64, float64, float64, float64, float64[:,:,:,::1])"])
+def _triplet_histogram_numba(dy_12,dy_13,cdy2_12,cdy2_13,idet,iy,dw_12,dw_13,iw,dwdy_min,dwdy_step,d2wdy2_min,d2wdy2_step,histogram) :
+    """Adds all pairs of (y,w) triplets to the histogram [ndwdy,nd2wdy2,ny,nw],
+    with the same operations as _triplet_bins, so the bins are identical.
+    """
+    ndwdy=histogram.shape[0]
+    nd2wdy2=histogram.shape[1]
+    for i in range(dy_12.size) :
+        for j in range(dw_12.size) :
+            # the truncation to int of astype(int) gives a bin in range
+            # for values in ]-1,n[
+            val=(idet[i]*(-cdy2_13[i]*dw_12[j]+cdy2_12[i]*dw_13[j])-dwdy_min)/dwdy_step
+            if not (val>-1. and val<ndwdy) :
+                continue
+            dwdy_bin=int(val)
+            val=(idet[i]*(dy_13[i]*dw_12[j]-dy_12[i]*dw_13[j])-d2wdy2_min)/d2wdy2_step
+            if not (val>-1. and val<nd2wdy2) :
+                continue
+            histogram[dwdy_bin,int(val),iy[i],iw[j]] += 1.
+
+
+def _id_arc_lines_using_prior(y,w,prior_id_dict,dwdy_prior) :
+    """Match lines using the solution of another fiber
+
+    Returns y_id, w_id, rms of the refined solution, or None if the
+    solution of the other fiber cannot be used.
+    """
+    pix = np.asarray(prior_id_dict.get("id_pix",[]),dtype=float)
+    wave = np.asarray(prior_id_dict.get("id_wave",[]),dtype=float)
+    deg = 3
+    if prior_id_dict.get("status") != "ok" or pix.size < deg+2 or pix.size != wave.size :
+        return None
+    # wavelength of the detected lines with the other fiber solution
+    transfo = np.poly1d(np.polyfit(pix,wave,deg=deg))
+    wy = transfo(y)
+    # nearest expected line, within a few pixels
+    j = np.argmin(np.abs(wy[:,None]-w[None,:]),axis=1)
+    y_id = np.where(np.abs(wy-w[j]) < 3.*abs(dwdy_prior))[0]
+    if y_id.size < deg+2 :
+        return None
+    w_id = j[y_id]
+    y_id,w_id,rms,niter = refine_solution(y,w,y_id,w_id)
+    return y_id,w_id,rms
+
+
+def _id_arc_lines_triplet_search(y,w,dwdy_prior,d2wdy2_prior,toler,ntrack) :
+    """Match lines by triplets, see id_arc_lines_using_triplets
+
+    Returns y_id, w_id, rms of the best solution
+    """
+    log=get_logger()
+
+    # compute triplets of waves of y positions
+    y_triplets = compute_triplets(y)
+    w_triplets = compute_triplets(w)
 
     # fill histogram with polynomial coefs and first index of each triplet in the pair for all pairs of triplets(y,w)
     # create the 4D histogram
@@ -415,17 +440,9 @@ def id_arc_lines_using_triplets(id_dict,w,dwdy_prior,d2wdy2_prior=1.5e-5,toler=0
     histogram = np.zeros((ndwdy,nd2wdy2,len(y),len(w))) # definition of the histogram
 
     # fill the histogram
-    for w_triplet in w_triplets :
-        #d2wdy2 = idet*(dy_13*w_triplet[6]-dy_12*w_triplet[7])
-        #dwdy   = idet*(-cdy2_13*w_triplet[6]+cdy2_12*w_triplet[7])
-        # bins in the histogram
-        dwdy_bin   = ((idet*(-cdy2_13*w_triplet[6]+cdy2_12*w_triplet[7])-dwdy_min)/dwdy_step).astype(int)
-        d2wdy2_bin = ((idet*(dy_13*w_triplet[6]-dy_12*w_triplet[7])-d2wdy2_min)/d2wdy2_step).astype(int)
-        pairs_in_histo=np.where((dwdy_bin>=0)&(dwdy_bin<ndwdy)&(d2wdy2_bin>=0)&(d2wdy2_bin<nd2wdy2))[0]
-        # fill histo
-        iw=int(w_triplet[3])
-        for a,b,c in zip(dwdy_bin[pairs_in_histo],d2wdy2_bin[pairs_in_histo],y_triplets[pairs_in_histo,3].astype(int)) :
-            histogram[a,b,c,iw] += 1
+    _triplet_histogram_numba(*_triplet_coefs(y_triplets),y_triplets[:,3].astype(int),
+                             np.ascontiguousarray(w_triplets[:,6]),np.ascontiguousarray(w_triplets[:,7]),w_triplets[:,3].astype(int),
+                             dwdy_min,dwdy_step,d2wdy2_min,d2wdy2_step,histogram)
 
     # find max bins in the histo
     histogram_ravel = histogram.ravel()
@@ -448,20 +465,12 @@ def id_arc_lines_using_triplets(id_dict,w,dwdy_prior,d2wdy2_prior=1.5e-5,toler=0
         #print("bins=",dwdy_best_bin,d2wdy2_best_bin,iy_best_bin,iw_best_bin)
 
         # pairs of triplets in this histo bin
-        w_id=np.array([])
-        y_id=np.array([])
         wok=np.where(w_triplets[:,3]==iw_best_bin)[0]
         yok=np.where(y_triplets[:,3]==iy_best_bin)[0]
-        for w_triplet in w_triplets[wok] :
-            #d2wdy2 = idet[yok]*(dy_13[yok]*w_triplet[6]-dy_12[yok]*w_triplet[7])
-            #dwdy   = idet[yok]*(-cdy2_13[yok]*w_triplet[6]+cdy2_12[yok]*w_triplet[7])
-            # bins in the histogram
-            dwdy_bin   = ((idet[yok]*(-cdy2_13[yok]*w_triplet[6]+cdy2_12[yok]*w_triplet[7])-dwdy_min)/dwdy_step).astype(int)
-            d2wdy2_bin = ((idet[yok]*(dy_13[yok]*w_triplet[6]-dy_12[yok]*w_triplet[7])-d2wdy2_min)/d2wdy2_step).astype(int)
-            wyok=yok[np.where((dwdy_bin==dwdy_best_bin)&(d2wdy2_bin==d2wdy2_best_bin))[0]]
-            for y_triplet in y_triplets[wyok] :
-                y_id=np.append(y_id,y_triplet[3:6])
-                w_id=np.append(w_id,w_triplet[3:6])
+        dwdy_bin,d2wdy2_bin = _triplet_bins(y_triplets[yok],w_triplets[wok],dwdy_min,dwdy_step,d2wdy2_min,d2wdy2_step)
+        iyok,iwok = np.where((dwdy_bin==dwdy_best_bin)&(d2wdy2_bin==d2wdy2_best_bin))
+        y_id=y_triplets[yok[iyok],3:6].ravel()
+        w_id=w_triplets[wok[iwok],3:6].ravel()
 
         # now need to rm duplicates
         nw=len(w)
@@ -487,6 +496,72 @@ def id_arc_lines_using_triplets(id_dict,w,dwdy_prior,d2wdy2_prior=1.5e-5,toler=0
             #log.info("stop here because we have a correct solution")
             break
 
+    return best_y_id,best_w_id,best_rms
+
+
+def id_arc_lines_using_triplets(id_dict,w,dwdy_prior,d2wdy2_prior=1.5e-5,toler=0.2,ntrack=50,nmax=40,prior_id_dict=None):
+    """Match (as best possible), a set of the input list of expected arc lines to the detected list
+
+    Parameters
+    ----------
+    id_dict : dictionnary with Pixel locations of detected arc lines in "pixpk" and fluxes in "flux"
+    w : ndarray
+      array of expected arc lines to be detected and identified
+    dwdy : float
+      Average dispersion in the spectrum
+    d2wdy2_prior : float
+      Prior on second derivative
+    toler : float, optional
+      Tolerance for matching (20%)
+    ntrack : max. number of solutions to be tracked
+    prior_id_dict : dict, optional
+      dict of identified lines of another fiber (e.g. the previous one);
+      its solution is tried first, and the triplet matching is skipped if
+      it gives a correct solution for this fiber
+
+    Returns
+    -------
+    id_dict : dict
+      dict of identified lines
+    """
+
+    log=get_logger()
+    #log.info("y=%s"%str(y))
+    #log.info("w=%s"%str(w))
+
+
+    y = id_dict["pixpk"]
+
+    log.info("ny=%d nw=%d"%(len(y),len(w)))
+
+    if nmax<10 :
+        nmax=10
+        log.warning("force nmax=10 (arg was too small: {:d})".format(nmax))
+
+    if len(y)>nmax :
+        # log.info("down-selecting the number of detected lines from {:d} to {:d}".format(len(y),nmax))
+        # keep at least the edges
+        margin=3
+        new_y=np.append(y[:margin],y[-margin:])
+        # now look at the flux to select the other ones
+        flux=id_dict["flux"][margin:-margin]
+        ii=np.argsort(flux)
+        new_y=np.append(new_y,y[margin:-margin][ii[-(nmax-2*margin):]])
+        y = np.sort(new_y)
+
+    # first try the solution of the other fiber
+    if prior_id_dict is not None :
+        result = _id_arc_lines_using_prior(y,w,prior_id_dict,dwdy_prior)
+        if result is not None and result[2]<0.2 and len(result[0])>=min(10,min(len(y),len(w))) :
+            log.info("using the solution of fiber {}".format(prior_id_dict.get("fiber","")))
+            best_y_id,best_w_id,best_rms = result
+        else :
+            log.info("solution of fiber {} does not match, using triplets".format(prior_id_dict.get("fiber","")))
+            prior_id_dict = None
+
+    if prior_id_dict is None :
+        best_y_id,best_w_id,best_rms = _id_arc_lines_triplet_search(y,w,dwdy_prior,d2wdy2_prior,toler,ntrack)
+
     if len(y) != len(id_dict["pixpk"]) :
         #log.info("re-indexing the result")
         tmp_y_id = []
@@ -1205,8 +1280,11 @@ def fit_traces(xset, xerr, func='legendre', order=6, sigrej=20.,
     return xnew, fits
 
 
-def extract_sngfibers_gaussianpsf(img, img_ivar, xtrc, sigma, box_radius=2, verbose=True):
-    """Extract spectrum for fibers one-by-one using a Gaussian PSF
+def extract_sngfibers_gaussianpsf(img, img_ivar, xtrc, sigma, box_radius=2, verbose=True, nrows=None):
+    """Extract spectrum of each fiber using a Gaussian PSF
+
+    Each fiber is fit independently, on the columns spanned by its trace
+    +/- box_radius, but all fibers are extracted at once by blocks of rows.
 
     Parameters
     ----------
@@ -1220,73 +1298,52 @@ def extract_sngfibers_gaussianpsf(img, img_ivar, xtrc, sigma, box_radius=2, verb
       Gaussian sigma for PSF
     box_radius : int, optional
       Radius for extraction (+/-)
+    nrows : int, optional
+      Number of rows extracted at once (default keeps the temporary
+      arrays to a few million elements)
 
     Returns
     -------
     spec : ndarray
       Extracted spectrum
     """
+    log = get_logger()
+    start = time.time()
 
-    # Init
-    xpix_img = np.outer(np.ones(img.shape[0]),np.arange(img.shape[1]))
-    mask = np.zeros_like(img,dtype=int)
-    iy = np.arange(img.shape[0],dtype=int)
+    ny, nx = img.shape
+    nfiber = xtrc.shape[1]
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (nfiber,))
 
-    log = get_logger()
+    # Columns of each fiber: the trace +/- box_radius over all rows,
+    # padded to the widest fiber
+    ixt = np.round(xtrc).astype(int)
+    minx = np.clip(np.min(ixt, axis=0) - box_radius, 0, nx-1)
+    maxx = np.clip(np.max(ixt, axis=0) + box_radius, 0, nx-1)
+    width = np.max(maxx - minx) + 1
+    xpix = minx[:,None] + np.arange(width)
+    inside = (xpix <= maxx[:,None])
+    xpix = np.minimum(xpix, nx-1)
+
+    if nrows is None:
+        nrows = max(1, 4000000 // (nfiber*width))
 
-    #
     all_spec = np.zeros_like(xtrc)
     cst = 1./np.sqrt(2*np.pi)
-    start=0
-    for qq in range(xtrc.shape[1]):
-        if verbose & (qq % 25 == 0):
-            stop=time.time()
-            if start>0 :
-                log.info("Working on fiber %d of %d (done 25 in %3.2f sec)"%(qq,xtrc.shape[1],stop-start))
-            else :
-                log.info("Working on fiber %d of %d"%(qq,xtrc.shape[1]))
-            start=stop
-
-        # Mask
-        mask[:,:] = 0
-        ixt = np.round(xtrc[:,qq]).astype(int)
-        for jj,ibox in enumerate(range(-box_radius,box_radius+1)):
-            ix = ixt + ibox
-            mask[iy,ix] = 1
-        # Sub-image (for speed, not convenience)
-        gdp = np.where(mask == 1)
-        minx = np.min(gdp[1])
-        maxx = np.max(gdp[1])
-        nx = (maxx-minx)+1
-
+    for begin in range(0, ny, nrows):
+        end = min(ny, begin+nrows)
         # Generate PSF
-        dx_img = xpix_img[:,minx:maxx+1] - np.outer(xtrc[:,qq], np.ones(nx))
-        psf = cst*np.exp(-0.5 * (dx_img/sigma[qq])**2)/sigma[qq]
-
-        #dx_img = xpix_img[:,minx:maxx+1] - np.outer(xtrc[:,qq],np.ones(img.shape[1]))
-        #g_init = models.Gaussian1D(amplitude=1., mean=0., stddev=sigma[qq])
-        #psf = mask * g_init(dx_img)
+        dx = xpix - xtrc[begin:end,:,None]
+        psf = cst*np.exp(-0.5 * (dx/sigma[:,None])**2)/sigma[:,None]
+        psf *= inside
         # Extract
-        #all_spec[:,qq] = np.sum(psf*img,axis=1) / np.sum(psf,axis=1)
-        #all_spec[:,qq] = np.sum(psf*img[:,minx:maxx+1],axis=1) / np.sum(psf,axis=1)
-        a=np.sum(img_ivar[:,minx:maxx+1]*psf**2,axis=1)
-        b=np.sum(img_ivar[:,minx:maxx+1]*psf*img[:,minx:maxx+1],axis=1)
-        ok=(a>1.e-6)
-        all_spec[ok,qq] = b[ok] / a[ok]
-
-        #import astropy.io.fits as pyfits
-        #h=pyfits.HDUList([pyfits.PrimaryHDU(),
-        #                  pyfits.ImageHDU(img[:,minx:maxx+1],name="FLUX"),
-        #                  pyfits.ImageHDU(img_ivar[:,minx:maxx+1],name="IVAR"),
-        #                  pyfits.ImageHDU(psf,name="PSF"),
-        #                  pyfits.ImageHDU(a,name="A"),
-        #                  pyfits.ImageHDU(b,name="B")])
-        #h.writeto("test.fits")
-        #sys.exit(12)
-
-
-
+        ivar = img_ivar[begin:end][:,xpix]
+        a = np.sum(ivar*psf**2, axis=2)
+        b = np.sum(ivar*psf*img[begin:end][:,xpix], axis=2)
+        ok = (a>1.e-6)
+        all_spec[begin:end][ok] = b[ok] / a[ok]
 
+    if verbose:
+        log.info("Extracted %d fibers in %3.2f sec"%(nfiber,time.time()-start))
 
     # Return
     return all_spec
@@ -1676,14 +1733,48 @@ def write_line_list(filename,all_wv_soln,llist) :
 # Utilities
 #####################################################################
 
+def _run_bootcalib(job):
+    """Run desi_bootcalib in this process, with its output in the job log file
+
+    Args:
+        job: tuple (options, logfile)
+
+    Returns:
+        tuple (logfile, exit code)
+    """
+    from desispec.scripts import bootcalib as bootcalib_script
+    from desispec.parallel import stdouterr_redirected
+    options, lfile = job
+    code = 0
+    with stdouterr_redirected(to=lfile):
+        try:
+            bootcalib_script.main(bootcalib_script.parse(options))
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            code = 1
+    plt.close('all')
+    return lfile, code
+
+
 def script_bootcalib(arc_idx, flat_idx, cameras=None, channels=None, nproc=10):
     """ Runs desi_bootcalib on a series of preproc files
 
+    The runs are done in a pool of nproc processes, a new run starting
+    as soon as a process is free, each run in a new process.  The output of each run is written in
+    its log file.
+
     Returns:
+        dict of the exit code of each run, keyed by log file name
+
+    Example:
         script_bootcalib([0,1,2,3,4,5,6,7,8,9], [10,11,12,13,14])
 
     """
-    from subprocess import Popen
+    import multiprocessing
+    log = get_logger()
     #
     if cameras is None:
         cameras = ['0','1','2','3','4','5','6','7','8','9']
@@ -1698,44 +1789,46 @@ def script_bootcalib(arc_idx, flat_idx, cameras=None, channels=None, nproc=10):
     ntrial = narc*nflat*ncameras*nchannels
 
     # Loop on the systems
-    nrun = -1
-    #nrun = 123
-    while(nrun < ntrial):
-
-        proc = []
-        ofiles = []
-        for ss in range(nproc):
-            nrun += 1
-            iarc = nrun % narc
-            jflat = (nrun//narc) % nflat
-            kcamera = (nrun//(narc*nflat)) % ncameras
-            lchannel = nrun // (narc*nflat*ncameras)
-            #pdb.set_trace()
-            if nrun == ntrial:
-                break
-            # Names
-            #- TODO: update to use desispec.io.findfile instead
-            afile = str('preproc-{:s}{:s}-{:08d}.fits'.format(channels[lchannel], cameras[kcamera], arc_idx[iarc]))
-            ffile = str('preproc-{:s}{:s}-{:08d}.fits'.format(channels[lchannel], cameras[kcamera], flat_idx[jflat]))
-            ofile = str('boot_psf-{:s}{:s}-{:d}{:d}.fits'.format(channels[lchannel], cameras[kcamera],
-                                                                 arc_idx[iarc], flat_idx[jflat]))
-            qfile = str('qa_boot-{:s}{:s}-{:d}{:d}.pdf'.format(channels[lchannel], cameras[kcamera],
-                                                                 arc_idx[iarc], flat_idx[jflat]))
-            lfile = str('boot-{:s}{:s}-{:d}{:d}.log'.format(channels[lchannel], cameras[kcamera],
-                                                               arc_idx[iarc], flat_idx[jflat]))
-            ## Run
-            script = [str('desi_bootcalib.py'), str('--fiberflat={:s}'.format(ffile)),
-                      str('--arcfile={:s}'.format(afile)),
-                      str('--outfile={:s}'.format(ofile)),
-                      str('--qafile={:s}'.format(qfile))]#,
-                      #str('>'),
-                      #str('{:s}'.format(lfile))]
-            f = open(lfile, "w")
-            proc.append(Popen(script, stdout=f))
-            ofiles.append(f)
-        exit_codes = [p.wait() for p in proc]
-        for ofile in ofiles:
-            ofile.close()
+    jobs = []
+    for nrun in range(ntrial):
+        iarc = nrun % narc
+        jflat = (nrun//narc) % nflat
+        kcamera = (nrun//(narc*nflat)) % ncameras
+        lchannel = nrun // (narc*nflat*ncameras)
+        # Names
+        #- TODO: update to use desispec.io.findfile instead
+        afile = str('preproc-{:s}{:s}-{:08d}.fits'.format(channels[lchannel], cameras[kcamera], arc_idx[iarc]))
+        ffile = str('preproc-{:s}{:s}-{:08d}.fits'.format(channels[lchannel], cameras[kcamera], flat_idx[jflat]))
+        ofile = str('boot_psf-{:s}{:s}-{:d}{:d}.fits'.format(channels[lchannel], cameras[kcamera],
+                                                             arc_idx[iarc], flat_idx[jflat]))
+        qfile = str('qa_boot-{:s}{:s}-{:d}{:d}.pdf'.format(channels[lchannel], cameras[kcamera],
+                                                             arc_idx[iarc], flat_idx[jflat]))
+        lfile = str('boot-{:s}{:s}-{:d}{:d}.log'.format(channels[lchannel], cameras[kcamera],
+                                                           arc_idx[iarc], flat_idx[jflat]))
+        options = [str('--fiberflat={:s}'.format(ffile)),
+                   str('--arcfile={:s}'.format(afile)),
+                   str('--outfile={:s}'.format(ofile)),
+                   str('--qafile={:s}'.format(qfile))]
+        jobs.append((options, lfile))
+
+    ## Run
+    #- each run in its own process (also when serial), so that the log
+    #- redirection and the matplotlib state do not affect the caller
+    pool = multiprocessing.Pool(max(1, min(nproc, ntrial)), maxtasksperchild=1)
+    results = pool.imap_unordered(_run_bootcalib, jobs)
+
+    exit_codes = dict()
+    for lfile, code in results:
+        exit_codes[lfile] = code
+        if code != 0:
+            log.error("bootcalib failed with exit code {}, see {}".format(code, lfile))
+        else:
+            log.info("bootcalib done, see {} ({}/{})".format(lfile, len(exit_codes), ntrial))
+
+    pool.close()
+    pool.join()
+
+    return exit_codes
 
 
 #####################################################################
@@ -0,0 +1,214 @@
+"""
+desispec.calibcache
+===================
+
+Process-wide cache of the CCD calibration products used by
+:func:`desispec.preproc.preproc` (bias, dark, pixflat and mask images, and the
+parsed ccd_calibration.yaml file).
+
+Entries are keyed by the kind of product, the absolute filename and the
+modification time, size and inode of the file, so a file that is updated on
+disk is read again.  The images are kept read-only and the least recently used
+entries are evicted when the total size of the cached images exceeds a cap.
+
+Several processes of a node (e.g. MPI ranks) can share one copy of each
+image with the memory-mapped mode: the images are converted once to ``.npy``
+files in a directory (typically on ``/dev/shm``) and memory-mapped read-only
+by every process.
+
+The cache is disabled by default, because every process keeps its cached
+images in memory.  It is configured with the environment variables
+
+    DESI_CALIB_CACHE_MB : maximum size in MB of the cached images per process
+        (default 0, which disables the cache)
+    DESI_CALIB_CACHE_DIR : directory of the memory-mapped images (default is
+        no memory mapping)
+
+or with :func:`configure`.  The drivers preprocessing several exposures in
+the same process enable it with :func:`enable` (:data:`DRIVER_CACHE_MB` per
+process unless DESI_CALIB_CACHE_MB is set, e.g. 16 GB for 32 MPI ranks on a
+node without memory mapping) and drop it with :func:`release` when done.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import yaml
+
+from desiutil.log import get_logger
+
+
+class CalibCache(object):
+    """LRU cache of calibration images and parsed yaml files.
+
+    Args:
+        max_bytes (int): maximum total size of the cached images, 0 disables
+            the cache.
+        memmap_dir (str): if not None, directory of the memory-mapped
+            copies of the images, shared by all processes using the same
+            directory.
+
+    """
+    def __init__(self, max_bytes=1024*2**20, memmap_dir=None):
+        self.max_bytes = max_bytes
+        self.memmap_dir = memmap_dir
+        self._images = OrderedDict()
+        self._yaml = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(kind, filename):
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        return (kind, filename, st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def clear(self):
+        """Remove all entries (the memory-mapped files are kept)."""
+        self._images.clear()
+        self._yaml.clear()
+        self.nbytes = 0
+
+    def _memmap(self, key, reader, filename):
+        """Read the image through a .npy copy shared by all processes."""
+        name = hashlib.md5(repr(key).encode()).hexdigest()
+        path = os.path.join(self.memmap_dir, "calib-{}-{}.npy".format(key[0].lower(), name))
+        if not os.path.isfile(path):
+            os.makedirs(self.memmap_dir, exist_ok=True)
+            # write a private temporary file then rename it, so that
+            # concurrent processes never see a partial file
+            tmp = "{}.tmp{}".format(path, os.getpid())
+            np.save(tmp, np.ascontiguousarray(reader(filename)))
+            os.rename(tmp+".npy", path)
+        return np.load(path, mmap_mode="r")
+
+    def get_image(self, kind, filename, reader):
+        """Get a calibration image, read-only.
+
+        Args:
+            kind (str): the kind of image, e.g. "BIAS".
+            filename (str): path of the image file.
+            reader (function): function reading the image, called with the
+                filename if it is not cached.
+
+        Returns:
+            numpy array, not writeable.
+
+        """
+        if self.max_bytes <= 0 :
+            return reader(filename)
+
+        key = self._key(kind, filename)
+        if key in self._images :
+            self.hits += 1
+            self._images.move_to_end(key)
+            return self._images[key]
+        self.misses += 1
+
+        if self.memmap_dir is not None :
+            image = self._memmap(key, reader, filename)
+        else :
+            image = np.asarray(reader(filename))
+            image.flags.writeable = False
+
+        if image.nbytes > self.max_bytes :
+            return image
+
+        self._images[key] = image
+        self.nbytes += image.nbytes
+        while self.nbytes > self.max_bytes :
+            oldkey, old = self._images.popitem(last=False)
+            self.nbytes -= old.nbytes
+            get_logger().debug("evicting {} {} from the calibration cache".format(oldkey[0], oldkey[1]))
+        return image
+
+    def get_yaml(self, filename):
+        """Get the content of a yaml file, parsed once per version of the file.
+
+        Args:
+            filename (str): path of the yaml file.
+
+        Returns:
+            the parsed content, shared by all callers: do not modify it.
+
+        """
+        if self.max_bytes <= 0 :
+            with open(filename) as stream :
+                return yaml.load(stream)
+        key = self._key("YAML", filename)
+        if key not in self._yaml :
+            self.misses += 1
+            # only keep the latest version of a file
+            for oldkey in [ k for k in self._yaml if k[1] == key[1] ] :
+                del self._yaml[oldkey]
+            with open(filename) as stream :
+                self._yaml[key] = yaml.load(stream)
+        else :
+            self.hits += 1
+        return self._yaml[key]
+
+
+_cache = None
+
+#- size in MB of the cache of each process in the drivers preprocessing
+#- several exposures per process
+DRIVER_CACHE_MB = 512
+
+
+def configure(max_mb=None, memmap_dir=None):
+    """(Re)configure the process-wide calibration cache.
+
+    Args:
+        max_mb (float): maximum size in MB of the cached images, 0 disables
+            the cache (default $DESI_CALIB_CACHE_MB or 0).
+        memmap_dir (str): directory of the memory-mapped images (default
+            $DESI_CALIB_CACHE_DIR or no memory mapping).
+
+    Returns:
+        CalibCache: the new cache.
+
+    """
+    global _cache
+    if max_mb is None :
+        max_mb = float(os.getenv("DESI_CALIB_CACHE_MB", 0))
+    if memmap_dir is None :
+        memmap_dir = os.getenv("DESI_CALIB_CACHE_DIR")
+    _cache = CalibCache(max_bytes=int(max_mb*2**20), memmap_dir=memmap_dir)
+    return _cache
+
+
+def get_cache():
+    """Get the process-wide calibration cache, configured from the
+    environment on first use."""
+    if _cache is None :
+        configure()
+    return _cache
+
+
+def enable(max_mb=DRIVER_CACHE_MB):
+    """Enable the process-wide calibration cache in a driver preprocessing
+    several exposures in the same process.
+
+    Args:
+        max_mb (float): maximum size in MB of the cached images of this
+            process, unless $DESI_CALIB_CACHE_MB is set.
+
+    Returns:
+        CalibCache: the new cache, to be dropped with :func:`release`.
+
+    """
+    if os.getenv("DESI_CALIB_CACHE_MB") is not None :
+        return configure()
+    return configure(max_mb=max_mb)
+
+
+def release():
+    """Drop the process-wide calibration cache and its images; the next use
+    configures it from the environment again."""
+    global _cache
+    _cache = None
@@ -13,22 +13,77 @@ import copy
 import scipy.ndimage
 import time
 
-import numba
+from desispec.jit import njit
 
 from desispec.maskbits import ccdmask
 from desispec.maskbits import specmask
+from desispec.util import default_nthreads, thread_map
 
 
 
+@njit(nogil=True, signatures=["(float64[:,::1], int64, int64, int64, float64[:,::1])"])
+def _running_median_numba(data,size,begin,end,out) :
+    """Running median of width size along the rows begin to end-1 of data,
+    same as scipy.ndimage.median_filter(data,size=(1,size),mode='constant')
+    for finite values. A sorted copy of the window is updated at each step.
+    """
+    n=data.shape[1]
+    left=size//2
+    right=size-left-1
+    rank=size//2
+    window=np.zeros(size)
+    for s in range(begin,end) :
+        row=data[s]
+        for k in range(size) :
+            j=k-left
+            if j>=0 and j<n :
+                window[k]=row[j]
+            else :
+                window[k]=0.
+        window.sort()
+        for i in range(n) :
+            out[s,i]=window[rank]
+            # slide the window: remove row[i-left], add row[i+right+1]
+            vo=0.
+            if i-left>=0 :
+                vo=row[i-left]
+            vi=0.
+            if i+right+1<n :
+                vi=row[i+right+1]
+            if vo==vi :
+                continue
+            q=np.searchsorted(window,vo)
+            if vi>vo :
+                while q+1<size and window[q+1]<vi :
+                    window[q]=window[q+1]
+                    q+=1
+            else :
+                while q>0 and window[q-1]>vi :
+                    window[q]=window[q-1]
+                    q-=1
+            window[q]=vi
+
+def _running_median(data,size,nthreads=None) :
+    """Running median of width size along the last axis of a 2D array,
+    with zeros outside of the array"""
+    if not np.all(np.isfinite(data)) :
+        return scipy.ndimage.median_filter(data,size=(1,size),mode='constant')
+    if nthreads is None :
+        nthreads = default_nthreads()
+    data = np.ascontiguousarray(data,dtype=np.float64)
+    out = np.zeros(data.shape)
+    edges = np.linspace(0,data.shape[0],nthreads+1).astype(int)
+    thread_map(_running_median_numba,[ (data,int(size),edges[i],edges[i+1],out) for i in range(nthreads) ],nthreads)
+    return out
+
 def reject_cosmic_rays_1d(frame,nsig=3,psferr=0.05) :
     """Use resolution matrix in frame to detect spikes in the spectra that
     are narrower than the PSF, and mask them"""
     log=get_logger()
     
     log.info("subtract continuum to flux")
-    tflux=np.zeros(frame.flux.shape)
-    for fiber in range(frame.nspec) :
-        tflux[fiber]=frame.flux[fiber]-scipy.ndimage.filters.median_filter(frame.flux[fiber],200,mode='constant')
+    # running median along wavelength, for all fibers at once
+    tflux=frame.flux-_running_median(frame.flux,200)
     log.info("done")
         
     # we do not use the mask here because we want to re-detect cosmics
@@ -56,53 +111,60 @@ def reject_cosmic_rays_1d(frame,nsig=3,psferr=0.05) :
     chi2p=dfp**2*(dfp>0)*(tflux>0)/(vp+(vp==0))
     chi2m=dfm**2*(dfm>0)*(tflux>0)/(vm+(vm==0))
         
-    for fiber in range(chi2m.shape[0]) :
-        R=frame.R[fiber]
-        
-        # potential cosmics 
-        selection=np.where( ( (chi2p[fiber]>nsig**2) | (chi2m[fiber]>nsig**2) ) & (peaks[fiber]>0) )[0]
-        if selection.size==0 : continue # no potential cosmic
-        
-        # loop on peaks
-        for i in selection :
-            
-            # relative variations
-            rdfpi=dfp[fiber,i]/tflux[fiber,i]
-            rdfmi=dfm[fiber,i]/tflux[fiber,i]
-            # error
-            errp=np.sqrt(vp[fiber,i])/tflux[fiber,i]
-            errm=np.sqrt(vm[fiber,i])/tflux[fiber,i]
-            
-            # profile from resolution matrix
-            r  =  R.data[:,i]
-            d  = r.size//2
-            rdrp = 1-r[d+1]/r[d]
-            rdrm = 1-r[d-1]/r[d]
-            snrp = (rdfpi-rdrp)/errp
-            snrm = (rdfmi-rdrm)/errm
-            
-            # S/N at peak (difference between peak at i and PSF profile at peak from adjacent pixels) 
-            # snr  = (dflux[fiber,i]-psfpeak)/np.sqrt( 1./(divar[fiber,i]+(divar[fiber,i]==0))+dr[d]**2/a )
-            snr=max(snrp,snrm)
-            if snr>nsig :
-                # also mask neighboring pixels if >nsig
-                d=2
-                b=i-d
-                e=i+d+1
-                previous_nmasked=np.sum(frame.mask[fiber,b:e]>0)
-                frame.mask[fiber,b:e][np.sqrt(frame.ivar[fiber,b:e])*tflux[fiber,b:e]>nsig] |= specmask.COSMIC
-                new_nmasked=np.sum(frame.mask[fiber,b:e]>0)
-                nmasked=(new_nmasked-previous_nmasked)
-                if nmasked>0 :
-                    if previous_nmasked>0 :
-                        log.info("fiber {} wave={} S/N={} broaden cosmic mask by {} pix".format(fiber,int(frame.wave[i]),int(snr),nmasked))
-                    else :
-                        log.info("fiber {} wave={} S/N={} add cosmic mask of {} pix".format(fiber,int(frame.wave[i]),int(snr),nmasked))
+    # potential cosmics (fiber and wavelength indices of the peaks)
+    fibers,ii=np.where( ( (chi2p>nsig**2) | (chi2m>nsig**2) ) & (peaks>0) )
+    if fibers.size==0 :
+        log.info("done")
+        return
+
+    # relative variations
+    rdfp=dfp[fibers,ii]/tflux[fibers,ii]
+    rdfm=dfm[fibers,ii]/tflux[fibers,ii]
+    # error
+    errp=np.sqrt(vp[fibers,ii])/tflux[fibers,ii]
+    errm=np.sqrt(vm[fibers,ii])/tflux[fibers,ii]
+
+    # profile from resolution matrix, [npeak,ndiag]
+    if frame.resolution_data is not None :
+        r=frame.resolution_data[fibers,:,ii]
+    else :
+        r=np.array([frame.R[fiber].data[:,i] for fiber,i in zip(fibers,ii)])
+    d=r.shape[1]//2
+    with np.errstate(divide='ignore',invalid='ignore') :
+        rdrp=1-r[:,d+1]/r[:,d]
+        rdrm=1-r[:,d-1]/r[:,d]
+    snrp=(rdfp-rdrp)/errp
+    snrm=(rdfm-rdrm)/errm
+
+    # S/N at peak (difference between peak at i and PSF profile at peak from adjacent pixels)
+    # (same as max(snrp,snrm) for NaN values)
+    snr=np.where(snrm>snrp,snrm,snrp)
+    cosmic=(snr>nsig)
+    # the slice [i-2:i+3] is empty for a peak at i=1
+    cosmic &= (ii>=2)
+    fibers=fibers[cosmic]
+    ii=ii[cosmic]
+    if fibers.size==0 :
+        log.info("done")
+        return
+
+    # also mask neighboring pixels if >nsig
+    d=2
+    around=np.zeros(tflux.shape,dtype=bool)
+    for k in range(-d,d+1) :
+        j=ii+k
+        ok=(j<tflux.shape[1])
+        around[fibers[ok],j[ok]]=True
+    newmask=around&(np.sqrt(frame.ivar)*tflux>nsig)
+    previous_nmasked=np.sum(newmask&(frame.mask>0))
+    frame.mask[newmask] |= specmask.COSMIC
+    log.info("{} cosmics in {} fibers, {} pixels masked ({} were already masked)".format(
+        fibers.size,np.unique(fibers).size,np.sum(newmask),previous_nmasked))
     log.info("done")
 
-@numba.jit
+@njit(signatures=["(boolean[:,::1], boolean)"])
 def dilate_numba(input_boolean_array,include_input=False) :
-    output_boolean_array = np.zeros(input_boolean_array.shape,dtype=bool)
+    output_boolean_array = np.zeros(input_boolean_array.shape,dtype=np.bool_)
     if include_input :
         output_boolean_array |= input_boolean_array
     for i0 in range(1,input_boolean_array.shape[0]-1) :
@@ -120,7 +182,7 @@ def dilate_numba(input_boolean_array,include_input=False) :
 
 
 
-@numba.jit
+@njit(signatures=["(float64[:,::1], float64[:,::1], boolean[:,::1], float64[::1], float64, float64, float64)"])
 def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,nsig,cfudge,c2fudge) :
     """Cosmic ray rejection following the implementation in SDSS/BOSS.
     (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
@@ -150,7 +212,7 @@ def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,n
     
     # definition of axis
     naxis = psf_gradients.size
-    dd = np.zeros((naxis,2),dtype=int)
+    dd = np.zeros((naxis,2),dtype=np.int64)
     for a in range(naxis) :
         if a==0 : 
             dd[a,0]=0
@@ -165,7 +227,7 @@ def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,n
             dd[a,0]=1
             dd[a,1]=-1
         
-    rejection=np.zeros(pix.shape,dtype=bool)
+    rejection=np.zeros(pix.shape,dtype=np.bool_)
     
     for i0 in range(1,n0-1) :
         for i1 in range(1,n1-1) :
@@ -218,6 +280,113 @@ def _reject_cosmic_rays_ala_sdss_single_numba(pix,ivar,selection,psf_gradients,n
             
     return rejection
     
+@njit(nogil=True, signatures=["(float64[:,::1], float64[:,::1], int64, int64, float64[::1], float64, float64, float64)"])
+def _is_cosmic_numba(pix,ivar,i0,i1,psf_gradients,nsig,cfudge,c2fudge) :
+    """Test of a single pixel of _reject_cosmic_rays_ala_sdss_single_numba,
+    with the same operations in the same order, so the results are identical.
+    Only reads the 3x3 pixels around (i0,i1), which must not be on the edge
+    of the image.
+    """
+    central_pix_ivar=ivar[i0,i1]
+    if central_pix_ivar<=0 :
+        return False
+
+    first_criterion=0
+    second_criterion=False
+
+    central_pix_val=pix[i0,i1]
+    central_pix_err=1/np.sqrt(central_pix_ivar)
+
+    # loop on axis: horizontal, vertical and 2 diagonals
+    for a in range(psf_gradients.size) :
+        if a==0 :
+            d0=0
+            d1=1
+        elif a==1 :
+            d0=1
+            d1=0
+        elif a==2 :
+            d0=1
+            d1=1
+        else :
+            d0=1
+            d1=-1
+
+        neighboring_pix_val=0.
+        neighboring_pix_err=0.
+
+        # compute average value on both sides of central pix
+        for signe in (-1,1) :
+            tmp_ivar = ivar[i0+signe*d0,i1+signe*d1]
+            if tmp_ivar > 0 :
+                neighboring_pix_val  += pix[i0+signe*d0,i1+signe*d1]
+                neighboring_pix_err  += 1/tmp_ivar
+            else : # replace it by the central pixel value
+                neighboring_pix_val  += central_pix_val
+                neighboring_pix_err  += central_pix_err**2
+
+        neighboring_pix_val  *= 0.5 # average value
+        neighboring_pix_err   = np.sqrt(neighboring_pix_err)*0.5 # uncertainty on average value
+
+        first_criterion += (central_pix_val>(neighboring_pix_val+nsig*central_pix_err))
+        second_criterion |= (((central_pix_val-cfudge*central_pix_err)*c2fudge*psf_gradients[a]) > ( neighboring_pix_val+cfudge*neighboring_pix_err ))
+
+    return (first_criterion>=2) and second_criterion
+
+@njit(nogil=True, signatures=["(float64[:,::1], float64[:,::1], boolean[:,::1], float64[::1], float64, float64, float64, int64, int64, boolean[:,::1])"])
+def _reject_cosmic_rays_rows_numba(pix,ivar,selection,psf_gradients,nsig,cfudge,c2fudge,begin,end,rejection) :
+    """Fills rows begin to end-1 of the rejection mask of
+    _reject_cosmic_rays_ala_sdss_single_numba; the pixels of the rows
+    begin-1 and end are read as a halo.
+    """
+    n1 = pix.shape[1]
+    for i0 in range(max(begin,1),min(end,pix.shape[0]-1)) :
+        for i1 in range(1,n1-1) :
+            if selection[i0,i1] :
+                rejection[i0,i1] = _is_cosmic_numba(pix,ivar,i0,i1,psf_gradients,nsig,cfudge,c2fudge)
+
+@njit(nogil=True, signatures=["(float64[:,::1], float64[:,::1], int64[::1], int64[::1], float64[::1], float64, float64, float64, int64, int64, boolean[::1])"])
+def _reject_cosmic_rays_pixels_numba(pix,ivar,ii0,ii1,psf_gradients,nsig,cfudge,c2fudge,begin,end,rejection) :
+    """Tests the pixels (ii0[k],ii1[k]) for k in begin to end-1,
+    result in rejection[k].
+    """
+    for k in range(begin,end) :
+        rejection[k] = _is_cosmic_numba(pix,ivar,ii0[k],ii1[k],psf_gradients,nsig,cfudge,c2fudge)
+
+@njit(nogil=True, signatures=["(boolean[:,::1], int64[::1], int64[::1], boolean[:,::1])"])
+def _frontier_numba(rejected,ii0,ii1,flag) :
+    """Pixels not rejected among the 8 neighbors of the pixels (ii0,ii1),
+    excluding the edges of the image (never tested), without duplicates.
+    flag is a boolean work array of the shape of the image, all False on
+    input and output.
+    """
+    n0 = rejected.shape[0]
+    n1 = rejected.shape[1]
+    out0 = np.zeros(8*ii0.size,dtype=np.int64)
+    out1 = np.zeros(8*ii0.size,dtype=np.int64)
+    n = 0
+    for k in range(ii0.size) :
+        i0 = ii0[k]
+        i1 = ii1[k]
+        if i0<1 or i0>=n0-1 or i1<1 or i1>=n1-1 :
+            continue
+        for d0 in range(-1,2) :
+            for d1 in range(-1,2) :
+                j0 = i0+d0
+                j1 = i1+d1
+                # (this also skips (i0,i1), already rejected)
+                if j0<1 or j0>=n0-1 or j1<1 or j1>=n1-1 :
+                    continue
+                if rejected[j0,j1] or flag[j0,j1] :
+                    continue
+                flag[j0,j1] = True
+                out0[n] = j0
+                out1[n] = j1
+                n += 1
+    for k in range(n) :
+        flag[out0[k],out1[k]] = False
+    return out0[:n],out1[:n]
+
 def _reject_cosmic_rays_ala_sdss_single(pix,ivar,selection,psf_gradients,nsig,cfudge,c2fudge) :
     """Cosmic ray rejection following the implementation in SDSS/BOSS.
     (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
@@ -334,7 +503,36 @@ def _reject_cosmic_rays_ala_sdss_single(pix,ivar,selection,psf_gradients,nsig,cf
     rejection[1:-1,1:-1][tselection] = (first_criterion&second_criterion).reshape(pix[1:-1,1:-1][tselection].shape)
     return rejection
 
-def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=6,dilate=True) :
+def _reject_cosmic_rays_tiled(pix,ivar,selection,psf_gradients,nsig,cfudge,c2fudge,nthreads=None) :
+    """Same as _reject_cosmic_rays_ala_sdss_single_numba, with the image cut
+    in bands of rows processed in parallel threads.
+    """
+    if nthreads is None :
+        nthreads = default_nthreads()
+    rejection = np.zeros(pix.shape,dtype=bool)
+    # more bands than threads to balance the load, the bands only share
+    # the rows of their halo, which are read but not written
+    edges = np.linspace(0,pix.shape[0],4*nthreads+1).astype(int)
+    thread_map(_reject_cosmic_rays_rows_numba,
+        [ (pix,ivar,selection,psf_gradients,float(nsig),float(cfudge),float(c2fudge),edges[i],edges[i+1],rejection) \
+          for i in range(edges.size-1) ],nthreads)
+    return rejection
+
+def _reject_cosmic_rays_pixels(pix,ivar,ii0,ii1,psf_gradients,nsig,cfudge,c2fudge,nthreads=None) :
+    """Cosmic ray test of the pixels (ii0,ii1), in parallel threads.
+    Returns an array of booleans of the size of ii0.
+    """
+    if nthreads is None :
+        nthreads = default_nthreads()
+    rejection = np.zeros(ii0.size,dtype=bool)
+    nchunks = max(1,min(nthreads,ii0.size//1000))
+    edges = np.linspace(0,ii0.size,nchunks+1).astype(int)
+    thread_map(_reject_cosmic_rays_pixels_numba,
+        [ (pix,ivar,ii0,ii1,psf_gradients,float(nsig),float(cfudge),float(c2fudge),edges[i],edges[i+1],rejection) \
+          for i in range(nchunks) ],nthreads)
+    return rejection
+
+def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=6,dilate=True,nthreads=None) :
     """Cosmic ray rejection following the implementation in SDSS/BOSS.
     (see idlutils/src/image/reject_cr_psf.c and idlutils/pro/image/reject_cr.pro)
 
@@ -352,6 +550,7 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=6,dilate
        c2fudge:  fudge factor applied to PSF
        niter: number of iterations on neighboring pixels of rejected pixels
        dilate: force +1 pixel dilation of rejection mask
+       nthreads: number of threads, default is desispec.util.default_nthreads()
     """
     log=get_logger()
     log.info("starting with nsig=%2.1f cfudge=%2.1f c2fudge=%2.1f"%(nsig,cfudge,c2fudge))
@@ -378,40 +577,57 @@ def reject_cosmic_rays_ala_sdss(img,nsig=6.,cfudge=3.,c2fudge=0.8,niter=6,dilate
     use_numba = True
     
     if use_numba :
-        rejected   = _reject_cosmic_rays_ala_sdss_single_numba(img.pix,tivar,selection,psf_gradients,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge)
+        rejected   = _reject_cosmic_rays_tiled(img.pix,tivar,selection,psf_gradients,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge,nthreads=nthreads)
     else :
         rejected  = _reject_cosmic_rays_ala_sdss_single(img.pix,tivar,selection,psf_gradients,nsig=nsig,cfudge=cfudge,c2fudge=c2fudge)
     
     
     log.info("first pass: %d pixels rejected"%(np.sum(rejected)))
     
-    if niter > 0 :        
+    if niter > 0 and use_numba :
+
+        # Only the neighbors of the pixels rejected at the previous iteration
+        # are tested: the other neighbors of rejected pixels have already been
+        # tested with the same cuts and the same ivar of their neighbors.
+        # Same result as testing all neighbors as below.
+        #- contiguous as in the next iterations, for a single compiled signature
+        new0,new1 = [ np.ascontiguousarray(ii) for ii in np.where(rejected) ]
+        flag = np.zeros(rejected.shape,dtype=bool)
+        for iteration in range(niter) :
+
+            tivar[new0,new1] = 0. # mask rejected pixels for the calculation of the background of the neighbors
+            neighbors0,neighbors1 = _frontier_numba(rejected,new0,new1,flag)
+
+            # rerun with much more strict cuts
+            newrejected = _reject_cosmic_rays_pixels(img.pix,tivar,neighbors0,neighbors1,psf_gradients,nsig=3.,cfudge=0.,c2fudge=1.,nthreads=nthreads)
+            new0,new1 = neighbors0[newrejected],neighbors1[newrejected]
+
+            log.info("at iter %d: %d new pixels rejected"%(iteration,new0.size))
+            if new0.size<1 :
+                break
+            rejected[new0,new1] = True
+
+    elif niter > 0 :        
         
         for iteration in range(niter) :
 
             # if np.sum(rejected)==0 : break
-            if use_numba :
-                neighbors = dilate_numba(rejected,False)
-            else :
-                neighbors = np.zeros(rejected.shape,dtype=bool)
-                # left and right neighbors
-                neighbors[1:,:]  |= rejected[:-1,:]
-                neighbors[:-1,:] |= rejected[1:,:]
-                neighbors[:,1:]  |= rejected[:,:-1]
-                neighbors[:,:-1] |= rejected[:,1:]
-                # adding diagonals (not in original SDSS version)
-                neighbors[1:,1:]  |= rejected[:-1,:-1]
-                neighbors[:-1,:-1]  |= rejected[1:,1:]
-                neighbors[1:,:-1]  |= rejected[:-1,1:]
-                neighbors[:-1,1:]  |= rejected[1:,:-1]
+            neighbors = np.zeros(rejected.shape,dtype=bool)
+            # left and right neighbors
+            neighbors[1:,:]  |= rejected[:-1,:]
+            neighbors[:-1,:] |= rejected[1:,:]
+            neighbors[:,1:]  |= rejected[:,:-1]
+            neighbors[:,:-1] |= rejected[:,1:]
+            # adding diagonals (not in original SDSS version)
+            neighbors[1:,1:]  |= rejected[:-1,:-1]
+            neighbors[:-1,:-1]  |= rejected[1:,1:]
+            neighbors[1:,:-1]  |= rejected[:-1,1:]
+            neighbors[:-1,1:]  |= rejected[1:,:-1]
             neighbors &= (rejected==False) # excluded already rejected pixel
             tivar[rejected] = 0. # mask already rejected pixels for the calculation of the background of the neighbors
 
             # rerun with much more strict cuts
-            if use_numba :
-                newrejected=_reject_cosmic_rays_ala_sdss_single_numba(img.pix,tivar,neighbors,psf_gradients,nsig=3.,cfudge=0.,c2fudge=1.)
-            else :
-                newrejected=_reject_cosmic_rays_ala_sdss_single(img.pix,tivar,neighbors,psf_gradients,nsig=3.,cfudge=0.,c2fudge=1.)
+            newrejected=_reject_cosmic_rays_ala_sdss_single(img.pix,tivar,neighbors,psf_gradients,nsig=3.,cfudge=0.,c2fudge=1.)
                 
             log.info("at iter %d: %d new pixels rejected"%(iteration,np.sum(newrejected)))
             if np.sum(newrejected)<1 :            
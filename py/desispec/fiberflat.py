@@ -8,10 +8,9 @@ We try to keep all the (fits) io separated.
 from __future__ import absolute_import, division
 
 import numpy as np
-from desispec.resolution import Resolution
-from desispec.linalg import cholesky_solve
-from desispec.linalg import cholesky_solve_and_invert
+from desispec.resolution import Resolution, ResolutionStack
 from desispec.linalg import spline_fit
+from desispec.linalg import BandedNormalEquation
 from desispec.maskbits import specmask
 from desispec.preproc import masked_median
 from desispec import util
@@ -209,6 +208,10 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
     previous_smooth_fiberflat = smooth_fiberflat*0
     previous_max_diff = 0.
     log.info("after 1st pass : nout = %d/%d"%(np.sum(ivar==0),np.size(ivar.flatten())))
+
+    # resolution matrices, possibly computed on the fly from sigma widths
+    Rframe = ResolutionStack(frame.R)
+
     # 2nd pass is full solution including deconvolved spectrum, no outlier rejection
     for iteration in range(max_iterations) :
         ## reset sum_chi2
@@ -216,50 +219,24 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
         log.info("2nd pass, iter %d : mean deconvolved spectrum"%iteration)
 
         # fit mean spectrum
-        A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        B=np.zeros((nwave))
-
-        # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
-        SD=scipy.sparse.lil_matrix((nwave,nwave))
-
-        # this is to go a bit faster
-        sqrtwflat=np.sqrt(ivar)*smooth_fiberflat
-
-        # loop on fiber to handle resolution (this is long)
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("2nd pass, filling matrix, iter %d fiber %d"%(iteration,fiber))
-
-            ### R = Resolution(resolution_data[fiber])
-            R = frame.R[fiber]
-            SD.setdiag(sqrtwflat[fiber])
-
-            sqrtwflatR = SD*R # each row r of R is multiplied by sqrtwflat[r]
+        # the normal equation is accumulated in banded storage, vectorized over fibers,
+        # and only rebuilt if the smooth fiber flat or ivar have changed
+        log.info("2nd pass, filling matrix, iter %d"%iteration)
+        if iteration == 0 :
+            neq = BandedNormalEquation(Rframe.data,flux,ivar,left=smooth_fiberflat.copy())
+        else :
+            neq.set_scaling(left=smooth_fiberflat.copy(),ivar=ivar)
 
-            A = A+(sqrtwflatR.T*sqrtwflatR).tocsr()
-            B += sqrtwflatR.T.dot(np.sqrt(ivar[fiber])*flux[fiber])
-        A_pos_def = A.todense()
         log.info("deconvolving")
-        w = A.diagonal() > 0
-
-        A_pos_def = A_pos_def[w,:]
-        A_pos_def = A_pos_def[:,w]
-        mean_spectrum = np.zeros(nwave)
-        try:
-            mean_spectrum[w]=cholesky_solve(A_pos_def,B[w])
-        except:
-            mean_spectrum[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
-            log.info("cholesky failes, trying svd inverse in iter {}".format(iteration))
+        mean_spectrum = neq.solve()
+        convolved_mean_spectrum = Rframe.dot(mean_spectrum)
 
         for fiber in range(nfibers) :
 
             if np.sum(ivar[fiber]>0)==0 :
                 continue
 
-            ### R = Resolution(resolution_data[fiber])
-            R = frame.R[fiber]
-
-            M = R.dot(mean_spectrum)
+            M = convolved_mean_spectrum[fiber]
             ok=(M!=0) & (ivar[fiber,:]>0)
             if ok.sum()==0:
                 continue
@@ -327,14 +304,13 @@ def compute_fiberflat(frame, nsig_clipping=10., accuracy=5.e-4, minval=0.1, maxv
 
     nsig_for_mask=nsig_clipping # only mask out N sigma outliers
 
+    convolved_mean_spectrum = Rframe.dot(mean_spectrum)
     for fiber in range(nfibers) :
 
         if np.sum(ivar[fiber]>0)==0 :
             continue
 
-        ### R = Resolution(resolution_data[fiber])
-        R = frame.R[fiber]
-        M = np.array(np.dot(R.todense(),mean_spectrum)).flatten()
+        M = convolved_mean_spectrum[fiber]
         fiberflat[fiber] = (M!=0)*flux[fiber]/(M+(M==0)) + (M==0)
         fiberflat_ivar[fiber] = ivar[fiber]*M**2
         nbad_tot=0
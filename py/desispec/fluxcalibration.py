@@ -6,8 +6,9 @@ Flux calibration routines.
 """
 from __future__ import absolute_import
 import numpy as np
-from .resolution import Resolution
-from .linalg import cholesky_solve, cholesky_solve_and_invert, spline_fit
+from .resolution import Resolution, ResolutionStack
+from .linalg import spline_fit
+from .linalg import BandedNormalEquation
 from .interpolation import resample_flux
 from desiutil.log import get_logger
 from .io.filters import load_filter
@@ -831,16 +832,17 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
     stdstars = frame[stdfibers]
 
     nwave=stdstars.nwave
+    Rframe=ResolutionStack(frame.R)
+    Rstd=Rframe[stdfibers]
     nstds=stdstars.flux.shape[0]
 
     dwave=(stdstars.wave-np.mean(stdstars.wave))/(stdstars.wave[-1]-stdstars.wave[0]) # normalized wave for polynomial fit
 
     # resample model to data grid and convolve by resolution
     model_flux=np.zeros((nstds, nwave))
-    convolved_model_flux=np.zeros((nstds, nwave))
     for fiber in range(model_flux.shape[0]) :
         model_flux[fiber]=resample_flux(stdstars.wave,input_model_wave,input_model_flux[fiber])
-        convolved_model_flux[fiber]=stdstars.R[fiber].dot(model_flux[fiber])
+    convolved_model_flux=Rstd.dot(model_flux)
 
     # iterative fitting and clipping to get precise mean spectrum
     current_ivar=stdstars.ivar*(stdstars.mask==0)
@@ -853,9 +855,10 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
     smooth_fiber_correction=np.ones((stdstars.flux.shape))
     chi2=np.zeros((stdstars.flux.shape))  
 
+    convolved_calib_model_flux = median_calib*convolved_model_flux
     for fiber in range(nstds) :
-        M = median_calib*stdstars.R[fiber].dot(model_flux[fiber])
-        
+        M = convolved_calib_model_flux[fiber]
+
         try:
             pol=np.poly1d(np.polyfit(dwave,stdstars.flux[fiber]/(M+(M==0)),deg=deg,w=current_ivar[fiber]*M**2))
             smooth_fiber_correction[fiber]=pol(dwave)
@@ -872,33 +875,20 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
     sqrtw=np.sqrt(current_ivar)
     sqrtwflux=np.sqrt(current_ivar)*stdstars.flux
 
-    # diagonal sparse matrices
-    D1=scipy.sparse.lil_matrix((nwave,nwave))
-    D2=scipy.sparse.lil_matrix((nwave,nwave))
-
     
     nout_tot=0
     previous_mean=0.
     for iteration in range(20) :
 
         # fit mean calibration
-        A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        B=np.zeros((nwave))
-
-        # loop on fiber to handle resolution
-        for fiber in range(nstds) :
-            if fiber%10==0 :
-                log.info("iter %d fiber %d"%(iteration,fiber))
-
-            R = stdstars.R[fiber]
-
-            # diagonal sparse matrix with content = sqrt(ivar)*flat
-            D1.setdiag(sqrtw[fiber]*smooth_fiber_correction[fiber])
-            D2.setdiag(model_flux[fiber])
-            sqrtwmodelR = D1.dot(R.dot(D2)) # chi2 = sum (sqrtw*data_flux -diag(sqrtw)*smooth_fiber_correction*R*diag(model_flux)*calib )
-
-            A = A+(sqrtwmodelR.T*sqrtwmodelR).tocsr()
-            B += sqrtwmodelR.T*sqrtwflux[fiber]
+        # chi2 = sum (sqrtw*data_flux -diag(sqrtw)*smooth_fiber_correction*R*diag(model_flux)*calib )
+        # the normal equation is accumulated in banded storage, and only rebuilt
+        # if the smooth fiber correction has changed, otherwise updated for the rejected pixels
+        log.info("iter %d filling matrix"%iteration)
+        if iteration == 0 :
+            neq = BandedNormalEquation(Rstd.data,stdstars.flux,current_ivar,left=smooth_fiber_correction.copy(),right=model_flux)
+        else :
+            neq.set_scaling(left=smooth_fiber_correction.copy(),ivar=current_ivar)
 
         if np.sum(current_ivar>0)==0 :
             log.error("null ivar, cannot calibrate this frame")
@@ -909,29 +899,18 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
         minivar = np.min(current_ivar[current_ivar>0])
         log.debug('min(ivar[ivar>0]) = {}'.format(minivar))
         epsilon = minivar/10000
-        A = epsilon*np.eye(nwave) + A   #- converts sparse A -> dense A
-        B += median_calib*epsilon
 
         log.info("iter %d solving"%iteration)
-        ### log.debug('cond(A) {:g}'.format(np.linalg.cond(A)))
-        #calibration=cholesky_solve(A, B)
-        w = np.diagonal(A)>0
-        A_pos_def = A[w,:]
-        A_pos_def = A_pos_def[:,w]
-        calibration = B*0
-        try:
-            calibration[w]=cholesky_solve(A_pos_def, B[w])
-        except np.linalg.linalg.LinAlgError:
-            log.info('cholesky fails in iteration {}, trying svd'.format(iteration))
-            calibration[w] = np.linalg.lstsq(A_pos_def,B[w])[0]
+        calibration = neq.solve(prior_ivar=epsilon,prior_value=median_calib)
 
         log.info("iter %d fit smooth correction per fiber"%iteration)
         # fit smooth fiberflat and compute chi2
+        convolved_calib_model_flux = Rstd.dot(calibration*model_flux)
         for fiber in range(nstds) :
             if fiber%10==0 :
                 log.info("iter %d fiber %d(smooth)"%(iteration,fiber))
 
-            M = stdstars.R[fiber].dot(calibration*model_flux[fiber])
+            M = convolved_calib_model_flux[fiber]
 
             try:
                 pol=np.poly1d(np.polyfit(dwave,stdstars.flux[fiber]/(M+(M==0)),deg=deg,w=current_ivar[fiber]*M**2))
@@ -991,32 +970,27 @@ def compute_flux_calibration(frame, input_model_wave,input_model_flux,input_mode
 
     log.info("nout tot=%d"%nout_tot)
 
-    # solve once again to get deconvolved variance
-    #calibration,calibcovar=cholesky_solve_and_invert(A.todense(),B)
-    calibcovar=np.linalg.inv(A)
-    calibvar=np.diagonal(calibcovar)
+    # compute the band of the covariance of the deconvolved calibration,
+    # this is all we need for its variance and the variance of the convolved calibration
+    log.info("updates of normal equation: {} pixels in {} updates, {} full builds".format(neq.npix_updated,neq.nupdate,neq.nbuild))
+    calibcovar_band=neq.covariance_band(prior_ivar=epsilon)
+    calibvar=calibcovar_band[0].copy()
     log.info("mean(var)={0:f}".format(np.mean(calibvar)))
 
-    calibvar=np.array(np.diagonal(calibcovar))
     # apply the mean (as in the iterative loop)
     calibvar *= mean**2
     calibivar=(calibvar>0)/(calibvar+(calibvar==0))
 
     # we also want to save the convolved calibration and a calibration variance
     # first compute average resolution
-    mean_res_data=np.mean(frame.resolution_data,axis=0)
+    mean_res_data=np.mean(Rframe.data,axis=0)
     R = Resolution(mean_res_data)
     # compute convolved calib
-    ccalibration = np.zeros(frame.flux.shape)
-    for i in range(frame.nspec):
-        norme = frame.R[i].dot(np.ones(calibration.shape))
-        ok=np.where(norme>0)[0]
-        if ok.size :
-            ccalibration[i][ok]=frame.R[i].dot(calibration)[ok]/norme[ok]
+    norme = Rframe.dot(np.ones(calibration.shape))
+    ccalibration = (norme>0)*Rframe.dot(calibration)/(norme+(norme==0))
         
     # Use diagonal of mean calibration covariance for output.
-    ccalibcovar=R.dot(calibcovar).dot(R.T.todense())
-    ccalibvar=np.array(np.diagonal(ccalibcovar))
+    ccalibvar=neq.sandwich_diagonal(mean_res_data,calibcovar_band)
 
     # apply the mean (as in the iterative loop)
     ccalibvar *= mean**2
@@ -11,7 +11,7 @@ import numbers
 import numpy as np
 
 from desispec import util
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, ResolutionStack
 from desispec.coaddition import Spectrum
 from desiutil.log import get_logger
 from desispec import util
@@ -82,8 +82,8 @@ class Frame(object):
             nspec : number of spectra, flux.shape[0]
             nwave : number of wavelengths, flux.shape[1]
             specmin : minimum fiber number
-            R: array of sparse Resolution matrix objects converted
-               from resolution_data
+            R: ResolutionStack of the sparse Resolution matrices of
+               resolution_data (array of QuickResolution if built from wsigma)
             fibermap: fibermap table if provided
         """
         assert wave.ndim == 1
@@ -123,7 +123,7 @@ class Frame(object):
         if resolution_data is not None:
             self.wsigma=None #ignore width coefficients if resolution data is given explicitly
             self.ndiag=None 
-            self.R = np.array( [Resolution(r) for r in resolution_data] )
+            self.R = ResolutionStack(resolution_data)
         elif wsigma is not None:
             from desispec.quicklook.qlresolution import QuickResolution
             assert ndiag is not None
@@ -251,7 +251,13 @@ class Frame(object):
             chi2pix = None
 
         #- we do not propagate the scores here
-            
+
+        #- the subset sets its own FIBERMIN, do not modify our header
+        if self.meta is not None:
+            meta = self.meta.copy()
+        else:
+            meta = None
+
         wsigma=None
         if self.wsigma is not None:
             wsigma=self.wsigma[index]
@@ -259,7 +265,7 @@ class Frame(object):
         result = Frame(self.wave, self.flux[index], self.ivar[index],
                     self.mask[index], resolution_data=rdata,
                     fibers=self.fibers[index], spectrograph=self.spectrograph,
-                       meta=self.meta, fibermap=fibermap, chi2pix=chi2pix,
+                       meta=meta, fibermap=fibermap, chi2pix=chi2pix,
                        wsigma=wsigma,ndiag=self.ndiag)
 
         return result
@@ -17,7 +17,7 @@ from .fluxcalibration import (read_stdstar_templates, write_stdstar_models,
                               read_stdstar_models, read_flux_calibration,
                               write_flux_calibration)
 from .spectra import read_spectra, write_spectra, read_frame_as_spectra
-from .frame import read_meta_frame, read_frame, write_frame
+from .frame import read_meta_frame, read_frame, write_frame, read_frame_rows
 from .image import read_image, write_image
 from .meta import (findfile, get_exposures, get_files, get_raw_files,
                    rawdata_root, specprod_root, validate_night, qaprod_root,
@@ -28,7 +28,7 @@ from .params import read_params
 from .qa import (read_qa_frame, read_qa_data, write_qa_frame, write_qa_brick,
                  load_qa_frame, write_qa_exposure, write_qa_multiexp, load_qa_multiexp,
                  qafile_from_framefile)
-from .raw import read_raw, write_raw
+from .raw import read_raw, read_raw_exposure, write_raw
 from .sky import read_sky, write_sky
 from .util import (header2wave, fitsheader, native_endian, makepath,
                    write_bintable, iterfiles, healpix_degrade_fixed,
@@ -9,6 +9,7 @@ import os.path
 import numpy as np
 import scipy, scipy.sparse
 from astropy.io import fits
+import fitsio
 import warnings
 
 from desiutil.depend import add_dependencies
@@ -124,7 +125,55 @@ def read_meta_frame(filename, extname=0):
     return hdr
 
 
-def read_frame(filename, nspec=None, skip_resolution=False):
+def read_frame_rows(filename, objtype):
+    """Indices of the spectra of a frame file with a given OBJTYPE
+
+    Only the OBJTYPE column of the FIBERMAP HDU is read, so that the
+    result can be given as the rows argument of read_frame.
+
+    Args:
+        filename: path to a frame file
+        objtype: OBJTYPE of the spectra, e.g. 'STD' or 'SKY'
+
+    Returns:
+        1D array of row indices
+    """
+    fibermap_objtype = fitsio.read(filename, 'FIBERMAP', columns=['OBJTYPE'])['OBJTYPE']
+    return np.where(np.char.strip(fibermap_objtype) == objtype)[0]
+
+
+def _row_runs(rows):
+    """Split sorted row indices into (start, stop) runs of consecutive rows"""
+    breaks = np.where(np.diff(rows) != 1)[0] + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [rows.size]])
+    return [ (rows[a], rows[b-1]+1) for a, b in zip(starts, stops) ]
+
+
+def _read_image_rows(hdu, rows, dtype=None):
+    """Read rows of the first axis of an astropy image HDU
+
+    Args:
+        hdu: astropy.io.fits.ImageHDU of a file opened with memmap=False
+        rows: None for all rows, or sorted array of unique row indices
+        dtype: optional numpy dtype of the output, no conversion if None
+
+    Returns:
+        native endian numpy array, only the requested rows are read from disk
+    """
+    if rows is None:
+        data = hdu.data
+    elif rows.size == 0:
+        data = hdu.section[0:0]
+    else:
+        data = np.concatenate([ hdu.section[a:b] for a, b in _row_runs(rows) ])
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return native_endian(data)
+
+
+def read_frame(filename, nspec=None, skip_resolution=False, rows=None,
+               skip_hdus=None, keep_float32=False):
     """Reads a frame fits file and returns its data.
 
     Args:
@@ -132,8 +181,18 @@ def read_frame(filename, nspec=None, skip_resolution=False):
             night = string YEARMMDD
             expid = integer exposure ID
             camera = b0, r1, .. z9
+        nspec: int, optional
+            Only read the first nspec spectra
         skip_resolution: bool, option
             Speed up read time (>5x) by avoiding the Resolution matrix
+        rows: optional slice or list of spectrum indices (not fiber numbers)
+            to read; only these rows are read from disk, and the frame
+            keeps their order, including repeated indices
+        skip_hdus: optional list of HDUs not to read, among
+            RESOLUTION, QUICKRESOLUTION, CHI2PIX, MASK, FIBERMAP and SCORES
+        keep_float32: bool, optional
+            Keep the flux, ivar, resolution and chi2pix in the precision of
+            the file (float32) instead of converting them to float64
 
     Returns:
         desispec.Frame object with attributes wave, flux, ivar, etc.
@@ -148,74 +207,84 @@ def read_frame(filename, nspec=None, skip_resolution=False):
     if not os.path.isfile(filename) :
         raise IOError("cannot open"+filename)
 
-    fx = fits.open(filename, uint=True, memmap=False)
-    hdr = fx[0].header
-    flux = native_endian(fx['FLUX'].data.astype('f8'))
-    ivar = native_endian(fx['IVAR'].data.astype('f8'))
-    wave = native_endian(fx['WAVELENGTH'].data.astype('f8'))
-    if 'MASK' in fx:
-        mask = native_endian(fx['MASK'].data)
-    else:
-        mask = None   #- let the Frame object create the default mask
+    skip_hdus = set() if skip_hdus is None else set([ name.upper() for name in skip_hdus ])
+    if skip_resolution:
+        skip_hdus.update(['RESOLUTION', 'QUICKRESOLUTION'])
+    dtype = None if keep_float32 else 'f8'
 
     # Init
     resolution_data=None
     qwsigma=None
     qndiag=None
+    mask = None   #- let the Frame object create the default mask
     fibermap = None
     chi2pix = None
     scores = None
     scores_comments = None
 
-    if skip_resolution:
-        pass
-    elif 'RESOLUTION' in fx:
-        resolution_data = native_endian(fx['RESOLUTION'].data.astype('f8'))
-    elif 'QUICKRESOLUTION' in fx:
-        qr=fx['QUICKRESOLUTION'].header
-        qndiag =qr['NDIAG']
-        qwsigma=native_endian(fx['QUICKRESOLUTION'].data.astype('f4'))
-
-    if 'FIBERMAP' in fx:
-        fibermap = fx['FIBERMAP'].data
-    else:
-        fibermap = None
-
-    if 'CHI2PIX' in fx:
-        chi2pix = native_endian(fx['CHI2PIX'].data.astype('f8'))
-    else:
-        chi2pix = None
-
-    if 'SCORES' in fx:
-        scores = fx['SCORES'].data
-        # I need to open the header to read the comments
-        scores_comments = dict()
-        head   = fx['SCORES'].header
-        for i in range(1,len(scores.columns)+1) :
-            k='TTYPE'+str(i)
-            scores_comments[head[k]]=head.comments[k]
-    else:
-        scores = None
-        scores_comments = None
-
-    fx.close()
-
-    if nspec is not None:
-        flux = flux[0:nspec]
-        ivar = ivar[0:nspec]
-        if resolution_data is not None:
-            resolution_data = resolution_data[0:nspec]
-        else:
-            qwsigma=qwsigma[0:nspec]
-        if chi2pix is not None:
-            chi2pix = chi2pix[0:nspec]
-        if mask is not None:
-            mask = mask[0:nspec]
+    with fits.open(filename, uint=True, memmap=False) as fx:
+        hdr = fx[0].header
+
+        #- spectrum indices to read, None for all of them;
+        #- urows[inverse] are the requested rows in the caller's order
+        nrows = fx['FLUX'].header['NAXIS2']
+        urows = inverse = None
+        if rows is None and nspec is not None:
+            rows = slice(0, nspec)
+        if rows is not None:
+            if isinstance(rows, slice):
+                rows = np.arange(nrows)[rows]
+            rows = np.asarray(rows, dtype=int)
+            urows, inverse = np.unique(rows, return_inverse=True)
+            if urows.size > 0 and (urows[0] < 0 or urows[-1] >= nrows):
+                raise IndexError("rows should be in [0,{}[".format(nrows))
+            if np.array_equal(urows, rows):
+                inverse = None
+
+        def _reorder(data):
+            return data if (data is None or inverse is None) else data[inverse]
+
+        flux = _reorder(_read_image_rows(fx['FLUX'], urows, dtype))
+        ivar = _reorder(_read_image_rows(fx['IVAR'], urows, dtype))
+        wave = native_endian(fx['WAVELENGTH'].data.astype('f8'))
+        if 'MASK' in fx and 'MASK' not in skip_hdus:
+            mask = _reorder(_read_image_rows(fx['MASK'], urows))
+
+        if 'RESOLUTION' in fx:
+            if 'RESOLUTION' not in skip_hdus:
+                resolution_data = _reorder(_read_image_rows(fx['RESOLUTION'], urows, dtype))
+        elif 'QUICKRESOLUTION' in fx and 'QUICKRESOLUTION' not in skip_hdus:
+            qndiag = fx['QUICKRESOLUTION'].header['NDIAG']
+            qwsigma = _reorder(_read_image_rows(fx['QUICKRESOLUTION'], urows, 'f4'))
+
+        if 'CHI2PIX' in fx and 'CHI2PIX' not in skip_hdus:
+            chi2pix = _reorder(_read_image_rows(fx['CHI2PIX'], urows, dtype))
+
+        if 'FIBERMAP' in fx and 'FIBERMAP' not in skip_hdus:
+            fibermap = fx['FIBERMAP'].data
+            if rows is not None:
+                fibermap = fibermap[rows]
+        if 'SCORES' in fx and 'SCORES' not in skip_hdus:
+            scores = fx['SCORES'].data
+            # I need to open the header to read the comments
+            scores_comments = dict()
+            head   = fx['SCORES'].header
+            for i in range(1,len(scores.columns)+1) :
+                k='TTYPE'+str(i)
+                scores_comments[head[k]]=head.comments[k]
+            if rows is not None:
+                scores = scores[rows]
+
+    #- fiber numbers of a subset of rows without fibermap
+    fibers = None
+    if fibermap is None and rows is not None and 'FIBERMIN' in hdr:
+        fibers = hdr['FIBERMIN'] + rows
 
     # return flux,ivar,wave,resolution_data, hdr
-    frame = Frame(wave, flux, ivar, mask, resolution_data, meta=hdr, fibermap=fibermap, chi2pix=chi2pix,
+    frame = Frame(wave, flux, ivar, mask, resolution_data, fibers=fibers, meta=hdr, fibermap=fibermap, chi2pix=chi2pix,
                   scores=scores,scores_comments=scores_comments,
-                  wsigma=qwsigma,ndiag=qndiag, suppress_res_warning=skip_resolution)
+                  wsigma=qwsigma,ndiag=qndiag,
+                  suppress_res_warning=('RESOLUTION' in skip_hdus or 'QUICKRESOLUTION' in skip_hdus))
 
     # Vette
     diagnosis = frame.vet()
@@ -37,9 +37,21 @@ def read_raw(filename, camera, **kwargs):
         raise IOError('Camera {} not in {}'.format(camera, filename))
 
     rawimage = fx[camera.upper()].data
-    header = fx[camera.upper()].header
+    header = _camera_header(fx, camera.upper(), kwargs.pop("fill_header", None))
     primary_header= fx[0].header
 
+    fx.close()
+
+    img = desispec.preproc.preproc(rawimage, header, primary_header, **kwargs)
+    return img
+
+def _camera_header(fx, hdu, fill_header=None):
+    """Header of HDU hdu of the opened file fx, with the keywords inherited
+    from the primary HDU and from the HDUs in the list fill_header"""
+    log = get_logger()
+
+    header = fx[hdu].header
+
     blacklist = ["EXTEND","SIMPLE","NAXIS1","NAXIS2","CHECKSUM","DATASUM","XTENSION","EXTNAME","COMMENT"]
     if 'INHERIT' in header and header['INHERIT']:
         h0 = fx[0].header
@@ -47,33 +59,149 @@ def read_raw(filename, camera, **kwargs):
             if ( key not in blacklist ) and ( key not in header ):
                 header[key] = h0[key]
 
-    if "fill_header" in kwargs :
-        hdus = kwargs["fill_header"]
-        if hdus is not None :
-            log.info("will add header keywords from hdus %s"%str(hdus))
-            for hdu in hdus :
-                try :
-                    ihdu = int(hdu)
-                    hdu = ihdu
-                except ValueError:
-                    pass
-                if hdu in fx :
-                    hdu_header = fx[hdu].header
-                    for key in hdu_header:
-                        if ( key not in blacklist ) and ( key not in header ) :
-                            log.debug("adding {} = {}".format(key,hdu_header[key]))
-                            header[key] = hdu_header[key]                        
-                        else :
-                            log.debug("key %s already in header or blacklisted"%key)
-                else :
-                    log.warning("warning HDU %s not in fits file"%str(hdu))
-
-        kwargs.pop("fill_header")
-    
-    fx.close()
+    if fill_header is not None :
+        hdus = fill_header
+        log.info("will add header keywords from hdus %s"%str(hdus))
+        for hdu in hdus :
+            try :
+                ihdu = int(hdu)
+                hdu = ihdu
+            except ValueError:
+                pass
+            if hdu in fx :
+                hdu_header = fx[hdu].header
+                for key in hdu_header:
+                    if ( key not in blacklist ) and ( key not in header ) :
+                        log.debug("adding {} = {}".format(key,hdu_header[key]))
+                        header[key] = hdu_header[key]                        
+                    else :
+                        log.debug("key %s already in header or blacklisted"%key)
+            else :
+                log.warning("warning HDU %s not in fits file"%str(hdu))
+
+    return header
+
+def _preproc_camera(arg):
+    """Preprocess one camera, used by read_raw_exposure (multiprocessing.Pool)
+
+    arg is a dictionary with the arguments of desispec.preproc.preproc,
+    plus camera, outfile and zero_masked.  Returns the Image, or the output
+    filename if outfile is not None, or None if there was an IOError.
+    """
+    log = get_logger()
+    arg = dict(arg)
+    camera = arg.pop("camera")
+    outfile = arg.pop("outfile")
+    zero_masked = arg.pop("zero_masked")
+    try :
+        img = desispec.preproc.preproc(**arg)
+    except IOError as err :
+        log.error('Error while preprocessing camera {}: {}'.format(camera, err))
+        return None
+
+    if zero_masked :
+        img.pix *= (img.mask==0)
+
+    if outfile is None :
+        return img
+    from .image import write_image
+    write_image(outfile, img)
+    log.info("wrote {}".format(outfile))
+    return outfile
+
+def read_raw_exposure(filename, cameras=None, outdir=None, nproc=None, zero_masked=False, **kwargs):
+    """
+    Preprocess several cameras of a raw data file concurrently
+
+    The file is opened once.  The HDUs are decompressed one after the other
+    by this process, while a pool of nproc processes runs preproc on the
+    cameras already decompressed.
 
-    img = desispec.preproc.preproc(rawimage, header, primary_header, **kwargs)
-    return img
+    Args:
+        filename : input fits filename with DESI raw data
+
+    Options:
+        cameras : list of camera names (B0,R1, .. Z9), default is all cameras
+            in the file
+        outdir : if not None, the workers write the preprocessed images
+            in this directory (with the io.findfile naming) instead of
+            returning them
+        nproc : number of processes, default is min(number of cameras,
+            desispec.parallel.default_nproc), 1 to run serially
+        zero_masked : set to zero the flux of masked pixels
+        Other keyword arguments are passed to desispec.preproc.preproc(),
+        plus fill_header, as in read_raw.
+
+    Returns dictionary of camera (lower case) : Image object, or output
+    filename if outdir is not None.  The cameras that are not in the file
+    or could not be preprocessed because of an IOError are logged and
+    skipped.
+    """
+    from desispec.parallel import default_nproc
+    from .meta import findfile
+
+    log = get_logger()
+
+    fill_header = kwargs.pop("fill_header", None)
+
+    fx = fits.open(filename, memmap=False)
+    extnames = [ hdu.name for hdu in fx[1:] ]
+    if cameras is None :
+        cameras = [ c+str(i) for c in 'BRZ' for i in range(10) if c+str(i) in extnames ]
+    cameras = [ camera.upper() for camera in cameras ]
+    for camera in cameras :
+        if camera not in extnames :
+            log.error('Camera {} not in {}'.format(camera, filename))
+    cameras = [ camera for camera in cameras if camera in extnames ]
+
+    if nproc is None :
+        nproc = min(len(cameras), default_nproc)
+    nproc = max(1, min(nproc, len(cameras)))
+
+    pool = None
+    if nproc > 1 :
+        import multiprocessing
+        pool = multiprocessing.Pool(nproc)
+
+    #- at most 2*nproc decompressed images waiting in the pool
+    maxpending = 2*nproc
+    pending = list()
+    results = dict()
+
+    try :
+        for camera in cameras :
+            header = _camera_header(fx, camera, fill_header)
+            outfile = None
+            if outdir is not None :
+                outfile = findfile('preproc', night=header['NIGHT'], expid=header['EXPID'],
+                                   camera=camera.lower(), outdir=outdir, specprod_dir=outdir)
+            #- plain Header, a CompImageHeader cannot be unpickled by the workers
+            arg = dict(rawimage=fx[camera].data, header=fits.Header(header),
+                       primary_header=fits.Header(fx[0].header),
+                       camera=camera.lower(), outfile=outfile, zero_masked=zero_masked)
+            arg.update(kwargs)
+            #- do not keep the decompressed image cached in the HDU, it is
+            #- only referenced by arg until preprocessed
+            del fx[camera].data
+
+            if pool is None :
+                results[camera.lower()] = _preproc_camera(arg)
+                continue
+
+            while len(pending) >= maxpending :
+                cam, res = pending.pop(0)
+                results[cam] = res.get()
+            pending.append((camera.lower(), pool.apply_async(_preproc_camera, (arg,))))
+
+        for cam, res in pending :
+            results[cam] = res.get()
+    finally :
+        fx.close()
+        if pool is not None :
+            pool.close()
+            pool.join()
+
+    return { cam : results[cam] for cam in results if results[cam] is not None }
 
 def write_raw(filename, rawdata, header, camera=None, primary_header=None):
     '''
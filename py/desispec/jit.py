@@ -0,0 +1,226 @@
+"""
+desispec.jit
+============
+
+Compilation policy of the numba kernels of desispec.
+
+All the compiled kernels of desispec are declared with :func:`njit`, which
+is ``numba.njit`` with an on-disk cache of the compiled code, so that short
+lived processes do not compile the kernels again, and with the argument
+types the kernels are called with, so that :func:`warmup` can compile (or
+load from the cache) all of them before the actual work, e.g. once per node
+before starting the pipeline processes (``desi_pipe_exec --jit-warmup``).
+
+The time spent compiling and loading kernels from the cache is recorded and
+reported by :func:`report`.
+
+The policy is configured with the environment variables
+
+    DESI_NUMBA_CACHE : set to 0 to disable the on-disk cache (default 1)
+    DESI_NUMBA_CACHE_DIR : directory of the cache (default is numba's
+        default, i.e. $NUMBA_CACHE_DIR or the ``__pycache__`` directories
+        of the package, or a user directory if they are not writable)
+
+or with :func:`configure`.  The cache is invalidated when the source file of
+a kernel changes.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import time
+from collections import OrderedDict
+
+import numba
+from numba.core import event
+from numba.core.caching import NullCache
+
+from desiutil.log import get_logger
+
+
+#- registered kernels: name -> (dispatcher, list of signatures)
+_kernels = OrderedDict()
+
+#- current policy
+_cache = os.getenv("DESI_NUMBA_CACHE", "1") not in ("0", "")
+_cache_dir = os.getenv("DESI_NUMBA_CACHE_DIR")
+_numba_cache_dir = numba.config.CACHE_DIR
+
+#- telemetry
+_start_time = time.time()
+_compile_time = dict()
+_load_time = dict()
+
+
+def _name(dispatcher):
+    return "{}.{}".format(dispatcher.py_func.__module__, dispatcher.py_func.__name__)
+
+
+class _CompileListener(event.Listener):
+    """Accumulate the compilation time of the registered kernels,
+    excluding the time spent compiling the kernels they call."""
+    def __init__(self):
+        self._stack = list()
+
+    def on_start(self, ev):
+        self._stack.append((ev.data["dispatcher"], time.time(), len(self._stack)))
+
+    def on_end(self, ev):
+        dispatcher, t0, depth = self._stack.pop()
+        if depth == 0 :
+            name = _name(dispatcher)
+            _compile_time[name] = _compile_time.get(name, 0.) + time.time() - t0
+
+event.register("numba:compile", _CompileListener())
+
+
+def _set_cache(dispatcher):
+    if _cache :
+        dispatcher.enable_caching()
+    else :
+        dispatcher._cache = NullCache()
+
+
+def njit(*args, signatures=(), **options):
+    """Same as ``numba.njit``, with the caching policy of this module.
+
+    Args:
+        signatures : list of the argument types the kernel is called with,
+            e.g. ``["(float64[:,::1], int64)"]``, compiled by :func:`warmup`.
+            They do not restrict the types the kernel can be called with.
+        options : numba.njit options (e.g. nogil=True), except cache
+
+    Can be used as ``@njit`` or ``@njit(signatures=..., nogil=True)``.
+    """
+    if "cache" in options :
+        raise ValueError("the cache is set by desispec.jit.configure")
+
+    def decorator(func):
+        dispatcher = numba.njit(**options)(func)
+        _set_cache(dispatcher)
+        _kernels[_name(dispatcher)] = (dispatcher, list(signatures))
+        return dispatcher
+
+    if len(args) == 1 and callable(args[0]) :
+        return decorator(args[0])
+    return decorator
+
+
+def configure(cache=None, cache_dir=None):
+    """(Re)configure the on-disk cache of the compiled kernels.
+
+    Args:
+        cache (bool): enable the cache (default $DESI_NUMBA_CACHE or True).
+        cache_dir (str): directory of the cache (default $DESI_NUMBA_CACHE_DIR
+            or numba's default).
+
+    Applies to the kernels already declared and to the next ones; the
+    directory is numba's configuration, so it also applies to the other
+    cached numba functions of the process.
+    """
+    global _cache, _cache_dir
+    if cache is None :
+        cache = os.getenv("DESI_NUMBA_CACHE", "1") not in ("0", "")
+    if cache_dir is None :
+        cache_dir = os.getenv("DESI_NUMBA_CACHE_DIR")
+    _cache = cache
+    _cache_dir = cache_dir
+    _set_cache_dir()
+    for dispatcher, signatures in _kernels.values() :
+        _set_cache(dispatcher)
+
+
+def _set_cache_dir():
+    if _cache_dir is not None :
+        os.makedirs(_cache_dir, exist_ok=True)
+        numba.config.CACHE_DIR = _cache_dir
+    else :
+        numba.config.CACHE_DIR = _numba_cache_dir
+
+
+def kernels():
+    """Names of the declared kernels.
+
+    Only the kernels of the modules already imported are declared, see
+    :func:`warmup`.
+    """
+    return list(_kernels.keys())
+
+
+def warmup(modules=None, verbose=True):
+    """Compile, or load from the cache, all kernels for their declared
+    signatures.
+
+    Args:
+        modules : list of modules to import to declare their kernels,
+            default is all the desispec modules with kernels.
+        verbose : if True, log the :func:`report` after the warmup.
+
+    Returns:
+        dict of the time in seconds spent for each kernel.
+    """
+    log = get_logger()
+    if modules is None :
+        modules = ["desispec.cosmics", "desispec.tiledstats",
+                   "desispec.qproc.qextract", "desispec.trace_shifts",
+                   "desispec.bootcalib"]
+    import importlib
+    for module in modules :
+        try :
+            importlib.import_module(module)
+        except ImportError as e :
+            log.warning("cannot import {}, its kernels are not compiled: {}".format(module, e))
+
+    timing = OrderedDict()
+    for name, (dispatcher, signatures) in _kernels.items() :
+        t0 = time.time()
+        compile_time = _compile_time.get(name, 0.)
+        for signature in signatures :
+            dispatcher.compile(signature)
+        timing[name] = time.time() - t0
+        if _compile_time.get(name, 0.) == compile_time :
+            _load_time[name] = _load_time.get(name, 0.) + timing[name]
+    if verbose :
+        report()
+    return timing
+
+
+def stats():
+    """Compilation telemetry of the declared kernels.
+
+    Returns:
+        dict keyed by kernel name of dicts with the number of compiled
+        signatures (nsig), of cache hits and misses, and the time in seconds
+        spent compiling (compile) and loading them from the cache in
+        :func:`warmup` (load).
+    """
+    result = OrderedDict()
+    for name, (dispatcher, signatures) in _kernels.items() :
+        result[name] = dict(nsig=len(dispatcher.signatures),
+                            hits=sum(dispatcher.stats.cache_hits.values()),
+                            misses=sum(dispatcher.stats.cache_misses.values()),
+                            compile=_compile_time.get(name, 0.),
+                            load=_load_time.get(name, 0.))
+    return result
+
+
+def report():
+    """Log the time spent compiling the kernels versus running since the
+    import of this module."""
+    log = get_logger()
+    allstats = stats()
+    compile_time = sum([ s["compile"] for s in allstats.values() ])
+    load_time = sum([ s["load"] for s in allstats.values() ])
+    hits = sum([ s["hits"] for s in allstats.values() ])
+    misses = sum([ s["misses"] for s in allstats.values() ])
+    elapsed = time.time() - _start_time
+    for name, s in allstats.items() :
+        if s["compile"] > 0 or s["load"] > 0 :
+            log.debug("{}: {} signatures, compile {:.2f} sec, cache load {:.2f} sec".format(
+                name, s["nsig"], s["compile"], s["load"]))
+    log.info("numba kernels: {:.2f} sec compiling ({} signatures), {:.2f} sec loading {} signatures from the cache, {:.2f} sec running, cache {}".format(
+        compile_time, misses, load_time, hits, elapsed - compile_time - load_time,
+        ("in " + str(numba.config.CACHE_DIR or "__pycache__")) if _cache else "disabled"))
+
+
+_set_cache_dir()
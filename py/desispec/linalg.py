@@ -65,6 +65,70 @@ def cholesky_invert(A) :
     inv = scipy.linalg.cho_solve((UorL,lower),scipy.eye(A.shape[0]))
     return inv
 
+def cholesky_solve_banded(Ab,B,overwrite=False) :
+    """Returns the solution X of the linear system A.X=B
+    assuming A is a banded positive definite matrix
+
+    Args :
+         Ab : 2D (nband+1,n) lower banded storage of the real symmetric
+              positive definite matrix A, with Ab[i-j,j] = A[i,j] for i>=j
+              (same convention as scipy.linalg.cholesky_banded with lower=True)
+         B : 1D vector, must have dimension n  (numpy.ndarray)
+
+    Options :
+        overwrite: replace Ab data by cholesky decomposition (faster)
+
+    Returns :
+         X : 1D vector, same dimension as B  (numpy.ndarray)
+    """
+    Lb = scipy.linalg.cholesky_banded(Ab, lower=True, overwrite_ab=overwrite)
+    X  = scipy.linalg.cho_solve_banded((Lb,True),B)
+    return X
+
+def cholesky_invert_band(Ab) :
+    """
+    returns the band of the inverse of a banded positive definite matrix
+
+    Only the elements of the inverse within the bandwidth of A are computed,
+    using the recursion of Takahashi, Fagan & Chin (1973) on the banded
+    Cholesky factor. This is O(n*nband^2) instead of O(n^3) for the full inverse.
+
+    Args :
+         Ab : 2D (nband+1,n) lower banded storage of the real symmetric
+              positive definite matrix A, with Ab[i-j,j] = A[i,j] for i>=j
+
+    Returns:
+         Cb : 2D (nband+1,n) lower banded storage of the inverse of A,
+              Cb[i-j,j] = inv(A)[i,j] for 0 <= i-j <= nband
+    """
+    nband = Ab.shape[0]-1
+    n     = Ab.shape[1]
+    Lb = scipy.linalg.cholesky_banded(Ab, lower=True)
+
+    # zero-padded copies so that the last columns do not need special care
+    L  = np.zeros((nband+1,n+nband))
+    L[:,:n] = Lb
+    Cb = np.zeros((nband+1,n+nband))
+
+    # indices to gather the symmetric (nband x nband) block C[k1,k2] for k1,k2 in j+1..j+nband
+    # from the banded storage, C[k1,k2] = Cb[|k1-k2|,min(k1,k2)]
+    k = np.arange(nband)
+    dk = np.abs(k[:,None]-k[None,:])
+    mk = np.minimum(k[:,None],k[None,:])
+
+    for j in range(n-1,-1,-1) :
+        ljj = L[0,j]
+        l   = L[1:,j] # L[j+1:j+nband+1,j]
+        if nband > 0 :
+            block = Cb[dk,j+1+mk]
+            c = -block.dot(l)/ljj # C[j+1:j+nband+1,j]
+            Cb[1:,j] = c
+            Cb[0,j]  = 1./ljj**2 - c.dot(l)/ljj
+        else :
+            Cb[0,j]  = 1./ljj**2
+
+    return Cb[:,:n]
+
 
 def spline_fit(output_wave,input_wave,input_flux,required_resolution,input_ivar=None,order=3,max_resolution=None):
     """Performs spline fit of input_flux vs. input_wave and resamples at output_wave
@@ -117,3 +181,346 @@ def spline_fit(output_wave,input_wave,input_flux,required_resolution,input_ivar=
             log.error("spline fit failed")
             raise ValueError
     return output_flux
+
+
+class BandedNormalEquation(object):
+    """Normal equation A.x = B of a weighted least-squares fit of spectra
+    through their resolution matrices, accumulated in banded storage.
+
+    The model of fiber f at wavelength bin w is::
+
+        model[f,w] = left[f,w] sum_i R_f[w,i] right[f,i] sum_p comp[f,p] x[i,p]
+
+    where R_f is the resolution matrix of fiber f, x are the parameters
+    (one deconvolved spectrum per component p), and left, right, comp
+    are fixed scalings (for instance a fiber flat, a stellar model, or
+    polynomials of the fiber focal plane coordinates).
+
+    The parameters are ordered as x[i*ncomp+p] such that A is a banded matrix
+    with ncomp*ndiag-1 sub-diagonals. A and B are kept between solutions;
+    changing the inverse variance of a few pixels (e.g. outlier rejection)
+    is applied as a low rank update of A and B, at a cost proportional to
+    the number of modified pixels instead of the full data set.
+
+    Args:
+        rdata : 3D[nfibers, ndiag, nwave] resolution data (offsets from ndiag//2 to -ndiag//2)
+        flux : 2D[nfibers, nwave] data
+        ivar : 2D[nfibers, nwave] inverse variance of flux
+
+    Options:
+        left : 2D[nfibers, nwave] scaling of the model rows (default 1)
+        right : 2D[nfibers, nwave] scaling of the model columns (default 1)
+        comp : 2D[nfibers, ncomp] coefficients of the components (default one component=1)
+        max_update_fraction : rebuild A and B from scratch instead of an incremental update
+            if more than this fraction of pixels are modified
+    """
+    def __init__(self, rdata, flux, ivar, left=None, right=None, comp=None, max_update_fraction=0.1):
+        self.rdata = rdata
+        self.nfibers, self.ndiag, self.nwave = rdata.shape
+        self.hw = self.ndiag//2
+        self.flux = flux
+        self.ivar = np.array(ivar, dtype=float)
+        self.left = left
+        self.right = right
+        if comp is None :
+            comp = np.ones((self.nfibers,1))
+        self.comp = np.atleast_2d(comp)
+        self.ncomp = self.comp.shape[1]
+        self.nband = self.ncomp*(2*self.hw+1)-1
+        self.npar = self.ncomp*self.nwave
+        self.max_update_fraction = max_update_fraction
+        #- some statistics
+        self.nbuild = 0
+        self.nupdate = 0
+        self.npix_updated = 0
+        self._build()
+
+    def _scaled_rdata(self, fibers=None) :
+        """resolution data times the right hand side scaling"""
+        if fibers is None :
+            fibers = slice(None)
+        if self.right is None :
+            return self.rdata[fibers]
+        return self.rdata[fibers]*self.right[fibers][:,None,:]
+
+    def _build(self) :
+        """accumulate A and B from all the data"""
+        nfibers, nwave, hw, nc = self.nfibers, self.nwave, self.hw, self.ncomp
+
+        # weights of the rows of the model
+        wivar  = self.ivar.copy()
+        wflux  = self.ivar*self.flux
+        if self.left is not None :
+            wflux *= self.left
+            wivar *= self.left**2
+
+        # zero-padded along wavelength so that xx_pad[:,hw+w] = xx[:,w]
+        wivar_pad = np.zeros((nfibers,nwave+2*hw))
+        wivar_pad[:,hw:hw+nwave] = wivar
+        wflux_pad = np.zeros((nfibers,nwave+2*hw))
+        wflux_pad[:,hw:hw+nwave] = wflux
+        valid_pad = (wivar_pad>0)
+
+        Q = self._scaled_rdata()
+        # products of components
+        pairs = [(p,q) for p in range(nc) for q in range(nc)]
+        ccomp = np.array([self.comp[:,p]*self.comp[:,q] for p,q in pairs])
+
+        # R_f[w,i] = rdata[f,hw-(i-w),i]
+        # A[i,i+d] = sum_f sum_o wivar[f,i-o] R_f[i-o,i] R_f[i-o,i+d]
+        # B[i]     = sum_f sum_o wflux[f,i-o] R_f[i-o,i]
+        self.Ab = np.zeros((self.nband+1,self.npar))
+        self.B  = np.zeros(self.npar)
+        self.npix = np.zeros(self.npar,dtype=int) # number of data points constraining each parameter
+        Bf = np.zeros((nfibers,nwave))
+        nf = np.zeros((nfibers,nwave),dtype=int)
+        for o1 in range(-hw,hw+1) :
+            k1 = hw-o1
+            rows = slice(hw-o1,hw-o1+nwave)
+            wr = wivar_pad[:,rows]*Q[:,k1]
+            Bf += wflux_pad[:,rows]*Q[:,k1]
+            nf += valid_pad[:,rows]&(Q[:,k1]!=0)
+            for d in range(0,hw-o1+1) :
+                k2 = k1-d
+                prod = wr[:,:nwave-d]*Q[:,k2,d:]
+                if nc == 1 :
+                    self.Ab[d,:nwave-d] += np.dot(self.comp[:,0]**2,prod)
+                    continue
+                res = ccomp.dot(prod)
+                for (p,q),val in zip(pairs,res) :
+                    if d==0 and q<p : continue
+                    self.Ab[d*nc+q-p,p:nc*(nwave-d):nc] += val
+        for p in range(nc) :
+            self.B[p::nc]    = self.comp[:,p].dot(Bf)
+            self.npix[p::nc] = (self.comp[:,p]!=0).astype(int).dot(nf)
+
+        self.nbuild += 1
+
+    def _update(self, fibers, waves, divar, sign) :
+        """add the contribution of a list of pixels with inverse variance divar to A and B
+
+        Args:
+            fibers, waves : 1D arrays of pixel indices
+            divar : 1D array of inverse variance increments (can be negative)
+            sign : 1D array of int, +1/-1 if the pixel is added/removed from the fit, 0 otherwise
+        """
+        nwave, hw, nc, npar = self.nwave, self.hw, self.ncomp, self.npar
+        wivar = divar.copy()
+        wflux = divar*self.flux[fibers,waves]
+        if self.left is not None :
+            wflux *= self.left[fibers,waves]
+            wivar *= self.left[fibers,waves]**2
+
+        # R values of the pixels rows, for each offset o = i - w
+        q = np.zeros((2*hw+1,fibers.size))
+        valid = np.zeros((2*hw+1,fibers.size),dtype=bool)
+        for o in range(-hw,hw+1) :
+            i = waves+o
+            valid[o+hw] = (i>=0)&(i<nwave)
+            ii = i[valid[o+hw]]
+            ff = fibers[valid[o+hw]]
+            q[o+hw,valid[o+hw]] = self.rdata[ff,hw-o,ii]
+            if self.right is not None :
+                q[o+hw,valid[o+hw]] *= self.right[ff,ii]
+
+        indices = []
+        weights = []
+        bindices = []
+        bweights = []
+        npix_change = np.zeros(npar,dtype=int)
+        for o1 in range(-hw,hw+1) :
+            ok1 = valid[o1+hw]
+            i1 = waves[ok1]+o1
+            q1 = q[o1+hw,ok1]
+            for p in range(nc) :
+                c1 = self.comp[fibers[ok1],p]
+                bindices.append(i1*nc+p)
+                bweights.append(wflux[ok1]*q1*c1)
+                np.add.at(npix_change,i1*nc+p,sign[ok1]*((q1*c1)!=0))
+            for o2 in range(o1,hw+1) :
+                ok = ok1&valid[o2+hw]
+                i1 = waves[ok]+o1
+                w12 = wivar[ok]*q[o1+hw,ok]*q[o2+hw,ok]
+                d = o2-o1
+                for p in range(nc) :
+                    for r in range(nc) :
+                        if d==0 and r<p : continue
+                        indices.append((d*nc+r-p)*npar+i1*nc+p)
+                        weights.append(w12*self.comp[fibers[ok],p]*self.comp[fibers[ok],r])
+
+        if len(indices)>0 :
+            self.Ab += np.bincount(np.concatenate(indices),weights=np.concatenate(weights),minlength=self.Ab.size).reshape(self.Ab.shape)
+            self.B  += np.bincount(np.concatenate(bindices),weights=np.concatenate(bweights),minlength=npar)
+        self.npix += npix_change
+
+    def set_ivar(self, ivar) :
+        """Change the inverse variance of the data, for instance after an outlier rejection.
+
+        Only the modified pixels are used to update A and B,
+        unless the fraction of modified pixels exceeds max_update_fraction.
+
+        Args:
+            ivar : 2D[nfibers, nwave] new inverse variance of flux
+        """
+        changed = (ivar != self.ivar)
+        nchanged = np.count_nonzero(changed)
+        if nchanged == 0 :
+            return
+        if nchanged > self.max_update_fraction*self.ivar.size :
+            self.ivar = np.array(ivar, dtype=float)
+            self._build()
+            return
+        fibers,waves = np.where(changed)
+        divar = ivar[fibers,waves]-self.ivar[fibers,waves]
+        sign  = (ivar[fibers,waves]>0).astype(int)-(self.ivar[fibers,waves]>0).astype(int)
+        self._update(fibers,waves,divar,sign)
+        self.ivar[fibers,waves] = ivar[fibers,waves]
+        self.nupdate += 1
+        self.npix_updated += nchanged
+
+    def set_scaling(self, left=None, right=None, comp=None, ivar=None) :
+        """Change the scalings of the model, this requires a full rebuild of A and B
+        if any of them is modified.
+
+        Options:
+            left, right, comp : same as in __init__, unchanged if None
+            ivar : 2D[nfibers, nwave] new inverse variance of flux, unchanged if None
+        """
+        changed = False
+        if left is not None and not np.array_equal(left,self.left) :
+            self.left = left
+            changed = True
+        if right is not None and not np.array_equal(right,self.right) :
+            self.right = right
+            changed = True
+        if comp is not None and not np.array_equal(np.atleast_2d(comp),self.comp) :
+            self.comp = np.atleast_2d(comp)
+            changed = True
+        if not changed :
+            if ivar is not None :
+                self.set_ivar(ivar)
+            return
+        if ivar is not None :
+            self.ivar = np.array(ivar, dtype=float)
+        self._build()
+
+    def _prepare(self, prior_ivar=0.) :
+        """returns a copy of Ab that is positive definite, and the mask of constrained parameters"""
+        Ab = self.Ab.copy()
+        ok = (self.npix>0)|(prior_ivar>0)
+        Ab[0] += prior_ivar
+        bad = np.where(~ok)[0]
+        if bad.size>0 :
+            # parameters without data : null row and column (up to rounding errors of the updates)
+            # set their diagonal to one so that A is positive definite
+            Ab[:,bad] = 0.
+            for d in range(1,self.nband+1) :
+                b = bad[bad>=d]
+                Ab[d,b-d] = 0.
+            Ab[0,bad] = 1.
+        return Ab,ok
+
+    def todense(self, prior_ivar=0.) :
+        """Returns A as a dense 2D array (with the prior_ivar added to its diagonal)"""
+        Ab = self.Ab.copy()
+        Ab[0] += prior_ivar
+        n = self.npar
+        A = np.zeros((n,n))
+        for d in range(self.nband+1) :
+            i = np.arange(n-d)
+            A[i+d,i] = Ab[d,:n-d]
+            A[i,i+d] = Ab[d,:n-d]
+        return A
+
+    def solve(self, prior_ivar=0., prior_value=0.) :
+        """Solve the normal equation, with an optional gaussian prior on the parameters.
+
+        Parameters that are not constrained by any data (or prior) are set to zero.
+
+        Options:
+            prior_ivar : inverse variance of a prior on the parameters (scalar or 1D[npar])
+            prior_value : value of the prior (scalar or 1D[npar])
+
+        Returns:
+            x : 1D[nwave] parameters if ncomp=1, 2D[ncomp,nwave] otherwise
+        """
+        Ab,ok = self._prepare(prior_ivar)
+        B = (self.B + prior_ivar*prior_value)*ok
+        try :
+            x = cholesky_solve_banded(Ab,B)
+        except np.linalg.linalg.LinAlgError :
+            log=get_logger()
+            log.info("banded cholesky failed, trying svd")
+            A = self.todense(prior_ivar)[ok][:,ok]
+            x = np.zeros(self.npar)
+            x[ok] = np.linalg.lstsq(A,B[ok],rcond=None)[0]
+        return self._unpack(x)
+
+    def covariance_band(self, prior_ivar=0.) :
+        """Returns the band of the inverse of A (the covariance of the parameters)
+
+        Options:
+            prior_ivar : inverse variance of a prior on the parameters (scalar or 1D[npar])
+
+        Returns:
+            Cb : 2D[nband+1,npar] lower banded storage of the covariance, Cb[i-j,j] = C[i,j]
+            with the interleaved ordering of parameters i*ncomp+p
+        """
+        Ab,ok = self._prepare(prior_ivar)
+        try :
+            Cb = cholesky_invert_band(Ab)
+        except np.linalg.linalg.LinAlgError :
+            log=get_logger()
+            log.warning("banded cholesky inversion failed, switching to np.linalg.pinv")
+            C = np.linalg.pinv(self.todense(prior_ivar))
+            Cb = np.zeros(Ab.shape)
+            for d in range(self.nband+1) :
+                Cb[d,:self.npar-d] = np.diagonal(C,-d)
+        Cb[0,~ok] = 0.
+        return Cb
+
+    def _unpack(self, x) :
+        if self.ncomp == 1 :
+            return x
+        return x.reshape(self.nwave,self.ncomp).T.copy()
+
+    def sandwich_diagonal(self, rdata, Cb) :
+        """Returns the diagonal of R.C_pq.R^T where C_pq is the block (p,q) of
+        the parameter covariance and R a resolution matrix
+
+        Args:
+            rdata : 2D[ndiag, nwave] resolution data (offsets from ndiag//2 to -ndiag//2),
+                    with ndiag <= ndiag of the data
+            Cb : output of covariance_band
+
+        Returns:
+            1D[nwave] if ncomp=1, 3D[ncomp,ncomp,nwave] otherwise
+        """
+        ndiag,nwave = rdata.shape
+        hw, nc, npar = ndiag//2, self.ncomp, self.npar
+        if hw > self.hw :
+            raise ValueError("resolution with {} diagonals is too wide for the covariance band".format(ndiag))
+
+        # zero-padded along parameter index
+        pad = nc*(2*hw+1)
+        rdata_pad = np.zeros((ndiag,nwave+2*hw))
+        rdata_pad[:,hw:hw+nwave] = rdata
+        Cb_pad = np.zeros((Cb.shape[0],npar+2*pad))
+        Cb_pad[:,pad:pad+npar] = Cb
+
+        # var_pq[w] = sum_o1 sum_o2 R[w,w+o1] C[(w+o1)*nc+p,(w+o2)*nc+q] R[w,w+o2]
+        # with R[w,w+o] = rdata[hw-o,w+o] and C[r,s] = Cb[|r-s|,min(r,s)]
+        var = np.zeros((nc,nc,nwave))
+        w = np.arange(nwave)
+        for o1 in range(-hw,hw+1) :
+            r1 = rdata_pad[hw-o1,hw+o1:hw+o1+nwave]
+            for o2 in range(-hw,hw+1) :
+                r2 = rdata_pad[hw-o2,hw+o2:hw+o2+nwave]
+                for p in range(nc) :
+                    for q in range(nc) :
+                        r = (w+o1)*nc+p
+                        s = (w+o2)*nc+q
+                        var[p,q] += r1*r2*Cb_pad[np.abs(r-s),pad+np.minimum(r,s)]
+        if nc == 1 :
+            return var[0,0]
+        return var
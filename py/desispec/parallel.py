@@ -279,6 +279,109 @@ def dist_discrete(worksizes, workers, workerid, power=1.0):
     return allworkers[workerid]
 
 
+#- environment variables enabling asynchronous progress of one-sided
+#- operations in MPICH / Cray MPICH and Intel MPI
+_async_progress_vars = ("MPICH_ASYNC_PROGRESS", "I_MPI_ASYNC_PROGRESS")
+
+
+def async_progress_enabled():
+    """Return True if the environment enables asynchronous MPI progress.
+    """
+    for var in _async_progress_vars:
+        if os.getenv(var, "0").strip().lower() in ("1", "yes", "true", "on",
+            "enable"):
+            return True
+    return False
+
+
+class TaskCounter(object):
+    """Shared counter handing out task indices to processes or process groups.
+
+    The counter lives in an MPI one-sided window on the root rank of the
+    communicator, and is incremented with an atomic fetch-and-add, so
+    there is no dedicated scheduler process.  This is a collective
+    operation over the communicator.
+
+    Without asynchronous progress (e.g. MPICH or Cray MPICH without
+    MPICH_ASYNC_PROGRESS=1), a fetch-and-add only completes when the root
+    rank enters the MPI library, which it does not do while it runs a long
+    task.  The root rank therefore polls MPI from a thread while the counter
+    is in use, which requires MPI_THREAD_MULTIPLE.  Otherwise a warning is
+    logged, and the root should preferably be a rank that does not run tasks.
+
+    Args:
+        comm (mpi4py.MPI.Comm): the communicator of all processes.
+        root (int): the rank hosting the counter.
+        poll (float): interval in seconds of the MPI polling on the root
+            rank, 0 to disable it.
+
+    """
+    def __init__(self, comm, root=0, poll=0.01):
+        import mpi4py.MPI as MPI
+        self._MPI = MPI
+        self._comm = comm
+        self._root = root
+        self._count = None
+        self._poll_comm = None
+        self._poll_stop = None
+        self._poll_thread = None
+        if comm.rank == root:
+            self._count = np.zeros(1, dtype=np.int64)
+            self._win = MPI.Win.Create(self._count, comm=comm)
+        else:
+            self._win = MPI.Win.Create(None, comm=comm)
+
+        threaded = (MPI.Query_thread() == MPI.THREAD_MULTIPLE)
+        poll = poll if (poll > 0 and threaded and comm.size > 1
+            and not async_progress_enabled()) else 0
+        if poll > 0:
+            #- collective, every rank has to take the same branch
+            self._poll_comm = comm.Dup()
+        if comm.rank == root:
+            if poll > 0:
+                import threading
+                self._poll_stop = threading.Event()
+                self._poll_thread = threading.Thread(target=self._progress,
+                    args=(poll,), daemon=True)
+                self._poll_thread.start()
+            elif comm.size > 1 and not async_progress_enabled():
+                log = get_logger()
+                log.warning("TaskCounter: MPI asynchronous progress is not "
+                    "enabled (set {}=1) and MPI is not initialized with "
+                    "MPI_THREAD_MULTIPLE, so taking the next task can wait "
+                    "for the tasks of rank {}".format(_async_progress_vars[0],
+                    root))
+
+    def _progress(self, poll):
+        """Enter the MPI library every poll seconds until the counter is freed,
+        so that the fetch-and-add of the other ranks can complete."""
+        while not self._poll_stop.wait(poll):
+            self._poll_comm.Iprobe(source=self._MPI.ANY_SOURCE,
+                tag=self._MPI.ANY_TAG)
+
+    def next(self):
+        """Return the current counter value and increment it by one.
+        """
+        one = np.ones(1, dtype=np.int64)
+        result = np.zeros(1, dtype=np.int64)
+        self._win.Lock(self._root, self._MPI.LOCK_SHARED)
+        self._win.Fetch_and_op(one, result, self._root, 0, self._MPI.SUM)
+        self._win.Unlock(self._root)
+        return int(result[0])
+
+    def free(self):
+        """Release the window.  This is a collective operation.
+        """
+        if self._poll_thread is not None:
+            self._poll_stop.set()
+            self._poll_thread.join()
+            self._poll_thread = None
+        self._win.Free()
+        if self._poll_comm is not None:
+            self._poll_comm.Free()
+            self._poll_comm = None
+
+
 @contextmanager
 def stdouterr_redirected(to=None, comm=None):
     """
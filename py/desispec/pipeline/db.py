@@ -12,6 +12,7 @@ Pipeline processing database
 from __future__ import absolute_import, division, print_function
 
 import os
+import time
 
 import re
 from collections import OrderedDict
@@ -372,11 +373,91 @@ def check_tasks(tasklist, db=None, inputs=None):
 class DataBase:
     """Class for tracking pipeline processing objects and state.
     """
+    # Placeholder of bound parameters in SQL commands.
+    _param = "?"
+
+    # Maximum number of task names passed as bound parameters in one
+    # selection (below the limit of old sqlite versions).
+    _bulk_names = 500
+
+    # Lock waits longer than this number of seconds count as blocked.
+    _lock_threshold = 0.01
+
     def __init__(self):
         self._conn = None
+        self._lockstats = OrderedDict([("ncursor", 0), ("nblocked", 0),
+            ("wait", 0.0), ("maxwait", 0.0)])
+        return
+
+
+    def _lock_wait(self, seconds):
+        """Record the time waited for a DB lock when opening a cursor.
+        """
+        st = self._lockstats
+        st["ncursor"] += 1
+        st["wait"] += seconds
+        st["maxwait"] = max(st["maxwait"], seconds)
+        if seconds > self._lock_threshold:
+            st["nblocked"] += 1
+            log = get_logger()
+            log.debug("waited {:.3f} s for the DB lock".format(seconds))
+        return
+
+
+    def lock_stats(self):
+        """Statistics of the waits for the DB lock in this process.
+
+        Returns:
+            OrderedDict: the number of cursors opened ("ncursor"), the
+                number of them which waited longer than 10 ms ("nblocked"),
+                and the total and maximum time waited in seconds ("wait",
+                "maxwait").  Only the sqlite backend records waits, which
+                include the time to open the connection.
+
+        """
+        return OrderedDict(self._lockstats)
+
+
+    def close(self):
+        """Release the resources kept between cursors, if any.
+        """
+        return
+
+
+    def _executemany(self, cur, cmd, rows):
+        """Execute a command with bound parameters for each row.
+        """
+        cur.executemany(cmd, rows)
         return
 
 
+    def _select_names(self, cur, table, cols, names):
+        """Select columns of the rows of a table matching a list of names.
+
+        The names are sorted, for locality of the index lookups, and passed
+        as bound parameters in selections of at most _bulk_names names.
+
+        Args:
+            cur (DB cursor): the cursor of an open connection.
+            table (str): the table.
+            cols (list): the columns to select.
+            names (list): the task names.
+
+        Returns:
+            list: the selected rows.
+
+        """
+        names = sorted(set(names))
+        rows = list()
+        for first in range(0, len(names), self._bulk_names):
+            chunk = names[first:first+self._bulk_names]
+            cmd = "select {} from {} where name in ({})".format(
+                ", ".join(cols), table, ", ".join([self._param]*len(chunk)))
+            cur.execute(cmd, chunk)
+            rows.extend(cur.fetchall())
+        return rows
+
+
     def get_states_type(self, tasktype, tasks):
         """Efficiently get the state of many tasks of a single type.
 
@@ -389,17 +470,13 @@ class DataBase:
 
         """
         states = None
-        namelist = ",".join([ "'{}'".format(x) for x in tasks ])
 
         log = get_logger()
         log.debug("opening db")
 
         with self.cursor() as cur:
             log.debug("selecting in db")
-            cur.execute(\
-                'select name, state from {} where name in ({})'.format(tasktype,
-                namelist))
-            st = cur.fetchall()
+            st = self._select_names(cur, tasktype, ["name", "state"], tasks)
             log.debug("done")
             states = { x[0] : task_int_to_state[x[1]] for x in st }
         return states
@@ -468,10 +545,16 @@ class DataBase:
 
         with self.cursor() as cur:
             log.debug("updating in db")
-            for tsk in tasks:
-                cur.execute("update {} set state = {} where name = '{}'".format(tasktype, task_state_to_int[tsk[1]], tsk[0]))
-                if postprocessing and tsk[1]=="done" :
-                    task_classes[tasktype].postprocessing(db=self,name=tsk[0],cur=cur)
+            # sorting by name gives local index lookups, the stable sort
+            # keeps the last state of duplicated tasks
+            self._executemany(cur, "update {} set state = {} where name = {}"\
+                .format(tasktype, self._param, self._param),
+                sorted([ (task_state_to_int[x[1]], x[0]) for x in tasks ],
+                key=lambda x: x[1]))
+            if postprocessing:
+                for tsk in tasks:
+                    if tsk[1]=="done" :
+                        task_classes[tasktype].postprocessing(db=self,name=tsk[0],cur=cur)
             log.debug("done")
         return
 
@@ -527,11 +610,8 @@ class DataBase:
         for t, tlist in taskbytype.items():
             if (t == "spectra") or (t == "redshift"):
                 raise RuntimeError("spectra and redshift tasks do not have submitted flag.")
-            namelist = ",".join([ "'{}'".format(x) for x in tlist ])
             with self.cursor() as cur:
-                cur.execute(\
-                    'select name, submitted from {} where name in ({})'.format(t, namelist))
-                sb = cur.fetchall()
+                sb = self._select_names(cur, t, ["name", "submitted"], tlist)
                 submitted.update({ x[0] : x[1] for x in sb })
         return submitted
 
@@ -553,8 +633,8 @@ class DataBase:
         if unset:
             val = 0
         with self.cursor() as cur:
-            for tsk in tasks:
-                cur.execute("update {} set submitted = {} where name = '{}'".format(tasktype, val, tsk))
+            self._executemany(cur, "update {} set submitted = {} where name = {}"\
+                .format(tasktype, val, self._param), [ (x,) for x in sorted(tasks) ])
         return
 
 
@@ -578,7 +658,7 @@ class DataBase:
         for t, tlist in taskbytype.items():
             if (t == "spectra") or (t == "redshift"):
                 raise RuntimeError("spectra and redshift tasks do not have submitted flag.")
-            self.set_submitted_type(tlist, unset=unset)
+            self.set_submitted_type(t, tlist, unset=unset)
         return
 
 
@@ -604,20 +684,24 @@ class DataBase:
         with self.cursor() as cur:
             # insert or ignore all healpix_frames
             log.debug("updating healpix_frame ...")
+            cur.execute("select expid, spec, nside, pixel from healpix_frame where night = {}".format(self._param), (int(night),))
+            have_rows = set(cur.fetchall())
+            newrows = list()
             for entry in healpix_frames:
-                # see if we already have this entry
-                cmd = "select exists(select 1 from healpix_frame where (expid = {} and spec = {} and nside = {} and pixel = {} ))".format(entry["expid"], entry["spec"], entry["nside"], entry["pixel"])
-                cur.execute(cmd)
-                have_row = cur.fetchone()[0]
-
-                if not have_row:
-                    cur.execute("insert into healpix_frame (night,expid,spec,nside,pixel,ntargets,state) values({},{},{},{},{},{},{})".format(entry["night"],entry["expid"],entry["spec"],entry["nside"],entry["pixel"],entry["ntargets"],0))
+                key = (entry["expid"], entry["spec"], entry["nside"],
+                    entry["pixel"])
+                if key not in have_rows:
+                    have_rows.add(key)
+                    newrows.append((entry["night"], entry["expid"],
+                        entry["spec"], entry["nside"], entry["pixel"],
+                        entry["ntargets"], 0))
+            self._executemany(cur, "insert into healpix_frame (night,expid,spec,nside,pixel,ntargets,state) values({})".format(", ".join([self._param]*7)), newrows)
 
             # read what is already in db
             tasks_in_db = {}
             for tt in all_task_types():
                 cur.execute("select name from {}".format(tt))
-                tasks_in_db[tt] = [ x for (x, ) in cur.fetchall()]
+                tasks_in_db[tt] = set([ x for (x, ) in cur.fetchall()])
 
             for tt in all_task_types():
                 log.debug("updating {} ...".format(tt))
@@ -944,6 +1028,34 @@ class DataBase:
         return res
 
 
+    def select_healpix_sizes(self, state=None):
+        """Number of frames and of targets of every healpix pixel.
+
+        All pixels are counted with a single query, to estimate the size of
+        many spectra or redshift tasks at once.
+
+        Args:
+            state (int): optional state of the healpix_frame entries to count.
+
+        Returns:
+            dict: (nside, pixel) -> (number of frames, number of targets).
+
+        """
+        cmd = "select nside, pixel, count(*), sum(ntargets) from healpix_frame"
+        params = list()
+        if state is not None:
+            cmd += " where state = {}".format(self._param)
+            params.append(int(state))
+        cmd += " group by nside, pixel"
+        with self.cursor() as cur:
+            if len(params) > 0:
+                cur.execute(cmd, tuple(params))
+            else:
+                cur.execute(cmd)
+            entries = cur.fetchall()
+        return { (x[0], x[1]) : (x[2], x[3]) for x in entries }
+
+
     def create_healpix_frame_table(self) :
         with self.cursor() as cur:
             cmd = "create table healpix_frame (night integer, expid integer, spec integer, nside integer, pixel integer, ntargets integer, state integer, unique(expid, spec, nside, pixel))"
@@ -952,6 +1064,89 @@ class DataBase:
         return
 
 
+    def create_indexes(self):
+        """Create the indexes on the columns used to select tasks.
+
+        The task tables are indexed on state, night and submitted, the
+        healpix_frame table on state and pixel.  Existing indexes are kept.
+
+        """
+        from .tasks.base import task_classes
+        with self.cursor() as cur:
+            for tt, tc in task_classes.items():
+                cols = [ x for x in ["state", "night"] if x in tc._cols ]
+                if tt not in ["spectra", "redshift"]:
+                    cols.append("submitted")
+                for col in cols:
+                    cur.execute("create index if not exists {}_{}_idx on {} ({})".format(tt, col, tt, col))
+            cur.execute("create index if not exists healpix_frame_state_idx on healpix_frame (state)")
+            cur.execute("create index if not exists healpix_frame_pixel_idx on healpix_frame (nside, pixel)")
+        return
+
+
+    def create_task_time_table(self, cur=None) :
+        """Create the table of measured task run times, if it does not exist.
+
+        Args:
+            cur (DB cursor): optional cursor of an open connection.
+
+        """
+        cmd = "create table if not exists task_time (name text, tasktype text, nproc integer, wall real, size real, stop real)"
+        if cur is None :
+            with self.cursor() as cur:
+                cur.execute(cmd)
+        else :
+            cur.execute(cmd)
+        return
+
+
+    def insert_task_time(self, name, tasktype, nproc, wall, size=None):
+        """Record the measured run time of a finished task.
+
+        Args:
+            name (str): the task name.
+            tasktype (str): the task type.
+            nproc (int): the number of processes used by the task.
+            wall (float): the wall clock time in seconds.
+            size (float): optional input size of the task (see
+                BaseTask.run_size).
+
+        """
+        if size is not None :
+            size = float(size)
+        with self.cursor() as cur:
+            cur.execute("insert into task_time values ({})".format(", ".join([self._param]*6)),
+                (name, tasktype, int(nproc), float(wall), size, time.time()))
+        return
+
+
+    def select_task_time(self, tasktype):
+        """Get the measured run times of a task type.
+
+        Args:
+            tasktype (str): the task type.
+
+        Returns:
+            list: (nproc, wall, size) of each recorded run, with size None if
+                not known.  Empty if the production has no task_time table
+                (created by initdb).
+
+        """
+        res = []
+        with self.cursor() as cur:
+            if not self._has_table(cur, "task_time") :
+                return res
+            cur.execute("select nproc, wall, size from task_time where tasktype = {}".format(self._param), (tasktype,))
+            res = [ (x[0], x[1], x[2]) for x in cur.fetchall() ]
+        return res
+
+
+    def _has_table(self, cur, table):
+        """True if the table exists in the database."""
+        cur.execute("select count(*) from sqlite_master where type='table' and name = ?", (table,))
+        return cur.fetchone()[0] > 0
+
+
 class DataBaseSqlite(DataBase):
     """Pipeline database using sqlite3 as the backend.
 
@@ -960,13 +1155,34 @@ class DataBaseSqlite(DataBase):
             a temporary database is created in memory.
         mode (str): if "r", the database is open in read-only mode.  If "w",
             the database is open in read-write mode and created if necessary.
+        persistent (bool): if True, keep one connection open per process and
+            reuse it for all cursors, instead of opening and closing a
+            connection for each cursor.  Call close() when done.
+        journalmode (str): the sqlite journal mode set in read-write mode
+            ("persist" by default).  "wal" lets readers proceed while a
+            writer is active, but requires all processes to run on hosts
+            sharing memory with the filesystem locks (not e.g. Lustre).
+        shadowdir (str): in read-only mode, read from a copy of the database
+            in this (local disk) directory, refreshed when the database is
+            modified, so that polling does not take locks on the shared
+            database.
 
     """
-    def __init__(self, path, mode):
+    def __init__(self, path, mode, persistent=False, journalmode=None,
+        shadowdir=None):
         super(DataBaseSqlite, self).__init__()
 
         self._path = path
         self._mode = mode
+        self._persistent = persistent
+        self._pid = None
+
+        self._shadowdir = None
+        if (shadowdir is not None) and (self._mode == "r") \
+            and (self._path is not None):
+            self._shadowdir = shadowdir
+        self._shadow = None
+        self._shadowtime = None
 
         create = True
         if (self._path is not None) and os.path.exists(self._path):
@@ -983,6 +1199,8 @@ class DataBaseSqlite(DataBase):
 
         # Journaling options
         self._journalmode = "persist"
+        if journalmode is not None:
+            self._journalmode = journalmode
         self._syncmode = "normal"
 
         if create:
@@ -990,12 +1208,64 @@ class DataBaseSqlite(DataBase):
         return
 
 
+    def _update_shadow(self):
+        """Refresh the local copy of the DB if the DB was modified.
+
+        Returns:
+            bool: True if the copy was refreshed.
+
+        """
+        import sqlite3
+        mtime = os.path.getmtime(self._path)
+        if os.path.exists(self._path + "-wal"):
+            mtime = max(mtime, os.path.getmtime(self._path + "-wal"))
+        if (self._shadow is not None) and (mtime == self._shadowtime):
+            return False
+
+        if self._shadow is None:
+            self._shadow = os.path.join(self._shadowdir, "{}_{}".format(
+                os.getpid(), os.path.basename(self._path)))
+        # The backup API gives a consistent copy, including the content of
+        # the WAL file.
+        tmpfile = self._shadow + ".tmp"
+        src = sqlite3.connect('file:{}?mode=ro'.format(self._path), uri=True,
+            timeout=self._busytime)
+        dst = sqlite3.connect(tmpfile)
+        src.backup(dst)
+        # the copy is only read, it does not need a WAL file
+        dst.execute("pragma journal_mode=delete")
+        dst.close()
+        src.close()
+        os.rename(tmpfile, self._shadow)
+        self._shadowtime = mtime
+        log = get_logger()
+        log.debug("updated copy {} of {}".format(self._shadow, self._path))
+        return True
+
+
     def _open(self):
         import sqlite3
 
+        if (self._conn is not None) and (self._pid != os.getpid()):
+            # A connection inherited from the parent process must not be used
+            self._conn = None
+
+        if self._shadowdir is not None:
+            if self._update_shadow() and (self._conn is not None):
+                self._conn.close()
+                self._conn = None
+
+        if self._conn is not None:
+            # Reuse the persistent connection
+            return
+
+        self._pid = os.getpid()
         if self._path is None:
             # We are opening an in-memory DB
             self._conn = sqlite3.connect(":memory:")
+        elif self._shadowdir is not None:
+            self._conn = sqlite3.connect('file:{}?mode=ro'.format(
+                self._shadow), uri=True, timeout=self._busytime)
         else:
             try:
                 # only python3 supports uri option
@@ -1020,17 +1290,38 @@ class DataBaseSqlite(DataBase):
 
 
     def _close(self):
+        if self._persistent:
+            return
         del self._conn
         self._conn = None
         return
 
 
+    def close(self):
+        """Close the persistent connection, if any.
+        """
+        if (self._conn is not None) and (self._pid == os.getpid()):
+            self._conn.close()
+        self._conn = None
+        if (self._shadow is not None) and os.path.exists(self._shadow):
+            os.remove(self._shadow)
+            self._shadow = None
+        return
+
+
     @contextmanager
     def cursor(self):
         import sqlite3
+        # Opening the connection (which sets the journal mode) and reading
+        # the schema version take the shared lock, this measures how long
+        # we are blocked by writers.
+        start = time.time()
         self._open()
         cur = self._conn.cursor()
         cur.execute("begin transaction")
+        cur.execute("pragma schema_version")
+        cur.fetchall()
+        self._lock_wait(time.time() - start)
         try:
             yield cur
         except sqlite3.DatabaseError as err:
@@ -1066,6 +1357,11 @@ class DataBaseSqlite(DataBase):
 
         if "healpix_frame" not in tables_in_db:
             self.create_healpix_frame_table()
+
+        if "task_time" not in tables_in_db:
+            self.create_task_time_table()
+
+        self.create_indexes()
         return
 
 
@@ -1086,6 +1382,8 @@ class DataBasePostgres(DataBase):
             additional roles that should be granted access.
 
     """
+    _param = "%s"
+
     def __init__(self, host, port, dbname, user, schema=None, authorize=None):
         super(DataBasePostgres, self).__init__()
 
@@ -1108,6 +1406,15 @@ class DataBasePostgres(DataBase):
         return
 
 
+    def _executemany(self, cur, cmd, rows):
+        """Execute a command for each row, in pages of many rows per server
+        round trip.
+        """
+        from psycopg2.extras import execute_batch
+        execute_batch(cur, cmd, rows, page_size=1000)
+        return
+
+
     def _compute_schema(self):
         import hashlib
         md = hashlib.md5()
@@ -1161,6 +1468,11 @@ class DataBasePostgres(DataBase):
         return cur.fetchone()[0]
 
 
+    def _has_table(self, cur, table):
+        cur.execute("select exists(select 1 from pg_tables where schemaname = %s and tablename = %s)", (self._schema, table))
+        return cur.fetchone()[0]
+
+
     @contextmanager
     def cursor(self, skipcheck=False):
         import psycopg2
@@ -1260,10 +1572,16 @@ class DataBasePostgres(DataBase):
         if "healpix_frame" not in tables_in_db:
             self.create_healpix_frame_table()
 
+        if "task_time" not in tables_in_db:
+            self.create_task_time_table()
+
+        self.create_indexes()
+
         return
 
 
-def load_db(dbstring, mode="w", user=None):
+def load_db(dbstring, mode="w", user=None, persistent=False, journalmode=None,
+    shadowdir=None):
     """Load a database from a connection string.
 
     This instantiates either an sqlite or postgresql database using a string.
@@ -1280,6 +1598,11 @@ def load_db(dbstring, mode="w", user=None):
         mode (str): for sqlite, the mode.
         user (str): for postgresql, an alternate user name for opening the DB.
             This can be used to connect as a user with read-only access.
+        persistent (bool): for sqlite, keep the connection open between
+            cursors (see DataBaseSqlite).
+        journalmode (str): for sqlite, the journal mode in read-write mode.
+        shadowdir (str): for sqlite, the directory of the local copy of the
+            DB in read-only mode.
 
     Returns:
         DataBase: a derived database class of the appropriate type.
@@ -1301,4 +1624,5 @@ def load_db(dbstring, mode="w", user=None):
         return DataBasePostgres(host=host, port=port, dbname=dbname,
             user=username, schema=schema)
     else:
-        return DataBaseSqlite(dbstring, mode)
+        return DataBaseSqlite(dbstring, mode, persistent=persistent,
+            journalmode=journalmode, shadowdir=shadowdir)
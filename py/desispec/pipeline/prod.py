@@ -232,6 +232,11 @@ def update_prod(nightstr=None, hpxnside=64, expid=None):
     dbpath = io.get_pipe_database()
     db = load_db(dbpath, "w")
 
+    # Productions created before the indexes and the task_time table existed
+    # get them here.
+    db.create_indexes()
+    db.create_task_time_table()
+
     # Get list of available nights
 
     allnights = []
@@ -293,7 +298,7 @@ def update_prod(nightstr=None, hpxnside=64, expid=None):
     return
 
 
-def load_prod(mode="w", user=None):
+def load_prod(mode="w", user=None, **dbopts):
     """Load the database and options for a production.
 
     This loads the database from the production location defined by the usual
@@ -304,6 +309,8 @@ def load_prod(mode="w", user=None):
         mode (str): open mode for sqlite database ("r" or "w").
         user (str): for postgresql, an alternate user name for opening the DB.
             This can be used to connect as a user with read-only access.
+        dbopts: other options of load_db (persistent, journalmode,
+            shadowdir).
 
     Returns:
         tuple: (pipeline.db.DataBase, dict) The database for the production
@@ -311,7 +318,7 @@ def load_prod(mode="w", user=None):
 
     """
     dbpath = io.get_pipe_database()
-    db = load_db(dbpath, mode=mode, user=user)
+    db = load_db(dbpath, mode=mode, user=user, **dbopts)
 
     rundir = io.get_pipe_rundir()
     optfile = os.path.join(rundir, prod_options_name)
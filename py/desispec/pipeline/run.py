@@ -13,6 +13,7 @@ from __future__ import absolute_import, division, print_function
 
 import os
 import sys
+import time
 
 import numpy as np
 
@@ -20,8 +21,10 @@ from desiutil.log import get_logger
 
 from .. import io
 
+from .. import calibcache
+
 from ..parallel import (dist_uniform, dist_discrete, dist_discrete_all,
-    stdouterr_redirected, use_mpi)
+    stdouterr_redirected, use_mpi, TaskCounter)
 
 from .prod import load_prod
 
@@ -106,7 +109,55 @@ def run_task_simple(name, opts, comm=None):
     return run_task(name, opts, comm=comm, logfile=None, db=None)
 
 
-def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
+def _task_logfile(name, logdir):
+    """Return the output log file of a task.
+
+    If the task has the "night" key in its name, then use that subdirectory.
+    Otherwise, if it has the "pixel" key, use the appropriate subdirectory.
+
+    Args:
+        name (str): the name of the task.
+        logdir (str): the top level log directory.
+
+    Returns:
+        str: the log file, or None if the task has neither key.
+
+    """
+    from .tasks.base import task_classes, task_type
+
+    tt = task_type(name)
+    fields = task_classes[tt].name_split(name)
+
+    tasklog = None
+    if "night" in fields:
+        tasklogdir = os.path.join(logdir, io.get_pipe_nightdir(),
+                                  "{:08d}".format(fields["night"]))
+        # (this directory should have been made during the prod update)
+        tasklog = os.path.join(tasklogdir,
+            "{}.log".format(name))
+    elif "pixel" in fields:
+        tasklogdir = os.path.join(logdir, "healpix",
+            io.healpix_subdirectory(fields["nside"],fields["pixel"]))
+        # When creating this directory, there MIGHT be conflicts from
+        # multiple processes working on pixels in the same
+        # sub-directories...
+        try :
+            if not os.path.isdir(os.path.dirname(tasklogdir)):
+                os.makedirs(os.path.dirname(tasklogdir))
+        except FileExistsError:
+            pass
+        try :
+            if not os.path.isdir(tasklogdir):
+                os.makedirs(tasklogdir)
+        except FileExistsError:
+            pass
+        tasklog = os.path.join(tasklogdir,
+            "{}.log".format(name))
+    return tasklog
+
+
+def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False,
+    dynamic=False):
     """Run a collection of tasks of the same type.
 
     This function requires that the DESI environment variables are set to
@@ -118,6 +169,12 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
     run time estimates to assign tasks to the process groups.  Each process
     group loops over its assigned tasks.
 
+    In dynamic mode, tasks are instead sorted by decreasing run time
+    estimate, and each process group takes the next task from a shared
+    counter as soon as it is done with the previous one, so that wrong
+    estimates do not leave groups idle while others work through a long
+    tail.  The busy fraction of each group is logged in both modes.
+
     If the database is not specified, no state tracking will be done and the
     filesystem will be checked as needed to determine the current state.
 
@@ -134,6 +191,9 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
         db (pipeline.db.DB): The optional database to update.
         force (bool): If True, ignore database and filesystem state and just
             run the tasks regardless.
+        dynamic (bool): If True and there is more than one process group,
+            distribute tasks dynamically rather than with a static
+            assignment.
 
     Returns:
         tuple: the number of ready tasks, and the number that failed.
@@ -191,8 +251,8 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
 
     weights = None
     if rank == 0:
-        weights = [ task_classes[tasktype].run_time(x, procs_per_node, db=db) \
-            for x in runtasks ]
+        weights = task_classes[tasktype].run_times(runtasks, procs_per_node,
+            db=db)
     if comm is not None:
         weights = comm.bcast(weights, root=0)
 
@@ -221,80 +281,134 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
             comm_group = None
             comm_rank = comm
 
-    # Now we divide up the tasks among the groups of processes as
-    # equally as possible.
-
-    group_ntask = 0
-    group_firsttask = 0
-
-    if group < ngroup:
-        # only assign tasks to whole groups
-        if ntask < ngroup:
-            if group < ntask:
-                group_ntask = 1
-                group_firsttask = group
-            else:
-                group_ntask = 0
-        else:
-            if ntask <= ngroup:
-                # distribute uniform in this case
-                group_firsttask, group_ntask = dist_uniform(ntask, ngroup,
-                    group)
-            else:
-                group_firsttask, group_ntask = dist_discrete(weights, ngroup,
-                    group)
-
-    # every group goes and does its tasks...
-
     rundir = io.get_pipe_rundir()
     logdir = os.path.join(rundir, io.get_pipe_logdir())
 
+    # Each process preprocesses several exposures, so keep the calibration
+    # images in memory until the end of the task list.
+    if tasktype == "preproc":
+        calibcache.enable()
+
     failcount = 0
     group_failcount = 0
+    group_ndone = 0
+    group_busy = 0.0
+    tstart = time.time()
+
+    def run_one(name):
+        # Run one task on this group, and update the group statistics.
+        nonlocal group_failcount, group_ndone, group_busy
+        tasklog = _task_logfile(name, logdir)
+        t0 = time.time()
+        failedprocs = run_task(name, options, comm=comm_group,
+            logfile=tasklog, db=db)
+        group_busy += time.time() - t0
+        group_ndone += 1
+        if failedprocs > 1:
+            group_failcount += 1
+
+    dynamic = dynamic and (comm is not None) and (ngroup > 1)
+
+    if dynamic:
+        # Every group takes the next task, ordered by decreasing run time
+        # estimate, from a counter shared by all groups.
+
+        order = np.argsort(-np.array(weights, dtype=np.float64),
+            kind="stable")
+        # Host the counter on a rank left out of the groups if there is one,
+        # since it never runs a task.
+        counter_root = 0
+        if ngroup * taskproc < nproc:
+            counter_root = ngroup * taskproc
+        counter = TaskCounter(comm, root=counter_root)
+
+        if group < ngroup:
+            while True:
+                t = None
+                if group_rank == 0:
+                    t = counter.next()
+                if comm_group is not None:
+                    t = comm_group.bcast(t, root=0)
+                if t >= ntask:
+                    break
+                log.debug("rank #{} Group {} dynamic task {}".format(rank,
+                    group, runtasks[order[t]]))
+                run_one(runtasks[order[t]])
+
+        counter.free()
 
-    if group_ntask > 0:
+    else:
+        # Now we divide up the tasks among the groups of processes as
+        # equally as possible.
+
+        group_ntask = 0
+        group_firsttask = 0
+
+        if group < ngroup:
+            # only assign tasks to whole groups
+            if ntask < ngroup:
+                if group < ntask:
+                    group_ntask = 1
+                    group_firsttask = group
+                else:
+                    group_ntask = 0
+            else:
+                if ntask <= ngroup:
+                    # distribute uniform in this case
+                    group_firsttask, group_ntask = dist_uniform(ntask, ngroup,
+                        group)
+                else:
+                    group_firsttask, group_ntask = dist_discrete(weights, ngroup,
+                        group)
 
-        log.debug("rank #{} Group number of task {}, first task {}".format(rank,group_ntask,group_firsttask))
+        # every group goes and does its tasks...
 
-        for t in range(group_firsttask, group_firsttask + group_ntask):
-            # For this task, determine the output log file.  If the task has
-            # the "night" key in its name, then use that subdirectory.
-            # Otherwise, if it has the "pixel" key, use the appropriate
-            # subdirectory.
-            tt = task_type(runtasks[t])
-            fields = task_classes[tt].name_split(runtasks[t])
+        if group_ntask > 0:
 
-            tasklog = None
-            if "night" in fields:
-                tasklogdir = os.path.join(logdir, io.get_pipe_nightdir(),
-                                          "{:08d}".format(fields["night"]))
-                # (this directory should have been made during the prod update)
-                tasklog = os.path.join(tasklogdir,
-                    "{}.log".format(runtasks[t]))
-            elif "pixel" in fields:
-                tasklogdir = os.path.join(logdir, "healpix",
-                    io.healpix_subdirectory(fields["nside"],fields["pixel"]))
-                # When creating this directory, there MIGHT be conflicts from
-                # multiple processes working on pixels in the same
-                # sub-directories...
-                try :
-                    if not os.path.isdir(os.path.dirname(tasklogdir)):
-                        os.makedirs(os.path.dirname(tasklogdir))
-                except FileExistsError:
-                    pass
-                try :
-                    if not os.path.isdir(tasklogdir):
-                        os.makedirs(tasklogdir)
-                except FileExistsError:
-                    pass
-                tasklog = os.path.join(tasklogdir,
-                    "{}.log".format(runtasks[t]))
+            log.debug("rank #{} Group number of task {}, first task {}".format(rank,group_ntask,group_firsttask))
 
-            failedprocs = run_task(runtasks[t], options, comm=comm_group,
-                logfile=tasklog, db=db)
+            for t in range(group_firsttask, group_firsttask + group_ntask):
+                run_one(runtasks[t])
 
-            if failedprocs > 1:
-                group_failcount += 1
+    group_elapsed = time.time() - tstart
+
+    if tasktype == "preproc":
+        calibcache.release()
+
+    # Report the utilization of each process group.
+
+    stats = [(group, group_rank, group_ndone, group_busy, group_elapsed)]
+    if comm is not None:
+        stats = comm.gather(stats[0], root=0)
+    if rank == 0:
+        stats = [ x for x in stats if (x[1] == 0) and (x[0] < ngroup) ]
+        wall = max([ x[4] for x in stats ])
+        util = list()
+        for (g, grank, gndone, gbusy, gelapsed) in stats:
+            gutil = gbusy / wall if wall > 0 else 1.0
+            util.append(gutil)
+            log.debug("{} group {}: {} tasks, busy {:.1f} s of {:.1f} s ({:.1f}%)"\
+                .format(tasktype, g, gndone, gbusy, wall, 100*gutil))
+        log.info("{} {} scheduling of {} tasks on {} groups: {:.1f} s, "
+            "group utilization mean {:.1f}% min {:.1f}% max {:.1f}%".format(
+            tasktype, ("dynamic" if dynamic else "static"), ntask,
+            len(stats), wall, 100*np.mean(util), 100*np.min(util),
+            100*np.max(util)))
+
+    # Report how often the processes were blocked on the DB lock.
+
+    if db is not None:
+        lstats = [ db.lock_stats() ]
+        if comm is not None:
+            lstats = comm.gather(lstats[0], root=0)
+        if rank == 0:
+            ncursor = np.sum([ x["ncursor"] for x in lstats ])
+            if ncursor > 0:
+                log.info("{} DB lock: {} of {} cursors blocked, waited {:.1f} s "
+                    "in total, {:.1f} s at most".format(tasktype,
+                    np.sum([ x["nblocked"] for x in lstats ]), ncursor,
+                    np.sum([ x["wait"] for x in lstats ]),
+                    np.max([ x["maxwait"] for x in lstats ])))
 
     failcount = group_failcount
 
@@ -328,7 +442,7 @@ def run_task_list(tasktype, tasklist, opts, comm=None, db=None, force=False):
     return ntask, ndone, failcount
 
 
-def run_task_list_db(tasktype, tasklist, comm=None):
+def run_task_list_db(tasktype, tasklist, comm=None, dynamic=False):
     """Run a list of tasks using the pipeline DB and options.
 
     This is a wrapper around run_task_list which uses the production database
@@ -339,13 +453,15 @@ def run_task_list_db(tasktype, tasklist, comm=None):
         tasklist (list): the list of tasks.  All tasks should be of type
             "tasktype" above.
         comm (mpi4py.Comm): the full communicator to use for whole set of tasks.
+        dynamic (bool): distribute tasks dynamically, see run_task_list.
 
     Returns:
         tuple: the number of ready tasks, and the number that failed.
 
     """
     (db, opts) = load_prod("w")
-    return run_task_list(tasktype, tasklist, opts, comm=comm, db=db)
+    return run_task_list(tasktype, tasklist, opts, comm=comm, db=db,
+        dynamic=dynamic)
 
 
 def dry_run(tasktype, tasklist, opts, procs, procs_per_node, db=None,
@@ -417,8 +533,7 @@ def dry_run(tasktype, tasklist, opts, procs, procs_per_node, db=None,
 
     # Get the weights for each task.
 
-    weights = [ task_classes[tasktype].run_time(x, procs_per_node, db=db) \
-            for x in runtasks ]
+    weights = task_classes[tasktype].run_times(runtasks, procs_per_node, db=db)
 
     # Get the max number of processes for this task type
 
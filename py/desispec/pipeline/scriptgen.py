@@ -356,8 +356,8 @@ def nersc_job_size(tasktype, tasklist, machine, queue, maxtime, maxnodes,
     taskproc = task_classes[tasktype].run_max_procs(nodeprocs)
 
     # Run times for each task at this concurrency
-    tasktimes = [ (x, task_classes[tasktype].run_time(x, nodeprocs,
-        db=db)) for x in tasklist ]
+    tasktimes = list(zip(tasklist, task_classes[tasktype].run_times(tasklist,
+        nodeprocs, db=db)))
 
     # We want to sort the times so that we can use a simple algorithm.
     tasktimes = list(sorted(tasktimes, key=lambda x: x[1]))[::-1]
@@ -398,8 +398,73 @@ class BaseTask(object):
         Returns:
             int: estimated minutes of run time.
 
+        If the database has enough recorded run times for this task type,
+        the estimate comes from the model learned on them (see
+        pipeline.timing), otherwise from the static guess of the task type.
+        Use run_times for many tasks.
+
+        """
+        return self.run_times([name], procs_per_node, db=db)[0]
+
+
+    def run_times(self, names, procs_per_node, db=None):
+        """Estimated runtimes for several tasks at maximum concurrency.
+
+        Same as run_time for each task, but the input sizes used by the
+        learned model are fetched from the database at once.
+
+        Args:
+            names (list): the names of the tasks.
+            procs_per_node (int): the number of processes running per node.
+            db (pipeline.DB): the optional database instance.
+
+        Returns:
+            list: estimated minutes (int) of run time of each task.
+
+        """
+        if db is not None:
+            from ..timing import learned_run_times
+            tm = learned_run_times(self, names, procs_per_node, db)
+            if tm is not None:
+                return tm
+        return [ self._run_time(x, procs_per_node, db) for x in names ]
+
+
+    def _run_size(self, name, db):
+        return None
+
+
+    def _run_sizes(self, names, db):
+        return [ self._run_size(x, db) for x in names ]
+
+
+    def run_size(self, name, db=None):
+        """Input size of a task, used to scale its run time.
+
+        Args:
+            name (str): the name of the task.
+            db (pipeline.DB): the optional database instance.
+
+        Returns:
+            float: the input size in units specific to the task type, or
+                None if not known.
+
         """
-        return self._run_time(name, procs_per_node, db)
+        return self._run_size(name, db)
+
+
+    def run_sizes(self, names, db=None):
+        """Input sizes of several tasks, see run_size.
+
+        Args:
+            names (list): the names of the tasks.
+            db (pipeline.DB): the optional database instance.
+
+        Returns:
+            list: the input size of each task, None if not known.
+
+        """
+        return self._run_sizes(names, db)
 
 
     def _run_defaults(self):
@@ -537,6 +602,19 @@ class BaseTask(object):
 
 
 
+    def _record_time(self, db, name, nproc, wall):
+        """Record the run time of a task in the DB, for the run time model.
+        """
+        try:
+            db.insert_task_time(name, self._type, nproc, wall,
+                self.run_size(name, db))
+        except Exception as err:
+            log = get_logger()
+            log.warning("could not record run time of {}: {}".format(name,
+                err))
+        return
+
+
     def run_and_update(self, db, name, opts, comm=None):
         """Run the task and update DB state.
 
@@ -559,7 +637,9 @@ class BaseTask(object):
             nproc = comm.size
             rank = comm.rank
 
+        start = time.time()
         failed = self.run(name, opts, comm=comm, db=db)
+        wall = time.time() - start
 
         if rank == 0:
             if failed > 0:
@@ -575,6 +655,7 @@ class BaseTask(object):
                 if done:
                     self.state_set(db, name, "done")
                     # post processing is now done by a single rank in run.run_task_list
+                    self._record_time(db, name, nproc, wall)
                 else:
                     self.state_set(db, name, "failed")
         return failed
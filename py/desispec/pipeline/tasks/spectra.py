@@ -57,11 +57,26 @@ class TaskSpectra(BaseTask):
     def run_max_procs(self, procs_per_node):
         return 1
 
-    def run_time(self, name, procs_per_node, db=None):
+    def _run_time(self, name, procs_per_node, db=None):
         """See BaseTask.run_time.
         """
         return 15 # in general faster but convergence slower for some realizations
 
+    def _run_size(self, name, db):
+        """See BaseTask.run_size.
+        """
+        return self._run_sizes([name], db)[0]
+
+    def _run_sizes(self, names, db):
+        """See BaseTask.run_sizes.
+        """
+        if db is None :
+            return [ None for x in names ]
+        # number of new frames read for each pixel
+        sizes = db.select_healpix_sizes(state=1)
+        props = [ self.name_split(x) for x in names ]
+        return [ sizes.get((x["nside"], x["pixel"]), (0, 0))[0] for x in props ]
+
     def _run_defaults(self):
         """See BaseTask.run_defaults.
         """
@@ -0,0 +1,184 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+desispec.pipeline.timing
+========================
+
+Run time model of pipeline tasks, learned from the run times recorded in the
+task_time table of the production database.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import time
+
+import numpy as np
+
+from desiutil.log import get_logger
+
+
+class RunTimeModel(object):
+    """Model of the run time of one task type.
+
+    The model assumes that a task scales perfectly with the number of
+    processes, so the fitted quantity is the cost in process-minutes
+    (wall time times number of processes).  If the recorded runs have an
+    input size (see BaseTask.run_size) with some spread, the cost is a
+    linear function of the size, otherwise it is the median cost.
+
+    Args:
+        nproc (array): number of processes of each recorded run.
+        wall (array): wall clock time in seconds of each recorded run.
+        size (array): optional input size of each recorded run, NaN if
+            not known.
+        min_tasks (int): minimum number of runs with a known size needed to
+            fit the dependence on size.
+
+    """
+    def __init__(self, nproc, wall, size=None, min_tasks=5):
+        nproc = np.asarray(nproc, dtype=np.float64)
+        wall = np.asarray(wall, dtype=np.float64)
+        if size is None :
+            size = np.nan*np.ones(nproc.size)
+        size = np.asarray(size, dtype=np.float64)
+        if nproc.size == 0 :
+            raise ValueError("no recorded run time")
+
+        cost = wall*np.maximum(nproc, 1)/60.
+        self.ntasks = cost.size
+        self.median = np.median(cost)
+        self.slope = 0.
+        self.offset = self.median
+
+        ok = np.isfinite(size)
+        if np.sum(ok) >= min_tasks and np.std(size[ok]) > 0 :
+            self.slope, self.offset = np.polyfit(size[ok], cost[ok], 1)
+            # a negative slope is noise, fall back to the median
+            if self.slope < 0 :
+                self.slope, self.offset = 0., self.median
+
+        # never predict less than the cheapest recorded run
+        self.min_cost = np.min(cost)
+
+    def cost(self, size=None):
+        """Cost in process-minutes of a task of a given size.
+
+        Args:
+            size (float): input size of the task, or None if not known.
+
+        Returns:
+            float: process-minutes.
+
+        """
+        if size is None or self.slope == 0 :
+            return max(self.median, self.min_cost)
+        return max(self.offset + self.slope*size, self.min_cost)
+
+    def run_time(self, size=None, nproc=1):
+        """Run time in minutes of a task of a given size.
+
+        Args:
+            size (float): input size of the task, or None if not known.
+            nproc (int): the number of processes running the task.
+
+        Returns:
+            float: minutes.
+
+        """
+        return self.cost(size)/max(nproc, 1)
+
+
+# Models cached per database and task type, with the time they were fit.
+_models = dict()
+
+# Refit the models after this many seconds.
+model_expiry = 600.
+
+
+def get_model(db, tasktype, min_tasks=5):
+    """Get the run time model of a task type.
+
+    The model is fit on the runs recorded in the task_time table of the
+    database and cached for model_expiry seconds.
+
+    Args:
+        db (pipeline.db.DB): the database.
+        tasktype (str): the task type.
+        min_tasks (int): minimum number of recorded runs needed to fit a
+            model.
+
+    Returns:
+        RunTimeModel: the model, or None if there are not enough recorded
+            runs.
+
+    """
+    key = (id(db), tasktype)
+    now = time.time()
+    if key in _models and now - _models[key][1] < model_expiry :
+        return _models[key][0]
+
+    model = None
+    try :
+        rows = db.select_task_time(tasktype)
+    except Exception as err :
+        log = get_logger()
+        log.debug("cannot read run times of {}: {}".format(tasktype, err))
+        rows = []
+    if len(rows) >= min_tasks :
+        nproc = [ x[0] for x in rows ]
+        wall = [ x[1] for x in rows ]
+        size = [ np.nan if x[2] is None else x[2] for x in rows ]
+        model = RunTimeModel(nproc, wall, size, min_tasks=min_tasks)
+
+    _models[key] = (model, now)
+    return model
+
+
+def learned_run_times(task, names, procs_per_node, db):
+    """Run times of tasks predicted by the model of their task type.
+
+    The input sizes of the tasks, if the model depends on them, are fetched
+    with a single call to BaseTask.run_sizes.
+
+    Args:
+        task (BaseTask): the task class instance.
+        names (list): the names of the tasks.
+        procs_per_node (int): the number of processes running per node.
+        db (pipeline.db.DB): the database.
+
+    Returns:
+        list: estimated minutes of run time of each task at maximum
+            concurrency, rounded to an int of at least 1, or None if there is
+            no model for this task type.
+
+    """
+    model = get_model(db, task._type)
+    if model is None :
+        return None
+    sizes = [ None for x in names ]
+    if model.slope != 0 :
+        sizes = task.run_sizes(names, db)
+    nproc = task.run_max_procs(procs_per_node)
+    return [ max(1, int(np.round(model.run_time(x, nproc)))) for x in sizes ]
+
+
+def learned_run_time(task, name, procs_per_node, db):
+    """Run time of a task predicted by the model of its task type.
+
+    Args:
+        task (BaseTask): the task class instance.
+        name (str): the name of the task.
+        procs_per_node (int): the number of processes running per node.
+        db (pipeline.db.DB): the database.
+
+    Returns:
+        int: estimated minutes of run time at maximum concurrency, or None
+            if there is no model for this task type.
+
+    """
+    tm = learned_run_times(task, [name], procs_per_node, db)
+    if tm is None :
+        return None
+    return tm[0]
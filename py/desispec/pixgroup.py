@@ -4,7 +4,7 @@ Tools to regroup spectra in individual exposures by healpix on the sky
 
 from __future__ import absolute_import, division, print_function
 import glob, os, sys, time
-from collections import Counter
+from collections import Counter, OrderedDict
 
 import numpy as np
 
@@ -19,7 +19,84 @@ import desiutil.depend
 from . import io
 from .maskbits import specmask
 
-def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
+def _fibermap_healpix(fibermap, nside):
+    '''
+    Returns NESTED healpix of each fibermap entry, -1 for NaN RA or DEC
+    '''
+    ra, dec = fibermap['RA_TARGET'], fibermap['DEC_TARGET']
+    ok = ~np.isnan(ra) & ~np.isnan(dec)
+    allpix = np.full(len(fibermap), -1, dtype=np.int64)
+    if np.any(ok):
+        allpix[ok] = desimodel.footprint.radec2pix(nside, ra[ok], dec[ok])
+    return allpix
+
+def _cframe_healpix(filename, nside):
+    '''
+    Returns list of (healpix, ntargets) for the targets of cframe `filename`
+    '''
+    #- Determine healpix, allowing for NaN
+    columns = ['RA_TARGET', 'DEC_TARGET']
+    fibermap = fitsio.read(filename, 'FIBERMAP', columns=columns)
+    allpix = _fibermap_healpix(fibermap, nside)
+    return sorted(Counter(allpix[allpix >= 0]).items())
+
+_exp2healpix_index_dtype = [
+    ('NIGHT', 'i4'), ('EXPID', 'i8'), ('SPECTRO', 'i4'),
+    ('HEALPIX', 'i8'), ('NTARGETS', 'i8'),
+    ('CAMERA', 'S2'), ('MTIME', 'f8')]
+
+def read_exp2healpix_index(filename, nside=64):
+    '''
+    Read persisted exposure to healpix index written by get_exp2healpix_map
+
+    Args:
+        filename: index FITS file
+
+    Options:
+        nside: healpix nside the index must have been computed with
+
+    Returns:
+        table with columns NIGHT EXPID SPECTRO HEALPIX NTARGETS CAMERA MTIME,
+        where CAMERA and MTIME identify the cframe file that was scanned;
+        or None if the file doesn't exist or is for a different nside
+    '''
+    log = get_logger()
+    if not os.path.exists(filename):
+        return None
+
+    index, header = fitsio.read(filename, 'EXP2HEALPIX', header=True)
+    if header['HPXNSIDE'] != nside:
+        log.warning('Ignoring {} with nside={} instead of {}'.format(
+            filename, header['HPXNSIDE'], nside))
+        return None
+
+    return index.astype(_exp2healpix_index_dtype)
+
+def write_exp2healpix_index(filename, index, nside=64):
+    '''
+    Write exposure to healpix index table to `filename`
+
+    Args:
+        filename: output FITS file
+        index: table with columns NIGHT EXPID SPECTRO HEALPIX NTARGETS CAMERA MTIME
+
+    Options:
+        nside: healpix nside used to compute the index
+    '''
+    outdir = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    #- write to temporary file and rename, so that the index is never
+    #- partially written
+    tmpfile = filename + '.tmp'
+    header = dict(HPXNSIDE=nside, HPXNEST=True)
+    fitsio.write(tmpfile, index, extname='EXP2HEALPIX', header=header,
+                 clobber=True)
+    os.rename(tmpfile, filename)
+
+def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None,
+        indexfile=None):
     '''
     Returns table with columns NIGHT EXPID SPECTRO HEALPIX NTARGETS 
 
@@ -28,6 +105,11 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
         specprod_dir: override $DESI_SPECTRO_REDUX/$SPECPROD
         nside: healpix nside, must be power of 2
         comm: MPI communicator
+        indexfile: persisted index, e.g. findfile('exp2healpix', nside=nside)
+
+    If `indexfile` is given, only the cframes that are not in the index or
+    whose modification time changed are opened; the index is then updated
+    with the requested nights.
 
     Note: This could be replaced by a DB query when the production DB exists.
     '''
@@ -45,7 +127,21 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
     
     if comm:
         nights = comm.bcast(nights, root=0)
-   
+
+    #- Rows of the persisted index, keyed by (night, expid, spectro)
+    oldindex = None
+    if indexfile is not None and rank == 0:
+        oldindex = read_exp2healpix_index(indexfile, nside=nside)
+
+    if comm:
+        oldindex = comm.bcast(oldindex, root=0)
+
+    indexed = dict()
+    if oldindex is not None:
+        for row in oldindex:
+            key = (int(row['NIGHT']), int(row['EXPID']), int(row['SPECTRO']))
+            indexed.setdefault(key, list()).append(tuple(row))
+
     #-----
     #- Distribute nights over ranks, scanning their exposures to build
     #- map of exposures -> healpix
@@ -56,6 +152,7 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
     #- for tracking exposures that we've already mapped in a different band
     night_expid_spectro = set()
 
+    nscan = 0
     for night in nights[rank::size]:
         night = str(night)
         nightdir = os.path.join(specprod_dir, 'exposures', night)
@@ -76,21 +173,32 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
                 else:
                     night_expid_spectro.add((night, expid, spectro))
 
+                #- reuse index entries if this cframe hasn't changed
+                mtime = os.path.getmtime(filename)
+                key = (int(night), int(expid), spectro)
+                if key in indexed:
+                    oldrows = indexed[key]
+                    if oldrows[0][5] == camera.encode() and oldrows[0][6] == mtime:
+                        rows.extend(oldrows)
+                        continue
+
                 log.debug('Rank {} mapping {} {}'.format(rank, night,
                     os.path.basename(filename)))
                 sys.stdout.flush()
+                nscan += 1
 
-                #- Determine healpix, allowing for NaN
-                columns = ['RA_TARGET', 'DEC_TARGET']
-                fibermap = fitsio.read(filename, 'FIBERMAP', columns=columns)
-                ra, dec = fibermap['RA_TARGET'], fibermap['DEC_TARGET']
-                ok = ~np.isnan(ra) & ~np.isnan(dec)
-                ra, dec = ra[ok], dec[ok]
-                allpix = desimodel.footprint.radec2pix(nside, ra, dec)
+                #- Add rows for final output; HEALPIX=-1 records cframes
+                #- without any target with valid coordinates
+                pixcounts = _cframe_healpix(filename, nside)
+                if len(pixcounts) == 0:
+                    pixcounts = [(-1, 0)]
+                for pix, ntargets in pixcounts:
+                    rows.append((night, expid, spectro, pix, ntargets,
+                                 camera, mtime))
 
-                #- Add rows for final output
-                for pix, ntargets in sorted(Counter(allpix).items()):
-                    rows.append((night, expid, spectro, pix, ntargets))
+    if indexfile is not None:
+        log.debug('Rank {} scanned {} cframes not in {}'.format(
+            rank, nscan, os.path.basename(indexfile)))
 
     #- Collect rows from individual ranks back to rank 0
     if comm:
@@ -104,13 +212,96 @@ def get_exp2healpix_map(nights=None, specprod_dir=None, nside=64, comm=None):
 
         rows = comm.bcast(rows, root=0)
 
+    index = np.array(rows, dtype=_exp2healpix_index_dtype)
+
+    #- Update persisted index, replacing the rows of the requested nights
+    if indexfile is not None and rank == 0:
+        if oldindex is not None:
+            keep = ~np.in1d(oldindex['NIGHT'], [int(night) for night in nights])
+            newindex = np.hstack([oldindex[keep], index])
+        else:
+            newindex = index
+        try:
+            if len(newindex) > 0:
+                write_exp2healpix_index(indexfile, newindex, nside=nside)
+        except (IOError, OSError) as err:
+            log.warning('Unable to update {}: {}'.format(indexfile, err))
+
     #- Create the final output table
-    exp2healpix = np.array(rows, dtype=[
+    index = index[index['HEALPIX'] >= 0]
+    exp2healpix = np.zeros(len(index), dtype=[
         ('NIGHT', 'i4'), ('EXPID', 'i8'), ('SPECTRO', 'i4'),
         ('HEALPIX', 'i8'), ('NTARGETS', 'i8')])
+    for name in exp2healpix.dtype.names:
+        exp2healpix[name] = index[name]
 
     return exp2healpix
 
+def plan_healpix_order(exp2healpix, pixels=None):
+    '''
+    Order healpix pixels to maximize the reuse of frames between pixels
+
+    Args:
+        exp2healpix: table with columns NIGHT EXPID SPECTRO HEALPIX,
+            e.g. from get_exp2healpix_map
+
+    Options:
+        pixels: subset of HEALPIX values to order; default all
+
+    Returns:
+        array of healpix pixels
+
+    Notes:
+        This is a greedy walk starting from the lowest pixel, always moving
+        to the remaining pixel that shares the most (night, expid, spectro)
+        with the current pixel, with ties broken by pixel number.  When no
+        remaining pixel shares an exposure, it continues with the next
+        remaining pixel in NESTED order, i.e. usually a neighbor on the sky.
+        Splitting the output in contiguous chunks (e.g. np.array_split)
+        gives each rank a set of pixels that share most of their frames.
+    '''
+    if pixels is None:
+        pixels = exp2healpix['HEALPIX']
+    pixels = np.unique(pixels)
+    if len(pixels) == 0:
+        return pixels
+
+    #- maps between pixels and (night, expid, spectro)
+    keep = np.in1d(exp2healpix['HEALPIX'], pixels)
+    pix2exp = dict([(pix, set()) for pix in pixels])
+    exp2pix = dict()
+    for night, expid, spectro, pix in zip(exp2healpix['NIGHT'][keep],
+            exp2healpix['EXPID'][keep], exp2healpix['SPECTRO'][keep],
+            exp2healpix['HEALPIX'][keep]):
+        key = (night, expid, spectro)
+        pix2exp[pix].add(key)
+        exp2pix.setdefault(key, set()).add(pix)
+
+    remaining = set(pixels)
+    order = list()
+    inext = 0
+    current = pixels[0]
+    while True:
+        order.append(current)
+        remaining.discard(current)
+        if len(remaining) == 0:
+            break
+
+        overlap = Counter()
+        for key in pix2exp[current]:
+            for pix in exp2pix[key]:
+                if pix in remaining:
+                    overlap[pix] += 1
+
+        if len(overlap) > 0:
+            current = min(overlap, key=lambda pix: (-overlap[pix], pix))
+        else:
+            while pixels[inext] not in remaining:
+                inext += 1
+            current = pixels[inext]
+
+    return np.array(order, dtype=pixels.dtype)
+
 #-----
 class FrameLite(object):
     '''
@@ -143,25 +334,54 @@ class FrameLite(object):
         self.fibermap = fibermap
         self.header = header
         self.scores = scores
-    
+        self._healpix = dict()
+
+    def healpix(self, nside=64):
+        '''
+        Returns NESTED healpix of each spectrum, -1 if RA or DEC is NaN
+
+        The result is cached per nside, so only computed once per frame.
+        '''
+        if nside not in self._healpix:
+            self._healpix[nside] = _fibermap_healpix(self.fibermap, nside)
+        return self._healpix[nside]
+
+    @property
+    def nbytes(self):
+        '''Number of bytes of the data arrays'''
+        nbytes = 0
+        for x in (self.wave, self.flux, self.ivar, self.mask, self.rdat,
+                  self.fibermap, self.scores):
+            if x is not None:
+                nbytes += x.nbytes
+        return nbytes
+
     def __getitem__(self, index):
         '''Return a subset of the original FrameLight'''
         if not isinstance(index, slice):
             index = np.atleast_1d(index)
         
-        if self.scores:
+        if self.scores is not None:
             scores = self.scores[index]
         else:
             scores = None
 
-        return FrameLite(self.wave, self.flux[index], self.ivar[index],
+        result = FrameLite(self.wave, self.flux[index], self.ivar[index],
             self.mask[index], self.rdat[index], self.fibermap[index],
             self.header, scores)
+        for nside, allpix in self._healpix.items():
+            result._healpix[nside] = allpix[index]
+
+        return result
     
     @classmethod
-    def read(cls, filename):
+    def read(cls, filename, nside=64):
         '''
         Return FrameLite read from `filename`
+
+        Options:
+            nside: precompute the healpix of each spectrum for this nside;
+                None to skip
         '''
         with fitsio.FITS(filename) as fx:
             header = fx[0].read_header()
@@ -185,7 +405,11 @@ class FrameLite(object):
             fibermap, ['NIGHT', 'EXPID', 'TILEID'], [night, expid, tileid],
             usemask=False)
 
-        return FrameLite(wave, flux, ivar, mask, rdat, fibermap, header, scores)
+        frame = FrameLite(wave, flux, ivar, mask, rdat, fibermap, header, scores)
+        if nside is not None:
+            frame.healpix(nside)
+
+        return frame
 
 #-----
 class SpectraLite(object):
@@ -439,118 +663,203 @@ def frames2spectra(frames, pix, nside=64):
         SpectraLite object with subset of spectra from frames that are in
         the requested healpix pixel `pix`
     '''
-    wave = dict()
-    flux = dict()
-    ivar = dict()
-    mask = dict()
-    rdat = dict()
-    fibermap = list()
-    scores = dict()
+    return frames2spectra_many(frames, [pix,], nside=nside)[pix]
 
-    bands = ['b', 'r', 'z']
-    for x in bands:
-        #- Select just the frames for this band
-        keys = sorted(frames.keys())
-        xframes = [frames[k] for k in keys if frames[k].header['CAMERA'].startswith(x)]
-        assert len(xframes) != 0
-
-        #- Select flux, ivar, etc. for just the spectra on this healpix
-        wave[x] = xframes[0].wave
-        flux[x] = list()
-        ivar[x] = list()
-        mask[x] = list()
-        rdat[x] = list()
-        scores[x] = list()
-        for xf in xframes:
-            ra, dec = xf.fibermap['RA_TARGET'], xf.fibermap['DEC_TARGET']
-            ok = ~np.isnan(ra) & ~np.isnan(dec)
-            ra[~ok] = 0.0
-            dec[~ok] = 0.0
-            allpix = desimodel.footprint.radec2pix(nside, ra, dec)
-            ii = (allpix == pix) & ok
-            flux[x].append(xf.flux[ii])
-            ivar[x].append(xf.ivar[ii])
-            mask[x].append(xf.mask[ii])
-            rdat[x].append(xf.rdat[ii])
-
-            if x == bands[0]:
-                fibermap.append(xf.fibermap[ii])
-
-            if xf.scores is not None:
-                scores[x].append(xf.scores[ii])
-
-        flux[x] = np.vstack(flux[x])
-
-        ivar[x] = np.vstack(ivar[x])
-        mask[x] = np.vstack(mask[x])
-        rdat[x] = np.vstack(rdat[x])
-        if x == bands[0]:
-            fibermap = np.hstack(fibermap)
-
-        if len(scores[x]) > 0:
-            try:
-                scores[x] = np.hstack(scores[x])
-            except:
-                import IPython; IPython.embed()
-
-    #- Combine scores into a single table
+def _combine_scores(scores, bands):
+    '''
+    Combine dict of per-band scores tables into a single table, or None
+    '''
     #- Why doesn't np.vstack work for this? (says invalid type promotion)
     if len(scores[bands[0]]) > 0:
         if len(bands) == 1:
-            scores = scores(bands[0])
+            return np.hstack(scores[bands[0]])
         else:
             names = list()
             data = list()
             for x in bands[1:]:
-                names.extend(scores[x].dtype.names)
-                for colname in scores[x].dtype.names:
-                    data.append(scores[x][colname])
-
-            scores = np.lib.recfunctions.append_fields(
-                    scores[bands[0]], names, data)
+                xscores = np.hstack(scores[x])
+                names.extend(xscores.dtype.names)
+                for colname in xscores.dtype.names:
+                    data.append(xscores[colname])
 
+            return np.lib.recfunctions.append_fields(
+                    np.hstack(scores[bands[0]]), names, data)
     else:
-        scores = None
-
-    return SpectraLite(bands, wave, flux, ivar, mask, rdat, fibermap, scores)
+        return None
 
-def update_frame_cache(frames, framekeys, specprod_dir=None):
+def frames2spectra_many(frames, pixels, nside=64):
     '''
-    Update a cache of FrameLite objects to match requested frameskeys
+    Combine a dict of FrameLite into one SpectraLite per healpix pixel
 
     Args:
-        frames: dict of FrameLite objects, keyed by (night, expid, camera)
-        framekeys: list of desired (night, expid, camera)
+        frames: dict of FrameLight, keyed by (night, expid, camera)
+        pixels: list of NESTED healpix pixel numbers
 
-    Updates `frames` in-place
+    Options:
+        nside: Healpix nside, must be power of 2
 
-    Notes:
-        `frames` is dictionary, `framekeys` is list.
-        When finished, the keys of `frames` match the entries in `framekeys`
+    Returns:
+        dict of SpectraLite objects keyed by pixel, with the subset of
+        spectra from frames that are in that pixel (possibly none)
+
+    Each frame is only sliced once: the spectra of all requested pixels are
+    gathered together, then sorted by pixel and split.
     '''
+    pixels = np.unique(pixels)
+    npix = len(pixels)
+    bands = ['b', 'r', 'z']
+    keys = sorted(frames.keys())
 
-    log = get_logger()
+    wave = dict()
+    flux = [dict() for i in range(npix)]
+    ivar = [dict() for i in range(npix)]
+    mask = [dict() for i in range(npix)]
+    rdat = [dict() for i in range(npix)]
+    fibermap = [None for i in range(npix)]
+    scores = [dict() for i in range(npix)]
 
-    #- Drop frames that we no longer need
-    ndrop = 0
-    for key in list(frames.keys()):
-        if key not in framekeys:
-            ndrop += 1
-            del frames[key]
-
-    nkeep = len(frames)
-
-    #- Read and add the new frames that we do need
-    nadd = 0
-    for key in framekeys:
-        if key not in frames.keys():
-            night, expid, camera = key
-            framefile = io.findfile('cframe', night, expid, camera,
-                    specprod_dir=specprod_dir)
-            log.debug('  Reading {}'.format(os.path.basename(framefile)))
-            nadd += 1
-            frames[key] = FrameLite.read(framefile)
-
-    log.debug('Frame cache: {} kept, {} added, {} dropped, now have {}'.format(
-         nkeep, nadd, ndrop, len(frames)))
+    for x in bands:
+        #- Select just the frames for this band
+        xframes = [frames[k] for k in keys if frames[k].header['CAMERA'].startswith(x)]
+        assert len(xframes) != 0
+        wave[x] = xframes[0].wave
 
+        #- Select flux, ivar, etc. for the spectra on any of the pixels
+        xpix = list()
+        xrows = list()
+        scorepix = list()
+        xscores = list()
+        for xf in xframes:
+            allpix = xf.healpix(nside)
+            ii = np.where(np.in1d(allpix, pixels))[0]
+            xpix.append(allpix[ii])
+            xrows.append(xf[ii])
+            if xf.scores is not None:
+                scorepix.append(allpix[ii])
+                xscores.append(xf.scores[ii])
+
+        xpix = np.concatenate(xpix)
+        xflux = np.vstack([xf.flux for xf in xrows])
+        xivar = np.vstack([xf.ivar for xf in xrows])
+        xmask = np.vstack([xf.mask for xf in xrows])
+        xrdat = np.vstack([xf.rdat for xf in xrows])
+        if x == bands[0]:
+            xfibermap = np.hstack([xf.fibermap for xf in xrows])
+
+        #- Group by pixel; the stable sort keeps frame then fiber order
+        order = np.argsort(xpix, kind='stable')
+        begin = np.searchsorted(xpix[order], pixels, side='left')
+        end = np.searchsorted(xpix[order], pixels, side='right')
+        if len(xscores) > 0:
+            scorepix = np.concatenate(scorepix)
+            xscores = np.hstack(xscores)
+            sorder = np.argsort(scorepix, kind='stable')
+            sbegin = np.searchsorted(scorepix[sorder], pixels, side='left')
+            send = np.searchsorted(scorepix[sorder], pixels, side='right')
+
+        for i in range(npix):
+            ii = order[begin[i]:end[i]]
+            flux[i][x] = xflux[ii]
+            ivar[i][x] = xivar[ii]
+            mask[i][x] = xmask[ii]
+            rdat[i][x] = xrdat[ii]
+            if x == bands[0]:
+                fibermap[i] = xfibermap[ii]
+            if len(xscores) > 0:
+                scores[i][x] = [xscores[sorder[sbegin[i]:send[i]]],]
+            else:
+                scores[i][x] = list()
+
+    spectra = dict()
+    for i, pix in enumerate(pixels):
+        spectra[pix] = SpectraLite(bands, dict(wave), flux[i], ivar[i], mask[i],
+            rdat[i], fibermap[i], _combine_scores(scores[i], bands))
+
+    return spectra
+
+#-----
+class FrameCache(object):
+    '''
+    Least recently used cache of FrameLite objects, bounded in bytes
+    '''
+    def __init__(self, max_bytes=4*1024**3, specprod_dir=None):
+        '''
+        Create an empty FrameCache
+
+        Options:
+            max_bytes: maximum size of the cached frames in bytes
+            specprod_dir: override $DESI_SPECTRO_REDUX/$SPECPROD
+
+        The frames requested by a single call to `get_frames` are never
+        evicted during that call, so the cache can temporarily exceed
+        `max_bytes` if they do not fit.
+        '''
+        self.max_bytes = max_bytes
+        self.specprod_dir = specprod_dir
+        self._frames = OrderedDict()
+        self.nbytes = 0
+        self.nhit = 0
+        self.nmiss = 0
+        self.nevict = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def get_frames(self, framekeys):
+        '''
+        Return dict of FrameLite for the requested framekeys
+
+        Args:
+            framekeys: list of (night, expid, camera)
+
+        Frames that are not in the cache are read from their cframe files,
+        least recently used frames are evicted to stay below `max_bytes`.
+        '''
+        log = get_logger()
+        protected = set(framekeys)
+        frames = dict()
+        for key in framekeys:
+            if key in self._frames:
+                self.nhit += 1
+                #- move to the most recently used end
+                frame = self._frames.pop(key)
+                self._frames[key] = frame
+            else:
+                self.nmiss += 1
+                night, expid, camera = key
+                framefile = io.findfile('cframe', night, expid, camera,
+                        specprod_dir=self.specprod_dir)
+                log.debug('  Reading {}'.format(os.path.basename(framefile)))
+                frame = FrameLite.read(framefile)
+                self._frames[key] = frame
+                self.nbytes += frame.nbytes
+                self._evict(protected)
+
+            frames[key] = frame
+
+        if self.nbytes > self.max_bytes:
+            log.warning('{} frames need {:.2f} GB, more than the frame cache '
+                'limit of {:.2f} GB'.format(len(frames), self.nbytes/1024**3,
+                self.max_bytes/1024**3))
+
+        return frames
+
+    def _evict(self, protected):
+        '''Drop least recently used frames not in `protected` until under max_bytes'''
+        for key in list(self._frames.keys()):
+            if self.nbytes <= self.max_bytes:
+                break
+            if key in protected:
+                continue
+            frame = self._frames.pop(key)
+            self.nbytes -= frame.nbytes
+            self.nevict += 1
+
+    def stats(self):
+        '''Return string with cache hits, misses, and evictions'''
+        return 'frame cache: {} hits, {} misses, {} evictions, {} frames ' \
+            '({:.2f}/{:.2f} GB) in cache'.format(self.nhit, self.nmiss,
+            self.nevict, len(self), self.nbytes/1024**3, self.max_bytes/1024**3)
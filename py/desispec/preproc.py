@@ -6,12 +6,14 @@ import re
 import os
 import numpy as np
 import scipy.interpolate
-import yaml
+import copy
 import os.path
 from pkg_resources import resource_exists, resource_filename
 
 from desispec.image import Image
 from desispec import cosmics
+from desispec.calibcache import get_cache
+from desispec.tiledstats import tile_edges, tiled_statistic
 from desispec.maskbits import ccdmask
 from desiutil.log import get_logger
 # log = get_logger()
@@ -101,7 +103,118 @@ def _overscan(pix, nsigma=5, niter=3):
     return overscan, readnoise
 
 
-def _global_background(image,patch_width=200) :
+def overscan_per_row(pix, nsigma=5, niter=3):
+    '''
+    returns overscan, readnoise per row of a 2D block of overscan pixels
+
+    All rows are fit at once, with the same iterative sigma clipping as
+    _overscan on each row.  Rows with NaN values get overscan=readnoise=0.
+
+    Args:
+        pix (ndarray) : 2D overscan pixels from CCD image [nrows, ncols]
+
+    Optional:
+        nsigma (float) : number of standard deviations for sigma clipping
+        niter (int) : number of iterative refits
+
+    Returns overscan, readnoise 1D arrays [nrows]
+    '''
+    log=get_logger()
+    pix = np.asarray(pix, dtype=np.float64)
+    nrows = pix.shape[0]
+
+    nanrows = np.isnan(pix).any(axis=1)
+    if np.any(nanrows) :
+        for j in np.where(nanrows)[0] :
+            log.warning("NaN values in row %d of overscan"%j)
+        pix = np.where(nanrows[:,None], 0., pix)
+
+    #- normalized median absolute deviation as robust version of RMS
+    #- see https://en.wikipedia.org/wiki/Median_absolute_deviation
+    overscan = np.median(pix, axis=1)
+    readnoise = 1.4826*np.median(np.abs(pix - overscan[:,None]), axis=1)
+    median_overscan = overscan.copy()
+    median_readnoise = readnoise.copy()
+
+    #- input pixels are integers, so iteratively refit
+    failed = np.zeros(nrows, dtype=bool)
+    for i in range(niter):
+        good = np.abs(pix - overscan[:,None]) < (nsigma*readnoise)[:,None]
+        ngood = np.sum(good, axis=1)
+        newfailed = (ngood<5) & (~failed)
+        if np.any(newfailed) :
+            log.error("error in sigma clipping for overscan measurement, return result without clipping")
+            failed |= newfailed
+        ok = ~failed
+        n = np.maximum(ngood, 1)
+        mean = np.sum(pix*good, axis=1)/n
+        var = np.sum(good*(pix - mean[:,None])**2, axis=1)/n
+        overscan[ok] = mean[ok]
+        readnoise[ok] = np.sqrt(var[ok])
+
+    #- correct for bias from sigma clipping
+    readnoise[~failed] /= _clipped_std_bias(nsigma)
+
+    #- no clipping for the rows where it failed
+    overscan[failed] = median_overscan[failed]
+    readnoise[failed] = median_readnoise[failed]
+
+    overscan[nanrows] = 0.
+    readnoise[nanrows] = 0.
+
+    return overscan, readnoise
+
+#- Orientation of the crosstalk of the amplifiers of a CCD with amplifiers
+#- C D
+#- A B
+#- flip_axis_0[a1,a2] (flip_axis_1[a1,a2]) is -1 if the crosstalk from a1 to
+#- a2 is flipped along axis 0 (1).
+_crosstalk_flip_axis_0 = np.array([[1,1,-1,-1],
+                                   [1,1,-1,-1],
+                                   [-1,-1,1,1],
+                                   [-1,-1,1,1]])
+_crosstalk_flip_axis_1 = np.array([[1,-1,1,-1],
+                                   [-1,1,-1,1],
+                                   [1,-1,1,-1],
+                                   [-1,1,-1,1]])
+
+def correct_crosstalk(image, ccdsecs, crosstalk):
+    '''
+    Subtract the crosstalk between amplifiers, in place
+
+    Args:
+        image (ndarray) : 2D CCD image, modified in place
+        ccdsecs (list) : 2D slices of the 4 amplifiers A,B,C,D in image,
+            with the CCD layout
+            C D
+            A B
+        crosstalk (dict) : crosstalk coefficient of amplifier of index a1
+            into amplifier of index a2, keyed by (a1,a2)
+
+    The crosstalks are subtracted sequentially in the order of the
+    amplifiers, so the crosstalk from an amplifier is computed with its
+    image already corrected for the crosstalk of the previous amplifiers.
+    '''
+    log=get_logger()
+    buf = None
+    for a1, a2 in sorted(crosstalk.keys()) :
+        coef = crosstalk[(a1,a2)]
+        if a1==a2 or coef==0. :
+            continue
+        log.info("Correct for crosstalk=%f from AMP %d into %d"%(coef,a1,a2))
+        source = image[ccdsecs[a1]]
+        if _crosstalk_flip_axis_0[a1,a2]==-1 :
+            source = source[::-1]
+        if _crosstalk_flip_axis_1[a1,a2]==-1 :
+            source = source[:,::-1]
+        #- one buffer for all the amplifier pairs
+        if buf is None or buf.shape != source.shape :
+            buf = np.empty(source.shape, dtype=image.dtype)
+        np.multiply(source, coef, out=buf)
+        target = image[ccdsecs[a2]]
+        target -= buf
+
+def _global_background(image,patch_width=200,method="median",backend="numba") :
     '''
     determine background using a 2D median with square patches of width = width
     that are interpolated
@@ -112,16 +225,14 @@ def _global_background(image,patch_width=200) :
        ( image = ((rawimage-bias-overscan)*gain)/pixflat )
     Options:
        patch_width (integer) size in pixels of the median square patches
+       method (str) statistic of the patches, "median" or "clipped_mean"
+       backend (str) "numba" or "numpy", see desispec.tiledstats.tiled_statistic
 
     Returns background image with same shape as input image
     '''
-    bkg=np.zeros_like(image)
-    bins0=np.linspace(0,image.shape[0],float(image.shape[0])/patch_width).astype(int)
-    bins1=np.linspace(0,image.shape[1],float(image.shape[1])/patch_width).astype(int)
-    bkg_grid=np.zeros((bins0.size-1,bins1.size-1))
-    for j in range(bins1.size-1) :
-        for i in range(bins0.size-1) :
-            bkg_grid[i,j]=np.median(image[bins0[i]:bins0[i+1],bins1[j]:bins1[j+1]])
+    bins0=tile_edges(0,image.shape[0],patch_width)
+    bins1=tile_edges(0,image.shape[1],patch_width)
+    bkg_grid=tiled_statistic(image,bins0,bins1,method=method,backend=backend)
 
     nodes0=bins0[:-1]+(bins0[1]-bins0[0])/2.
     nodes1=bins1[:-1]+(bins1[1]-bins0[0])/2.
@@ -149,7 +260,7 @@ def masked_median(images,masks=None) :
         log.info("masked array median of %d images"%len(images))
         return np.ma.median(np.ma.masked_array(data=images,mask=(masks!=0)),axis=0).data
 
-def _background(image,header,patch_width=200,stitch_width=10,stitch=False) :
+def _background(image,header,patch_width=200,stitch_width=10,stitch=False,method="median",backend="numba") :
     '''
     determine background using a 2D median with square patches of width = width
     that are interpolated and optionnally try and match the level of amplifiers
@@ -163,14 +274,16 @@ def _background(image,header,patch_width=200,stitch_width=10,stitch=False) :
        patch_width (integer) size in pixels of the median square patches
        stitch_width (integer) width in pixels of amplifier edges to match level of amplifiers
        stitch : do match level of amplifiers
+       method (str) statistic of the patches, "median" or "clipped_mean"
+       backend (str) "numba" or "numpy", see desispec.tiledstats.tiled_statistic
 
     Returns background image with same shape as input image
     '''
     log=get_logger()
 
 
-    log.info("fit a smooth background over the whole image with median patches of size %dx%d"%(patch_width,patch_width))
-    bkg=_global_background(image,patch_width)
+    log.info("fit a smooth background over the whole image with %s patches of size %dx%d"%(method,patch_width,patch_width))
+    bkg=_global_background(image,patch_width,method=method,backend=backend)
 
     if stitch :
 
@@ -190,13 +303,14 @@ def _background(image,header,patch_width=200,stitch_width=10,stitch=False) :
             ii0=_parse_sec_keyword(header['CCDSEC%d'%amp0])
             ii1=_parse_sec_keyword(header['CCDSEC%d'%amp1])
             pos=ii0[axis].stop
-            bins=np.linspace(ii0[axis-1].start,ii0[axis-1].stop,float(ii0[axis-1].stop-ii0[axis-1].start)/patch_width).astype(int)
-            delta=np.zeros((bins.size-1))
-            for i in range(bins.size-1) :
-                if axis==0 :
-                    delta[i]=np.median(tmp_image[pos-stitch_width:pos,bins[i]:bins[i+1]])-np.median(tmp_image[pos:pos+stitch_width,bins[i]:bins[i+1]])
-                else :
-                    delta[i]=np.median(tmp_image[bins[i]:bins[i+1],pos-stitch_width:pos])-np.median(tmp_image[bins[i]:bins[i+1],pos:pos+stitch_width])
+            bins=tile_edges(ii0[axis-1].start,ii0[axis-1].stop,patch_width)
+            #- the strips on each side of the edge, cut in patches
+            below=np.array([pos-stitch_width,pos])
+            above=np.array([pos,pos+stitch_width])
+            if axis==0 :
+                delta=(tiled_statistic(tmp_image,below,bins,method=method,backend=backend)-tiled_statistic(tmp_image,above,bins,method=method,backend=backend))[0]
+            else :
+                delta=(tiled_statistic(tmp_image,bins,below,method=method,backend=backend)-tiled_statistic(tmp_image,bins,above,method=method,backend=backend))[:,0]
             nodes=bins[:-1]+(bins[1]-bins[0])/2.
 
             log.info("AMPS %d:%d mean diff=%f"%(amp0,amp1,np.mean(delta)))
@@ -225,8 +339,8 @@ def _background(image,header,patch_width=200,stitch_width=10,stitch=False) :
 
         bkg += tmp_bkg
         tmp_image=image-bkg
-        log.info("refit smooth background over the whole image with median patches of size %dx%d"%(patch_width,patch_width))
-        bkg+=_global_background(tmp_image,patch_width)
+        log.info("refit smooth background over the whole image with %s patches of size %dx%d"%(method,patch_width,patch_width))
+        bkg+=_global_background(tmp_image,patch_width,method=method,backend=backend)
 
 
 
@@ -251,9 +365,8 @@ def read_ccd_calibration(header, primary_header, filename=None) :
 
     log.info("Reading CCD calibration data in {}".format(filename))
 
-    stream = open(filename, 'r')
-    data   = yaml.load(stream)
-    stream.close()
+    #- parsed once per version of the file
+    data   = get_cache().get_yaml(filename)
     cameraid=header["CAMERA"].lower()
     if not cameraid in data :
         log.error("Cannot find data for camera %s in filename %s"%(cameraid,filename))
@@ -296,7 +409,8 @@ def read_ccd_calibration(header, primary_header, filename=None) :
             raise KeyError("Duplicate possible calibration data. Please fix this ambiguity in %s"%filename)
         found=True
         matching_data=data[version]
-    data=matching_data
+    #- a copy, the parsed file is cached
+    data=copy.deepcopy(matching_data)
 
 
     if not found :
@@ -335,18 +449,14 @@ def get_calibration_image(calibration_data,calibration_data_path,keyword,entry)
 
 
     log.info("Using %s %s"%(keyword,filename))
-    if keyword == "BIAS" :
-        return read_bias(filename=filename)
-    elif keyword == "MASK" :
-        return read_mask(filename=filename)
-    elif keyword == "DARK" :
-        return read_dark(filename=filename)
-    elif keyword == "PIXFLAT" :
-        return read_pixflat(filename=filename)
-    else :
-        log.error("Don't known how to read %s in %s"%(keyword,path))
-        raise ValueError("Don't known how to read %s in %s"%(keyword,path))
-    return False
+    readers = dict(BIAS=read_bias, MASK=read_mask, DARK=read_dark, PIXFLAT=read_pixflat)
+    if not keyword in readers :
+        log.error("Don't known how to read %s in %s"%(keyword,filename))
+        raise ValueError("Don't known how to read %s in %s"%(keyword,filename))
+
+    #- the images are cached (read-only) across calls, see desispec.calibcache
+    reader = readers[keyword]
+    return get_cache().get_image(keyword, filename, lambda x : reader(filename=x))
 
 def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True, mask=True, bkgsub=False, nocosmic=False, cosmics_nsig=6, cosmics_cfudge=3., cosmics_c2fudge=0.8,ccd_calibration_filename=None, nocrosstalk=False, nogain=False):
 
@@ -483,6 +593,8 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
     else :
         if mask.shape != image.shape :
             raise ValueError('shape mismatch mask {} != image {}'.format(mask.shape, image.shape))
+        #- the mask is updated below, do not modify the (cached) input
+        mask = np.array(mask)
 
     #- Load dark
     dark = get_calibration_image(calibration_data,calibration_data_path,"DARK",dark)
@@ -501,7 +613,7 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
         exptime =  primary_header[exptime_key]
 
         log.info("Multiplying dark by exptime %f"%(exptime))
-        dark *= exptime
+        dark = dark*exptime
 
 
 
@@ -534,27 +646,17 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
                 saturlev = 200000
                 log.warning('Missing keyword SATURLEV{} in header and nothing in calib data; using 200000'.format(amp,saturlev))
 
-        overscan_image = rawimage[ii].copy()
+        overscan_image = rawimage[ii]
         nrows=overscan_image.shape[0]
         log.info("nrows in overscan=%d"%nrows)
-        overscan = np.zeros(nrows)
-        rdnoise  = np.zeros(nrows)
-        overscan_per_row = True
         if calibration_data and 'OVERSCAN'+amp in calibration_data and calibration_data["OVERSCAN"+amp].upper()=="PER_ROW" :
             log.info("Subtracting overscan per row for amplifier %s of camera %s"%(amp,camera))
-            for j in range(nrows) :
-                if np.isnan(np.sum(overscan_image[j])) :
-                    log.warning("NaN values in row %d of overscan of amplifier %s of camera %s"%(j,amp,camera))
-                    continue
-                o,r =  _overscan(overscan_image[j])
-                #log.info("%d %f %f"%(j,o,r))
-                overscan[j]=o
-                rdnoise[j]=r
+            overscan, rdnoise = overscan_per_row(overscan_image)
         else :
             log.info("Subtracting average overscan for amplifier %s of camera %s"%(amp,camera))
             o,r =  _overscan(overscan_image)
-            overscan += o
-            rdnoise  += r
+            overscan = np.repeat(o, nrows)
+            rdnoise  = np.repeat(r, nrows)
 
         rdnoise *= gain
         median_rdnoise  = np.median(rdnoise)
@@ -562,8 +664,7 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
         log.info("Median rdnoise and overscan= %f %f"%(median_rdnoise,median_overscan))
 
         kk = _parse_sec_keyword(header['CCDSEC'+amp])
-        for j in range(nrows) :
-            readnoise[kk][j] = rdnoise[j]
+        readnoise[kk][:nrows] = rdnoise[:,None]
 
         header['OVERSCN'+amp] = median_overscan
         header['OBSRDN'+amp] = median_rdnoise
@@ -591,9 +692,7 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
         #- subtract overscan from data region and apply gain
         jj = _parse_sec_keyword(header['DATASEC'+amp])
 
-        data = rawimage[jj].copy()
-        for k in range(nrows) :
-            data[k] -= overscan[k]
+        data = rawimage[jj] - overscan[:,None]
 
         #- apply saturlev (defined in ADU), prior to multiplication by gain
         saturated = (rawimage[jj]>=saturlev)
@@ -604,61 +703,20 @@ def preproc(rawimage, header, primary_header, bias=True, dark=True, pixflat=True
             log.info("subtracting dark for amp %s"%amp)
             data -= dark[kk]
 
-        image[kk] = data*gain
+        np.multiply(data, gain, out=image[kk])
 
 
     if not nocrosstalk :
         #- apply cross-talk
-
-        # the ccd looks like :
-        # C D
-        # A B
-        # for cross talk, we need a symmetric 4x4 flip_matrix
-        # of coordinates ABCD giving flip of both axis
-        # when computing crosstalk of
-        #    A   B   C   D
-        #
-        # A  AA  AB  AC  AD
-        # B  BA  BB  BC  BD
-        # C  CA  CB  CC  CD
-        # D  DA  DB  DC  BB
-        # orientation_matrix_defines change of orientation
-        #
-        fip_axis_0= np.array([[1,1,-1,-1],
-                              [1,1,-1,-1],
-                              [-1,-1,1,1],
-                              [-1,-1,1,1]])
-        fip_axis_1= np.array([[1,-1,1,-1],
-                              [-1,1,-1,1],
-                              [1,-1,1,-1],
-                              [-1,1,-1,1]])
-
-        for a1 in range(len(amp_ids)) :
-            amp1=amp_ids[a1]
-            ii1 = _parse_sec_keyword(header['CCDSEC'+amp1])
-            a1flux=image[ii1]
-            #a1mask=mask[ii1]
-
-            for a2 in range(len(amp_ids)) :
-                if a1==a2 :
-                    continue
-                amp2=amp_ids[a2]
-                if calibration_data is None : continue
-                if not "CROSSTALK%s%s"%(amp1,amp2) in calibration_data : continue
-                crosstalk=calibration_data["CROSSTALK%s%s"%(amp1,amp2)]
-                if crosstalk==0. : continue
-                log.info("Correct for crosstalk=%f from AMP %s into %s"%(crosstalk,amp1,amp2))
-                a12flux=crosstalk*a1flux.copy()
-                #a12mask=a1mask.copy()
-                if fip_axis_0[a1,a2]==-1 :
-                    a12flux=a12flux[::-1]
-                    #a12mask=a12mask[::-1]
-                if fip_axis_1[a1,a2]==-1 :
-                    a12flux=a12flux[:,::-1]
-                    #a12mask=a12mask[:,::-1]
-                ii2 = _parse_sec_keyword(header['CCDSEC'+amp2])
-                image[ii2] -= a12flux
-                # mask[ii2]  |= a12mask (not sure we really need to propagate the mask)
+        if calibration_data is not None :
+            crosstalk = dict()
+            for a1 in range(len(amp_ids)) :
+                for a2 in range(len(amp_ids)) :
+                    key = "CROSSTALK%s%s"%(amp_ids[a1],amp_ids[a2])
+                    if a1!=a2 and key in calibration_data :
+                        crosstalk[(a1,a2)] = calibration_data[key]
+            ccdsecs = [ _parse_sec_keyword(header['CCDSEC'+amp]) for amp in amp_ids ]
+            correct_crosstalk(image, ccdsecs, crosstalk)
 
     #- Divide by pixflat image
     pixflat = get_calibration_image(calibration_data,calibration_data_path,"PIXFLAT",pixflat)
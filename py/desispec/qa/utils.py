@@ -23,7 +23,7 @@ def get_skyres(cframes, sub_sky=False, flatten=True):
         ivar : ndarray
 
     """
-    from desispec.io import read_frame
+    from desispec.io import read_frame, read_frame_rows
     from desispec.io.sky import read_sky
     from desispec.sky import subtract_sky
 
@@ -44,20 +44,21 @@ def get_skyres(cframes, sub_sky=False, flatten=True):
         # Return
         return twave, tflux, tres, tivar
 
-    cframe = read_frame(cframes, skip_resolution=True)
+    #- only the sky fibers are read
+    skyfibers = read_frame_rows(cframes, 'SKY')
+    cframe = read_frame(cframes, rows=skyfibers, skip_resolution=True)
     if cframe.meta['FLAVOR'] in ['flat','arc']:
         raise ValueError("Bad flavor for exposure: {:s}".format(cframes))
 
     # Sky
     sky_file = cframes.replace('cframe', 'sky')
-    skymodel = read_sky(sky_file)
+    skymodel = read_sky(sky_file)[skyfibers]
     if sub_sky:
         subtract_sky(cframe, skymodel)
     # Resid
-    skyfibers = np.where(cframe.fibermap['OBJTYPE'] == 'SKY')[0]
-    res = cframe.flux[skyfibers]  # Flux calibrated
-    ivar = cframe.ivar[skyfibers] # Flux calibrated
-    flux = skymodel.flux[skyfibers]  # Residuals; not flux calibrated!
+    res = cframe.flux  # Flux calibrated
+    ivar = cframe.ivar # Flux calibrated
+    flux = skymodel.flux  # Residuals; not flux calibrated!
     wave = np.outer(np.ones(flux.shape[0]), cframe.wave)
     # Combine?
     '''
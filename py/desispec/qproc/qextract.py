@@ -1,36 +1,68 @@
 import time
 import numpy as np
 from numpy.polynomial.legendre import legval
-import numba
+from desispec.jit import njit
 
 from desiutil.log import get_logger
 from desispec.xytraceset import XYTraceSet
 from desispec.image import Image
 from desispec.io.fibermap import empty_fibermap
 from desispec.qproc.qframe import QFrame
+from desispec.util import default_nthreads, thread_map
 
 
-@numba.jit
-def numba_extract(image_flux,image_var,x,hw=3) :
+@njit(nogil=True, signatures=["(float64[:,::1], float64[:,::1], float64[:,::1], int64, int64, int64, float64[:,::1], float64[:,::1])"])
+def _numba_extract_fibers(image_flux,image_var,x,hw,begin,end,flux,ivar) :
     n0=image_flux.shape[0]
-    flux=np.zeros(n0)
-    ivar=np.zeros(n0)
-    for j in range(n0) :
-        var=0
-        for i in range(int(x[j]-hw),int(x[j]+hw+1)) :
-            flux[j] += image_flux[j,i]
-            if image_var[j,i]>0 :
-                var += image_var[j,i]
-            else :
-                flux[j]=0
-                ivar[j]=0
-                var=0
-                break
-        if var>0 : 
-            ivar[j] = 1./var
-    return flux,ivar
+    for f in range(begin,end) :
+        for j in range(n0) :
+            var=0.
+            for i in range(int(x[f,j]-hw),int(x[f,j]+hw+1)) :
+                flux[f,j] += image_flux[j,i]
+                if image_var[j,i]>0 :
+                    var += image_var[j,i]
+                else :
+                    flux[f,j]=0
+                    ivar[f,j]=0
+                    var=0.
+                    break
+            if var>0 :
+                ivar[f,j] = 1./var
+
+def numba_extract_fibers(image_flux,image_var,x,hw=3,nthreads=None) :
+    """
+    Boxcar extraction of several fibers
+
+    Args:
+        image_flux : 2D array of pixel values
+        image_var : 2D array of pixel variances, 0 for masked pixels
+        x : 2D array [nfibers,ny] of trace x coordinates for each CCD row
+
+    Optional:
+        hw : half width of the boxcar
+        nthreads : number of threads, default is desispec.util.default_nthreads()
 
+    Returns:
+        flux, ivar : 2D arrays [nfibers,ny]
+    """
+    x = np.ascontiguousarray(x,dtype=np.float64)
+    flux = np.zeros(x.shape)
+    ivar = np.zeros(x.shape)
+    if x.shape[0] == 0 :
+        return flux,ivar
+    if nthreads is None :
+        nthreads = default_nthreads()
+    nthreads = max(1,min(nthreads,x.shape[0]))
+    thread_map(_numba_extract_fibers,[ (image_flux,image_var,x,hw,f[0],f[-1]+1,flux,ivar) \
+        for f in np.array_split(np.arange(x.shape[0]),nthreads) if f.size>0 ],nthreads)
+    return flux,ivar
 
+def numba_extract(image_flux,image_var,x,hw=3) :
+    """
+    Boxcar extraction of one fiber, see numba_extract_fibers
+    """
+    flux,ivar = numba_extract_fibers(image_flux,image_var,x[None,:],hw,nthreads=1)
+    return flux[0],ivar[0]
 
 def qproc_boxcar_extraction(xytraceset, image, fibers=None, width=7, fibermap=None, save_sigma=True) :    
     """
@@ -86,8 +118,6 @@ def qproc_boxcar_extraction(xytraceset, image, fibers=None, width=7, fibermap=No
     n0 = image.pix.shape[0]
     n1 = image.pix.shape[1]
     
-    frame_flux = np.zeros((fibers.size,n0))
-    frame_ivar = np.zeros((fibers.size,n0))
     frame_wave = np.zeros((fibers.size,n0))
 
     frame_sigma = None
@@ -99,7 +129,6 @@ def qproc_boxcar_extraction(xytraceset, image, fibers=None, width=7, fibermap=No
             frame_sigma = np.zeros((fibers.size,n0))
             ysigcoef    = xytraceset.ysig_vs_wave_traceset._coeff
 
-    xx         = np.tile(np.arange(n1),(n0,1))
     hw = width//2
     
     
@@ -107,32 +136,36 @@ def qproc_boxcar_extraction(xytraceset, image, fibers=None, width=7, fibermap=No
     rwave=(twave-wavemin)/(wavemax-wavemin)*2-1.
     y=np.arange(n0).astype(float)
     
-    
-    dwave = np.zeros(n0)
-    for f,fiber in enumerate(fibers) :
-        log.debug("extracting fiber #%03d"%fiber)
-        ty = legval(rwave, ycoef[f])
-        tx = legval(rwave, xcoef[f])
+    # traces of all fibers at once
+    nfibers = fibers.size
+    ty_of_fiber = legval(rwave, ycoef[:nfibers].T)
+    tx_of_fiber = legval(rwave, xcoef[:nfibers].T)
+    x_of_y = np.zeros((nfibers,n0))
+    for f in range(nfibers) :
+        ty = ty_of_fiber[f]
         frame_wave[f] = np.interp(y,ty,twave)
-        dwave[1:]     = frame_wave[f,1:]-frame_wave[f,:-1]
-        dwave[0]      = 2*dwave[1]-dwave[2]
-        x_of_y        = np.interp(y,ty,tx)        
-        
+        x_of_y[f]     = np.interp(y,ty,tx_of_fiber[f])
+        if frame_sigma is not None :
+            frame_sigma[f] = np.interp(y,ty,legval(rwave, ysigcoef[f]))
+
+    # the wavelength step is computed before the extrapolation
+    dwave = np.zeros((nfibers,n0))
+    dwave[:,1:] = frame_wave[:,1:]-frame_wave[:,:-1]
+    dwave[:,0]  = 2*dwave[:,1]-dwave[:,2]
+
+    for f in range(nfibers) :
+        ty = ty_of_fiber[f]
         i=np.where(y<ty[0])[0]
         if i.size>0 : # need extrapolation
             frame_wave[f,i] = twave[0]+(twave[1]-twave[0])/(ty[1]-ty[0])*(y[i]-ty[0])
         i=np.where(y>ty[-1])[0]
         if i.size>0 : # need extrapolation
             frame_wave[f,i] = twave[-1]+(twave[-2]-twave[-1])/(ty[-2]-ty[-1])*(y[i]-ty[-1])
-                
-        frame_flux[f],frame_ivar[f] = numba_extract(image.pix,var,x_of_y,hw)
-        # flux density
-        frame_flux[f] /= dwave
-        frame_ivar[f] *= dwave**2
-    
-        if frame_sigma is not None :
-            ts = legval(rwave, ysigcoef[f])
-            frame_sigma[f] = np.interp(y,ty,ts)
+
+    frame_flux,frame_ivar = numba_extract_fibers(image.pix,var,x_of_y,hw)
+    # flux density
+    frame_flux /= dwave
+    frame_ivar *= dwave**2
 
     t1=time.time()
     log.info(" done {} fibers in {:3.1f} sec".format(len(fibers),t1-t0))
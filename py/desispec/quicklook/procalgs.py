@@ -93,9 +93,13 @@ class Preproc(pas.PipelineAlg):
             mask=kwargs["Mask"]
         else: mask=False
 
-        return self.run_pa(input_raw,camera,bias=bias,pixflat=pixflat,mask=mask,dumpfile=dumpfile)
+        if "BkgSub" in kwargs:
+            bkgsub=kwargs["BkgSub"]
+        else: bkgsub=False
 
-    def run_pa(self,input_raw,camera,bias=False,pixflat=False,mask=True,dumpfile='ttt1.fits'):
+        return self.run_pa(input_raw,camera,bias=bias,pixflat=pixflat,mask=mask,bkgsub=bkgsub,dumpfile=dumpfile)
+
+    def run_pa(self,input_raw,camera,bias=False,pixflat=False,mask=True,bkgsub=False,dumpfile='ttt1.fits'):
         import desispec.preproc
 
         rawimage=input_raw[camera.upper()].data
@@ -113,7 +117,7 @@ class Preproc(pas.PipelineAlg):
         if header["FLAVOR"] not in [None,'bias','arc','flat','science']:
             header["FLAVOR"] = 'science'        
 
-        img = desispec.preproc.preproc(rawimage,header,primary_header,bias=bias,pixflat=pixflat,mask=mask)
+        img = desispec.preproc.preproc(rawimage,header,primary_header,bias=bias,pixflat=pixflat,mask=mask,bkgsub=bkgsub)
                 
         
         if img.mask is not None :
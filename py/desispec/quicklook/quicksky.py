@@ -139,10 +139,11 @@ def compute_sky(fframe,fibermap=None,nsig_clipping=4., apply_resolution=False):
 
         # Use diagonal of skycovar convolved with mean resolution of all fibers
         # first compute average resolution
-        #- computing mean from matrix itself
-        R= (fframe.R.sum()/fframe.nspec).todia()
-        #mean_res_data=np.mean(fframe.resolution_data,axis=0)
-        #R = Resolution(mean_res_data)
+        if fframe.resolution_data is not None:
+            R = Resolution(np.mean(fframe.resolution_data,axis=0)).todia()
+        else:
+            #- quicklook resolution, computing mean from matrix itself
+            R= (fframe.R.sum()/fframe.nspec).todia()
         # compute convolved sky and ivar
         cskycovar=R.dot(skycovar).dot(R.T.todense())
         cskyvar=np.diagonal(cskycovar)
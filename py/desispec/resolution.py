@@ -9,6 +9,8 @@ Use ``python -m desispec.resolution`` to run unit tests.
 
 from __future__ import division, absolute_import
 
+import numbers
+
 import numpy as np
 import scipy.sparse
 import scipy.special
@@ -153,6 +155,122 @@ class Resolution(scipy.sparse.dia_matrix):
         """
         return self.data
 
+class ResolutionStack(object):
+    """Stack of resolution matrices of several spectra on the same wavelength grid.
+
+    Holds the 3D array of sparse diagonals as stored in FITS files and
+    provides batched operations on all spectra at once. The individual
+    :class:`Resolution` matrices are only built when accessed by index.
+
+    Args:
+        data: 3D array[nspec, ndiag, nwave] of sparse diagonal values
+            (same ordering as :meth:`Resolution.to_fits_array`), or a
+            sequence of scipy.sparse.dia_matrix with canonical offsets,
+            or another ResolutionStack.
+
+    Raises:
+        ValueError: Invalid input for initializing a resolution stack.
+
+    Indexing with an integer returns a :class:`Resolution`, indexing with
+    a slice, a boolean mask or an array of indices returns a ResolutionStack.
+    """
+    #- number of spectra processed together in the batched products
+    _block_size = 16
+
+    def __init__(self, data):
+        if isinstance(data, ResolutionStack):
+            data = data.data
+        elif not isinstance(data, np.ndarray) or data.ndim != 3:
+            #- sequence of sparse matrices (e.g. quicklook resolution)
+            data = np.array([_sort_and_symmeterize(r.data, r.offsets)[0] for r in data])
+        if data.ndim != 3:
+            raise ValueError('Cannot initialize ResolutionStack from array shape {}'.format(data.shape))
+        if data.shape[1]%2 == 0:
+            raise ValueError("Number of diagonals ({}) should be odd".format(data.shape[1]))
+        self.data = data
+        self.nspec, self.ndiag, self.nwave = data.shape
+        self.offsets = np.arange(self.ndiag//2,-(self.ndiag//2)-1,-1)
+        self._matrices = [None for i in range(self.nspec)]
+
+    def __len__(self):
+        return self.nspec
+
+    def __getitem__(self, index):
+        if isinstance(index, numbers.Integral):
+            if index < 0:
+                index += self.nspec
+            if self._matrices[index] is None:
+                self._matrices[index] = Resolution(self.data[index])
+            return self._matrices[index]
+        return ResolutionStack(self.data[index])
+
+    def __iter__(self):
+        for i in range(self.nspec):
+            yield self[i]
+
+    def _check_shape(self, x):
+        x = np.asarray(x)
+        if x.shape[-1] != self.nwave or (x.ndim == 2 and x.shape[0] != self.nspec) or x.ndim > 2:
+            raise ValueError('Cannot multiply {} resolution matrices of size {} with array shape {}'.format(self.nspec,self.nwave,x.shape))
+        return x
+
+    def dot(self, x):
+        """Multiply all resolution matrices with a vector.
+
+        Args:
+            x: 1D array[nwave], applied to all spectra, or 2D array[nspec, nwave]
+                with one vector per spectrum.
+
+        Returns:
+            numpy.ndarray: 2D array[nspec, nwave] with R_i.x (or R_i.x_i)
+        """
+        x = self._check_shape(x)
+        result = np.zeros((self.nspec, self.nwave), dtype=np.result_type(self.data, x))
+        #- loop on blocks of spectra to keep the output in cache
+        for b in range(0, self.nspec, self._block_size):
+            e = min(self.nspec, b+self._block_size)
+            r = result[b:e]
+            d = self.data[b:e]
+            xb = x if x.ndim == 1 else x[b:e]
+            for k, offset in enumerate(self.offsets):
+                #- r[:,w] += d[:,k,w+offset]*xb[...,w+offset]
+                if offset >= 0:
+                    r[:, :self.nwave-offset] += d[:, k, offset:]*xb[..., offset:]
+                else:
+                    r[:, -offset:] += d[:, k, :offset]*xb[..., :offset]
+        return result
+
+    def transpose_dot(self, y):
+        """Multiply all transposed resolution matrices with a vector.
+
+        Args:
+            y: 1D array[nwave], applied to all spectra, or 2D array[nspec, nwave]
+                with one vector per spectrum.
+
+        Returns:
+            numpy.ndarray: 2D array[nspec, nwave] with R_i^T.y (or R_i^T.y_i)
+        """
+        y = self._check_shape(y)
+        result = np.zeros((self.nspec, self.nwave), dtype=np.result_type(self.data, y))
+        for b in range(0, self.nspec, self._block_size):
+            e = min(self.nspec, b+self._block_size)
+            r = result[b:e]
+            d = self.data[b:e]
+            yb = y if y.ndim == 1 else y[b:e]
+            for k, offset in enumerate(self.offsets):
+                #- r[:,w] += d[:,k,w]*yb[...,w-offset]
+                if offset >= 0:
+                    r[:, offset:] += d[:, k, offset:]*yb[..., :self.nwave-offset]
+                else:
+                    r[:, :offset] += d[:, k, :offset]*yb[..., -offset:]
+        return result
+
+    def to_fits_array(self):
+        """Convert to the 3D array[nspec, ndiag, nwave] of sparse diagonal values
+        used to store resolution matrices in FITS files.
+        """
+        return self.data
+
 def _gauss_pix(x, mean=0.0, sigma=1.0):
     """
     Utility function to integrate Gaussian density within pixels
@@ -53,6 +53,7 @@ def parse(options=None):
     parser.add_argument("--ntrack", type = int, default=5, required=False, help="Number of solutions to be tracked (only used with triplet-matching, more is safer but slower)")
     parser.add_argument("--toler", type = float, default=0.5, required=False, help="Allowed fractional variation of d wave / dy around prior")
     parser.add_argument("--nmax", type = int, default=100, required=False, help="Max number of measured emission lines kept in triplet-matching algorithm")
+    parser.add_argument("--no-fiber-prior", default=False, action="store_true", help="do not start the line identification of a fiber from the solution of the previous fiber (always use the full triplet matching)")
     parser.add_argument("--out-line-list", type = str, default=False, required=False, help="Write to the list of lines found (can be used as input to specex)")
 
     args = None
@@ -208,6 +209,7 @@ def main(args):
         debug=False
 
         id_dict_of_fibers=[]
+        prior_id_dict=None
         # first loop to find arc lines and do a first matching
         for ii in range(all_spec.shape[1]):
             spec = all_spec[:,ii]
@@ -225,7 +227,7 @@ def main(args):
             id_dict["flux"]  =  flux
 
             try:
-                desiboot.id_arc_lines_using_triplets(id_dict, gd_lines, dlamb,ntrack=args.ntrack,nmax=args.nmax,toler=args.toler)
+                desiboot.id_arc_lines_using_triplets(id_dict, gd_lines, dlamb,ntrack=args.ntrack,nmax=args.nmax,toler=args.toler,prior_id_dict=prior_id_dict)
             except :
                 log.warning(sys.exc_info())
                 log.warning("fiber {:d} ID_ARC failed".format(ii))
@@ -239,6 +241,9 @@ def main(args):
             log.info("Fiber #{:d} n_match={:d} n_detec={:d}".format(ii,len(id_dict['id_pix']),len(id_dict['pixpk'])))
             # Save
             id_dict_of_fibers.append(id_dict)
+            # the solution of this fiber is the starting point of the next one
+            if not args.no_fiber_prior and id_dict['status']=="ok" :
+                prior_id_dict=id_dict
 
 
 
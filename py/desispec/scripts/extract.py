@@ -60,6 +60,12 @@ def parse(options=None):
                         help="fractional PSF model error used to compute chi2 and mask pixels (default = value saved in psf file)")
     parser.add_argument("--fibermap-index", type=int, default=None, required=False,
                         help="start at this index in the fibermap table instead of using the spectro id from the camera")
+    parser.add_argument("--gather", action="store_true",
+                        help="with --mpi, send the bundles to rank 0 that writes the output without intermediate bundle files")
+    parser.add_argument("--dynamic", action="store_true",
+                        help="with --mpi, the ranks take the next bundle from a shared queue when they are done instead of a fixed range of bundles")
+    parser.add_argument("--timing-report", action="store_true",
+                        help="write the extraction and write times of each bundle in OUTPUT-timing.ecsv, and the read, preparation and merge times of each rank in OUTPUT-timing-ranks.ecsv")
 
     args = None
     if options is None:
@@ -149,11 +155,59 @@ regularize: {regularize}
         specmin=specmin, nspec=nspec,
         regularize=args.regularize))
 
+    img.meta['IN_PSF']  = (_trim(psf_file), 'Input spectral PSF')
+    img.meta['IN_IMG']  = (_trim(input_file), 'Input image')
+
     #- The actual extraction
+    frame, results = extract_frame(img, psf, (wstart, wstop, dw), fibers, specmin=specmin, nspec=nspec,
+        fibermap=fibermap, regularize=args.regularize, bundlesize=bundlesize,
+        nsubbundles=args.nsubbundles, nwavestep=args.nwavestep,
+        decorrelate_fibers=args.decorrelate_fibers, psferr=args.psferr,
+        verbose=args.verbose, scores=not args.no_scores)
+
+    #- Write output
+    io.write_frame(args.output, frame)
+
+    if args.model is not None:
+        from astropy.io import fits
+        fits.writeto(args.model, results['modelimage'], header=frame.meta, overwrite=True)
+
+    print('Done {} spectra {}:{} at {}'.format(os.path.basename(input_file),
+        specmin, specmin+nspec, time.asctime()))
+
+
+def extract_frame(img, psf, wavelength, fibers, specmin=0, nspec=None, fibermap=None,
+                  regularize=0.0, bundlesize=25, nsubbundles=6, nwavestep=50,
+                  decorrelate_fibers=False, psferr=None, verbose=False, scores=True):
+    """Extract the spectra of an image in memory
+
+    Args:
+        img : Image object
+        psf : specter PSF object
+        wavelength : (wavemin, wavemax, dw) tuple of the output wavelengths
+        fibers : fiber numbers of the extracted spectra
+
+    Options:
+        specmin, nspec : range of spectra of the PSF to extract
+        fibermap : fibermap table of the extracted spectra
+        regularize, bundlesize, nsubbundles, nwavestep, decorrelate_fibers,
+        psferr, verbose : passed to specter.extract.ex2d
+        scores : if True, append the RAW scores to the frame
+
+    Returns (frame, results), the Frame object and the full output
+    dictionary of ex2d (e.g. results['modelimage']).  The frame header is
+    the image header.
+    """
+    if nspec is None:
+        nspec = psf.nspec
+
+    wstart, wstop, dw = wavelength
+    wave = np.arange(wstart, wstop+dw/2.0, dw)
+
     results = ex2d(img.pix, img.ivar*(img.mask==0), psf, specmin, nspec, wave,
-                 regularize=args.regularize, ndecorr=args.decorrelate_fibers,
-                 bundlesize=bundlesize, wavesize=args.nwavestep, verbose=args.verbose,
-                   full_output=True, nsubbundles=args.nsubbundles,psferr=args.psferr)
+                 regularize=regularize, ndecorr=decorrelate_fibers,
+                 bundlesize=bundlesize, wavesize=nwavestep, verbose=verbose,
+                   full_output=True, nsubbundles=nsubbundles,psferr=psferr)
     flux = results['flux']
     ivar = results['ivar']
     Rdata = results['resolution_data']
@@ -170,8 +224,6 @@ regularize: {regularize}
     img.meta['WAVEMAX'] = (wstop, 'Last wavelength [Angstroms]')
     img.meta['WAVESTEP']= (dw, 'Wavelength step size [Angstroms]')
     img.meta['SPECTER'] = (specter.__version__, 'https://github.com/desihub/specter')
-    img.meta['IN_PSF']  = (_trim(psf_file), 'Input spectral PSF')
-    img.meta['IN_IMG']  = (_trim(input_file), 'Input image')
 
     frame = Frame(wave, flux, ivar, mask=mask, resolution_data=Rdata,
                 fibers=fibers, meta=img.meta, fibermap=fibermap,
@@ -184,24 +236,60 @@ regularize: {regularize}
     frame.meta['BUNIT'] = 'electron/Angstrom'
 
     #- Add scores to frame
-    if not args.no_scores :
+    if scores :
         compute_and_append_frame_scores(frame,suffix="RAW")
 
-    #- Write output
-    io.write_frame(args.output, frame)
-
-    if args.model is not None:
-        from astropy.io import fits
-        fits.writeto(args.model, results['modelimage'], header=frame.meta, overwrite=True)
-
-    print('Done {} spectra {}:{} at {}'.format(os.path.basename(input_file),
-        specmin, specmin+nspec, time.asctime()))
+    return frame, results
 
 
 #- TODO: The level of repeated code from main() is problematic, e.g. the
 #- recent addition of mask and chi2pix code required nearly identical edits
 #- in two places.  Could main(args) just call main_mpi(args, comm=None) ?
 
+def _timing_table(rows, nproc=1, dynamic=False):
+    """Table of the timing of the bundles, sorted by bundle
+
+    Args:
+        rows : list of dict, one per bundle, with the times in seconds
+            of main_mpi
+
+    Options:
+        nproc : number of MPI ranks
+        dynamic : True if the bundles were assigned dynamically
+
+    Returns astropy.table.Table, with one row per bundle.  The one-time
+    costs of the ranks are in the table of _rank_timing_table.
+    """
+    from astropy.table import Table
+    names = ['BUNDLE', 'RANK', 'SPECMIN', 'NSPEC', 'START', 'EXTRACTION',
+             'WRITE_OUTPUT']
+    dtypes = [int, int, int, int] + [float]*(len(names)-4)
+    rows = sorted(rows, key=lambda row: row['BUNDLE'])
+    table = Table([ np.array([ row[name] for row in rows ], dtype=dtype) for name, dtype in zip(names, dtypes) ],
+        names=names)
+    table.meta['NPROC'] = nproc
+    table.meta['DYNAMIC'] = dynamic
+    return table
+
+
+def _rank_timing_table(rows):
+    """Table of the timing of the ranks, sorted by rank
+
+    Args:
+        rows : list of dict, one per rank, with the number of bundles
+            and the times in seconds of main_mpi
+
+    Returns astropy.table.Table, with one row per rank
+    """
+    from astropy.table import Table
+    names = ['RANK', 'NBUNDLE', 'READ_INPUT', 'PREPARATION', 'EXTRACTION',
+             'WRITE_OUTPUT', 'MERGE']
+    dtypes = [int, int] + [float]*(len(names)-2)
+    rows = sorted(rows, key=lambda row: row['RANK'])
+    return Table([ np.array([ row[name] for row in rows ], dtype=dtype) for name, dtype in zip(names, dtypes) ],
+        names=names)
+
+
 def main_mpi(args, comm=None, timing=None):
 
     mark_start = time.time()
@@ -313,6 +401,21 @@ def main_mpi(args, comm=None, timing=None):
     else:
         myfirstbundle = ((mynbundle + 1) * leftover) + (mynbundle * (rank - leftover))
 
+    def mybundles():
+        """Bundles of this rank, either a fixed contiguous range or, with
+        --dynamic, the next bundle of a queue shared by all ranks"""
+        if args.dynamic and comm is not None:
+            from desispec.parallel import TaskCounter
+            counter = TaskCounter(comm)
+            i = counter.next()
+            while i < nbundle:
+                yield bundles[i]
+                i = counter.next()
+            counter.free()
+        else:
+            for b in range(myfirstbundle, myfirstbundle+mynbundle):
+                yield b
+
     if rank == 0:
         #- Print parameters
         log.info("extract:  input = {}".format(input_file))
@@ -322,6 +425,8 @@ def main_mpi(args, comm=None, timing=None):
         log.info("extract:  wavelength = {},{},{}".format(wstart, wstop, dw))
         log.info("extract:  nwavestep = {}".format(args.nwavestep))
         log.info("extract:  regularize = {}".format(args.regularize))
+        if args.dynamic and comm is not None:
+            log.info("extract:  dynamic assignment of {} bundles to {} ranks".format(nbundle, nproc))
 
     # get the root output file
 
@@ -346,7 +451,16 @@ def main_mpi(args, comm=None, timing=None):
 
     failcount = 0
 
-    for b in range(myfirstbundle, myfirstbundle+mynbundle):
+    #- extraction and write times of the bundles of this rank
+    mytiming = list()
+
+    #- with --gather, the bundles of this rank and the sum of their models
+    myframes = list()
+    mymodel = None
+    if args.gather and args.model is not None:
+        mymodel = np.zeros(img.pix.shape)
+
+    for b in mybundles():
         mark_iteration_start = time.time()
         outbundle = "{}_{:02d}.fits".format(outroot, b)
         outmodel = "{}_model_{:02d}.fits".format(outroot, b)
@@ -405,12 +519,17 @@ def main_mpi(args, comm=None, timing=None):
 
             mark_extraction = time.time()
 
-            #- Write output
-            io.write_frame(outbundle, frame)
+            #- Write output, or keep it for rank 0
+            if args.gather:
+                myframes.append(frame)
+                if args.model is not None:
+                    mymodel += results['modelimage']
+            else:
+                io.write_frame(outbundle, frame)
 
-            if args.model is not None:
-                from astropy.io import fits
-                fits.writeto(outmodel, results['modelimage'], header=frame.meta)
+                if args.model is not None:
+                    from astropy.io import fits
+                    fits.writeto(outmodel, results['modelimage'], header=frame.meta)
 
             log.info('extract:  Done {} spectra {}:{} at {}'.format(os.path.basename(input_file),
                 bspecmin[b], bspecmin[b]+bnspec[b], time.asctime()))
@@ -420,6 +539,10 @@ def main_mpi(args, comm=None, timing=None):
 
             time_total_extraction += mark_extraction - mark_iteration_start
             time_total_write_output += mark_write_output - mark_extraction
+            mytiming.append(dict(BUNDLE=b, RANK=rank, SPECMIN=bspecmin[b], NSPEC=bnspec[b],
+                START=mark_iteration_start - mark_start,
+                EXTRACTION=mark_extraction - mark_iteration_start,
+                WRITE_OUTPUT=mark_write_output - mark_extraction))
 
         except:
             # Log the error and increment the number of failures
@@ -438,8 +561,31 @@ def main_mpi(args, comm=None, timing=None):
         raise RuntimeError("some extraction bundles failed")
 
     time_merge = None
-    if rank == 0:
-        mark_merge_start = time.time()
+    mark_merge_start = time.time()
+    if args.gather:
+        #- rank 0 merges the frames and writes the output
+        if comm is not None:
+            frames = comm.gather(myframes, root=0)
+            if rank == 0:
+                frames = [ frame for rankframes in frames for frame in rankframes ]
+        else:
+            frames = myframes
+        model = None
+        if args.model is not None:
+            if comm is not None:
+                from mpi4py import MPI
+                model = np.zeros(mymodel.shape) if rank == 0 else None
+                comm.Reduce(mymodel, model, op=MPI.SUM, root=0)
+            else:
+                model = mymodel
+        if rank == 0:
+            frame = mergebundles.merge_frames(frames)
+            io.write_frame(args.output, frame)
+            if model is not None:
+                from astropy.io import fits
+                fits.writeto(args.model, model)
+    else:
+        #- all ranks read the bundle files, rank 0 writes the output
         mergeopts = [
             '--output', args.output,
             '--force',
@@ -447,25 +593,58 @@ def main_mpi(args, comm=None, timing=None):
         ]
         mergeopts.extend([ "{}_{:02d}.fits".format(outroot, b) for b in bundles ])
         mergeargs = mergebundles.parse(mergeopts)
-        mergebundles.main(mergeargs)
+        mergebundles.main(mergeargs, comm=comm)
 
         if args.model is not None:
-            model = None
-            for b in bundles:
-                outmodel = "{}_model_{:02d}.fits".format(outroot, b)
-                if model is None:
-                    model = fits.getdata(outmodel)
-                else:
-                    #- TODO: test and warn if models overlap for pixels with
-                    #- non-zero values
-                    model += fits.getdata(outmodel)
-
-                os.remove(outmodel)
-
-            fits.writeto(args.model, model)
+            from astropy.io import fits
+            outmodels = [ "{}_model_{:02d}.fits".format(outroot, b) for b in bundles ]
+            mymodel = np.zeros(img.pix.shape)
+            for outmodel in outmodels[rank::nproc]:
+                #- TODO: test and warn if models overlap for pixels with
+                #- non-zero values
+                mymodel += fits.getdata(outmodel)
+            if comm is not None:
+                from mpi4py import MPI
+                model = np.zeros(mymodel.shape) if rank == 0 else None
+                comm.Reduce(mymodel, model, op=MPI.SUM, root=0)
+            else:
+                model = mymodel
+            if rank == 0:
+                for outmodel in outmodels:
+                    os.remove(outmodel)
+                fits.writeto(args.model, model)
+    if rank == 0:
         mark_merge_end = time.time()
         time_merge = mark_merge_end - mark_merge_start
 
+    #- per-bundle report, and per-rank report of the one-time costs
+    mark_merge_end = time.time()
+    myranktiming = dict(RANK=rank, NBUNDLE=len(mytiming),
+        READ_INPUT=mark_read_input - mark_start,
+        PREPARATION=mark_preparation - mark_read_input,
+        EXTRACTION=sum([ row['EXTRACTION'] for row in mytiming ]),
+        WRITE_OUTPUT=sum([ row['WRITE_OUTPUT'] for row in mytiming ]),
+        MERGE=mark_merge_end - mark_merge_start)
+    if comm is not None:
+        mytiming = comm.gather(mytiming, root=0)
+        myranktiming = comm.gather(myranktiming, root=0)
+        if rank == 0:
+            mytiming = [ row for ranktiming in mytiming for row in ranktiming ]
+    else:
+        myranktiming = [myranktiming,]
+    bundletiming = None
+    ranktiming = None
+    if rank == 0:
+        bundletiming = _timing_table(mytiming, nproc=nproc, dynamic=(args.dynamic and comm is not None))
+        ranktiming = _rank_timing_table(myranktiming)
+        if args.timing_report:
+            timingfile = "{}-timing.ecsv".format(outroot)
+            bundletiming.write(timingfile, format='ascii.ecsv', overwrite=True)
+            log.info("extract:  wrote {}".format(timingfile))
+            timingfile = "{}-timing-ranks.ecsv".format(outroot)
+            ranktiming.write(timingfile, format='ascii.ecsv', overwrite=True)
+            log.info("extract:  wrote {}".format(timingfile))
+
     # Resolve difference timer data
 
     if type(timing) is dict:
@@ -474,3 +653,5 @@ def main_mpi(args, comm=None, timing=None):
         timing["total_extraction"] = time_total_extraction
         timing["total_write_output"] = time_total_write_output
         timing["merge"] = time_merge
+        timing["bundles"] = bundletiming
+        timing["ranks"] = ranktiming
@@ -22,6 +22,11 @@ import numpy as np
 import sys
 
 
+class StdStarSelectionError(ValueError):
+    """No valid standard star for the flux calibration (exit code 12 of main)"""
+    pass
+
+
 def parse(options=None):
     parser = argparse.ArgumentParser(description="Compute the flux calibration for a DESI frame using precomputed spectro-photometrically calibrated stellar models.")
 
@@ -81,11 +86,57 @@ def main(args) :
     # read models
     model_flux,model_wave,model_fibers,model_metadata=read_stdstar_models(args.models)
 
-    if args.chi2cut > 0 :
-        ok = np.where(model_metadata["CHI2DOF"]<args.chi2cut)[0]
+    try :
+        fluxcalib = calibrate(frame, model_flux, model_wave, model_fibers, model_metadata, chi2cut=args.chi2cut, delta_color_cut=args.delta_color_cut, chi2cut_nsig=args.chi2cut_nsig)
+    except StdStarSelectionError as err :
+        log.error(err)
+        sys.exit(12)
+
+    # QA
+    if (args.qafile is not None):
+        log.info("performing fluxcalib QA")
+        # Load
+        qaframe = load_qa_frame(args.qafile, frame, flavor=frame.meta['FLAVOR'])
+        # Run
+        #import pdb; pdb.set_trace()
+        qaframe.run_qa('FLUXCALIB', (frame, fluxcalib))
+        # Write
+        if args.qafile is not None:
+            write_qa_frame(args.qafile, qaframe)
+            log.info("successfully wrote {:s}".format(args.qafile))
+        # Figure(s)
+        if args.qafig is not None:
+            qa_plots.frame_fluxcalib(args.qafig, qaframe, frame, fluxcalib)
+
+    # write result
+    write_flux_calibration(args.outfile, fluxcalib, header=frame.meta)
+
+    log.info("successfully wrote %s"%args.outfile)
+
+
+def calibrate(frame, model_flux, model_wave, model_fibers, model_metadata, chi2cut=0., delta_color_cut=0.1, chi2cut_nsig=3.) :
+    """Select the standard star models and compute the flux calibration
+
+    Args:
+        frame : fiberflat corrected and sky subtracted Frame object
+        model_flux, model_wave, model_fibers, model_metadata : as returned by
+            io.read_stdstar_models
+
+    Options:
+        chi2cut, delta_color_cut, chi2cut_nsig : see parse()
+
+    Returns FluxCalib object
+
+    Raises StdStarSelectionError if chi2cut discards all stars or if the
+    model fibers are not standard stars in the frame fibermap
+    """
+
+    log=get_logger()
+
+    if chi2cut > 0 :
+        ok = np.where(model_metadata["CHI2DOF"]<chi2cut)[0]
         if ok.size == 0 :
-            log.error("chi2cut has discarded all stars")
-            sys.exit(12)
+            raise StdStarSelectionError("chi2cut has discarded all stars")
         nstars=model_flux.shape[0]
         nbad=nstars-ok.size
         if nbad>0 :
@@ -94,27 +145,27 @@ def main(args) :
             model_fibers=model_fibers[ok]
             model_metadata=model_metadata[:][ok]
     
-    if args.delta_color_cut > 0 :
-        ok = np.where(np.abs(model_metadata["MODEL_G-R"]-model_metadata["DATA_G-R"])<args.delta_color_cut)[0]
+    if delta_color_cut > 0 :
+        ok = np.where(np.abs(model_metadata["MODEL_G-R"]-model_metadata["DATA_G-R"])<delta_color_cut)[0]
         nstars=model_flux.shape[0]
         nbad=nstars-ok.size
         if nbad>0 :
-            log.warning("discarding %d star(s) out of %d because |delta_color|>%f"%(nbad,nstars,args.delta_color_cut))
+            log.warning("discarding %d star(s) out of %d because |delta_color|>%f"%(nbad,nstars,delta_color_cut))
             model_flux=model_flux[ok]
             model_fibers=model_fibers[ok]
             model_metadata=model_metadata[:][ok]
     
 
     # automatically reject stars that ar chi2 outliers
-    if args.chi2cut_nsig > 0 :
+    if chi2cut_nsig > 0 :
         mchi2=np.median(model_metadata["CHI2DOF"])
         rmschi2=np.std(model_metadata["CHI2DOF"])
-        maxchi2=mchi2+args.chi2cut_nsig*rmschi2
+        maxchi2=mchi2+chi2cut_nsig*rmschi2
         ok=np.where(model_metadata["CHI2DOF"]<=maxchi2)[0]
         nstars=model_flux.shape[0]
         nbad=nstars-ok.size
         if nbad>0 :
-            log.warning("discarding %d star(s) out of %d because reduced chi2 outliers (at %d sigma, giving rchi2<%f )"%(nbad,nstars,args.chi2cut_nsig,maxchi2))
+            log.warning("discarding %d star(s) out of %d because reduced chi2 outliers (at %d sigma, giving rchi2<%f )"%(nbad,nstars,chi2cut_nsig,maxchi2))
             model_flux=model_flux[ok]
             model_fibers=model_fibers[ok]
             model_metadata=model_metadata[:][ok]
@@ -129,27 +180,6 @@ def main(args) :
     if len(w)>0:
         for i in model_fibers%500:
             log.error("inconsistency with spectrum %d, OBJTYPE='%s' in fibermap"%(i,fibermap["OBJTYPE"][i]))
-        sys.exit(12)
-
-    fluxcalib = compute_flux_calibration(frame, model_wave, model_flux, model_fibers%500)
+        raise StdStarSelectionError("model fibers {} are not standard stars".format(model_fibers[w]))
 
-    # QA
-    if (args.qafile is not None):
-        log.info("performing fluxcalib QA")
-        # Load
-        qaframe = load_qa_frame(args.qafile, frame, flavor=frame.meta['FLAVOR'])
-        # Run
-        #import pdb; pdb.set_trace()
-        qaframe.run_qa('FLUXCALIB', (frame, fluxcalib))
-        # Write
-        if args.qafile is not None:
-            write_qa_frame(args.qafile, qaframe)
-            log.info("successfully wrote {:s}".format(args.qafile))
-        # Figure(s)
-        if args.qafig is not None:
-            qa_plots.frame_fluxcalib(args.qafig, qaframe, frame, fluxcalib)
-
-    # write result
-    write_flux_calibration(args.outfile, fluxcalib, header=frame.meta)
-
-    log.info("successfully wrote %s"%args.outfile)
+    return compute_flux_calibration(frame, model_wave, model_flux, model_fibers%500)
@@ -6,13 +6,14 @@ from __future__ import absolute_import, division, print_function
 import os, sys, time
 
 import numpy as np
+import fitsio
 
 from desiutil.log import get_logger
 
 from .. import io
 from ..pixgroup import FrameLite, SpectraLite
 from ..pixgroup import (get_exp2healpix_map, add_missing_frames,
-        frames2spectra, update_frame_cache)
+        frames2spectra_many, plan_healpix_order, FrameCache)
 
 def parse(options=None):
     import argparse
@@ -22,6 +23,12 @@ def parse(options=None):
     parser.add_argument("--nights", type=str,  help="YEARMMDD to add")
     parser.add_argument("--nside", type=int,default=64,help="input spectra healpix nside")
     parser.add_argument("-o", "--outdir", type=str,  help="output directory")
+    parser.add_argument("--index", type=str,
+            help="exposure to healpix index file; default spectra-NSIDE/exp2healpix-NSIDE.fits in reduxdir")
+    parser.add_argument("--no-index", action="store_true",
+            help="do not use or update the exposure to healpix index")
+    parser.add_argument("--max-cache-gb", type=float, default=4.0,
+            help="maximum size of the cframe cache per rank [GB]")
     parser.add_argument("--mpi", action="store_true",
             help="Use MPI for parallelism")
 
@@ -61,20 +68,37 @@ def main(args=None, comm=None):
 
     #- Get table NIGHT EXPID SPECTRO HEALPIX NTARGETS 
     t0 = time.time()
+    if args.no_index:
+        indexfile = None
+    elif args.index:
+        indexfile = args.index
+    else:
+        indexfile = io.findfile('exp2healpix', nside=args.nside,
+                                specprod_dir=args.reduxdir)
+
     exp2pix = get_exp2healpix_map(nights=nights, comm=comm,
-                                  specprod_dir=args.reduxdir)
+                                  specprod_dir=args.reduxdir, nside=args.nside,
+                                  indexfile=indexfile)
     assert len(exp2pix) > 0
     if rank == 0:
         dt = time.time() - t0
         log.debug('Exposure to healpix mapping took {:.1f} sec'.format(dt))
         sys.stdout.flush()
 
-    allpix = sorted(set(exp2pix['HEALPIX']))
+    #- Order pixels such that consecutive pixels share frames, and give
+    #- contiguous chunks of that walk to each rank
+    allpix = plan_healpix_order(exp2pix)
     mypix = np.array_split(allpix, size)[rank]
     log.info('Rank {} will process {} pixels'.format(rank, len(mypix)))
     sys.stdout.flush()
 
-    frames = dict()
+    cache = FrameCache(max_bytes=int(args.max_cache_gb*1024**3),
+            specprod_dir=args.reduxdir)
+    allframekeys = set()
+
+    #- Frames to add to each pixel, grouping the pixels that need the same
+    #- frames, in the order of mypix
+    groups = dict()
     for pix in mypix:
         iipix = np.where(exp2pix['HEALPIX'] == pix)[0]
         ntargets = np.sum(exp2pix['NTARGETS'][iipix])
@@ -103,10 +127,8 @@ def main(args=None, comm=None):
         if args.outdir:
             specfile = os.path.join(args.outdir, os.path.basename(specfile))
 
-        oldspectra = None
         if os.path.exists(specfile):
-            oldspectra = SpectraLite.read(specfile)
-            fm = oldspectra.fibermap
+            fm = fitsio.read(specfile, 'FIBERMAP', columns=['NIGHT', 'EXPID', 'SPECTROID'])
             for night, expid, spectro in set(zip(fm['NIGHT'], fm['EXPID'], fm['SPECTROID'])):
                 for band in ['b', 'r', 'z']:
                     camera = band + str(spectro)
@@ -117,26 +139,39 @@ def main(args=None, comm=None):
             log.info('pix {} already has all exposures; moving on'.format(pix))
             continue
 
+        groups.setdefault(tuple(sorted(framekeys)), list()).append((pix, specfile))
+
+    for framekeys, pixfiles in groups.items():
         #- Load new frames to add
-        log.info('pix {} has {} frames to add'.format(pix, len(framekeys)))
-        update_frame_cache(frames, framekeys, specprod_dir=args.reduxdir)
+        pixels = [pix for pix, specfile in pixfiles]
+        log.info('pixels {} have {} frames to add'.format(
+            ','.join([str(pix) for pix in pixels]), len(framekeys)))
+        frames = cache.get_frames(list(framekeys))
+        allframekeys.update(framekeys)
 
         #- add any missing frames
         add_missing_frames(frames)
 
-        #- convert individual FrameLite objects into SpectraLite
-        newspectra = frames2spectra(frames, pix)
+        #- convert individual FrameLite objects into SpectraLite for all
+        #- the pixels, slicing each frame once
+        allspectra = frames2spectra_many(frames, pixels, nside=args.nside)
+
+        for pix, specfile in pixfiles:
+            newspectra = allspectra.pop(pix)
+
+            #- Combine with any previous spectra if needed
+            if os.path.exists(specfile):
+                spectra = SpectraLite.read(specfile) + newspectra
+            else:
+                spectra = newspectra
+
+            #- Write new spectra file
+            header = dict(HPXNSIDE=args.nside, HPXPIXEL=pix, HPXNEST=True)
+            spectra.write(specfile, header=header)
 
-        #- Combine with any previous spectra if needed
-        if oldspectra:
-            spectra = oldspectra + newspectra
-        else:
-            spectra = newspectra
+    log.info('Rank {} {} for {} distinct frames'.format(
+        rank, cache.stats(), len(allframekeys)))
 
-        #- Write new spectra file
-        header = dict(HPXNSIDE=args.nside, HPXPIXEL=pix, HPXNEST=True)
-        spectra.write(specfile, header=header)
-    
     if rank == 0:
         dt = time.time() - t0
         log.info('Done in {:.1f} minutes'.format(dt/60))
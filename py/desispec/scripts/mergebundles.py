@@ -15,7 +15,6 @@ from __future__ import absolute_import, division, print_function
 import sys
 import os
 import numpy as np
-from astropy.io import fits
 
 from desispec.frame import Frame
 import desispec.io
@@ -32,6 +31,8 @@ def parse(options=None):
         help="delete input files when done")
     parser.add_argument("-f", "--force", action="store_true",
         help="merge files even if some fibers are missing")
+    parser.add_argument("--ncpu", type=int, default=1,
+        help="number of processes reading the input files")
     parser.add_argument("files", nargs='*')
 
     args = None
@@ -42,32 +43,25 @@ def parse(options=None):
     return args
 
 
-def main(args):
+def merge_frames(frames, nspec=500):
+    """Merge the frames of bundles of fibers of a spectrograph.
 
-    log = get_logger()
-
-    nspec = 500  #- Hardcode!  Number of DESI fibers per spectrograph
+    Args:
+        frames: list of desispec.frame.Frame objects with resolution data,
+            on the same wavelength grid.
 
-    #- Sanity check that all spectra are represented
-    fibers = set()
-    for filename in args.files:
-        x = fits.getdata(filename, 'FIBERMAP')
-        fibers.update( set(x['FIBER']) )
-
-    if len(fibers) != nspec:
-        msg = "Input files only have {} instead of {} spectra".format(len(fibers), nspec)
-        if args.force:
-            log.warning(msg)
-        else:
-            log.fatal(msg)
-            sys.exit(1)
+    Options:
+        nspec: number of fibers of the spectrograph.
 
-    #- Read a file to get basic dimensions
-    w = fits.getdata(args.files[0], 'WAVELENGTH')
+    Returns:
+        desispec.frame.Frame with nspec fibers (the missing fibers have
+        ivar=0), with the header of the first frame. The scores are merged
+        if present in all frames.
+    """
+    w = frames[0].wave
     nwave = len(w)
-    R1 = fits.getdata(args.files[0], 'RESOLUTION')
-    ndiag = R1.shape[1]
-    hdr = fits.getheader(args.files[0])
+    ndiag = frames[0].resolution_data.shape[1]
+    hdr = frames[0].meta
 
     camera = hdr['CAMERA'].lower()     #- b0, r1, .. z9
     spectrograph = int(camera[1])
@@ -81,32 +75,110 @@ def main(args):
     mask = np.zeros( (nspec, nwave), dtype=np.uint32)
     chi2pix = np.zeros( (nspec, nwave) )
 
+    merge_scores = all([frame.scores is not None for frame in frames])
+    scores = None
+    scores_comments = None
+    if merge_scores:
+        scores = dict()
+        first = frames[0].scores
+        for k in _score_names(first):
+            scores[k] = np.zeros(nspec, dtype=np.asarray(first[k]).dtype)
+        scores_comments = frames[0].scores_comments
+
     #- Fill them!
-    for filename in args.files :
-        fx = fits.open(filename)
-        xhdr = fx[0].header
-        xflux = fx['FLUX'].data
-        xivar = fx['IVAR'].data
-        xR = fx['RESOLUTION'].data
-        xfibermap = fx['FIBERMAP'].data
-        xmask = fx['MASK'].data
-        xchi2pix = fx['CHI2PIX'].data
-        fx.close()
-
-        ii = xfibermap['FIBER'] % nspec
-
-        flux[ii] = xflux
-        ivar[ii] = xivar
-        R[ii] = xR
-        fibermap[ii] = xfibermap
-        mask[ii] = xmask
-        chi2pix[ii] = xchi2pix
+    for frame in frames :
+        ii = np.asarray(frame.fibers) % nspec
+
+        flux[ii] = frame.flux
+        ivar[ii] = frame.ivar
+        R[ii] = frame.resolution_data
+        mask[ii] = frame.mask
+        if frame.chi2pix is not None:
+            chi2pix[ii] = frame.chi2pix
+        if frame.fibermap is not None:
+            xfibermap = frame.fibermap
+            names = xfibermap.dtype.names
+            for name in fibermap.colnames:
+                if name in names:
+                    fibermap[name][ii] = xfibermap[name]
+        if merge_scores:
+            for k in scores:
+                scores[k][ii] = frame.scores[k]
+
+    return Frame(w, flux, ivar, mask=mask, resolution_data=R,
+                spectrograph=spectrograph,
+                meta=hdr, fibermap=fibermap, chi2pix=chi2pix,
+                scores=scores, scores_comments=scores_comments)
+
+
+def _score_names(scores):
+    if isinstance(scores, dict):
+        return list(scores.keys())
+    return list(scores.dtype.names)
+
+
+def read_bundles(filenames, ncpu=1, comm=None):
+    """Read the frames of bundle files, in parallel.
+
+    Args:
+        filenames: list of frame files.
+
+    Options:
+        ncpu: number of processes of a multiprocessing pool (without comm).
+        comm: MPI communicator; each rank reads a share of the files.
+
+    Returns:
+        list of desispec.frame.Frame, in the order of filenames, on rank 0
+        (None on the other ranks).
+    """
+    if comm is not None:
+        myframes = [ desispec.io.read_frame(filename) for filename in filenames[comm.rank::comm.size] ]
+        allframes = comm.gather(myframes, root=0)
+        if comm.rank != 0:
+            return None
+        #- undo the round-robin distribution
+        frames = [None, ] * len(filenames)
+        for rank, rankframes in enumerate(allframes):
+            frames[rank::comm.size] = rankframes
+        return frames
+    elif ncpu > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(ncpu, len(filenames)))
+        frames = pool.map(desispec.io.read_frame, filenames)
+        pool.close()
+        pool.join()
+        return frames
+    else:
+        return [ desispec.io.read_frame(filename) for filename in filenames ]
+
+
+def main(args, comm=None):
+
+    log = get_logger()
+
+    nspec = 500  #- Hardcode!  Number of DESI fibers per spectrograph
+
+    #- Each input file is read once
+    frames = read_bundles(args.files, ncpu=args.ncpu, comm=comm)
+    if comm is not None and comm.rank != 0:
+        return
+
+    #- Sanity check that all spectra are represented
+    fibers = set()
+    for frame in frames:
+        fibers.update( set(frame.fibers) )
+
+    if len(fibers) != nspec:
+        msg = "Input files only have {} instead of {} spectra".format(len(fibers), nspec)
+        if args.force:
+            log.warning(msg)
+        else:
+            log.fatal(msg)
+            sys.exit(1)
 
     #- Write it out
     print("Writing", args.output)
-    frame = Frame(w, flux, ivar, mask=mask, resolution_data=R,
-                spectrograph=spectrograph,
-                meta=hdr, fibermap=fibermap, chi2pix=chi2pix)
+    frame = merge_frames(frames, nspec=nspec)
     desispec.io.write_frame(args.output, frame)
 
     #- Scary!  Delete input files
@@ -939,6 +939,10 @@ Where supported commands are (use desi_pipe <command> --help for details):
         parser.add_argument("--once", required=False, action="store_true",
             default=False, help="Print info once without clearing the terminal")
 
+        parser.add_argument("--db-shadow", type=str, required=False,
+            default=None, help="If using sqlite, query a copy of the DB in "
+            "this (local disk) directory, refreshed when the DB changes.")
+
         args = parser.parse_args(sys.argv[2:])
 
         import signal
@@ -946,11 +950,13 @@ Where supported commands are (use desi_pipe <command> --help for details):
         import numpy as np
 
         def signal_handler(signal, frame):
+            db.close()
             sys.exit(0)
         signal.signal(signal.SIGINT, signal_handler)
 
         dbpath = io.get_pipe_database()
-        db = pipe.load_db(dbpath, mode="r", user=args.db_postgres_user)
+        db = pipe.load_db(dbpath, mode="r", user=args.db_postgres_user,
+            persistent=True, shadowdir=args.db_shadow)
 
         tasktypes = pipe.tasks.base.default_task_chain
 
@@ -1000,6 +1006,7 @@ Where supported commands are (use desi_pipe <command> --help for details):
 
         if args.once:
             print_status(clear=False)
+            db.close()
         else:
             while True:
                 print_status(clear=True)
@@ -35,6 +35,21 @@ def parse(options=None):
     parser.add_argument("--taskfile", required=False, default=None,
         help="Use a file containing the list of tasks.  If not specified, "
         "read list of tasks from STDIN")
+    parser.add_argument("--dynamic", required=False, default=False,
+        action="store_true", help="Hand out tasks to process groups as they "
+        "finish their previous task, longest first, instead of a static "
+        "assignment based on run time estimates.")
+    parser.add_argument("--db-persistent", required=False, default=False,
+        action="store_true", help="With sqlite, keep one DB connection per "
+        "process instead of opening one for every DB access.")
+    parser.add_argument("--db-wal", required=False, default=False,
+        action="store_true", help="With sqlite, use write-ahead logging so "
+        "that readers are not blocked by writers.  Only for file systems "
+        "with working locks and shared memory between all hosts using the DB.")
+    parser.add_argument("--jit-warmup", required=False,
+        default=(os.getenv("DESI_NUMBA_WARMUP", "0") not in ("0", "")),
+        action="store_true", help="Compile, or load from the cache, the numba "
+        "kernels before running the tasks (default $DESI_NUMBA_WARMUP).")
 
     args = None
     if options is None:
@@ -70,6 +85,18 @@ def main(args, comm=None):
             log.info("Python startup time unknown since $STARTTIME not set")
         sys.stdout.flush()
 
+    # Compile the numba kernels once on the first process, so that the others
+    # load them from the on-disk cache instead of compiling them concurrently.
+
+    if args.jit_warmup:
+        from .. import jit
+        if rank == 0:
+            jit.warmup()
+        if comm is not None:
+            comm.barrier()
+            if rank != 0:
+                jit.warmup(verbose=False)
+
     # raw and production locations
 
     rawdir = os.path.abspath(io.rawdata_root())
@@ -102,7 +129,10 @@ def main(args, comm=None):
 
     # run it!
 
-    (db, opts) = pipe.load_prod("w")
+    dbopts = dict(persistent=args.db_persistent)
+    if args.db_wal:
+        dbopts["journalmode"] = "wal"
+    (db, opts) = pipe.load_prod("w", **dbopts)
 
     ntask = len(tasklist)
     ready = None
@@ -110,10 +140,13 @@ def main(args, comm=None):
     failed = None
     if args.nodb:
         ready, done, failed = pipe.run_task_list(args.tasktype, tasklist, opts,
-                                           comm=comm, db=None)
+                                           comm=comm, db=None,
+                                           dynamic=args.dynamic)
     else:
         ready, done, failed = pipe.run_task_list(args.tasktype, tasklist, opts,
-                                           comm=comm, db=db)
+                                           comm=comm, db=db,
+                                           dynamic=args.dynamic)
+    db.close()
 
     t2 = datetime.datetime.now()
 
@@ -122,6 +155,8 @@ def main(args, comm=None):
         dt = t2 - t1
         minutes, seconds = dt.seconds//60, dt.seconds%60
         log.info("Run time: {} min {} sec".format(minutes, seconds))
+        from .. import jit
+        jit.report()
         sys.stdout.flush()
 
     if comm is not None:
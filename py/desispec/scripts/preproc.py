@@ -75,6 +75,8 @@ to use, but also only if a single camera is specified.
     parser.add_argument('--ccd-calib-filename', required=False, default=None,
                         help = 'specify a difference ccd calibration filename (for dev. purpose), default is in desispec/data/ccd')
     parser.add_argument('--fill-header', type = str, default = None,  nargs ='*', help="fill camera header with contents of those of other hdus")
+    parser.add_argument('--ncpu', type = int, default = None, required=False,
+                        help = 'number of processes preprocessing the cameras concurrently (default is min(number of cameras, number of cores/2))')
     
     #- uses sys.argv if options=None
     args = parser.parse_args(options)
@@ -134,33 +136,30 @@ def main(args=None):
         ccd_calibration_filename = args.ccd_calib_filename
 
 
-    for camera in args.cameras:
-        try:
-            img = io.read_raw(args.infile, camera,
-
-                              bias=bias, dark=dark, pixflat=pixflat, mask=mask, bkgsub=args.bkgsub,
-                              nocosmic=args.nocosmic,                              
-                              cosmics_nsig=args.cosmics_nsig,
-                              cosmics_cfudge=args.cosmics_cfudge,
-                              cosmics_c2fudge=args.cosmics_c2fudge,
-                              ccd_calibration_filename=ccd_calibration_filename,
-                              nocrosstalk=args.nocrosstalk,
-                              nogain=args.nogain,
-                              fill_header=args.fill_header
-            )
-        except IOError:
-            log.error('Error while reading or preprocessing camera {} in {}'.format(camera, args.infile))
-            continue
-
-        if(args.zero_masked) :
-            img.pix *= (img.mask==0)
-
-        if args.outfile is None:
-            night = img.meta['NIGHT']
-            expid = img.meta['EXPID']
-            outfile = io.findfile('preproc', night=night, expid=expid, camera=camera,
-                                  outdir=args.outdir)
-        else:
-            outfile = args.outfile
-
-        io.write_image(outfile, img)
+    opts = dict(bias=bias, dark=dark, pixflat=pixflat, mask=mask, bkgsub=args.bkgsub,
+                nocosmic=args.nocosmic,
+                cosmics_nsig=args.cosmics_nsig,
+                cosmics_cfudge=args.cosmics_cfudge,
+                cosmics_c2fudge=args.cosmics_c2fudge,
+                ccd_calibration_filename=ccd_calibration_filename,
+                nocrosstalk=args.nocrosstalk,
+                nogain=args.nogain,
+                fill_header=args.fill_header)
+
+    if args.outfile is None:
+        #- all cameras at once, the output files are written by the workers
+        io.read_raw_exposure(args.infile, cameras=args.cameras, outdir=args.outdir,
+                             nproc=args.ncpu, zero_masked=args.zero_masked, **opts)
+        return
+
+    camera = args.cameras[0]
+    try:
+        img = io.read_raw(args.infile, camera, **opts)
+    except IOError:
+        log.error('Error while reading or preprocessing camera {} in {}'.format(camera, args.infile))
+        return
+
+    if(args.zero_masked) :
+        img.pix *= (img.mask==0)
+
+    io.write_image(args.outfile, img)
@@ -0,0 +1,212 @@
+"""
+Process the science frames of one spectrograph of an exposure in a single
+process, from extraction (or extracted frames) to flux calibrated frames,
+keeping the frames in memory between the steps.
+
+The steps are the same as the ones of the pipeline, i.e. desi_extract_spectra,
+desi_compute_sky, desi_fit_stdstars, desi_compute_fluxcalibration and
+desi_process_exposure, but the frames are read (or extracted) only once and
+only the final products (sky, stdstars, calib and cframe files) are written,
+with optional checkpoints of the extracted frames.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import time
+
+import numpy as np
+from astropy.table import Table
+
+from desispec import io
+from desispec.io.fluxcalibration import write_flux_calibration
+from desispec.sky import compute_sky
+from desispec.specscore import compute_and_append_frame_scores
+from desispec.scripts import procexp
+from desispec.scripts import stdstars
+from desispec.scripts import fluxcalibration
+from desiutil.log import get_logger
+
+#- same defaults as the extract task of the pipeline
+default_wavelength = {
+    "b" : "3579.0,5939.0,0.8",
+    "r" : "5635.0,7731.0,0.8",
+    "z" : "7445.0,9824.0,0.8",
+}
+
+
+def parse(options=None):
+    parser = argparse.ArgumentParser(description="Process the science frames of one spectrograph of an exposure in memory, from extraction to flux calibrated frames.")
+    parser.add_argument('-n','--night', type = str, required=True,
+                        help = 'night YEARMMDD')
+    parser.add_argument('-e','--expid', type = int, required=True,
+                        help = 'exposure id')
+    parser.add_argument('-s','--spectrograph', type = int, required=True,
+                        help = 'spectrograph number, 0-9')
+    parser.add_argument('--cameras', type = str, default = 'b,r,z',
+                        help = 'comma separated list of camera bands (default %(default)s)')
+    parser.add_argument('--specprod-dir', type = str, default = None,
+                        help = 'overrides $DESI_SPECTRO_REDUX/$SPECPROD/')
+    parser.add_argument('--extract', action='store_true',
+                        help = 'extract the frames from the preproc images instead of reading the frame files')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help = 'with --extract, write the extracted frame files')
+    parser.add_argument('--psferr', type = float, default = 0.05,
+                        help = 'fractional PSF model error for the extraction (default %(default)s)')
+    parser.add_argument('--starmodels', type = str, default = None,
+                        help = 'path of spectro-photometric stellar spectra fits (default is first $DESI_BASIS_TEMPLATES/star_templates_*.fits)')
+    parser.add_argument('--color', type = str, default = "G-R", choices=['G-R', 'R-Z'],
+                        help = 'color used for filtering the standard stars')
+    parser.add_argument('--delta-color', type = float, default = 0.2,
+                        help = 'max delta-color for the selection of standard stars')
+    parser.add_argument('--cosmics-nsig', type = float, default = 0,
+                        help = 'n sigma rejection for cosmics in 1D after sky subtraction (default, no rejection)')
+    parser.add_argument('--sky-throughput-correction', action='store_true',
+                        help = 'apply a throughput correction when subtraction the sky')
+    parser.add_argument('--ncpu', type = int, default = stdstars.default_nproc,
+                        help = 'number of cpu for the standard star fit')
+
+    args = None
+    if options is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(options)
+    return args
+
+
+def _starmodels(args) :
+    if args.starmodels is not None :
+        return args.starmodels
+    import glob
+    if "DESI_BASIS_TEMPLATES" in os.environ :
+        filenames = sorted(glob.glob(os.environ["DESI_BASIS_TEMPLATES"]+"/star_templates_*.fits"))
+        if len(filenames) > 0 :
+            return filenames[0]
+    raise RuntimeError("could not find the stellar templates, use --starmodels or set $DESI_BASIS_TEMPLATES")
+
+
+def extract(night, expid, camera, psferr=0.05, specprod_dir=None) :
+    """Extract the frame of a camera from its preproc image, in memory
+
+    Args:
+        night : YEARMMDD string
+        expid : integer exposure id
+        camera : 'b0' 'r1' .. 'z9'
+
+    Options:
+        psferr : fractional PSF model error
+        specprod_dir : overrides $DESI_SPECTRO_REDUX/$SPECPROD/
+
+    Returns Frame object, with the RAW scores
+    """
+    #- specter is only needed for the extraction
+    from specter.psf import load_psf
+    from desispec.scripts import extract as extract_script
+
+    input_file = io.findfile('preproc', night, expid, camera, specprod_dir=specprod_dir)
+    psf_file = io.findfile('psf', night, expid, camera, specprod_dir=specprod_dir)
+    fibermap_file = io.findfile('fibermap', night, expid, specprod_dir=specprod_dir)
+
+    psf = load_psf(psf_file)
+    img = io.read_image(input_file)
+    nspec = psf.nspec
+    fibermin = int(camera[1]) * nspec
+    fibermap = io.read_fibermap(fibermap_file)[fibermin:fibermin+nspec]
+
+    wstart, wstop, dw = [float(tmp) for tmp in default_wavelength[camera[0]].split(',')]
+    img.meta['IN_PSF']  = (extract_script._trim(psf_file), 'Input spectral PSF')
+    img.meta['IN_IMG']  = (extract_script._trim(input_file), 'Input image')
+
+    frame, results = extract_script.extract_frame(img, psf, (wstart, wstop, dw),
+        fibermap['FIBER'], specmin=0, nspec=nspec, fibermap=fibermap, psferr=psferr)
+    return frame
+
+
+def main(args) :
+
+    log = get_logger()
+
+    night = args.night
+    expid = args.expid
+    specprod_dir = args.specprod_dir
+    cameras = [ "{}{}".format(band.strip(), args.spectrograph) for band in args.cameras.split(',') ]
+    starmodels = _starmodels(args)
+
+    def findfile(filetype, camera=None) :
+        return io.findfile(filetype, night, expid, camera, spectrograph=args.spectrograph, specprod_dir=specprod_dir)
+
+    t0 = time.time()
+
+    #- Frames and sky in memory, and subsets of the standard stars
+    #- before fiberflat correction for the star fit
+    frames = dict()
+    skies = dict()
+    stdframes = dict()
+    stdskies = dict()
+    stdflats = dict()
+
+    for camera in cameras :
+
+        if args.extract :
+            log.info("extracting {}".format(camera))
+            frame = extract(night, expid, camera, psferr=args.psferr, specprod_dir=specprod_dir)
+            if args.checkpoint :
+                filename = findfile('frame', camera)
+                io.write_frame(filename, frame)
+                log.info("wrote checkpoint {}".format(filename))
+        else :
+            frame = io.read_frame(findfile('frame', camera))
+            compute_and_append_frame_scores(frame,suffix="RAW")
+
+        fiberflat = io.read_fiberflat(io.findfile('fiberflatnight', night, camera=camera, specprod_dir=specprod_dir))
+
+        #- the star fit uses the frames before fiberflat correction
+        stars = np.where(frame.fibermap["OBJTYPE"]=="STD")[0]
+        if stars.size > 0 :
+            stdframes[camera] = [frame[stars]]
+            stdflats[camera] = fiberflat[stars]
+
+        procexp.process(frame, fiberflat=fiberflat)
+
+        log.info("compute sky {}".format(camera))
+        skymodel = compute_sky(frame)
+        io.write_sky(findfile('sky', camera), skymodel, frame.meta)
+        if stars.size > 0 :
+            stdskies[camera] = [skymodel[stars]]
+
+        frames[camera] = frame
+        skies[camera] = skymodel
+
+    t1 = time.time()
+    log.info("frames and sky in {:.1f} sec".format(t1-t0))
+
+    #- Standard stars of this spectrograph
+    normflux, stdwave, starfibers, data = stdstars.fit_stdstars(stdframes, stdskies, stdflats, starmodels,
+        color=args.color, delta_color=args.delta_color, ncpu=args.ncpu)
+    io.write_stdstar_models(findfile('stdstars'), normflux, stdwave, starfibers, data)
+
+    t2 = time.time()
+    log.info("standard stars in {:.1f} sec".format(t2-t1))
+
+    #- same table as read by io.read_stdstar_models
+    metadata = Table([ data[k] for k in data.keys() if len(data[k].shape)==1 ],
+        names=[ k for k in data.keys() if len(data[k].shape)==1 ])
+
+    for camera in cameras :
+        frame = frames[camera]
+
+        procexp.process(frame, skymodel=skies[camera], cosmics_nsig=args.cosmics_nsig,
+            sky_throughput_correction=args.sky_throughput_correction)
+
+        log.info("compute flux calibration {}".format(camera))
+        fluxcalib = fluxcalibration.calibrate(frame, normflux, stdwave, starfibers, metadata)
+        write_flux_calibration(findfile('calib', camera), fluxcalib, header=frame.meta)
+
+        procexp.process(frame, fluxcalib=fluxcalib)
+
+        filename = findfile('cframe', camera)
+        io.write_frame(filename, frame, units='1e-17 erg/(s cm2 Angstrom)')
+        log.info("successfully wrote {}".format(filename))
+
+    log.info("calibration in {:.1f} sec, total {:.1f} sec".format(time.time()-t2, time.time()-t0))
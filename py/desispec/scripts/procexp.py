@@ -56,55 +56,86 @@ def main(args):
     #- Raw scores already added in extraction, but just in case they weren't
     #- it is harmless to rerun to make sure we have them.
     compute_and_append_frame_scores(frame,suffix="RAW")
-    
-    if args.cosmics_nsig>0 and args.sky==None : # Reject cosmics (otherwise do it after sky subtraction)
-        log.info("cosmics ray 1D rejection")
-        reject_cosmic_rays_1d(frame,args.cosmics_nsig)
-    
+
+    fiberflat = None
     if args.fiberflat!=None :
-        log.info("apply fiberflat")
-        # read fiberflat
         fiberflat = read_fiberflat(args.fiberflat)
 
+    skymodel = None
+    if args.sky!=None :
+        skymodel = read_sky(args.sky)
+
+    fluxcalib = None
+    if args.calib!=None :
+        fluxcalib = read_flux_calibration(args.calib)
+
+    process(frame, fiberflat=fiberflat, skymodel=skymodel, fluxcalib=fluxcalib,
+            cosmics_nsig=args.cosmics_nsig,
+            sky_throughput_correction=args.sky_throughput_correction)
+
+    # save output
+    write_frame(args.outfile, frame, units='1e-17 erg/(s cm2 Angstrom)')
+
+    log.info("successfully wrote %s"%args.outfile)
+
+
+def process(frame, fiberflat=None, skymodel=None, fluxcalib=None, cosmics_nsig=0,
+            sky_throughput_correction=False):
+    """Apply fiberflat, sky subtraction and calibration to a frame, in place
+
+    Args:
+        frame : Frame object
+
+    Options:
+        fiberflat : FiberFlat object
+        skymodel : SkyModel object
+        fluxcalib : FluxCalib object
+        cosmics_nsig : n sigma rejection for cosmics in 1D, after sky
+            subtraction if skymodel is given (default 0, no rejection)
+        sky_throughput_correction : apply a throughput correction when
+            subtracting the sky
+
+    The scores of each step are appended to the frame.  The steps can be done
+    in separate calls in this order, e.g. to compute the sky model of a
+    fiberflat corrected frame before subtracting it.
+    """
+    log = get_logger()
+
+    if cosmics_nsig>0 and skymodel is None : # Reject cosmics (otherwise do it after sky subtraction)
+        log.info("cosmics ray 1D rejection")
+        reject_cosmic_rays_1d(frame,cosmics_nsig)
+
+    if fiberflat is not None :
+        log.info("apply fiberflat")
         # apply fiberflat to all fibers
         apply_fiberflat(frame, fiberflat)
         compute_and_append_frame_scores(frame,suffix="FFLAT")
 
-    if args.sky!=None :
-        
-        # read sky
-        skymodel=read_sky(args.sky)
-        
-        if args.cosmics_nsig>0 :
-        
+    if skymodel is not None :
+
+        if cosmics_nsig>0 :
+
             # first subtract sky without throughput correction
             subtract_sky(frame, skymodel, throughput_correction = False)
-            
+
             # then find cosmics
             log.info("cosmics ray 1D rejection after sky subtraction")
-            reject_cosmic_rays_1d(frame,args.cosmics_nsig)
-            
-            if args.sky_throughput_correction :
+            reject_cosmic_rays_1d(frame,cosmics_nsig)
+
+            if sky_throughput_correction :
                 # and (re-)subtract sky, but just the correction term
                 subtract_sky(frame, skymodel, throughput_correction = True, default_throughput_correction = 0.)
-        
+
         else :
             # subtract sky
-            subtract_sky(frame, skymodel, throughput_correction = args.sky_throughput_correction )
-        
+            subtract_sky(frame, skymodel, throughput_correction = sky_throughput_correction )
+
         compute_and_append_frame_scores(frame,suffix="SKYSUB")
-    
 
-    if args.calib!=None :
+    if fluxcalib is not None :
         log.info("calibrate")
-        # read calibration
-        fluxcalib=read_flux_calibration(args.calib)
         # apply calibration
         apply_flux_calibration(frame, fluxcalib)
         compute_and_append_frame_scores(frame,suffix="CALIB")
-        
-    
-    # save output
-    write_frame(args.outfile, frame, units='1e-17 erg/(s cm2 Angstrom)')
 
-    log.info("successfully wrote %s"%args.outfile)
+    return frame
@@ -92,70 +92,49 @@ def main(args) :
 
     log = get_logger()
 
-    log.info("mag delta %s = %f (for the pre-selection of stellar models)"%(args.color,args.delta_color))
-
     frames={}
     flats={}
     skies={}
 
-    spectrograph=None
-    starfibers=None
-    starindices=None
-    fibermap=None
-
-
     # READ DATA
     ############################################
 
+    #- only the standard stars are read from the frame, sky and flat files
+    starrows=None
+    for filename in args.frames :
+        rows=io.read_frame_rows(filename, "STD")
+        if starrows is None :
+            starrows=rows
+        elif not np.array_equal(rows, starrows) :
+            log.error("incompatible fibermap")
+            raise ValueError("incompatible fibermap")
+    if starrows is None or starrows.size == 0 :
+        log.error("no STD star found in fibermap")
+        raise ValueError("no STD star found in fibermap")
+
     for filename in args.frames :
 
         log.info("reading %s"%filename)
-        frame=io.read_frame(filename)
+        frame=io.read_frame(filename, rows=starrows)
         header=fits.getheader(filename, 0)
-        frame_fibermap = frame.fibermap
-        frame_starindices=np.where(frame_fibermap["OBJTYPE"]=="STD")[0]
-        
-        # check magnitude are well defined or discard stars
-        tmp=[]
-        for i in frame_starindices :
-            mags=frame_fibermap["MAG"][i]
-            ok=np.sum((mags>0)&(mags<30))
-            if np.sum((mags>0)&(mags<30)) == mags.size :
-                tmp.append(i)
-        frame_starindices=np.array(tmp).astype(int)
-        
         camera=safe_read_key(header,"CAMERA").strip().lower()
-
-        if spectrograph is None :
-            spectrograph = frame.spectrograph
-            fibermap = frame_fibermap
-            starindices=frame_starindices
-            starfibers=fibermap["FIBER"][starindices]
-
-        elif spectrograph != frame.spectrograph :
-            log.error("incompatible spectrographs %d != %d"%(spectrograph,frame.spectrograph))
-            raise ValueError("incompatible spectrographs %d != %d"%(spectrograph,frame.spectrograph))
-        elif starindices.size != frame_starindices.size or np.sum(starindices!=frame_starindices)>0 :
-            log.error("incompatible fibermap")
-            raise ValueError("incompatible fibermap")
-
         if not camera in frames :
             frames[camera]=[]
         frames[camera].append(frame)
- 
+
     for filename in args.skymodels :
         log.info("reading %s"%filename)
-        sky=io.read_sky(filename)
+        sky=io.read_sky(filename)[starrows]
         header=fits.getheader(filename, 0)
         camera=safe_read_key(header,"CAMERA").strip().lower()
         if not camera in skies :
             skies[camera]=[]
         skies[camera].append(sky)
-        
+
     for filename in args.fiberflats :
         log.info("reading %s"%filename)
         header=fits.getheader(filename, 0)
-        flat=io.read_fiberflat(filename)
+        flat=io.read_fiberflat(filename)[starrows]
         camera=safe_read_key(header,"CAMERA").strip().lower()
 
         # NEED TO ADD MORE CHECKS
@@ -165,7 +144,65 @@ def main(args) :
             #raise ValueError("cannot handle several flats of same camera (%s)"%camera)
         else :
             flats[camera]=flat
-    
+
+    normflux,stdwave,starfibers,data=fit_stdstars(frames,skies,flats,args.starmodels,color=args.color,delta_color=args.delta_color,ncpu=args.ncpu,z_max=args.z_max,z_res=args.z_res,template_error=args.template_error)
+
+    io.write_stdstar_models(args.outfile,normflux,stdwave,starfibers,data)
+
+
+def fit_stdstars(frames,skies,flats,starmodels,color="G-R",delta_color=0.2,ncpu=default_nproc,z_max=0.008,z_res=0.00002,template_error=0.1) :
+    """ finds the best models of all standard stars in the frames
+    and normalize the model flux.
+
+    Args:
+        frames : dict of lists of uncalibrated Frame objects, keyed by camera
+            (same exposure and spectrograph)
+        skies : dict of lists of SkyModel objects, keyed by camera
+        flats : dict of FiberFlat objects, keyed by camera
+        starmodels : path of spectro-photometric stellar spectra fits
+
+    Options:
+        color, delta_color, ncpu, z_max, z_res, template_error : see parse()
+
+    Returns normflux, stdwave, starfibers, data, the arguments of
+    io.write_stdstar_models.  The input objects are not modified.
+    """
+
+    log = get_logger()
+
+    log.info("mag delta %s = %f (for the pre-selection of stellar models)"%(color,delta_color))
+
+    spectrograph=None
+    starfibers=None
+    starindices=None
+    fibermap=None
+
+    for camera in frames :
+        for frame in frames[camera] :
+            frame_fibermap = frame.fibermap
+            frame_starindices=np.where(frame_fibermap["OBJTYPE"]=="STD")[0]
+
+            # check magnitude are well defined or discard stars
+            tmp=[]
+            for i in frame_starindices :
+                mags=frame_fibermap["MAG"][i]
+                ok=np.sum((mags>0)&(mags<30))
+                if np.sum((mags>0)&(mags<30)) == mags.size :
+                    tmp.append(i)
+            frame_starindices=np.array(tmp).astype(int)
+
+            if spectrograph is None :
+                spectrograph = frame.spectrograph
+                fibermap = frame_fibermap
+                starindices=frame_starindices
+                starfibers=fibermap["FIBER"][starindices]
+
+            elif spectrograph != frame.spectrograph :
+                log.error("incompatible spectrographs %d != %d"%(spectrograph,frame.spectrograph))
+                raise ValueError("incompatible spectrographs %d != %d"%(spectrograph,frame.spectrograph))
+            elif starindices.size != frame_starindices.size or np.sum(starindices!=frame_starindices)>0 :
+                log.error("incompatible fibermap")
+                raise ValueError("incompatible fibermap")
 
     if starindices.size == 0 :
         log.error("no STD star found in fibermap")
@@ -189,41 +226,42 @@ def main(args) :
     
     # DIVIDE FLAT AND SUBTRACT SKY , TRIM DATA
     ############################################
+    starframes={}
     for cam in frames :
 
         if not cam in skies:
             log.warning("Missing sky for %s"%cam)
-            frames.pop(cam)
             continue
         if not cam in flats:
             log.warning("Missing flat for %s"%cam)
-            frames.pop(cam)
             continue
         
 
         flat=flats[cam]
+        starframes[cam]=[]
         for frame,sky in zip(frames[cam],skies[cam]) :
-            frame.flux = frame.flux[starindices]
-            frame.ivar = frame.ivar[starindices]
-            frame.ivar *= (frame.mask[starindices] == 0)
+            # work on a copy of the star spectra
+            frame = frame[starindices]
+            frame.ivar *= (frame.mask == 0)
             frame.ivar *= (sky.ivar[starindices] != 0)
             frame.ivar *= (sky.mask[starindices] == 0)
             frame.ivar *= (flat.ivar[starindices] != 0)
             frame.ivar *= (flat.mask[starindices] == 0)
             frame.flux *= ( frame.ivar > 0) # just for clean plots
             for star in range(frame.flux.shape[0]) :
-                ok=np.where((frame.ivar[star]>0)&(flat.fiberflat[star]!=0))[0]
+                ok=np.where((frame.ivar[star]>0)&(flat.fiberflat[starindices[star]]!=0))[0]
                 if ok.size > 0 :
-                    frame.flux[star] = frame.flux[star]/flat.fiberflat[star] - sky.flux[star]
-            frame.resolution_data = frame.resolution_data[starindices]
+                    frame.flux[star] = frame.flux[star]/flat.fiberflat[starindices[star]] - sky.flux[starindices[star]]
+            starframes[cam].append(frame)
+    frames=starframes
         
     nstars = starindices.size
     starindices=None # we don't need this anymore
 
     # READ MODELS
     ############################################
-    log.info("reading star models in %s"%args.starmodels)
-    stdwave,stdflux,templateid,teff,logg,feh=io.read_stdstar_templates(args.starmodels)
+    log.info("reading star models in %s"%starmodels)
+    stdwave,stdflux,templateid,teff,logg,feh=io.read_stdstar_templates(starmodels)
 
     # COMPUTE MAGS OF MODELS FOR EACH STD STAR MAG
     ############################################
@@ -303,7 +341,7 @@ def main(args) :
         # preselec models based on magnitudes
 
         # compute star color
-        index1,index2=get_color_filter_indices(imaging_filters[star],args.color)
+        index1,index2=get_color_filter_indices(imaging_filters[star],color)
         if index1<0 or index2<0 :
             log.error("cannot compute '%s' color from %s"%(color_name,filters))
         filter1=imaging_filters[star][index1]
@@ -337,7 +375,7 @@ def main(args) :
             log.info("Apply a %s-%s color offset = %4.3f to the models for star with E(B-V)=%4.3f"%(model_filters[model_index1],model_filters[model_index2],delta_color,ebv[star]))
         # selection
         
-        selection = np.abs(model_colors-star_color)<args.delta_color
+        selection = np.abs(model_colors-star_color)<delta_color
         # smallest cube in parameter space including this selection (needed for interpolation)
         new_selection = (teff>=np.min(teff[selection]))&(teff<=np.max(teff[selection]))
         new_selection &= (logg>=np.min(logg[selection]))&(logg<=np.max(logg[selection]))
@@ -345,13 +383,13 @@ def main(args) :
         selection = np.where(new_selection)[0]
         
         
-        log.info("star#%d fiber #%d, %s = %s-%s = %f, number of pre-selected models = %d/%d"%(star,starfibers[star],args.color,filter1,filter2,star_color,selection.size,stdflux.shape[0]))
+        log.info("star#%d fiber #%d, %s = %s-%s = %f, number of pre-selected models = %d/%d"%(star,starfibers[star],color,filter1,filter2,star_color,selection.size,stdflux.shape[0]))
         
         # apply extinction to selected_models
         dust_transmission_of_this_star = dust_transmission(stdwave,ebv[star])
         selected_reddened_stdflux = stdflux[selection]*dust_transmission_of_this_star
         
-        coefficients,redshift[star],chi2dof[star]=match_templates(wave,flux,ivar,resolution_data,stdwave,selected_reddened_stdflux, teff[selection], logg[selection], feh[selection], ncpu=args.ncpu,z_max=args.z_max,z_res=args.z_res,template_error=args.template_error)
+        coefficients,redshift[star],chi2dof[star]=match_templates(wave,flux,ivar,resolution_data,stdwave,selected_reddened_stdflux, teff[selection], logg[selection], feh[selection], ncpu=ncpu,z_max=z_max,z_res=z_res,template_error=template_error)
         
         linear_coefficients[star,selection] = coefficients
         
@@ -378,7 +416,7 @@ def main(args) :
 
 
 
-    # Now write the normalized flux for all best models to a file
+    # Now return the normalized flux for all best models
     normflux=np.array(normflux)
     data={}
     data['LOGG']=linear_coefficients.dot(logg)
@@ -387,8 +425,6 @@ def main(args) :
     data['CHI2DOF']=chi2dof
     data['REDSHIFT']=redshift
     data['COEFF']=linear_coefficients
-    data['DATA_%s'%args.color]=star_colors_array
-    data['MODEL_%s'%args.color]=model_colors_array
-    norm_model_file=args.outfile
-    io.write_stdstar_models(args.outfile,normflux,stdwave,starfibers,data)
-
+    data['DATA_%s'%color]=star_colors_array
+    data['MODEL_%s'%color]=model_colors_array
+    return normflux,stdwave,starfibers,data
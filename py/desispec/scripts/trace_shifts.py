@@ -15,6 +15,7 @@ from desispec.xytraceset import XYTraceSet
 from desispec.io.xytraceset import read_xytraceset
 from desispec.io import read_image
 from desiutil.log import get_logger
+from desispec.parallel import default_nproc
 from desispec.trace_shifts import write_traces_in_psf,compute_dx_from_cross_dispersion_profiles,compute_dy_from_spectral_cross_correlation,monomials,polynomial_fit,compute_dy_using_boxcar_extraction,compute_dx_dy_using_psf,shift_ycoef_using_external_spectrum,recompute_legendre_coefficients
 
 
@@ -65,6 +66,8 @@ Two methods are implemented.
                         help = "width of cross-dispersion profile")
     parser.add_argument('--ccd-rows-rebin', type = int, default = 4 , required=False,
                         help = "rebinning of CCD rows to run faster")
+    parser.add_argument('--ncpu', type = int, default = default_nproc, required=False,
+                        help = "number of processes for the fits of the lines with the psf (with --lines)")
     args = None
     if options is None:
         args = parser.parse_args()
@@ -178,7 +181,7 @@ def main(args) :
         
         psf = read_specter_psf(args.psf)
         
-        x,y,dx,ex,dy,ey,fiber_xy,wave_xy=compute_dx_dy_using_psf(psf,image,fibers,lines)
+        x,y,dx,ex,dy,ey,fiber_xy,wave_xy=compute_dx_dy_using_psf(psf,image,fibers,lines,ncpu=args.ncpu)
         x_for_dx=x
         y_for_dx=y
         fiber_for_dx=fiber_xy
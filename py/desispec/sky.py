@@ -7,9 +7,10 @@ Utility functions to compute a sky model and subtract it.
 
 
 import numpy as np
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, ResolutionStack
 from desispec.linalg import cholesky_solve
 from desispec.linalg import cholesky_invert
+from desispec.linalg import BandedNormalEquation
 from desispec.linalg import spline_fit
 from desiutil.log import get_logger
 from desispec import util
@@ -119,7 +120,7 @@ def _model_variance(frame,cskyflux,cskyivar,skyfibers) :
     
 
      
-def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=False,add_variance=True) :
+def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=False,add_variance=True,banded=True) :
     """Compute a sky model.
     
     Sky[fiber,i] = R[fiber,i,j] Flux[j]
@@ -140,6 +141,7 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
         max_iterations : int , number of iterations
         model_ivar : replace ivar by a model to avoid bias due to correlated flux and ivar. this has a negligible effect on sims.
         add_variance : evaluate calibration error and add this to the sky model variance
+        banded : solve the normal equations in banded storage (default); if False use the dense solver (slower)
         
     returns SkyModel object with attributes wave, flux, ivar, mask
     """
@@ -156,7 +158,9 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
 
     current_ivar=frame.ivar[skyfibers].copy()*(frame.mask[skyfibers]==0)
     flux = frame.flux[skyfibers]
-    Rsky = frame.R[skyfibers]
+    Rframe = ResolutionStack(frame.R)
+    Rsky = Rframe[skyfibers]
+    Rsky_data = Rsky.data
     
     input_ivar=None 
     if model_ivar :
@@ -205,44 +209,53 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
         # B = sum_fiber sum_wave_w ivar[fiber,w] R[fiber][w] * flux[fiber,w]
         # B = sum_fiber sum_wave_w sqrt(ivar)[fiber,w]*flux[fiber,w] sqrtwR[fiber,wave]
         
-        #A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
-        A=np.zeros((nwave,nwave))
-        B=np.zeros((nwave))
-        
-        # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
-        SD=scipy.sparse.lil_matrix((nwave,nwave))
-        
-        # loop on fiber to handle resolution
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("iter %d sky fiber %d/%d"%(iteration,fiber,nfibers))
-            R = Rsky[fiber]
+        if banded :
+            if iteration == 0 :
+                log.info("iter %d accumulate banded normal equation"%iteration)
+                neq = BandedNormalEquation(Rsky_data,flux,current_ivar)
+            else :
+                log.info("iter %d update normal equation for rejected pixels"%iteration)
+                neq.set_ivar(current_ivar)
 
-            # diagonal sparse matrix with content = sqrt(ivar)
-            SD.setdiag(sqrtw[fiber])
+            log.info("iter %d solving"%iteration)
+            parameters = neq.solve()
+        else :
+            #A=scipy.sparse.lil_matrix((nwave,nwave)).tocsr()
+            A=np.zeros((nwave,nwave))
+            B=np.zeros((nwave))
+
+            # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
+            SD=scipy.sparse.lil_matrix((nwave,nwave))
+
+            # loop on fiber to handle resolution
+            for fiber in range(nfibers) :
+                if fiber%10==0 :
+                    log.info("iter %d sky fiber %d/%d"%(iteration,fiber,nfibers))
+                R = Rsky[fiber]
+
+                # diagonal sparse matrix with content = sqrt(ivar)
+                SD.setdiag(sqrtw[fiber])
+
+                sqrtwR = SD*R # each row r of R is multiplied by sqrtw[r]
+                A += (sqrtwR.T*sqrtwR).todense()
+                B += sqrtwR.T*sqrtwflux[fiber]
+
+            log.info("iter %d solving"%iteration)
+            w = A.diagonal()>0
+            A_pos_def = A[w,:]
+            A_pos_def = A_pos_def[:,w]
+            parameters = B*0
+            try:
+                parameters[w]=cholesky_solve(A_pos_def,B[w])
+            except:
+                log.info("cholesky failed, trying svd in iteration {}".format(iteration))
+                parameters[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
 
-            sqrtwR = SD*R # each row r of R is multiplied by sqrtw[r]
-            A += (sqrtwR.T*sqrtwR).todense()
-            B += sqrtwR.T*sqrtwflux[fiber]
-                        
-        log.info("iter %d solving"%iteration)
-        w = A.diagonal()>0
-        A_pos_def = A[w,:]
-        A_pos_def = A_pos_def[:,w]
-        parameters = B*0
-        try:
-            parameters[w]=cholesky_solve(A_pos_def,B[w])
-        except:
-            log.info("cholesky failed, trying svd in iteration {}".format(iteration))
-            parameters[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
-        
         log.info("iter %d compute chi2"%iteration)
 
-        for fiber in range(nfibers) :
-            # the parameters are directly the unconvolve sky flux
-            # so we simply have to reconvolve it
-            fiber_convolved_sky_flux = Rsky[fiber].dot(parameters)
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-fiber_convolved_sky_flux)**2
+        # the parameters are directly the unconvolve sky flux
+        # so we simply have to reconvolve it
+        chi2=current_ivar*(flux-Rsky.dot(parameters))**2
             
         log.info("rejecting")
 
@@ -289,32 +302,37 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
     # no need to restore the original ivar to compute the model errors when modeling ivar
     # the sky inverse variances are very similar
     
-    log.info("compute the parameter covariance")
-    # we may have to use a different method to compute this
-    # covariance
-   
-    try :
-        parameter_covar=cholesky_invert(A)
-        # the above is too slow
-        # maybe invert per block, sandwich by R 
-    except np.linalg.linalg.LinAlgError :
-        log.warning("cholesky_solve_and_invert failed, switching to np.linalg.lstsq and np.linalg.pinv")
-        parameter_covar = np.linalg.pinv(A)
-    
     log.info("compute mean resolution")
     # we make an approximation for the variance to save CPU time
     # we use the average resolution of all fibers in the frame:
-    mean_res_data=np.mean(frame.resolution_data,axis=0)
-    Rmean = Resolution(mean_res_data)
-    
-    log.info("compute convolved sky and ivar")
-    
-    # The parameters are directly the unconvolved sky
-    # First convolve with average resolution :
-    convolved_sky_covar=Rmean.dot(parameter_covar).dot(Rmean.T.todense())
-        
-    # and keep only the diagonal
-    convolved_sky_var=np.diagonal(convolved_sky_covar)
+    mean_res_data=np.mean(Rframe.data,axis=0)
+
+    log.info("compute the parameter covariance")
+    if banded :
+        # we only need the band of the covariance that is
+        # within the sandwich by the mean resolution
+        log.info("updates of normal equation: {} pixels in {} updates, {} full builds".format(neq.npix_updated,neq.nupdate,neq.nbuild))
+        parameter_covar_band = neq.covariance_band()
+
+        log.info("compute convolved sky and ivar")
+        convolved_sky_var = neq.sandwich_diagonal(mean_res_data,parameter_covar_band)
+    else :
+        try :
+            parameter_covar=cholesky_invert(A)
+        except np.linalg.linalg.LinAlgError :
+            log.warning("cholesky_solve_and_invert failed, switching to np.linalg.lstsq and np.linalg.pinv")
+            parameter_covar = np.linalg.pinv(A)
+
+        Rmean = Resolution(mean_res_data)
+
+        log.info("compute convolved sky and ivar")
+
+        # The parameters are directly the unconvolved sky
+        # First convolve with average resolution :
+        convolved_sky_covar=Rmean.dot(parameter_covar).dot(Rmean.T.todense())
+
+        # and keep only the diagonal
+        convolved_sky_var=np.diagonal(convolved_sky_covar)
         
     # inverse
     convolved_sky_ivar=(convolved_sky_var>0)/(convolved_sky_var+(convolved_sky_var==0))
@@ -323,9 +341,7 @@ def compute_uniform_sky(frame, nsig_clipping=4.,max_iterations=100,model_ivar=Fa
     cskyivar = np.tile(convolved_sky_ivar, frame.nspec).reshape(frame.nspec, nwave)
 
     # The sky model for each fiber (simple convolution with resolution of each fiber)
-    cskyflux = np.zeros(frame.flux.shape)
-    for i in range(frame.nspec):
-        cskyflux[i] = frame.R[i].dot(parameters)
+    cskyflux = Rframe.dot(parameters)
         
     # look at chi2 per wavelength and increase sky variance to reach chi2/ndf=1
     if skyfibers.size > 1 and add_variance :
@@ -377,7 +393,9 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
 
     current_ivar=frame.ivar[skyfibers].copy()*(frame.mask[skyfibers]==0)
     flux = frame.flux[skyfibers]
-    Rsky = frame.R[skyfibers]
+    Rframe = ResolutionStack(frame.R)
+    Rsky = Rframe[skyfibers]
+    Rsky_data = Rsky.data
     
 
     input_ivar=None 
@@ -454,45 +472,30 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
         # the parameters are the unconvolved sky flux at the wavelength i
         # and the polynomial coefficients
         
-        A=np.zeros((nwave,nwave),dtype=float)
-        B=np.zeros((nwave),dtype=float)
-        D=scipy.sparse.lil_matrix((nwave,nwave))
-        D2=scipy.sparse.lil_matrix((nwave,nwave))
-        
         Pol /= coef[0] # force constant term to 1.
         
         # solving for the deconvolved mean sky spectrum
-        # loop on fiber to handle resolution
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("iter %d sky fiber (1st fit) %d/%d"%(iteration,fiber,nfibers))
-            D.setdiag(sqrtw[fiber])
-            D2.setdiag(Pol[fiber])
-            sqrtwRP = D.dot(Rsky[fiber]).dot(D2) # each row r of R is multiplied by sqrtw[r]
-            A += (sqrtwRP.T*sqrtwRP).todense()
-            B += sqrtwRP.T*sqrtwflux[fiber]
+        # the polynomial changes at each iteration, so the normal equation
+        # is updated incrementally only if it has not changed
+        if iteration == 0 :
+            log.info("iter %d accumulate banded normal equation"%iteration)
+            neq = BandedNormalEquation(Rsky_data,flux,current_ivar,right=Pol)
+        else :
+            neq.set_scaling(right=Pol,ivar=current_ivar)
         
         log.info("iter %d solving"%iteration)
-        w = A.diagonal()>0
-        A_pos_def = A[w,:]
-        A_pos_def = A_pos_def[:,w]
-        parameters = B*0
-        try:
-            parameters[w]=cholesky_solve(A_pos_def,B[w])
-        except:
-            log.info("cholesky failed, trying svd in iteration {}".format(iteration))
-            parameters[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
+        parameters = neq.solve()
         # parameters = the deconvolved mean sky spectrum
         
         # now evaluate the polynomial coefficients
         Ap=np.zeros((ncoef,ncoef),dtype=float)
         Bp=np.zeros((ncoef),dtype=float)
-        D2.setdiag(parameters)
         for fiber in range(nfibers) :
             if fiber%10==0 :
                 log.info("iter %d sky fiber  (2nd fit) %d/%d"%(iteration,fiber,nfibers))
-            D.setdiag(sqrtw[fiber])
-            sqrtwRSM = D.dot(Rsky[fiber]).dot(D2).dot(skyfibers_monomials[:,fiber,:].T)
+            # sqrt(w) * R * (sky * monomials), without building diagonal matrices
+            SM = parameters[:,None]*skyfibers_monomials[:,fiber,:].T
+            sqrtwRSM = sqrtw[fiber][:,None]*Rsky[fiber].dot(SM)
             Ap += sqrtwRSM.T.dot(sqrtwRSM)
             Bp += sqrtwRSM.T.dot(sqrtwflux[fiber])
         
@@ -513,8 +516,7 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
         
         # chi2 and outlier rejection
         log.info("iter %d compute chi2"%iteration)
-        for fiber in range(nfibers) :
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-Rsky[fiber].dot(Pol[fiber]*parameters))**2
+        chi2=current_ivar*(flux-Rsky.dot(Pol*parameters))**2
         
         log.info("rejecting")
 
@@ -567,26 +569,19 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
     # so the sky model uncertainties are inaccurate
     
     log.info("compute the parameter covariance")
-    try :
-        parameter_covar=cholesky_invert(A)
-    except np.linalg.linalg.LinAlgError :
-        log.warning("cholesky_solve_and_invert failed, switching to np.linalg.lstsq and np.linalg.pinv")
-        parameter_covar = np.linalg.pinv(A)
+    log.info("updates of normal equation: {} pixels in {} updates, {} full builds".format(neq.npix_updated,neq.nupdate,neq.nbuild))
+    parameter_covar_band = neq.covariance_band()
     
     log.info("compute mean resolution")
     # we make an approximation for the variance to save CPU time
     # we use the average resolution of all fibers in the frame:
-    mean_res_data=np.mean(frame.resolution_data,axis=0)
-    Rmean = Resolution(mean_res_data)
+    mean_res_data=np.mean(Rframe.data,axis=0)
     
     log.info("compute convolved sky and ivar")
     
     # The parameters are directly the unconvolved sky
-    # First convolve with average resolution :
-    convolved_sky_covar=Rmean.dot(parameter_covar).dot(Rmean.T.todense())
-        
-    # and keep only the diagonal
-    convolved_sky_var=np.diagonal(convolved_sky_covar)
+    # convolve with average resolution and keep only the diagonal
+    convolved_sky_var=neq.sandwich_diagonal(mean_res_data,parameter_covar_band)
         
     # inverse
     convolved_sky_ivar=(convolved_sky_var>0)/(convolved_sky_var+(convolved_sky_var==0))
@@ -595,11 +590,8 @@ def compute_polynomial_times_sky(frame, nsig_clipping=4.,max_iterations=30,model
     cskyivar = np.tile(convolved_sky_ivar, frame.nspec).reshape(frame.nspec, nwave)
 
     # The sky model for each fiber (simple convolution with resolution of each fiber)
-    cskyflux = np.zeros(frame.flux.shape)
-    
     Pol = allfibers_monomials.T.dot(coef).T
-    for fiber in range(frame.nspec):
-        cskyflux[fiber] = frame.R[fiber].dot(Pol[fiber]*parameters)
+    cskyflux = Rframe.dot(Pol*parameters)
         
     # look at chi2 per wavelength and increase sky variance to reach chi2/ndf=1
     if skyfibers.size > 1 and add_variance :
@@ -652,7 +644,9 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
 
     current_ivar=frame.ivar[skyfibers].copy()*(frame.mask[skyfibers]==0)
     flux = frame.flux[skyfibers]
-    Rsky = frame.R[skyfibers]
+    Rframe = ResolutionStack(frame.R)
+    Rsky = Rframe[skyfibers]
+    Rsky_data = Rsky.data
     
     
     # need focal plane coordinates of fibers
@@ -726,55 +720,23 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
         # similarily
         # B[p]  =  sum_fiber monom[fiber,p] * sum_wave_w (sqrt(ivar)[fiber,w]*flux[fiber,w]) sqrtwR[fiber,wave]
         
-        A=np.zeros((nwave*ncoef,nwave*ncoef))
-        B=np.zeros((nwave*ncoef))
-        
-        # diagonal sparse matrix with content = sqrt(ivar)*flat of a given fiber
-        SD=scipy.sparse.lil_matrix((nwave,nwave))
-        
-        # loop on fiber to handle resolution
-        for fiber in range(nfibers) :
-            if fiber%10==0 :
-                log.info("iter %d sky fiber %d/%d"%(iteration,fiber,nfibers))
-            R = Rsky[fiber]
-
-            # diagonal sparse matrix with content = sqrt(ivar)
-            SD.setdiag(sqrtw[fiber])
-
-            sqrtwR = SD*R # each row r of R is multiplied by sqrtw[r]
-
-            #wRtR=(sqrtwR.T*sqrtwR).tocsr()
-            wRtR=(sqrtwR.T*sqrtwR).todense()
-            wRtF=sqrtwR.T*sqrtwflux[fiber]
-            # loop on polynomial coefficients (double loop for A)
-            # fill only blocks of A and B
-            for p in range(ncoef) :
-                for k in range(ncoef) :
-                    A[p*nwave:(p+1)*nwave,k*nwave:(k+1)*nwave] += monomials[p,fiber]*monomials[k,fiber]*wRtR
-                B[p*nwave:(p+1)*nwave] += monomials[p,fiber]*wRtF
+        # A is accumulated in banded storage with the parameters ordered as a_ip -> i*ncoef+p
+        # and is updated incrementally for the rejected pixels
+        if iteration == 0 :
+            log.info("iter %d accumulate banded normal equation"%iteration)
+            neq = BandedNormalEquation(Rsky_data,flux,current_ivar,comp=monomials.T)
+        else :
+            log.info("iter %d update normal equation for rejected pixels"%iteration)
+            neq.set_ivar(current_ivar)
                 
         log.info("iter %d solving"%iteration)
-        w = A.diagonal()>0
-        A_pos_def = A[w,:]
-        A_pos_def = A_pos_def[:,w]
-        parameters = B*0
-        try:
-            parameters[w]=cholesky_solve(A_pos_def,B[w])
-        except:
-            log.info("cholesky failed, trying svd in iteration {}".format(iteration))
-            parameters[w]=np.linalg.lstsq(A_pos_def,B[w])[0]
+        parameters = neq.solve().ravel() # parameters[p*nwave+i] = a_ip
         
         log.info("iter %d compute chi2"%iteration)
 
-        for fiber in range(nfibers) :
-            # loop on polynomial indices
-            unconvolved_fiber_sky_flux = np.zeros(nwave)
-            for p in range(ncoef) :
-                unconvolved_fiber_sky_flux += monomials[p,fiber]*parameters[p*nwave:(p+1)*nwave]
-            # then convolve
-            fiber_convolved_sky_flux = Rsky[fiber].dot(unconvolved_fiber_sky_flux)
-            
-            chi2[fiber]=current_ivar[fiber]*(flux[fiber]-fiber_convolved_sky_flux)**2
+        # sum of the polynomial terms, then convolve
+        unconvolved_sky_flux = monomials.T.dot(parameters.reshape(ncoef,nwave))
+        chi2=current_ivar*(flux-Rsky.dot(unconvolved_sky_flux))**2
             
         log.info("rejecting")
 
@@ -823,31 +785,21 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
     
     # is there a different method to compute this ?
     log.info("compute covariance")
-    try :
-        parameter_covar=cholesky_invert(A)
-    except np.linalg.linalg.LinAlgError :
-        log.warning("cholesky_solve_and_invert failed, switching to np.linalg.lstsq and np.linalg.pinv")
-        parameter_covar = np.linalg.pinv(A)
+    log.info("updates of normal equation: {} pixels in {} updates, {} full builds".format(neq.npix_updated,neq.nupdate,neq.nbuild))
+    parameter_covar_band = neq.covariance_band()
     
     log.info("compute mean resolution")
     # we make an approximation for the variance to save CPU time
     # we use the average resolution of all fibers in the frame:
-    mean_res_data=np.mean(frame.resolution_data,axis=0)
-    Rmean = Resolution(mean_res_data)
+    mean_res_data=np.mean(Rframe.data,axis=0)
     
     log.info("compute convolved sky and ivar")
         
-    cskyflux = np.zeros(frame.flux.shape)
-    cskyivar = np.zeros(frame.flux.shape)
-
     log.info("compute convolved parameter covariance")
     # The covariance of the parameters is composed of ncoef*ncoef blocks each of size nwave*nwave
     # A block (p,k) is the covariance of the unconvolved spectra p and k , corresponding to the polynomial indices p and k
-    # We first sandwich each block with the average resolution.
-    convolved_parameter_covar=np.zeros((ncoef,ncoef,nwave))
-    for p in range(ncoef) :
-        for k in range(ncoef) :
-            convolved_parameter_covar[p,k] = np.diagonal(Rmean.dot(parameter_covar[p*nwave:(p+1)*nwave,k*nwave:(k+1)*nwave]).dot(Rmean.T.todense()))
+    # We sandwich each block with the average resolution, and only need the band of the covariance for this.
+    convolved_parameter_covar=neq.sandwich_diagonal(mean_res_data,parameter_covar_band).reshape(ncoef,ncoef,nwave)
     
     '''
     import astropy.io.fits as pyfits
@@ -879,28 +831,23 @@ def compute_non_uniform_sky(frame, nsig_clipping=4.,max_iterations=10,model_ivar
     # so that a target fiber distant for a sky fiber will naturally have a larger
     # sky model variance
     log.info("compute sky and variance per fiber")        
-    for i in range(frame.nspec):
-        # compute monomials
-        M = []
-        xi=(frame.fibermap["X_TARGET"][i]-xm)/xs
-        yi=(frame.fibermap["Y_TARGET"][i]-ym)/ys
-        for dx in range(angular_variation_deg+1) :
-            for dy in range(angular_variation_deg+1-dx) :
-                M.append((xi**dx)*(yi**dy))
-        M = np.array(M)
-
-        unconvolved_fiber_sky_flux=np.zeros(nwave)
-        convolved_fiber_skyvar=np.zeros(nwave)
-        for p in range(ncoef) :
-            unconvolved_fiber_sky_flux += M[p]*parameters[p*nwave:(p+1)*nwave]
-            for k in range(ncoef) :
-                convolved_fiber_skyvar += M[p]*M[k]*convolved_parameter_covar[p,k]
-
-        # convolve sky model with this fiber's resolution
-        cskyflux[i] = frame.R[i].dot(unconvolved_fiber_sky_flux)
-
-        # save inverse of variance
-        cskyivar[i] = (convolved_fiber_skyvar>0)/(convolved_fiber_skyvar+(convolved_fiber_skyvar==0))
+    # compute monomials of all fibers
+    xi=(frame.fibermap["X_TARGET"]-xm)/xs
+    yi=(frame.fibermap["Y_TARGET"]-ym)/ys
+    M = []
+    for dx in range(angular_variation_deg+1) :
+        for dy in range(angular_variation_deg+1-dx) :
+            M.append((xi**dx)*(yi**dy))
+    M = np.array(M) # M[p,fiber]
+
+    unconvolved_sky_flux = M.T.dot(parameters.reshape(ncoef,nwave))
+    convolved_skyvar = np.einsum('pf,kf,pkw->fw',M,M,convolved_parameter_covar)
+
+    # convolve sky model with the resolution of each fiber
+    cskyflux = Rframe.dot(unconvolved_sky_flux)
+
+    # save inverse of variance
+    cskyivar = (convolved_skyvar>0)/(convolved_skyvar+(convolved_skyvar==0))
 
     
     # look at chi2 per wavelength and increase sky variance to reach chi2/ndf=1
@@ -943,6 +890,24 @@ class SkyModel(object):
         self.nrej = nrej
         self.stat_ivar = stat_ivar
 
+    def __getitem__(self, index):
+        """
+        Return a subset of the spectra as a new SkyModel object
+
+        index can be anything that can index or slice a numpy array
+        """
+        #- convert index to 1d array to maintain dimentionality of sliced arrays
+        if not isinstance(index, slice):
+            index = np.atleast_1d(index)
+
+        stat_ivar = None
+        if self.stat_ivar is not None:
+            stat_ivar = self.stat_ivar[index]
+
+        return SkyModel(self.wave, self.flux[index], self.ivar[index],
+                    self.mask[index], header=self.header, nrej=self.nrej,
+                    stat_ivar=stat_ivar)
+
 def subtract_sky(frame, skymodel, throughput_correction = False, default_throughput_correction = 1.) :
     """Subtract skymodel from frame, altering frame.flux, .ivar, and .mask
 
@@ -21,7 +21,7 @@ from desiutil.depend import add_dependencies
 from desiutil.io import encode_table
 
 from .maskbits import specmask
-from .resolution import Resolution
+from .resolution import Resolution, ResolutionStack
 
 class Spectra(object):
     """
@@ -138,7 +138,7 @@ class Spectra(object):
                 self.mask[b] = np.copy(mask[b])
             if resolution_data is not None:
                 self.resolution_data[b] = resolution_data[b].astype(self._ftype)
-                self.R[b] = np.array( [ Resolution(r) for r in resolution_data[b] ] )
+                self.R[b] = ResolutionStack(self.resolution_data[b])
             if extra is not None:
                 self.extra[b] = {}
                 for ex in extra[b].items():
@@ -527,7 +527,7 @@ class Spectra(object):
 
         for b in bands:
             if newres is not None:
-                newR[b] = np.array( [ Resolution(r) for r in newres[b] ] )
+                newR[b] = ResolutionStack(newres[b])
 
         # Swap data into place
 
@@ -0,0 +1,108 @@
+"""
+desispec.test.bench_pipeline_db
+===============================
+
+Benchmark of the bulk state selections and updates of
+:class:`desispec.pipeline.db.DataBase` against the former one command per
+task, with a sqlite database of up to 1e6 tasks.
+
+Run with ``python -m desispec.test.bench_pipeline_db --help``.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from desispec.pipeline.db import DataBaseSqlite
+from desispec.pipeline.defs import task_state_to_int
+
+
+def fill_preproc(db, ntask):
+    """Insert ntask waiting preproc tasks in the DB and return their names.
+    """
+    names = [ "preproc_20200101_b0_{:08d}".format(i) for i in range(ntask) ]
+    rows = [ (x, 20200101, "b", 0, i, "science", task_state_to_int["waiting"], 0)
+        for i, x in enumerate(names) ]
+    with db.cursor() as cur:
+        cur.execute("delete from preproc")
+        cur.executemany("insert into preproc values (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    return names
+
+
+def legacy_set_states(db, tasktype, tasks):
+    """One formatted update per task, as done before the bulk updates."""
+    with db.cursor() as cur:
+        for tsk in tasks:
+            cur.execute("update {} set state = {} where name = '{}'".format(tasktype, task_state_to_int[tsk[1]], tsk[0]))
+
+
+def legacy_get_states(db, tasktype, tasks):
+    """A single selection with a literal list of names."""
+    namelist = ",".join([ "'{}'".format(x) for x in tasks ])
+    with db.cursor() as cur:
+        cur.execute('select name, state from {} where name in ({})'.format(tasktype, namelist))
+        return cur.fetchall()
+
+
+def parse(options=None):
+    parser = argparse.ArgumentParser(description="Benchmark bulk pipeline DB state updates.")
+    parser.add_argument('--ntasks', type=str, default='1000,10000,100000,1000000',
+                        help='comma separated numbers of tasks')
+    parser.add_argument('--max-legacy', type=int, default=100000,
+                        help='largest number of tasks for the legacy commands')
+    parser.add_argument('--dir', type=str, default=None,
+                        help='directory of the temporary DB (default is system temporary directory)')
+    return parser.parse_args(options)
+
+
+def main(args):
+    tmpdir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        db = DataBaseSqlite(os.path.join(tmpdir, "bench.db"), "w")
+        print('{:>8s} {:>12s} {:>12s} {:>12s} {:>12s} {:>12s}'.format(
+            'ntasks', 'set', 'set legacy', 'get', 'get legacy', 'count ready'))
+        for ntask in [ int(float(x)) for x in args.ntasks.split(',') ]:
+            names = fill_preproc(db, ntask)
+            # update a random half of the tasks
+            sel = np.random.RandomState(1).permutation(ntask)[:ntask//2]
+            tasks = [ (names[i], "ready") for i in sel ]
+            subnames = [ names[i] for i in sel ]
+
+            t0 = time.time()
+            db.set_states_type("preproc", tasks, postprocessing=False)
+            t1 = time.time()
+            states = db.get_states_type("preproc", subnames)
+            t2 = time.time()
+            assert len(states) == len(subnames)
+            with db.cursor() as cur:
+                cur.execute("select count(*) from preproc where state = {}".format(task_state_to_int["ready"]))
+                assert cur.fetchone()[0] == len(subnames)
+            t3 = time.time()
+
+            tset = tget = np.nan
+            if ntask <= args.max_legacy:
+                fill_preproc(db, ntask)
+                t4 = time.time()
+                legacy_set_states(db, "preproc", tasks)
+                t5 = time.time()
+                try:
+                    legacy_get_states(db, "preproc", subnames)
+                    tget = time.time() - t5
+                except Exception as err:
+                    # e.g. a too long SQL statement
+                    print('legacy get failed: {}'.format(err))
+                tset = t5 - t4
+
+            print('{:8d} {:12.3f} {:12.3f} {:12.3f} {:12.3f} {:12.4f}'.format(
+                ntask, t1-t0, tset, t2-t1, tget, t3-t2))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(parse())
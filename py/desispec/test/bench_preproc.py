@@ -0,0 +1,158 @@
+"""
+desispec.test.bench_preproc
+===========================
+
+Benchmark of the whole-array preproc kernels
+(:func:`desispec.preproc.overscan_per_row`,
+:func:`desispec.preproc.correct_crosstalk` and the tiled background
+statistics of :mod:`desispec.tiledstats`) against the former loops over
+rows, amplifier pairs and patches, on a synthetic 4-amplifier 4k x 4k image.
+
+Run with ``python -m desispec.test.bench_preproc --help``.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import numpy as np
+
+from desispec.preproc import _overscan, overscan_per_row, correct_crosstalk
+from desispec.tiledstats import tile_edges, tiled_statistic
+
+# CCD layout
+# C D
+# A B
+flip_axis_0 = np.array([[1,1,-1,-1],[1,1,-1,-1],[-1,-1,1,1],[-1,-1,1,1]])
+flip_axis_1 = np.array([[1,-1,1,-1],[-1,1,-1,1],[1,-1,1,-1],[-1,1,-1,1]])
+
+
+def synthetic_image(ny, nx, nover, seed=1):
+    """Raw image of 4 amplifiers of ny x nx pixels with nover columns of
+    overscan, and the overscan, data and ccd slices of each amplifier."""
+    rng = np.random.RandomState(seed)
+    #- integer ADUs, converted to float64 as in preproc
+    raw = rng.normal(loc=1000., scale=3., size=(2*ny, 2*nx+2*nover)).astype(np.int32).astype(np.float64)
+    biassec = [ np.s_[0:ny, nx:nx+nover], np.s_[0:ny, nx+nover:nx+2*nover],
+                np.s_[ny:2*ny, nx:nx+nover], np.s_[ny:2*ny, nx+nover:nx+2*nover] ]
+    datasec = [ np.s_[0:ny, 0:nx], np.s_[0:ny, nx+2*nover:2*nx+2*nover],
+                np.s_[ny:2*ny, 0:nx], np.s_[ny:2*ny, nx+2*nover:2*nx+2*nover] ]
+    ccdsec = [ np.s_[0:ny, 0:nx], np.s_[0:ny, nx:2*nx],
+               np.s_[ny:2*ny, 0:nx], np.s_[ny:2*ny, nx:2*nx] ]
+    return raw, biassec, datasec, ccdsec
+
+
+def legacy_amps(raw, biassec, datasec, ccdsec, image, readnoise):
+    """Per-row overscan, subtraction and readnoise with loops over rows."""
+    for ii, jj, kk in zip(biassec, datasec, ccdsec):
+        overscan_image = raw[ii].copy()
+        nrows = overscan_image.shape[0]
+        overscan = np.zeros(nrows)
+        rdnoise = np.zeros(nrows)
+        for j in range(nrows):
+            overscan[j], rdnoise[j] = _overscan(overscan_image[j])
+        for j in range(nrows):
+            readnoise[kk][j] = rdnoise[j]
+        data = raw[jj].copy()
+        for k in range(nrows):
+            data[k] -= overscan[k]
+        image[kk] = data*1.
+
+
+def kernel_amps(raw, biassec, datasec, ccdsec, image, readnoise):
+    """Same as legacy_amps with the whole-array kernels."""
+    for ii, jj, kk in zip(biassec, datasec, ccdsec):
+        overscan, rdnoise = overscan_per_row(raw[ii])
+        readnoise[kk] = rdnoise[:,None]
+        np.multiply(raw[jj] - overscan[:,None], 1., out=image[kk])
+
+
+def legacy_crosstalk(image, ccdsec, crosstalk):
+    """Crosstalk with a copy of the amplifier image per pair."""
+    for a1 in range(4):
+        a1flux = image[ccdsec[a1]]
+        for a2 in range(4):
+            if (a1, a2) not in crosstalk:
+                continue
+            a12flux = crosstalk[(a1, a2)]*a1flux.copy()
+            if flip_axis_0[a1, a2] == -1:
+                a12flux = a12flux[::-1]
+            if flip_axis_1[a1, a2] == -1:
+                a12flux = a12flux[:, ::-1]
+            image[ccdsec[a2]] -= a12flux
+
+
+def legacy_background_grid(image, patch_width):
+    """Median of the background patches with a loop over patches."""
+    bins0 = tile_edges(0, image.shape[0], patch_width)
+    bins1 = tile_edges(0, image.shape[1], patch_width)
+    bkg_grid = np.zeros((bins0.size-1, bins1.size-1))
+    for j in range(bins1.size-1):
+        for i in range(bins0.size-1):
+            bkg_grid[i,j] = np.median(image[bins0[i]:bins0[i+1], bins1[j]:bins1[j+1]])
+    return bkg_grid
+
+
+def tiled_background_grid(image, patch_width, method, backend):
+    bins0 = tile_edges(0, image.shape[0], patch_width)
+    bins1 = tile_edges(0, image.shape[1], patch_width)
+    return tiled_statistic(image, bins0, bins1, method=method, backend=backend)
+
+
+def parse(options=None):
+    parser = argparse.ArgumentParser(description="Benchmark the whole-array preproc kernels.")
+    parser.add_argument('--ny', type=int, default=2064,
+                        help='number of rows per amplifier')
+    parser.add_argument('--nx', type=int, default=2057,
+                        help='number of columns per amplifier')
+    parser.add_argument('--nover', type=int, default=64,
+                        help='number of overscan columns per amplifier')
+    parser.add_argument('--patch-width', type=int, default=200,
+                        help='size in pixels of the background patches')
+    parser.add_argument('--nloop', type=int, default=3,
+                        help='number of timed runs (the best one is reported)')
+    return parser.parse_args(options)
+
+
+def _best(func, nloop, *args):
+    times = []
+    for i in range(nloop):
+        t0 = time.time()
+        func(*args)
+        times.append(time.time()-t0)
+    return min(times)
+
+
+def main(args):
+    raw, biassec, datasec, ccdsec = synthetic_image(args.ny, args.nx, args.nover)
+    shape = (2*args.ny, 2*args.nx)
+    print('image {} x {}, {} overscan columns per amplifier'.format(shape[0], shape[1], args.nover))
+
+    image1, readnoise1 = np.zeros(shape), np.zeros(shape)
+    image2, readnoise2 = np.zeros(shape), np.zeros(shape)
+    tlegacy = _best(legacy_amps, 1, raw, biassec, datasec, ccdsec, image1, readnoise1)
+    tkernel = _best(kernel_amps, args.nloop, raw, biassec, datasec, ccdsec, image2, readnoise2)
+    assert np.allclose(image1, image2) and np.allclose(readnoise1, readnoise2)
+    print('{:30s} {:8.3f} sec (legacy {:8.3f} sec)'.format('overscan per row + subtraction', tkernel, tlegacy))
+
+    crosstalk = { (a1, a2): 1e-3*(1+a1+a2) for a1 in range(4) for a2 in range(4) if a1 != a2 }
+    image1 = image2.copy()
+    tlegacy = _best(legacy_crosstalk, args.nloop, image1, ccdsec, crosstalk)
+    tkernel = _best(correct_crosstalk, args.nloop, image2, ccdsec, crosstalk)
+    assert np.allclose(image1, image2)
+    print('{:30s} {:8.3f} sec (legacy {:8.3f} sec)'.format('crosstalk, 12 pairs', tkernel, tlegacy))
+
+    expected = legacy_background_grid(image2, args.patch_width)
+    tlegacy = _best(legacy_background_grid, args.nloop, image2, args.patch_width)
+    for backend in ('numpy', 'numba'):
+        for method in ('median', 'clipped_mean'):
+            #- first call compiles the numba functions
+            grid = tiled_background_grid(image2, args.patch_width, method, backend)
+            if method == 'median':
+                assert np.allclose(grid, expected)
+            tkernel = _best(tiled_background_grid, args.nloop, image2, args.patch_width, method, backend)
+            print('{:30s} {:8.3f} sec (legacy {:8.3f} sec)'.format('background {} {}'.format(method, backend), tkernel, tlegacy))
+
+
+if __name__ == '__main__':
+    main(parse())
@@ -0,0 +1,82 @@
+"""
+desispec.test.bench_sky
+=======================
+
+Benchmark of the banded vs. dense solvers of :func:`desispec.sky.compute_uniform_sky`.
+
+Run with ``python -m desispec.test.bench_sky --help``.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import time
+
+import numpy as np
+
+from desispec.resolution import Resolution
+from desispec.frame import Frame
+from desispec.io import empty_fibermap
+from desispec.sky import compute_uniform_sky
+
+
+def get_sky_frame(nspec=100, nsky=40, nwave=4000, ndiag=11, seed=1):
+    """Returns a fake Frame with nsky sky fibers among nspec
+
+    The sky is a continuum plus emission lines, convolved with a gaussian
+    resolution of about 1 pixel rms that slightly varies from fiber to fiber.
+    """
+    rng = np.random.RandomState(seed)
+    wave = 3600. + 0.8*np.arange(nwave)
+    sky = 10. + np.zeros(nwave)
+    lines = rng.uniform(wave[0], wave[-1], size=nwave//40)
+    sky[np.searchsorted(wave, lines)] += rng.uniform(50., 2000., size=lines.size)
+
+    xx = np.linspace(-(ndiag-1)/2., (ndiag-1)/2., ndiag)
+    rdata = np.zeros((nspec, ndiag, nwave))
+    flux = np.zeros((nspec, nwave))
+    ivar = 1./(1.+sky)*rng.uniform(0.8, 1.2, size=(nspec, nwave))
+    for i in range(nspec):
+        sigma = rng.uniform(0.9, 1.1)
+        kernel = np.exp(-xx**2/(2*sigma**2))
+        rdata[i] = (kernel/np.sum(kernel))[:, None]
+        flux[i] = Resolution(rdata[i]).dot(sky)
+    flux += rng.normal(size=flux.shape)/np.sqrt(ivar)
+    mask = np.zeros(flux.shape, dtype=np.uint32)
+
+    fibermap = empty_fibermap(nspec)
+    fibermap['OBJTYPE'][:] = 'TGT'
+    fibermap['OBJTYPE'][rng.choice(nspec, size=nsky, replace=False)] = 'SKY'
+
+    return Frame(wave, flux, ivar, mask, rdata, spectrograph=0, fibermap=fibermap)
+
+
+def parse(options=None):
+    parser = argparse.ArgumentParser(description="Benchmark banded vs. dense sky model fit.")
+    parser.add_argument('--nspec', type=int, default=100, help='number of fibers')
+    parser.add_argument('--nsky', type=int, default=40, help='number of sky fibers')
+    parser.add_argument('--nwave', type=int, default=4000, help='number of wavelength bins')
+    parser.add_argument('--ndiag', type=int, default=11, help='number of resolution diagonals')
+    parser.add_argument('--no-dense', action='store_true', help='only run the banded solver')
+    return parser.parse_args(options)
+
+
+def main(args):
+    frame = get_sky_frame(nspec=args.nspec, nsky=args.nsky, nwave=args.nwave, ndiag=args.ndiag)
+
+    t0 = time.time()
+    banded = compute_uniform_sky(frame, add_variance=False, banded=True)
+    t1 = time.time()
+    print('banded : {:.2f} sec'.format(t1-t0))
+
+    if not args.no_dense:
+        dense = compute_uniform_sky(frame, add_variance=False, banded=False)
+        t2 = time.time()
+        print('dense  : {:.2f} sec'.format(t2-t1))
+        print('speedup: {:.1f}'.format((t2-t1)/(t1-t0)))
+        print('max |dflux|/flux : {:.2e}'.format(np.max(np.abs(banded.flux-dense.flux)/np.maximum(np.abs(dense.flux), 1.))))
+        ok = dense.ivar > 0
+        print('max |divar|/ivar : {:.2e}'.format(np.max(np.abs(banded.ivar-dense.ivar)[ok]/dense.ivar[ok])))
+
+
+if __name__ == '__main__':
+    main(parse())
@@ -99,6 +99,62 @@ class TestBoot(unittest.TestCase):
         #pdb.set_trace()
         np.testing.assert_allclose(np.median(gauss), 1.06, rtol=0.05)
 
+    def test_extract_gaussianpsf(self):
+        """Gaussian PSF extraction of curved traces, all fibers at once"""
+        ny, nx, nfiber = 200, 80, 6
+        y = np.arange(ny)
+        xtrc = 8. + 11.*np.arange(nfiber)[None,:] + 2.*np.sin(y/50.)[:,None]
+        sigma = np.linspace(0.9, 1.2, nfiber)
+        flux = np.outer(1000.+y, 1.+np.arange(nfiber))
+        x = np.arange(nx)
+        img = np.zeros((ny, nx))
+        for i in range(nfiber):
+            img += flux[:,i,None]*np.exp(-0.5*((x[None,:]-xtrc[:,i,None])/sigma[i])**2)/(np.sqrt(2*np.pi)*sigma[i])
+        ivar = np.ones(img.shape)
+        spec = desiboot.extract_sngfibers_gaussianpsf(img, ivar, xtrc, sigma, verbose=False)
+        self.assertEqual(spec.shape, xtrc.shape)
+        np.testing.assert_allclose(spec, flux, rtol=1e-3)
+        #- independent of the number of rows extracted at once, and of masked rows
+        ivar[10:20] = 0.
+        spec1 = desiboot.extract_sngfibers_gaussianpsf(img, ivar, xtrc, sigma, verbose=False, nrows=7)
+        spec2 = desiboot.extract_sngfibers_gaussianpsf(img, ivar, xtrc, sigma, verbose=False)
+        np.testing.assert_array_equal(spec1, spec2)
+        self.assertTrue(np.all(spec1[10:20] == 0.))
+
+    def test_triplets(self):
+        """Line identification with triplets, and with the solution of another fiber"""
+        rng = np.random.RandomState(1)
+        w = np.sort(rng.uniform(3600., 5800., 20))
+        dwdy = 0.55
+        fibers = []
+        for shift in [0., 0.5]:
+            # 16 of the lines are detected, plus 4 unknown lines
+            y = 2000. + shift + (w-4700.)/dwdy + 1.e-5*(w-4700.)**2
+            y = np.sort(np.append(y[2:-2], rng.uniform(10., 3990., 4)))
+            id_dict = {"pixpk": y, "flux": np.ones(y.size), "fiber": len(fibers)}
+            prior = fibers[-1] if len(fibers) > 0 else None
+            desiboot.id_arc_lines_using_triplets(id_dict, w, dwdy, prior_id_dict=prior)
+            self.assertEqual(id_dict['status'], 'ok')
+            self.assertEqual(len(id_dict['id_wave']), 16)
+            np.testing.assert_allclose(id_dict['id_wave'], w[2:-2])
+            self.assertLess(id_dict['rms'], 0.01)
+            fibers.append(id_dict)
+        # the histogram and its binning in python agree
+        yt = desiboot.compute_triplets(fibers[0]['pixpk'])
+        wt = desiboot.compute_triplets(w)
+        histogram = np.zeros((41, 21, fibers[0]['pixpk'].size, w.size))
+        args = (dwdy*0.8, dwdy*0.4/41, -1.5e-5, 3.e-5/21)
+        desiboot._triplet_histogram_numba(*desiboot._triplet_coefs(yt), yt[:,3].astype(int),
+            np.ascontiguousarray(wt[:,6]), np.ascontiguousarray(wt[:,7]), wt[:,3].astype(int),
+            *args, histogram)
+        dwdy_bin, d2wdy2_bin = desiboot._triplet_bins(yt, wt, *args)
+        ok = (dwdy_bin>=0)&(dwdy_bin<41)&(d2wdy2_bin>=0)&(d2wdy2_bin<21)
+        self.assertEqual(np.sum(histogram), np.sum(ok))
+        iy, iw = np.where(ok)
+        expected = np.zeros(histogram.shape)
+        np.add.at(expected, (dwdy_bin[ok], d2wdy2_bin[ok], yt[iy,3].astype(int), wt[iw,3].astype(int)), 1.)
+        np.testing.assert_array_equal(histogram, expected)
+
     @unittest.skipUnless(PY3, "Skipping arc line test that is only relevant to Python 3.")
     def test_parse_nist(self):
         """Test parsing of NIST arc line files.
@@ -0,0 +1,128 @@
+"""
+tests desispec.calibcache
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import yaml
+from astropy.io import fits
+
+from desispec.calibcache import CalibCache
+
+
+class TestCalibCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.nread = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, value, shape=(100, 100)):
+        filename = os.path.join(self.tmpdir, name)
+        fits.writeto(filename, value*np.ones(shape, dtype=np.float32), overwrite=True)
+        return filename
+
+    def _read(self, filename):
+        self.nread += 1
+        return fits.getdata(filename, 0)
+
+    def test_cache(self):
+        cache = CalibCache()
+        filename = self._write('bias.fits', 1.)
+        a = cache.get_image('BIAS', filename, self._read)
+        b = cache.get_image('BIAS', filename, self._read)
+        self.assertEqual(self.nread, 1)
+        self.assertTrue(a is b)
+        self.assertFalse(a.flags.writeable)
+        #- another kind of image of the same file is another entry
+        cache.get_image('DARK', filename, self._read)
+        self.assertEqual(self.nread, 2)
+
+        #- a modified file is read again
+        time.sleep(0.01)
+        filename = self._write('bias.fits', 2.)
+        a = cache.get_image('BIAS', filename, self._read)
+        self.assertEqual(self.nread, 3)
+        self.assertTrue(np.all(a == 2.))
+
+    def test_lru(self):
+        #- room for two images
+        nbytes = 100*100*4
+        cache = CalibCache(max_bytes=2*nbytes)
+        files = [ self._write('img{}.fits'.format(i), i) for i in range(3) ]
+        cache.get_image('BIAS', files[0], self._read)
+        cache.get_image('BIAS', files[1], self._read)
+        cache.get_image('BIAS', files[0], self._read)
+        cache.get_image('BIAS', files[2], self._read) # evicts files[1]
+        self.assertEqual(self.nread, 3)
+        self.assertEqual(cache.nbytes, 2*nbytes)
+        cache.get_image('BIAS', files[0], self._read)
+        self.assertEqual(self.nread, 3)
+        cache.get_image('BIAS', files[1], self._read)
+        self.assertEqual(self.nread, 4)
+
+        #- disabled cache
+        cache = CalibCache(max_bytes=0)
+        a = cache.get_image('BIAS', files[0], self._read)
+        b = cache.get_image('BIAS', files[0], self._read)
+        self.assertEqual(self.nread, 6)
+        self.assertTrue(a.flags.writeable)
+
+    def test_memmap(self):
+        filename = self._write('mask.fits', 3.)
+        memmap_dir = os.path.join(self.tmpdir, 'shm')
+        a = CalibCache(memmap_dir=memmap_dir).get_image('MASK', filename, self._read)
+        #- a second process finds the memory-mapped copy
+        b = CalibCache(memmap_dir=memmap_dir).get_image('MASK', filename, self._read)
+        self.assertEqual(self.nread, 1)
+        self.assertTrue(isinstance(b, np.memmap))
+        self.assertFalse(b.flags.writeable)
+        self.assertTrue(np.all(a == b))
+        self.assertEqual(len(os.listdir(memmap_dir)), 1)
+
+    def test_yaml(self):
+        filename = os.path.join(self.tmpdir, 'ccd_calibration.yaml')
+        with open(filename, 'w') as fx:
+            yaml.dump(dict(b0=dict(V0=dict(DETECTOR='SIM'))), fx)
+        cache = CalibCache()
+        a = cache.get_yaml(filename)
+        b = cache.get_yaml(filename)
+        self.assertTrue(a is b)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(a['b0']['V0']['DETECTOR'], 'SIM')
+
+    def test_process_cache(self):
+        from unittest.mock import patch
+        from desispec import calibcache
+        with patch.dict(os.environ):
+            os.environ.pop('DESI_CALIB_CACHE_MB', None)
+            calibcache.release()
+            #- disabled by default
+            self.assertEqual(calibcache.get_cache().max_bytes, 0)
+            #- enabled by the drivers until released
+            cache = calibcache.enable()
+            self.assertTrue(calibcache.get_cache() is cache)
+            self.assertEqual(cache.max_bytes, calibcache.DRIVER_CACHE_MB*2**20)
+            calibcache.release()
+            self.assertEqual(calibcache.get_cache().max_bytes, 0)
+            #- the environment wins
+            os.environ['DESI_CALIB_CACHE_MB'] = '10'
+            self.assertEqual(calibcache.enable().max_bytes, 10*2**20)
+            calibcache.release()
+
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m <modulename>
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -6,6 +6,11 @@ import unittest
 import numpy as np
 from desispec.image import Image
 from desispec.cosmics import reject_cosmic_rays_ala_sdss, reject_cosmic_rays
+from desispec.cosmics import _reject_cosmic_rays_ala_sdss_single_numba, dilate_numba
+from desispec.cosmics import reject_cosmic_rays_1d, _running_median
+from desispec.frame import Frame
+from desispec.maskbits import specmask
+import scipy.ndimage
 from desiutil.log import get_logger
 from desispec.maskbits import ccdmask
 
@@ -87,6 +92,133 @@ class TestCosmics(unittest.TestCase):
         cosmic = (image.pix > 0)
         self.assertTrue(np.all(image.mask[cosmic] & ccdmask.COSMIC))
 
+    def test_tiled_same_as_serial(self):
+        """
+        Test that the threaded version gives the same mask as the serial one
+        """
+        rng = np.random.RandomState(1)
+        pix = rng.normal(size=(301,257))
+        ivar = np.ones(pix.shape)
+        mask = np.zeros(pix.shape, dtype=np.uint32)
+        mask[:, 100] = ccdmask.BAD
+        #- tracks with a wide and bright core, rejected in several iterations
+        for k in range(40):
+            i, j = rng.randint(0, pix.shape[0]), rng.randint(0, pix.shape[1])
+            length = rng.randint(2, 30)
+            ii = np.clip(i+np.arange(length), 0, pix.shape[0]-1)
+            jj = np.clip(j+np.arange(length)//2, 0, pix.shape[1]-1)
+            for d in (-1, 0, 1):
+                pix[ii, np.clip(jj+d, 0, pix.shape[1]-1)] += rng.uniform(3., 300.)/(1+3*abs(d))
+        image = Image(pix, ivar, mask=mask, camera='b0')
+
+        #- reference: serial test of all the neighbors of rejected pixels
+        nsig, cfudge, c2fudge, niter = 6., 3., 0.8, 6
+        psf_gradients = np.array([0.366247,0.391422,0.172965,0.184552])
+        tivar = ivar*(mask==0)
+        selection = (pix*np.sqrt(tivar)) > nsig
+        expected = _reject_cosmic_rays_ala_sdss_single_numba(pix,tivar,selection,psf_gradients,nsig,cfudge,c2fudge)
+        for iteration in range(niter):
+            neighbors = dilate_numba(expected,False) & (expected==False)
+            tivar[expected] = 0.
+            new = _reject_cosmic_rays_ala_sdss_single_numba(pix,tivar,neighbors,psf_gradients,3.,0.,1.)
+            if np.sum(new) < 1:
+                break
+            expected |= new
+        self.assertGreater(iteration, 1)
+
+        for nthreads in (1, 3):
+            rejected = reject_cosmic_rays_ala_sdss(image, nsig=nsig, cfudge=cfudge, c2fudge=c2fudge,
+                niter=niter, dilate=False, nthreads=nthreads)
+            self.assertTrue(np.all(rejected == expected))
+
+    def test_running_median(self):
+        """
+        Test the running median against scipy
+        """
+        data = np.random.RandomState(3).normal(size=(7, 300))
+        data[:, 50:60] = 1.  # ties
+        for size in (200, 51, 4):
+            expected = scipy.ndimage.median_filter(data, size=(1, size), mode='constant')
+            for nthreads in (1, 2):
+                self.assertTrue(np.all(_running_median(data, size, nthreads=nthreads) == expected))
+
+    def _reject_cosmic_rays_1d_loop(self, frame, nsig=3, psferr=0.05):
+        """
+        Former implementation of reject_cosmic_rays_1d with loops on fibers and peaks
+        """
+        tflux=np.zeros(frame.flux.shape)
+        for fiber in range(frame.nspec) :
+            tflux[fiber]=frame.flux[fiber]-scipy.ndimage.median_filter(frame.flux[fiber],200,mode='constant')
+        var=(frame.ivar>0)/(frame.ivar+(frame.ivar==0))
+        var[var==0]=(np.max(var)*1000.)
+        var += (psferr*tflux)**2
+        peaks=np.zeros(tflux.shape)
+        peaks[:,1:-1]=(tflux[:,1:-1]>tflux[:,:-2])*(tflux[:,1:-1]>tflux[:,2:])
+        dfp=np.zeros(tflux.shape)
+        dfm=np.zeros(tflux.shape)
+        dfp[:,1:-1]=(tflux[:,1:-1]-tflux[:,2:])
+        dfm[:,1:-1]=(tflux[:,1:-1]-tflux[:,:-2])
+        vp=np.zeros(tflux.shape)
+        vm=np.zeros(tflux.shape)
+        vp[:,1:-1]=(var[:,1:-1]+var[:,2:])
+        vm[:,1:-1]=(var[:,1:-1]+var[:,:-2])
+        chi2p=dfp**2*(dfp>0)*(tflux>0)/(vp+(vp==0))
+        chi2m=dfm**2*(dfm>0)*(tflux>0)/(vm+(vm==0))
+        for fiber in range(chi2m.shape[0]) :
+            R=frame.R[fiber]
+            selection=np.where( ( (chi2p[fiber]>nsig**2) | (chi2m[fiber]>nsig**2) ) & (peaks[fiber]>0) )[0]
+            for i in selection :
+                rdfpi=dfp[fiber,i]/tflux[fiber,i]
+                rdfmi=dfm[fiber,i]/tflux[fiber,i]
+                errp=np.sqrt(vp[fiber,i])/tflux[fiber,i]
+                errm=np.sqrt(vm[fiber,i])/tflux[fiber,i]
+                r  =  R.data[:,i]
+                d  = r.size//2
+                snrp = (rdfpi-(1-r[d+1]/r[d]))/errp
+                snrm = (rdfmi-(1-r[d-1]/r[d]))/errm
+                if max(snrp,snrm)>nsig :
+                    b=i-2
+                    e=i+3
+                    frame.mask[fiber,b:e][np.sqrt(frame.ivar[fiber,b:e])*tflux[fiber,b:e]>nsig] |= specmask.COSMIC
+
+    def test_reject_cosmics_1d(self):
+        """
+        Test that the array implementation masks the same pixels as the loops
+        """
+        rng = np.random.RandomState(2)
+        nspec, nwave, ndiag = 20, 800, 11
+        wave = np.linspace(5000, 5800, nwave)
+        x = np.arange(nwave)
+        sigma = 1.+0.5*rng.uniform(size=(nspec, 1))
+        flux = np.zeros((nspec, nwave))
+        #- continuum and PSF-wide emission lines
+        for line in rng.uniform(10, nwave-10, 15):
+            flux += rng.uniform(20, 200)*np.exp(-0.5*((x-line)/sigma)**2)
+        flux += 10.*(1+np.sin(x/100.))
+        ivar = 1./(flux.clip(1)+4.)
+        flux += rng.normal(size=flux.shape)/np.sqrt(ivar)
+        #- cosmics, one or two pixels wide, including at the edges
+        for k in range(60):
+            fiber, i = rng.randint(nspec), rng.randint(nwave)
+            flux[fiber, i:i+rng.randint(1, 3)] += rng.uniform(10, 300)
+        flux[3, 1] += 200.
+        flux[4, nwave-2] += 200.
+        ivar[5, 100:110] = 0.
+        resolution_data = np.zeros((nspec, ndiag, nwave))
+        for i, offset in enumerate(range(ndiag//2, -ndiag//2, -1)):
+            resolution_data[:, i] = np.exp(-0.5*(offset/sigma)**2)
+        resolution_data /= np.sum(resolution_data, axis=1)[:, None]
+        mask = np.zeros(flux.shape, dtype=np.uint32)
+        mask[6, 200:205] = specmask.SOMEBADPIX
+
+        frame1 = Frame(wave, flux.copy(), ivar.copy(), mask.copy(), resolution_data=resolution_data, spectrograph=0)
+        frame2 = Frame(wave, flux.copy(), ivar.copy(), mask.copy(), resolution_data=resolution_data, spectrograph=0)
+        with np.errstate(all='ignore'):
+            self._reject_cosmic_rays_1d_loop(frame1, nsig=4)
+        reject_cosmic_rays_1d(frame2, nsig=4)
+        self.assertGreater(np.sum(frame1.mask & specmask.COSMIC > 0), 50)
+        self.assertTrue(np.all(frame1.mask == frame2.mask))
+
 #- This runs all test* functions in any TestCase class in this file
 if __name__ == '__main__':
     unittest.main()
@@ -51,7 +51,7 @@ class TestExtract(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        for filename in glob('test-*{}*.fits'.format(cls.testhash)):
+        for filename in glob('test-*{}*.fits'.format(cls.testhash)) + glob('test-*{}*.ecsv'.format(cls.testhash)):
             if os.path.exists(filename):
                 os.remove(filename)
 
@@ -137,6 +137,61 @@ class TestExtract(unittest.TestCase):
         #- pixel model isn't valid for small bundles that actually overlap; don't test
         # self.assertTrue(np.allclose(model1, model2, rtol=1e-15, atol=1e-15))
 
+    @unittest.skipIf(nospecter, 'specter not installed; skipping extraction test')
+    def test_gather(self):
+        #- bundles merged in memory without intermediate files
+        template = "desi_extract_spectra -i {} -p {} -w 7500,7530,0.75 --nwavestep 10 -f {} --bundlesize 3 -o {} -m {} -s 0 -n 7"
+        cmd = template.format(self.imgfile, self.psffile, self.fibermapfile, self.outfile, self.outmodel)
+        args = desispec.scripts.extract.parse(cmd.split(" ")[1:])
+        desispec.scripts.extract.main_mpi(args, comm=None)
+        frame1 = desispec.io.read_frame(self.outfile)
+        model1 = fits.getdata(self.outmodel)
+        os.remove(self.outfile)
+        os.remove(self.outmodel)
+
+        args = desispec.scripts.extract.parse(cmd.split(" ")[1:] + ["--gather"])
+        desispec.scripts.extract.main_mpi(args, comm=None)
+        frame2 = desispec.io.read_frame(self.outfile)
+        model2 = fits.getdata(self.outmodel)
+        self.assertEqual(len(glob('test-out-{}_*.fits'.format(self.testhash))), 0)
+
+        self.assertTrue(np.all(frame1.flux == frame2.flux))
+        self.assertTrue(np.all(frame1.ivar == frame2.ivar))
+        self.assertTrue(np.all(frame1.mask == frame2.mask))
+        self.assertTrue(np.all(frame1.chi2pix == frame2.chi2pix))
+        self.assertTrue(np.all(frame1.resolution_data == frame2.resolution_data))
+        self.assertTrue(np.all(frame1.fibermap['FIBER'] == frame2.fibermap['FIBER']))
+        self.assertTrue(np.allclose(model1, model2))
+
+    @unittest.skipIf(nospecter, 'specter not installed; skipping extraction test')
+    def test_timing_report(self):
+        template = "desi_extract_spectra -i {} -p {} -w 7500,7530,0.75 --nwavestep 10 -f {} --bundlesize 3 -o {} -s 0 -n 7 --dynamic --timing-report"
+        cmd = template.format(self.imgfile, self.psffile, self.fibermapfile, self.outfile)
+        args = desispec.scripts.extract.parse(cmd.split(" ")[1:])
+        timing = dict()
+        desispec.scripts.extract.main_mpi(args, comm=None, timing=timing)
+        self.assertTrue(os.path.exists(self.outfile))
+
+        #- one row per bundle, also returned in the timing dict
+        from astropy.table import Table
+        timingfile = self.outfile.replace('.fits', '-timing.ecsv')
+        report = Table.read(timingfile, format='ascii.ecsv')
+        self.assertEqual(list(report['BUNDLE']), [0, 1, 2])
+        self.assertEqual(list(report['NSPEC']), [3, 3, 1])
+        self.assertTrue(np.all(report['RANK'] == 0))
+        self.assertTrue(np.all(report['EXTRACTION'] > 0))
+        self.assertEqual(len(timing['bundles']), 3)
+        self.assertAlmostEqual(np.sum(timing['bundles']['EXTRACTION']), timing['total_extraction'])
+        self.assertNotIn('READ_INPUT', report.colnames)
+
+        #- one row per rank for the one-time costs
+        report = Table.read(timingfile.replace('-timing.ecsv', '-timing-ranks.ecsv'), format='ascii.ecsv')
+        self.assertEqual(list(report['RANK']), [0])
+        self.assertEqual(list(report['NBUNDLE']), [3])
+        self.assertAlmostEqual(report['READ_INPUT'][0], timing['read_input'])
+        self.assertAlmostEqual(report['EXTRACTION'][0], timing['total_extraction'])
+        self.assertEqual(len(timing['ranks']), 1)
+
     #- traditional and MPI versions agree when starting at spectrum 0
     def test_bundles1(self):
         self._test_bundles("desi_extract_spectra -i {} -p {} -w 7500,7530,0.75 --nwavestep 10 -f {} --bundlesize 3 -o {} -m {} -s {} -n {}", 0, 5)
@@ -128,6 +128,24 @@ class TestFluxCalibration(unittest.TestCase):
         #- nothing should be masked for this test case
         self.assertFalse(np.any(fluxCalib.mask))
 
+    def test_calibrate_no_stars(self):
+        """calibrate raises instead of exiting when no star is usable"""
+        from astropy.table import Table
+        from desispec.scripts.fluxcalibration import calibrate, StdStarSelectionError
+        frame = get_frame_data()
+        modelwave, modelflux = get_models()
+        metadata = Table(dict(CHI2DOF=np.array([5., 6., 7.]),
+                              DATA_G_R=np.zeros(3), MODEL_G_R=np.zeros(3)))
+        metadata.rename_column('DATA_G_R', 'DATA_G-R')
+        metadata.rename_column('MODEL_G_R', 'MODEL_G-R')
+        fibers = np.arange(3)
+        with self.assertRaises(StdStarSelectionError):
+            calibrate(frame, modelflux[0:3], modelwave, fibers, metadata, chi2cut=2.)
+        #- the fibers are not standard stars
+        frame.fibermap['OBJTYPE'] = 'TGT'
+        with self.assertRaises(StdStarSelectionError):
+            calibrate(frame, modelflux[0:3], modelwave, fibers, metadata)
+
     def test_outliers(self):
         '''Test fluxcalib when input starts with large outliers'''
         frame = get_frame_data()
@@ -99,6 +99,12 @@ class TestFrame(unittest.TestCase):
         self.assertEqual(len(x.fibermap), 2)
         self.assertEqual(x.chi2pix.shape, (2,nwave))
 
+        #- slicing does not modify the header of the original frame
+        frame = Frame(wave, flux, ivar, spectrograph=0, meta=dict(FOO='bar'))
+        x = frame[2:4]
+        self.assertEqual(x.meta['FIBERMIN'], 2)
+        self.assertEqual(frame.meta['FIBERMIN'], 0)
+
     def test_vet(self):
         """ Vette method on Frame class
         """
@@ -225,6 +225,69 @@ class TestIO(unittest.TestCase):
             match = np.all(fibermap[name] == frame.fibermap[name])
             self.assertTrue(match, 'Fibermap column {} mismatch'.format(name))
 
+    def test_frame_read_subset(self):
+        """Test reading a subset of rows and HDUs of a Frame file.
+        """
+        from ..io.frame import read_frame, write_frame
+        from ..io.fibermap import empty_fibermap
+        nspec, nwave, ndiag = 8, 10, 3
+        flux = np.random.uniform(size=(nspec, nwave))
+        ivar = np.random.uniform(size=(nspec, nwave))
+        mask = np.zeros((nspec, nwave), dtype=np.uint32)
+        mask[3, 4] = 1
+        R = np.random.uniform(size=(nspec, ndiag, nwave))
+        chi2pix = np.random.uniform(size=(nspec, nwave))
+        fibermap = empty_fibermap(nspec)
+        fibermap['FIBER'] = 500 + np.arange(nspec)
+        frx = Frame(np.arange(nwave), flux, ivar, mask, R, fibermap=fibermap,
+                    chi2pix=chi2pix, meta=dict(FLAVOR='science'))
+        write_frame(self.testfile, frx)
+        full = read_frame(self.testfile)
+
+        #- index list, with two runs of consecutive rows
+        rows = [1, 2, 3, 6]
+        frame = read_frame(self.testfile, rows=rows)
+        self.assertTrue(np.all(frame.flux == full.flux[rows]))
+        self.assertTrue(np.all(frame.ivar == full.ivar[rows]))
+        self.assertTrue(np.all(frame.mask == full.mask[rows]))
+        self.assertTrue(np.all(frame.resolution_data == full.resolution_data[rows]))
+        self.assertTrue(np.all(frame.chi2pix == full.chi2pix[rows]))
+        self.assertTrue(np.all(frame.fibers == 500 + np.array(rows)))
+        self.assertTrue(np.all(frame.fibermap['FIBER'] == 500 + np.array(rows)))
+
+        #- unsorted and repeated rows keep the caller's order
+        rows = [6, 1, 6, 2]
+        frame = read_frame(self.testfile, rows=rows)
+        self.assertTrue(np.all(frame.flux == full.flux[rows]))
+        self.assertTrue(np.all(frame.mask == full.mask[rows]))
+        self.assertTrue(np.all(frame.resolution_data == full.resolution_data[rows]))
+        self.assertTrue(np.all(frame.fibermap['FIBER'] == 500 + np.array(rows)))
+        frame = read_frame(self.testfile, rows=rows, skip_hdus=['FIBERMAP'])
+        self.assertTrue(np.all(frame.fibers == 500 + np.array(rows)))
+
+        #- slice and nspec
+        frame = read_frame(self.testfile, rows=slice(2, 5))
+        self.assertTrue(np.all(frame.flux == full.flux[2:5]))
+        frame = read_frame(self.testfile, nspec=3)
+        self.assertTrue(np.all(frame.flux == full.flux[0:3]))
+
+        #- fiber numbers from FIBERMIN without the fibermap
+        frame = read_frame(self.testfile, rows=rows, skip_hdus=['FIBERMAP', 'CHI2PIX'])
+        self.assertIsNone(frame.fibermap)
+        self.assertIsNone(frame.chi2pix)
+        self.assertTrue(np.all(frame.fibers == 500 + np.array(rows)))
+
+        #- float32 as on disk
+        frame = read_frame(self.testfile, keep_float32=True, skip_resolution=True)
+        self.assertEqual(frame.flux.dtype, np.float32)
+        self.assertEqual(frame.ivar.dtype, np.float32)
+        self.assertEqual(frame.wave.dtype, np.float64)
+        self.assertIsNone(frame.resolution_data)
+        self.assertTrue(np.all(frame.flux == full.flux))
+
+        with self.assertRaises(IndexError):
+            read_frame(self.testfile, rows=[nspec])
+
     def test_sky_rw(self):
         """Test reading and writing sky files.
         """
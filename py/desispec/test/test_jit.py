@@ -0,0 +1,97 @@
+"""
+tests desispec.jit
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import desispec.jit
+from desispec.jit import njit
+
+
+@njit(signatures=["(float64[::1], float64)"])
+def _scale(x, a):
+    return a*x
+
+
+class TestJit(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        #- back to the default policy
+        desispec.jit.configure()
+        shutil.rmtree(self.cachedir, ignore_errors=True)
+
+    def test_declared(self):
+        import desispec.cosmics
+        import desispec.tiledstats
+        names = desispec.jit.kernels()
+        self.assertIn('desispec.cosmics.dilate_numba', names)
+        self.assertIn('desispec.tiledstats._tiles_numba', names)
+        self.assertIn('desispec.test.test_jit._scale', names)
+        with self.assertRaises(ValueError):
+            njit(cache=True)
+
+    def test_warmup(self):
+        """The kernels are compiled for the types they are called with"""
+        import desispec.cosmics
+        from desispec.image import Image
+        from desispec.tiledstats import tiled_statistic
+        timing = desispec.jit.warmup(modules=['desispec.cosmics', 'desispec.tiledstats'])
+        self.assertIn('desispec.cosmics._reject_cosmic_rays_rows_numba', timing)
+        nsig = { name : s['nsig'] for name, s in desispec.jit.stats().items() }
+
+        np.random.seed(2)
+        pix = np.random.normal(0, 1, size=(60, 50))
+        pix[20, 30] += 200.
+        pix[21, 30] += 150.
+        image = Image(pix, np.ones(pix.shape), mask=np.zeros(pix.shape, dtype=np.uint32), camera='b0')
+        desispec.cosmics.reject_cosmic_rays_ala_sdss(image)
+        desispec.cosmics._running_median(pix, 5)
+        tiled_statistic(pix, [0, 30, 60], [0, 25, 50], backend='numba')
+
+        for name, s in desispec.jit.stats().items():
+            self.assertEqual(s['nsig'], nsig[name], '{} was compiled again'.format(name))
+
+    def test_cache_dir(self):
+        desispec.jit.configure(cache=True, cache_dir=self.cachedir)
+        self.assertTrue(_scale.stats.cache_path.startswith(self.cachedir))
+        _scale.compile("(int32[::1], int32)")
+        self.assertTrue(np.allclose(_scale(np.arange(3, dtype=np.int32), np.int32(2)), [0, 2, 4]))
+        self.assertTrue(len(os.listdir(self.cachedir)) > 0)
+
+        #- without cache
+        shutil.rmtree(self.cachedir)
+        desispec.jit.configure(cache=False, cache_dir=self.cachedir)
+        _scale.compile("(int16[::1], int16)")
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def test_report(self):
+        desispec.jit.warmup(modules=[])
+        stats = desispec.jit.stats()['desispec.test.test_jit._scale']
+        self.assertGreaterEqual(stats['nsig'], 1)
+        self.assertGreaterEqual(stats['compile']+stats['load'], 0.)
+
+        #- the other processes of desi_pipe_exec --jit-warmup do not log it
+        from unittest.mock import patch
+        with patch('desispec.jit.report') as report:
+            desispec.jit.warmup(modules=[], verbose=False)
+            self.assertFalse(report.called)
+            desispec.jit.warmup(modules=[])
+            self.assertTrue(report.called)
+
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m <modulename>
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -9,6 +9,7 @@ import numpy.random
 from desispec.linalg import cholesky_solve
 from desispec.linalg import cholesky_solve_and_invert
 from desispec.linalg import cholesky_invert
+from desispec.linalg import BandedNormalEquation
 
 class TestLinalg(unittest.TestCase):
     
@@ -83,6 +84,80 @@ class TestLinalg(unittest.TestCase):
         
         
                 
+    def _dense_normal_equation(self,rdata,flux,ivar,left,right,comp) :
+        # reference dense accumulation of the normal equation
+        nfibers,ndiag,nwave=rdata.shape
+        ncomp=comp.shape[1]
+        hw=ndiag//2
+        A=np.zeros((nwave*ncomp,nwave*ncomp))
+        B=np.zeros(nwave*ncomp)
+        for f in range(nfibers) :
+            R=np.zeros((nwave,nwave))
+            for k in range(ndiag) :
+                R+=np.diag(rdata[f,k,max(0,hw-k):nwave-max(0,k-hw)],hw-k)
+            M=left[f][:,None]*R*right[f][None,:]
+            M=np.kron(M,comp[f][None,:])
+            A+=M.T.dot(ivar[f][:,None]*M)
+            B+=M.T.dot(ivar[f]*flux[f])
+        return A,B
+
+    def _random_problem(self,nfibers=6,nwave=40,ndiag=5,ncomp=2) :
+        rng=np.random.RandomState(0)
+        rdata=rng.uniform(0.1,1.,size=(nfibers,ndiag,nwave))
+        flux=rng.normal(size=(nfibers,nwave))
+        ivar=rng.uniform(0.5,2.,size=(nfibers,nwave))
+        left=rng.uniform(0.8,1.2,size=(nfibers,nwave))
+        right=rng.uniform(0.8,1.2,size=(nfibers,nwave))
+        comp=rng.uniform(-1,1,size=(nfibers,ncomp))
+        comp[:,0]=1.
+        return rdata,flux,ivar,left,right,comp
+
+    def test_banded_normal_equation(self):
+        rdata,flux,ivar,left,right,comp=self._random_problem()
+        neq=BandedNormalEquation(rdata,flux,ivar,left=left,right=right,comp=comp)
+        A,B=self._dense_normal_equation(rdata,flux,ivar,left,right,comp)
+        self.assertTrue(np.allclose(neq.todense(),A))
+        self.assertTrue(np.allclose(neq.B,B))
+        x=neq.solve()
+        self.assertEqual(x.shape,(comp.shape[1],rdata.shape[2]))
+        self.assertTrue(np.allclose(x.T.ravel(),np.linalg.solve(A,B)))
+
+        # diagonal band of the covariance
+        Cb=neq.covariance_band()
+        C=np.linalg.inv(A)
+        for d in range(Cb.shape[0]) :
+            self.assertTrue(np.allclose(Cb[d,:C.shape[0]-d],np.diag(C,-d)))
+
+    def test_banded_normal_equation_update(self):
+        rdata,flux,ivar,left,right,comp=self._random_problem()
+        neq=BandedNormalEquation(rdata,flux,ivar,left=left,right=right,comp=comp,max_update_fraction=0.5)
+        ivar2=ivar.copy()
+        ivar2[1,3:7]=0.
+        ivar2[4,20]*=2.
+        neq.set_ivar(ivar2)
+        self.assertEqual(neq.nupdate,1)
+        self.assertEqual(neq.nbuild,1)
+        ref=BandedNormalEquation(rdata,flux,ivar2,left=left,right=right,comp=comp)
+        self.assertTrue(np.allclose(neq.Ab,ref.Ab))
+        self.assertTrue(np.allclose(neq.B,ref.B))
+        self.assertTrue(np.allclose(neq.solve(),ref.solve()))
+
+        # a large modification triggers a rebuild
+        neq.set_ivar(0.5*ivar2)
+        self.assertEqual(neq.nbuild,2)
+        self.assertTrue(np.allclose(neq.B,0.5*ref.B))
+
+    def test_banded_sandwich_diagonal(self):
+        rdata,flux,ivar,left,right,comp=self._random_problem(ncomp=1)
+        neq=BandedNormalEquation(rdata,flux,ivar)
+        Cb=neq.covariance_band()
+        C=np.linalg.inv(neq.todense())
+        R=np.zeros(C.shape)
+        hw=rdata.shape[1]//2
+        for k in range(rdata.shape[1]) :
+            R+=np.diag(rdata[0,k,max(0,hw-k):C.shape[0]-max(0,k-hw)],hw-k)
+        self.assertTrue(np.allclose(neq.sandwich_diagonal(rdata[0],Cb),np.diag(R.dot(C).dot(R.T))))
+
     def runTest(self):
         pass
                 
@@ -93,6 +93,17 @@ class TestParallel(unittest.TestCase):
 
         assert(ret == "turns_{}".format(rank))
 
+    def test_async_progress_enabled(self):
+        from unittest.mock import patch
+        with patch.dict(os.environ, {}, clear=True):
+            self.assertFalse(async_progress_enabled())
+        with patch.dict(os.environ, {"MPICH_ASYNC_PROGRESS": "0"}, clear=True):
+            self.assertFalse(async_progress_enabled())
+        with patch.dict(os.environ, {"MPICH_ASYNC_PROGRESS": "1"}, clear=True):
+            self.assertTrue(async_progress_enabled())
+        with patch.dict(os.environ, {"I_MPI_ASYNC_PROGRESS": "enable"}, clear=True):
+            self.assertTrue(async_progress_enabled())
+
 
 #- This runs all test* functions in any TestCase class in this file
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+"""
+tests desispec.pipeline.db
+"""
+
+import os
+import unittest
+import shutil
+import tempfile
+
+try:
+    import redrock.external.desi
+    from desispec.pipeline.db import DataBaseSqlite
+    nopipeline = False
+except ImportError:
+    nopipeline = True
+
+
+@unittest.skipIf(nopipeline, 'redrock not installed; skipping pipeline DB tests')
+class TestPipelineDB(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.db = DataBaseSqlite(os.path.join(self.testdir, "test.db"), "w")
+        self.names = [ "preproc_20200101_b0_{:08d}".format(i) for i in range(20) ]
+        with self.db.cursor() as cur:
+            for i, name in enumerate(self.names):
+                cur.execute("insert into preproc values ('{}', 20200101, 'b', 0, {}, 'science', 0, 0)".format(name, i))
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_indexes(self):
+        """Test the creation of the indexes"""
+        with self.db.cursor() as cur:
+            cur.execute("select name from sqlite_master where type='index'")
+            indexes = [ x for (x, ) in cur.fetchall() ]
+        for idx in ["preproc_state_idx", "preproc_night_idx",
+                    "preproc_submitted_idx", "healpix_frame_state_idx"]:
+            self.assertIn(idx, indexes)
+        self.assertNotIn("spectra_submitted_idx", indexes)
+        # can be called again on an existing DB
+        self.db.create_indexes()
+
+    def test_states(self):
+        """Test the bulk state selections and updates"""
+        # names in one or several selections
+        for bulk in [1000, 5]:
+            self.db._bulk_names = bulk
+            tasks = [ (x, "ready") for x in self.names[::2] ]
+            # the last state of a duplicated task wins
+            tasks.append((self.names[0], "done"))
+            self.db.set_states_type("preproc", tasks, postprocessing=False)
+            states = self.db.get_states_type("preproc", self.names[:10] + ["preproc_nothere"])
+            self.assertEqual(len(states), 10)
+            self.assertEqual(states[self.names[0]], "done")
+            self.assertEqual(states[self.names[2]], "ready")
+            self.assertEqual(states[self.names[3]], "waiting")
+            self.assertEqual(self.db.get_states_type("preproc", []), {})
+
+            self.db.set_submitted(self.names[:8])
+            sub = self.db.get_submitted(self.names)
+            self.assertEqual(sum(sub.values()), 8)
+            self.db.set_submitted(self.names, unset=True)
+            self.assertEqual(sum(self.db.get_submitted(self.names).values()), 0)
+
+            self.db.set_states_type("preproc", [ (x, "waiting") for x in self.names ], postprocessing=False)
+
+    def test_persistent(self):
+        """Test the persistent connection and the local copy"""
+        db = DataBaseSqlite(self.db._path, "w", persistent=True)
+        db.set_states_type("preproc", [ (self.names[0], "ready") ], postprocessing=False)
+        conn = db._conn
+        self.assertIsNotNone(conn)
+        self.assertEqual(db.get_states_type("preproc", self.names[:1])[self.names[0]], "ready")
+        self.assertIs(db._conn, conn)
+
+        shadowdir = os.path.join(self.testdir, "shadow")
+        os.makedirs(shadowdir)
+        rdb = DataBaseSqlite(self.db._path, "r", persistent=True, shadowdir=shadowdir)
+        self.assertEqual(rdb.get_states_type("preproc", self.names[:1])[self.names[0]], "ready")
+        self.assertEqual(len(os.listdir(shadowdir)), 1)
+        # the copy is refreshed when the DB changes
+        os.utime(self.db._path, (0, 0))
+        db.set_states_type("preproc", [ (self.names[0], "done") ], postprocessing=False)
+        self.assertEqual(rdb.get_states_type("preproc", self.names[:1])[self.names[0]], "done")
+        with self.assertRaises(Exception):
+            with rdb.cursor() as cur:
+                cur.execute("delete from preproc")
+        rdb.close()
+        db.close()
+        self.assertEqual(os.listdir(shadowdir), [])
+        self.assertIsNone(db._conn)
+
+    def test_lock_wait(self):
+        """Test the measurement of the waits for the DB lock"""
+        import sqlite3
+        import threading
+        conn = sqlite3.connect(self.db._path, check_same_thread=False)
+        conn.execute("begin exclusive")
+        timer = threading.Timer(0.2, conn.commit)
+        timer.start()
+        self.db.get_states_type("preproc", self.names[:1])
+        timer.join()
+        conn.close()
+        st = self.db.lock_stats()
+        self.assertGreater(st["ncursor"], 1)
+        self.assertGreaterEqual(st["nblocked"], 1)
+        self.assertGreater(st["maxwait"], 0.1)
+
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m <modulename>
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
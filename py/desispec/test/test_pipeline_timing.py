@@ -0,0 +1,130 @@
+"""
+tests desispec.pipeline.timing
+"""
+
+import os
+import unittest
+import shutil
+import tempfile
+
+import numpy as np
+
+try:
+    import redrock.external.desi
+    from desispec.pipeline import timing
+    from desispec.pipeline.timing import RunTimeModel, get_model
+    from desispec.pipeline.db import DataBaseSqlite
+    nopipeline = False
+except ImportError:
+    nopipeline = True
+
+
+@unittest.skipIf(nopipeline, 'redrock not installed; skipping pipeline run time model tests')
+class TestPipelineTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_model(self):
+        """Test the fit of the run time model"""
+        # no size: median of the process-minutes
+        model = RunTimeModel([1, 2, 4], [60., 30., 30.])
+        self.assertAlmostEqual(model.cost(), 1.)
+        self.assertAlmostEqual(model.run_time(nproc=4), 0.25)
+        self.assertAlmostEqual(model.run_time(size=100., nproc=1), 1.)
+
+        # linear in size
+        size = np.arange(10.)
+        nproc = np.ones(10, dtype=int)*2
+        wall = 60.*(1. + 0.5*size)/nproc
+        model = RunTimeModel(nproc, wall, size)
+        self.assertAlmostEqual(model.slope, 0.5)
+        self.assertAlmostEqual(model.cost(20.), 11.)
+        self.assertAlmostEqual(model.run_time(20., nproc=11), 1.)
+        self.assertAlmostEqual(model.cost(), np.median(1. + 0.5*size))
+        # never less than the cheapest run
+        self.assertAlmostEqual(model.cost(-10.), 1.)
+
+        # too few sizes to fit the slope
+        model = RunTimeModel(nproc[:3], wall[:3], size[:3])
+        self.assertEqual(model.slope, 0.)
+
+        with self.assertRaises(ValueError):
+            RunTimeModel([], [])
+
+    def test_db(self):
+        """Test the recording of run times in a sqlite DB"""
+        path = os.path.join(self.testdir, "test.db")
+        db = DataBaseSqlite(path, "w")
+        self.assertIsNone(get_model(db, "redshift"))
+        for i in range(6):
+            db.insert_task_time("redshift_64_{}".format(i), "redshift", 4,
+                60.*(i+1), size=1000.*(i+1))
+        db.insert_task_time("preproc_0", "preproc", 1, 10.)
+        self.assertEqual(len(db.select_task_time("redshift")), 6)
+        self.assertEqual(db.select_task_time("preproc"), [(1, 10., None)])
+        # the model without runs is cached
+        self.assertIsNone(get_model(db, "redshift"))
+        timing._models.clear()
+        model = get_model(db, "redshift")
+        self.assertAlmostEqual(model.cost(7000.), 28.)
+        # names are bound parameters
+        db.insert_task_time("it's", "preproc", 1, 20.)
+        self.assertEqual(len(db.select_task_time("preproc")), 2)
+        self.assertEqual(db.select_task_time("no'type"), [])
+
+    def test_run_times(self):
+        """Test the estimates of many tasks from one query of their sizes"""
+        from desispec.pipeline.tasks.base import task_classes
+        path = os.path.join(self.testdir, "test.db")
+        db = DataBaseSqlite(path, "w")
+        with db.cursor() as cur:
+            cur.executemany("insert into healpix_frame values (?,?,?,?,?,?,?)",
+                [(20200101, 1, 0, 64, 10, 5, 1), (20200101, 2, 0, 64, 10, 7, 0),
+                 (20200101, 1, 1, 64, 11, 3, 1)])
+        self.assertEqual(db.select_healpix_sizes(),
+            {(64, 10): (2, 12), (64, 11): (1, 3)})
+        self.assertEqual(db.select_healpix_sizes(state=1),
+            {(64, 10): (1, 5), (64, 11): (1, 3)})
+
+        names = ["redshift_64_11", "redshift_64_10", "redshift_64_12"]
+        task = task_classes["redshift"]
+        self.assertEqual(task.run_sizes(names, db), [3, 12, 0])
+        self.assertEqual(task.run_size(names[1], db), 12)
+        self.assertEqual(task_classes["spectra"].run_sizes(
+            ["spectra_64_10", "spectra_64_11"], db), [1, 1])
+
+        # static guess without recorded runs, learned model with them
+        self.assertEqual(task.run_times(names, 1, db=db), [15, 15, 15])
+        timing._models.clear()
+        for i in range(6):
+            db.insert_task_time("redshift_64_{}".format(i), "redshift", 1,
+                60.*(1+2*i), size=float(i))
+        times = task.run_times(names, 1, db=db)
+        self.assertEqual(times, [7, 25, 1])
+        self.assertTrue(all([ isinstance(x, int) for x in times ]))
+        self.assertEqual(task.run_time(names[1], 1, db=db), 25)
+
+    def test_db_without_table(self):
+        """Productions without the task_time table have no run time history"""
+        path = os.path.join(self.testdir, "old.db")
+        db = DataBaseSqlite(path, "w")
+        with db.cursor() as cur:
+            cur.execute("drop table task_time")
+        db = DataBaseSqlite(path, "r")
+        self.assertEqual(db.select_task_time("redshift"), [])
+        with db.cursor() as cur:
+            cur.execute("select count(*) from sqlite_master where name = 'task_time'")
+            self.assertEqual(cur.fetchone()[0], 0)
+
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m <modulename>
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
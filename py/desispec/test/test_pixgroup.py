@@ -10,6 +10,9 @@ if __name__ == '__main__':
 from ..test.util import get_frame_data
 from ..io import findfile, write_frame, read_spectra, specprod_root
 from ..scripts import group_spectra
+from ..pixgroup import plan_healpix_order, FrameCache, FrameLite
+from ..pixgroup import frames2spectra, frames2spectra_many
+from ..pixgroup import get_exp2healpix_map, read_exp2healpix_index, write_exp2healpix_index
 
 class TestPixGroup(unittest.TestCase):
 
@@ -140,6 +143,141 @@ class TestPixGroup(unittest.TestCase):
         self.assertEqual(len(spectra.fibermap), nspec)
         self.assertEqual(spectra.flux['b'].shape[0], nspec)
 
+    def test_exp2healpix_index(self):
+        indexfile = os.path.join(self.outdir, 'exp2healpix-64.fits')
+        exp2pix = get_exp2healpix_map(nights=self.nights[0:2])
+        exp2pix_indexed = get_exp2healpix_map(nights=self.nights[0:2],
+                indexfile=indexfile)
+        self.assertTrue(np.all(exp2pix == exp2pix_indexed))
+        index = read_exp2healpix_index(indexfile)
+        self.assertEqual(len(index), len(exp2pix))
+        self.assertTrue(read_exp2healpix_index(indexfile, nside=32) is None)
+
+        #- unchanged cframes are not re-read, so edits to the index show up
+        index['NTARGETS'] += 100
+        write_exp2healpix_index(indexfile, index)
+        exp2pix_indexed = get_exp2healpix_map(nights=self.nights[0:2],
+                indexfile=indexfile)
+        self.assertTrue(np.all(exp2pix_indexed['NTARGETS'] == exp2pix['NTARGETS']+100))
+
+        #- but modified cframes are
+        night = self.nights[1]
+        for camera in ('b0', 'r0', 'z0'):
+            filename = findfile('cframe', night, 2, camera)
+            os.utime(filename, (0, 0))
+        exp2pix_indexed = get_exp2healpix_map(nights=self.nights[0:2],
+                indexfile=indexfile)
+        ii = (exp2pix_indexed['NIGHT'] == night) & (exp2pix_indexed['EXPID'] == 2)
+        self.assertEqual(np.count_nonzero(ii), 1)
+        self.assertTrue(np.all(exp2pix_indexed['NTARGETS'][ii] == exp2pix['NTARGETS'][ii]))
+        self.assertTrue(np.all(exp2pix_indexed['NTARGETS'][~ii] == exp2pix['NTARGETS'][~ii]+100))
+
+        #- adding a night keeps the previous ones in the index
+        exp2pix_indexed = get_exp2healpix_map(nights=self.nights[2:],
+                indexfile=indexfile)
+        self.assertTrue(np.all(exp2pix_indexed['NIGHT'] == self.nights[2]))
+        index = read_exp2healpix_index(indexfile)
+        self.assertEqual(sorted(set(index['NIGHT'])), self.nights)
+
+    def test_frames2spectra_many(self):
+        #- frames with targets spread over a few pixels, including NaN
+        nspec, nwave, ndiag = 20, 10, 3
+        rand = np.random.RandomState(0)
+        frames = dict()
+        for expid in (1, 2):
+            ra = rand.uniform(10, 12, nspec)
+            dec = rand.uniform(0, 2, nspec)
+            ra[0] = np.nan
+            fibermap = np.zeros(nspec, dtype=[('RA_TARGET', 'f8'),
+                ('DEC_TARGET', 'f8'), ('EXPID', 'i4'), ('FIBER', 'i4')])
+            fibermap['RA_TARGET'] = ra
+            fibermap['DEC_TARGET'] = dec
+            fibermap['EXPID'] = expid
+            fibermap['FIBER'] = np.arange(nspec)
+            for camera in ('b0', 'r0', 'z0'):
+                X = camera[0].upper()
+                scores = np.zeros(nspec, dtype=[('SUM_'+X, 'f4')])
+                scores['SUM_'+X] = 100*expid + np.arange(nspec)
+                header = dict(CAMERA=camera)
+                flux = rand.uniform(size=(nspec, nwave))
+                frames[(20200101, expid, camera)] = FrameLite(
+                    np.arange(nwave), flux, flux, np.zeros(flux.shape, dtype=int),
+                    rand.uniform(size=(nspec, ndiag, nwave)), fibermap.copy(),
+                    header, scores)
+
+        allpix = np.concatenate([frames[(20200101, expid, 'b0')].healpix(16) for expid in (1, 2)])
+        self.assertEqual(allpix[0], -1)
+        pixels = sorted(set(allpix[allpix >= 0]))
+        self.assertGreater(len(pixels), 1)
+
+        spectra = frames2spectra_many(frames, pixels + [0,], nside=16)
+        self.assertEqual(len(spectra[0].fibermap), 0)
+        nspec_tot = 0
+        for pix in pixels:
+            sp = spectra[pix]
+            nspec_tot += len(sp.fibermap)
+            #- same as the single pixel version
+            sp1 = frames2spectra(frames, pix, nside=16)
+            for x in ('b', 'r', 'z'):
+                self.assertTrue(np.all(sp.flux[x] == sp1.flux[x]))
+                self.assertTrue(np.all(sp.rdat[x] == sp1.rdat[x]))
+            self.assertTrue(np.all(sp.fibermap == sp1.fibermap))
+            self.assertTrue(np.all(sp.scores == sp1.scores))
+            #- spectra in frame then fiber order, with matching scores and flux
+            ii = np.where(allpix == pix)[0]
+            self.assertTrue(np.all(sp.fibermap['FIBER'] == ii % nspec))
+            self.assertTrue(np.all(sp.fibermap['EXPID'] == ii // nspec + 1))
+            self.assertTrue(np.all(sp.scores['SUM_R'] == 100*(ii // nspec + 1) + ii % nspec))
+            for i, j in enumerate(ii):
+                key = (20200101, j // nspec + 1, 'z0')
+                self.assertTrue(np.all(sp.flux['z'][i] == frames[key].flux[j % nspec]))
+
+        #- all spectra with valid coordinates are assigned
+        self.assertEqual(nspec_tot, 2*(nspec-1))
+        #- input frames are not modified
+        self.assertTrue(np.isnan(frames[(20200101, 1, 'b0')].fibermap['RA_TARGET'][0]))
+
+    def test_plan_healpix_order(self):
+        #- pixels 1,5,7 share exposure 10; pixels 2,3 share exposure 20;
+        #- pixel 4 is alone
+        rows = [(20200101, 10, 0, 1, 3), (20200101, 10, 0, 5, 3),
+                (20200101, 10, 0, 7, 3), (20200101, 11, 0, 7, 3),
+                (20200101, 11, 0, 5, 3), (20200101, 20, 1, 2, 3),
+                (20200101, 20, 1, 3, 3), (20200101, 30, 1, 4, 3)]
+        exp2pix = np.array(rows, dtype=[
+            ('NIGHT', 'i4'), ('EXPID', 'i8'), ('SPECTRO', 'i4'),
+            ('HEALPIX', 'i8'), ('NTARGETS', 'i8')])
+        order = plan_healpix_order(exp2pix)
+        self.assertEqual(list(order), [1, 5, 7, 2, 3, 4])
+        self.assertEqual(list(plan_healpix_order(exp2pix, [4, 3, 2])), [2, 3, 4])
+        self.assertEqual(len(plan_healpix_order(exp2pix, [])), 0)
+
+    def test_frame_cache(self):
+        night = self.nights[1]
+        keys = [(night, 2, 'b0'), (night, 2, 'r0'), (night, 3, 'b0')]
+        cache = FrameCache()
+        frames = cache.get_frames(keys[0:2])
+        self.assertEqual(sorted(frames.keys()), sorted(keys[0:2]))
+        self.assertEqual((cache.nhit, cache.nmiss, cache.nevict), (0, 2, 0))
+        nbytes = frames[keys[0]].nbytes
+        self.assertEqual(cache.nbytes, 2*nbytes)
+
+        #- room for two frames: the least recently used one is evicted
+        cache.max_bytes = 2*nbytes
+        frames = cache.get_frames(keys[0:1])
+        frames = cache.get_frames(keys[2:3])
+        self.assertEqual((cache.nhit, cache.nmiss, cache.nevict), (1, 3, 1))
+        self.assertTrue(keys[0] in cache)
+        self.assertFalse(keys[1] in cache)
+        self.assertEqual(len(cache), 2)
+
+        #- frames requested together are kept even if they don't fit
+        cache.max_bytes = nbytes
+        frames = cache.get_frames(keys)
+        self.assertEqual(len(frames), 3)
+        self.assertEqual(len(cache), 3)
+        self.assertTrue(isinstance(cache.stats(), str))
+
 def test_suite():
     """Allows testing of only this module with the command::
 
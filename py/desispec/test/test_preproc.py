@@ -8,6 +8,8 @@ import numpy as np
 
 import desispec.scripts.preproc
 from desispec.preproc import preproc, _parse_sec_keyword, _clipped_std_bias
+from desispec.preproc import _overscan, overscan_per_row, correct_crosstalk
+from desispec.preproc import _background
 from desispec import io
 
 def xy2hdr(xyslice):
@@ -176,7 +178,23 @@ class TestPreProc(unittest.TestCase):
         self.assertEqual(b1.meta['CAMERA'], 'b1')
         self.assertEqual(r1.meta['CAMERA'], 'r1')
         self.assertEqual(z9.meta['CAMERA'], 'z9')
-        
+
+        #- all cameras at once, serially and with 2 processes
+        for nproc in (1, 2):
+            images = io.read_raw_exposure(self.rawfile, nproc=nproc)
+            self.assertEqual(sorted(images.keys()), ['b0', 'b1', 'r1', 'z9'])
+            self.assertTrue(np.all(images['r1'].pix == r1.pix))
+            self.assertEqual(images['b1'].meta['CAMERA'], 'b1')
+
+        #- missing cameras are skipped, outputs written in outdir
+        outdir = os.path.dirname(os.path.abspath(self.rawfile))
+        outfiles = io.read_raw_exposure(self.rawfile, cameras=['b0', 'b5'], outdir=outdir)
+        self.assertEqual(list(outfiles.keys()), ['b0'])
+        self.assertTrue(os.path.exists(outfiles['b0']))
+        img = io.read_image(outfiles['b0'])
+        os.remove(outfiles['b0'])
+        self.assertTrue(np.allclose(img.pix, b0.pix))
+
     def test_32_64(self):
         '''
         64-bit integers aren't supported for compressed HDUs;
@@ -310,6 +328,57 @@ class TestPreProc(unittest.TestCase):
         biased_std = np.std(x[np.abs(x)<3])
         self.assertAlmostEqual(biased_std, _clipped_std_bias(3), places=3)
 
+    def test_overscan_per_row(self):
+        np.random.seed(2)
+        pix = np.random.normal(loc=1000, scale=3, size=(50, 64)).astype(np.int32).astype(float)
+        pix[3, 5] = 5000.  # outlier
+        pix[7, :] = 1000.  # no noise, sigma clipping fails
+        pix[9, 2] = np.nan # skipped row
+        overscan, readnoise = overscan_per_row(pix)
+        for j in range(pix.shape[0]):
+            if j == 9:
+                self.assertEqual(overscan[j], 0.)
+                self.assertEqual(readnoise[j], 0.)
+                continue
+            o, r = _overscan(pix[j])
+            self.assertAlmostEqual(overscan[j], o, places=10)
+            self.assertAlmostEqual(readnoise[j], r, places=10)
+
+    def test_crosstalk(self):
+        np.random.seed(3)
+        image = np.random.uniform(size=(2*self.ny, 2*self.nx))
+        secs = [ self.quad[amp] for amp in ('1', '2', '3', '4') ]
+        crosstalk = { (0,1):0.01, (1,0):0.02, (2,3):0.03, (3,0):0.04, (1,2):0. }
+
+        #- reference: crosstalk images computed with copies
+        expected = image.copy()
+        flip_0 = [[1,1,-1,-1],[1,1,-1,-1],[-1,-1,1,1],[-1,-1,1,1]]
+        flip_1 = [[1,-1,1,-1],[-1,1,-1,1],[1,-1,1,-1],[-1,1,-1,1]]
+        for a1, a2 in sorted(crosstalk.keys()):
+            flux = crosstalk[(a1,a2)]*expected[secs[a1]].copy()
+            if flip_0[a1][a2] == -1: flux = flux[::-1]
+            if flip_1[a1][a2] == -1: flux = flux[:,::-1]
+            expected[secs[a2]] -= flux
+
+        correct_crosstalk(image, secs, crosstalk)
+        self.assertTrue(np.allclose(image, expected, rtol=0, atol=1e-15))
+
+    def test_background(self):
+        #- smooth gradient and an offset of amplifier 2
+        yy, xx = np.indices((2*self.ny, 2*self.nx))
+        image = 1e-2*xx + 2e-2*yy
+        image[self.quad['2']] += 5.
+        image += np.random.RandomState(4).normal(scale=0.1, size=image.shape)
+        bkg = _background(image, self.header, patch_width=100)
+        self.assertEqual(bkg.shape, image.shape)
+        for backend in ('numpy', 'numba'):
+            for method in ('median', 'clipped_mean'):
+                bkg = _background(image, self.header, patch_width=100, stitch=True, method=method, backend=backend)
+                resid = (image-bkg)[100:-100, 100:-100]
+                self.assertLess(np.median(np.abs(resid)), 1.)
+        img = preproc(self.rawimage, self.header, primary_header=self.primary_header, bkgsub=True)
+        self.assertEqual(img.pix.shape, (2*self.ny, 2*self.nx))
+
     #- Not implemented yet, but flag these as expectedFailures instead of
     #- successful tests of raising NotImplementedError
     def test_default_bias(self):
@@ -6,7 +6,7 @@ import unittest
 import numpy as np
 import scipy.sparse
 
-from desispec.resolution import Resolution
+from desispec.resolution import Resolution, ResolutionStack
 import desispec.resolution
 
 class TestResolution(unittest.TestCase):
@@ -145,6 +145,46 @@ class TestResolution(unittest.TestCase):
         self.assertTrue(data is data2)
         self.assertTrue(offsets is offsets2)
 
+    def test_resolution_stack(self):
+        nspec, ndiag, nwave = 20, 7, 50
+        data = np.random.uniform(size=(nspec, ndiag, nwave))
+        stack = ResolutionStack(data)
+        self.assertEqual(len(stack), nspec)
+        self.assertTrue(stack.to_fits_array() is data)
+
+        #- individual matrices are built lazily and cached
+        self.assertTrue(isinstance(stack[1], Resolution))
+        self.assertTrue(stack[1] is stack[1])
+        self.assertTrue(np.array_equal(stack[-1].toarray(), Resolution(data[-1]).toarray()))
+        self.assertEqual(len(list(stack)), nspec)
+
+        #- sub-stacks
+        sub = stack[[0,2]]
+        self.assertTrue(isinstance(sub, ResolutionStack))
+        self.assertTrue(np.array_equal(sub.data, data[[0,2]]))
+        self.assertEqual(len(stack[1:3]), 2)
+
+        #- batched products vs. individual sparse matrices
+        x = np.random.uniform(size=nwave)
+        xx = np.random.uniform(size=(nspec, nwave))
+        Rx = stack.dot(x)
+        Rxx = stack.dot(xx)
+        RTxx = stack.transpose_dot(xx)
+        for i in range(nspec):
+            R = Resolution(data[i])
+            self.assertTrue(np.allclose(Rx[i], R.dot(x)))
+            self.assertTrue(np.allclose(Rxx[i], R.dot(xx[i])))
+            self.assertTrue(np.allclose(RTxx[i], R.T.dot(xx[i])))
+
+        #- from a sequence of sparse matrices, another stack, or bad input
+        stack2 = ResolutionStack([Resolution(d) for d in data])
+        self.assertTrue(np.array_equal(stack2.data, data))
+        self.assertTrue(ResolutionStack(stack).data is data)
+        with self.assertRaises(ValueError):
+            ResolutionStack(np.ones((nspec, 6, nwave)))
+        with self.assertRaises(ValueError):
+            stack.dot(np.ones(nwave+1))
+
 #- This runs all test* functions in any TestCase class in this file
 if __name__ == '__main__':
     unittest.main()           
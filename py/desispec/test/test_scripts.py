@@ -77,6 +77,62 @@ class TestScripts(unittest.TestCase):
         self.assertEqual(options.night, '20170317')
         self.assertEqual(options.nightStatus, 'start')
 
+    def test_mergebundles(self):
+        """Test desispec.scripts.mergebundles.
+        """
+        import shutil
+        import tempfile
+        import numpy as np
+        from ..frame import Frame
+        from ..io import empty_fibermap, write_frame, read_frame
+        from ..scripts import mergebundles
+        tmpdir = tempfile.mkdtemp()
+        try:
+            nspec, nwave, ndiag = 500, 20, 5
+            wave = np.linspace(5000, 5020, nwave)
+            fibermap = empty_fibermap(nspec, specmin=1000)
+            fibermap['OBJTYPE'][::3] = 'SKY'
+            rng = np.random.RandomState(1)
+            filenames = list()
+            #- bundles written in random order, with a missing bundle of 100 fibers
+            for i, b in enumerate([3, 0, 1, 2]):
+                ii = np.arange(b*100, (b+1)*100)
+                frame = Frame(wave, rng.uniform(size=(100, nwave)), rng.uniform(size=(100, nwave)),
+                              mask=rng.randint(0, 2, size=(100, nwave)).astype(np.uint32),
+                              resolution_data=rng.uniform(size=(100, ndiag, nwave)),
+                              fibermap=fibermap[ii], chi2pix=rng.uniform(size=(100, nwave)),
+                              meta=dict(CAMERA='r2', EXPID=12, FLAVOR='science'),
+                              scores=dict(SCORE=rng.uniform(size=100)))
+                filenames.append(os.path.join(tmpdir, 'frame-{}.fits'.format(b)))
+                write_frame(filenames[-1], frame)
+            expected = [ read_frame(filename) for filename in filenames ]
+
+            for ncpu in (1, 2):
+                output = os.path.join(tmpdir, 'merged-{}.fits'.format(ncpu))
+                args = mergebundles.parse(['-o', output, '--force', '--ncpu', str(ncpu)] + filenames)
+                mergebundles.main(args)
+                merged = read_frame(output)
+                self.assertEqual(merged.nspec, nspec)
+                self.assertTrue(np.all(merged.fibers == np.arange(1000, 1000+nspec)))
+                self.assertTrue(np.all(merged.ivar[400:] == 0.))
+                for frame in expected:
+                    ii = frame.fibers % nspec
+                    self.assertTrue(np.all(merged.flux[ii] == frame.flux))
+                    self.assertTrue(np.all(merged.ivar[ii] == frame.ivar))
+                    self.assertTrue(np.all(merged.mask[ii] == frame.mask))
+                    self.assertTrue(np.all(merged.resolution_data[ii] == frame.resolution_data))
+                    self.assertTrue(np.all(merged.chi2pix[ii] == frame.chi2pix))
+                    self.assertTrue(np.all(merged.fibermap['OBJTYPE'][ii] == frame.fibermap['OBJTYPE']))
+                    self.assertTrue(np.all(merged.scores['SCORE'][ii] == frame.scores['SCORE']))
+                self.assertEqual(merged.meta['EXPID'], 12)
+
+            #- all fibers are required without --force
+            args = mergebundles.parse(['-o', output] + filenames)
+            with self.assertRaises(SystemExit):
+                mergebundles.main(args)
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 def test_suite():
     """Allows testing of only this module with the command::
@@ -5,7 +5,7 @@ tests desispec.sky
 import unittest
 
 import numpy as np
-from desispec.sky import compute_sky, subtract_sky
+from desispec.sky import compute_sky, subtract_sky, compute_uniform_sky
 from desispec.resolution import Resolution
 from desispec.frame import Frame
 import desispec.io
@@ -93,6 +93,50 @@ class TestSky(unittest.TestCase):
         #- allow some slop in the sky subtraction
         self.assertTrue(np.allclose(spectra.flux, 0, rtol=1e-5, atol=1e-6))
 
+    def test_quicklook_compute_sky_with_resolution(self):
+        from desispec.quicklook.quicksky import compute_sky as ql_compute_sky
+        spectra = self._get_spectra()
+        sky = ql_compute_sky(spectra, apply_resolution=True)
+        self.assertEqual(sky.flux.shape, spectra.flux.shape)
+        self.assertEqual(sky.ivar.shape, spectra.ivar.shape)
+        self.assertTrue(np.allclose(sky.flux, spectra.flux, atol=1e-3))
+
+    def test_slice(self):
+        spectra = self._get_spectra()
+        sky = compute_sky(spectra,add_variance=self.add_variance)
+        sub = sky[[1,3,5]]
+        self.assertEqual(sub.flux.shape, (3, self.nwave))
+        self.assertTrue(np.all(sub.flux == sky.flux[[1,3,5]]))
+        self.assertTrue(np.all(sub.ivar == sky.ivar[[1,3,5]]))
+        self.assertTrue(np.all(sub.mask == sky.mask[[1,3,5]]))
+
+    def test_banded_vs_dense(self):
+        #- narrower resolution than in _get_spectra so that the deconvolution is well conditioned
+        sigma2 = 1.0
+        ndiag = 11
+        xx = np.linspace(-(ndiag-1)/2.0, +(ndiag-1)/2.0, ndiag)
+        Rdata = np.zeros( (self.nspec, ndiag, self.nwave) )
+        for i in range(self.nspec):
+            kernel = np.exp(-(xx+float(i)/self.nspec*0.3)**2/(2*sigma2))
+            Rdata[i] = (kernel/np.sum(kernel))[:,None]
+        ivar = 1+0.4*np.random.uniform(size=(self.nspec, self.nwave))
+        flux = np.zeros((self.nspec, self.nwave))
+        for i in range(self.nspec):
+            flux[i] = Resolution(Rdata[i]).dot(self.flux+10.)
+        flux += np.random.normal(size=flux.shape)/np.sqrt(ivar)
+        #- mask a few pixels of some of the sky fibers
+        ivar[0:8:2,100:110] = 0.
+        mask = np.zeros((self.nspec, self.nwave), dtype=int)
+        fibermap = desispec.io.empty_fibermap(self.nspec, 1500)
+        fibermap['OBJTYPE'][0::2] = 'SKY'
+        frame = Frame(self.wave, flux, ivar, mask, Rdata, spectrograph=2, fibermap=fibermap)
+
+        sky1 = compute_uniform_sky(frame,add_variance=False,banded=True)
+        sky2 = compute_uniform_sky(frame,add_variance=False,banded=False)
+        self.assertTrue(np.allclose(sky1.flux, sky2.flux, rtol=1e-6, atol=1e-6))
+        self.assertTrue(np.allclose(sky1.ivar, sky2.ivar, rtol=1e-6, atol=0))
+        self.assertEqual(sky1.nrej, sky2.nrej)
+
     def test_subtract_sky_with_gradient_using_compute_polynomial_times_sky(self):
         spectra = self._get_spectra(with_gradient=True)
         sky = compute_sky(spectra,angular_variation_deg=1,chromatic_variation_deg=1,add_variance=self.add_variance)
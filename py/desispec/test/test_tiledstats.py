@@ -0,0 +1,95 @@
+"""
+tests desispec.tiledstats
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+
+from desispec.tiledstats import tile_edges, tiled_statistic
+
+
+class TestTiledStats(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(1)
+        self.image = np.random.normal(loc=10., scale=2., size=(523, 611))
+        #- a few bright outliers
+        self.image[np.random.randint(0, 523, 200), np.random.randint(0, 611, 200)] += 1000.
+        #- tiles of two heights and two widths
+        self.edges0 = tile_edges(0, 523, 50)
+        self.edges1 = tile_edges(0, 611, 50)
+
+    def _loop(self, func):
+        e0, e1 = self.edges0, self.edges1
+        res = np.zeros((e0.size-1, e1.size-1))
+        for i in range(e0.size-1):
+            for j in range(e1.size-1):
+                res[i, j] = func(self.image[e0[i]:e0[i+1], e1[j]:e1[j+1]])
+        return res
+
+    def test_tile_edges(self):
+        #- same grid as np.linspace with a truncated number of points
+        edges = tile_edges(0, 4128, 200)
+        self.assertTrue(np.all(edges == np.linspace(0, 4128, 20).astype(int)))
+        edges = tile_edges(10, 60, 200)
+        self.assertEqual(list(edges), [10, 60])
+        self.assertEqual(len(np.unique(np.diff(self.edges0))), 2)
+        self.assertEqual(len(np.unique(np.diff(self.edges1))), 2)
+
+    def test_median(self):
+        expected = self._loop(np.median)
+        for backend in ("numpy", "numba"):
+            res = tiled_statistic(self.image, self.edges0, self.edges1, backend=backend)
+            self.assertTrue(np.allclose(res, expected, rtol=0, atol=1e-12))
+
+    def test_clipped_mean(self):
+        def clipped_mean(tile, nsig=3., niter=3):
+            values = tile.ravel()
+            keep = np.ones(values.size, dtype=bool)
+            for i in range(niter):
+                mean, rms = np.mean(values[keep]), np.std(values[keep])
+                keep = np.abs(values-mean) <= nsig*rms
+            return np.mean(values[keep])
+        expected = self._loop(clipped_mean)
+        #- the outliers are rejected
+        self.assertTrue(np.all(np.abs(expected-10.) < 0.5))
+        for backend in ("numpy", "numba"):
+            res = tiled_statistic(self.image, self.edges0, self.edges1, method="clipped_mean", backend=backend)
+            self.assertTrue(np.allclose(res, expected, rtol=0, atol=1e-8))
+
+    def test_non_finite(self):
+        #- both backends ignore the inf and NaN pixels in the clipped mean
+        image = self.image.copy()
+        image[10, 20] = np.inf
+        image[60, 70] = -np.inf
+        image[110, 120] = np.nan
+        image[:50, 600:] = np.inf
+        res = dict()
+        for backend in ("numpy", "numba"):
+            res[backend] = tiled_statistic(image, self.edges0, self.edges1, method="clipped_mean", backend=backend)
+        self.assertTrue(np.all(np.isfinite(res["numpy"])))
+        self.assertTrue(np.allclose(res["numba"], res["numpy"], rtol=0, atol=1e-8))
+
+    def test_strip(self):
+        #- single row of tiles, as used to match amplifiers
+        edges0 = np.array([100, 110])
+        res = tiled_statistic(self.image, edges0, self.edges1)
+        self.assertEqual(res.shape, (1, self.edges1.size-1))
+        self.assertAlmostEqual(res[0, 3], np.median(self.image[100:110, self.edges1[3]:self.edges1[4]]))
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            tiled_statistic(self.image, self.edges0, self.edges1, method="mode")
+        with self.assertRaises(ValueError):
+            tiled_statistic(self.image, self.edges0, self.edges1, backend="cuda")
+
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m <modulename>
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,146 @@
+"""
+desispec.tiledstats
+===================
+
+Robust statistics (median or sigma-clipped mean) of the rectangular tiles of
+an image, as used for the background of the preprocessed images.
+
+The tiles are given by their edges along each axis.  The tiles of a regular
+grid only have one or two heights and one or two widths, so all the tiles
+of a given shape are gathered into a single array and the statistic is
+computed along its last axis with one vectorized call (a partial sort for
+the median).  The numba backend computes the rows of tiles in parallel
+threads with a compiled function that releases the GIL (see
+:func:`desispec.util.thread_map`).
+"""
+
+from __future__ import absolute_import, division
+
+import numpy as np
+from desispec.jit import njit
+
+from desispec.util import default_nthreads, thread_map
+
+
+def tile_edges(start, stop, width) :
+    '''
+    Edges of the tiles of about width pixels covering the range [start,stop[
+
+    This is the integer grid historically used for the background patches:
+    ``np.linspace(start,stop,int((stop-start)/width)).astype(int)``,
+    with at least two edges.
+
+    Args:
+       start (int) first pixel
+       stop (int) last pixel + 1
+       width (int) size in pixels of the tiles
+
+    Returns 1D array of integer edges, the first one is start, the last one is stop
+    '''
+    num = max(2,int(float(stop-start)/width))
+    return np.linspace(start,stop,num).astype(int)
+
+def _clipped_mean(values,nsig,niter) :
+    '''
+    mean of values along the last axis with iterative rejection of the values
+    more than nsig standard deviations away from the mean
+    '''
+    squares = values**2
+    keep = np.isfinite(values)
+    for i in range(niter+1) :
+        n    = np.maximum(np.sum(keep,axis=-1),1)
+        mean = np.sum(values,axis=-1,where=keep)/n
+        if i == niter :
+            break
+        rms  = np.sqrt(np.maximum(np.sum(squares,axis=-1,where=keep)/n-mean**2,0.))
+        keep = (values>=(mean-nsig*rms)[...,None])&(values<=(mean+nsig*rms)[...,None])
+    return mean
+
+def _tiles_numpy(image,edges0,edges1,method,nsig,niter) :
+    res = np.zeros((edges0.size-1,edges1.size-1))
+    size0 = np.diff(edges0)
+    size1 = np.diff(edges1)
+    #- a regular grid has at most two tile heights and two tile widths
+    for h in np.unique(size0) :
+        ii = np.where(size0==h)[0]
+        rows = np.take(image,(edges0[ii][:,None]+np.arange(h)).ravel(),axis=0)
+        for w in np.unique(size1) :
+            jj = np.where(size1==w)[0]
+            tiles = np.take(rows,(edges1[jj][:,None]+np.arange(w)).ravel(),axis=1)
+            #- (nrows*h,ncols*w) -> (nrows,ncols,h*w)
+            tiles = tiles.reshape(ii.size,h,jj.size,w).transpose(0,2,1,3).reshape(ii.size,jj.size,h*w)
+            if method == "median" :
+                res[ii[:,None],jj] = np.median(tiles,axis=-1,overwrite_input=True)
+            else :
+                res[ii[:,None],jj] = _clipped_mean(tiles,nsig,niter)
+    return res
+
+@njit(nogil=True, signatures=["(float64[:,::1], int64[::1], int64[::1], int64[::1], boolean, float64, int64, float64[:,::1])"])
+def _tiles_numba(image,edges0,edges1,rows,median,nsig,niter,res) :
+    n1 = edges1.size-1
+    for i in rows :
+        for j in range(n1) :
+            tile = image[edges0[i]:edges0[i+1],edges1[j]:edges1[j+1]]
+            if median :
+                res[i,j] = np.median(tile)
+                continue
+            #- clipped mean with one pass over the tile per iteration
+            lo = -np.inf
+            hi = np.inf
+            mean = 0.
+            for it in range(niter+1) :
+                n = 0
+                s = 0.
+                s2 = 0.
+                for v in tile.flat :
+                    #- non-finite values are ignored, as in _clipped_mean
+                    if np.isfinite(v) and v>=lo and v<=hi :
+                        n += 1
+                        s += v
+                        s2 += v*v
+                mean = s/max(n,1)
+                if it == niter :
+                    break
+                rms = np.sqrt(max(s2/max(n,1)-mean*mean,0.))
+                lo = mean-nsig*rms
+                hi = mean+nsig*rms
+            res[i,j] = mean
+
+def tiled_statistic(image,edges0,edges1,method="median",nsig=3.,niter=3,backend="numpy",nthreads=None) :
+    '''
+    Robust statistic of each tile of an image
+
+    Args:
+       image (ndarray) 2D image
+       edges0 (1D array of int) edges of the tiles along axis 0
+       edges1 (1D array of int) edges of the tiles along axis 1
+    Options:
+       method (str) "median" or "clipped_mean", the mean after iterative
+              rejection of the outliers at nsig sigma (cheaper than the median)
+       nsig (float) rejection threshold of the clipped mean
+       niter (int) number of rejection iterations of the clipped mean
+       backend (str) "numpy" (vectorized) or "numba" (compiled, rows of tiles
+              in parallel threads)
+       nthreads (int) number of threads of the numba backend, default is
+              desispec.util.default_nthreads()
+
+    Returns 2D array of shape (edges0.size-1,edges1.size-1); tile (i,j) is
+    image[edges0[i]:edges0[i+1],edges1[j]:edges1[j+1]]
+    '''
+    if method not in ("median","clipped_mean") :
+        raise ValueError("unknown method '{}', expecting 'median' or 'clipped_mean'".format(method))
+    edges0 = np.asarray(edges0,dtype=np.int64)
+    edges1 = np.asarray(edges1,dtype=np.int64)
+    if backend == "numpy" :
+        return _tiles_numpy(image,edges0,edges1,method,nsig,niter)
+    elif backend != "numba" :
+        raise ValueError("unknown backend '{}', expecting 'numpy' or 'numba'".format(backend))
+
+    image = np.asarray(image,dtype=np.float64)
+    res = np.zeros((edges0.size-1,edges1.size-1))
+    if nthreads is None :
+        nthreads = default_nthreads()
+    nthreads = max(1,min(nthreads,res.shape[0]))
+    thread_map(_tiles_numba,[ (image,edges0,edges1,rows,method=="median",float(nsig),int(niter),res) \
+        for rows in np.array_split(np.arange(res.shape[0]),nthreads) ],nthreads)
+    return res
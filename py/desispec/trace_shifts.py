@@ -5,12 +5,13 @@ from __future__ import absolute_import, division
 import sys
 import argparse
 import time
+import multiprocessing
 import numpy as np
 from numpy.linalg.linalg import LinAlgError
 import astropy.io.fits as pyfits
 from numpy.polynomial.legendre import legval,legfit
 from scipy.signal import fftconvolve
-import numba
+from desispec.jit import njit
 
 import specter.psf
 from desispec.io import read_image
@@ -18,6 +19,7 @@ from desiutil.log import get_logger
 from desispec.linalg import cholesky_solve,cholesky_solve_and_invert
 from desispec.interpolation import resample_flux
 from desispec.qproc.qextract import qproc_boxcar_extraction
+from desispec.util import default_nthreads, thread_map
 
 def write_traces_in_psf(input_psf_filename,output_psf_filename,xcoef,ycoef,wavemin,wavemax,header_keywords=None) :
     """
@@ -419,29 +421,57 @@ def compute_dy_using_boxcar_extraction(xytraceset, image, fibers, width=7, degyy
     
     return compute_dy_from_spectral_cross_correlations_of_frame(flux=flux, ivar=ivar, wave=wave, xcoef=xcoef, ycoef=ycoef, wavemin=wavemin, wavemax=wavemax, reference_flux = mflux , n_wavelength_bins = degyy+4)
 
-@numba.jit
-def numba_cross_profile(image_flux,image_ivar,x,wave,hw=3) :
+@njit(nogil=True, signatures=["(float64[:,::1], float64[:,::1], float64[:,::1], float64[:,::1], int64, int64, int64, float64[:,::1], float64[:,::1], float64[:,::1], float64[:,::1], float64[:,::1], float64[:,::1])"])
+def _numba_cross_profile_fibers(image_flux,image_ivar,x,wave,hw,begin,end,swdx,sw,svar,swy,swx,swl) :
     n0=image_flux.shape[0]
-    swdx=np.zeros(n0)
-    sw=np.zeros(n0)
-    svar=np.zeros(n0)
-    swy=np.zeros(n0)
-    swx=np.zeros(n0)
-    swl=np.zeros(n0)
-    for j in range(n0) :
-        for i in range(int(x[j]-hw),int(x[j]+hw+1)) :
-            if image_ivar[j,i]==0 :
-               swdx[j]=0
-               sw[j]=0
-               break
-            swdx[j]    += (i-x[j])*image_flux[j,i]
-            sw[j]      += image_flux[j,i]
-            svar[j]    += 1./image_ivar[j,i]
-        swy[j] = sw[j]*j
-        swx[j] = sw[j]*x[j]
-        swl[j] = sw[j]*wave[j]
-
-    return swdx,sw,svar,swy,swx,swl
+    for f in range(begin,end) :
+        for j in range(n0) :
+            for i in range(int(x[f,j]-hw),int(x[f,j]+hw+1)) :
+                if image_ivar[j,i]==0 :
+                   swdx[f,j]=0
+                   sw[f,j]=0
+                   break
+                swdx[f,j]    += (i-x[f,j])*image_flux[j,i]
+                sw[f,j]      += image_flux[j,i]
+                svar[f,j]    += 1./image_ivar[j,i]
+            swy[f,j] = sw[f,j]*j
+            swx[f,j] = sw[f,j]*x[f,j]
+            swl[f,j] = sw[f,j]*wave[f,j]
+
+def numba_cross_profiles(image_flux,image_ivar,x,wave,hw=3,nthreads=None) :
+    """
+    Moments of the cross-dispersion profiles of several fibers
+
+    Args:
+        image_flux : 2D array of pixel values
+        image_ivar : 2D array of pixel inverse variances
+        x : 2D array [nfibers,ny] of trace x coordinates for each CCD row
+        wave : 2D array [nfibers,ny] of wavelength for each CCD row
+
+    Optional:
+        hw : half width of the profile
+        nthreads : number of threads, default is desispec.util.default_nthreads()
+
+    Returns:
+        swdx,sw,svar,swy,swx,swl : 2D arrays [nfibers,ny]
+    """
+    x = np.ascontiguousarray(x,dtype=np.float64)
+    wave = np.ascontiguousarray(wave,dtype=np.float64)
+    moments = tuple(np.zeros(x.shape) for k in range(6))
+    if x.shape[0] == 0 :
+        return moments
+    if nthreads is None :
+        nthreads = default_nthreads()
+    nthreads = max(1,min(nthreads,x.shape[0]))
+    thread_map(_numba_cross_profile_fibers,[ (image_flux,image_ivar,x,wave,hw,f[0],f[-1]+1)+moments \
+        for f in np.array_split(np.arange(x.shape[0]),nthreads) if f.size>0 ],nthreads)
+    return moments
+
+def numba_cross_profile(image_flux,image_ivar,x,wave,hw=3) :
+    """
+    Moments of the cross-dispersion profile of one fiber, see numba_cross_profiles
+    """
+    return tuple(m[0] for m in numba_cross_profiles(image_flux,image_ivar,x[None,:],wave[None,:],hw,nthreads=1))
 
 
 def compute_dx_from_cross_dispersion_profiles(xcoef,ycoef,wavemin,wavemax, image, fibers=None, width=7,deg=2,image_rebin=4) :
@@ -475,7 +505,7 @@ def compute_dx_from_cross_dispersion_profiles(xcoef,ycoef,wavemin,wavemax, image
     t0=time.time()
 
     if fibers is None :
-        fibers = np.arange(psf.nspec)
+        fibers = np.arange(xcoef.shape[0])
 
     log.info("wavelength range : [%f,%f]"%(wavemin,wavemax))
 
@@ -500,35 +530,38 @@ def compute_dx_from_cross_dispersion_profiles(xcoef,ycoef,wavemin,wavemax, image
         ivar = image.ivar
 
     y  = np.arange(n0)+0.5 # this 0.5 is important when rebinning to avoid a bias on y (here y = CCD_rows//rebin + 0.5 )
-    xx = np.tile(np.arange(n1),(n0,1))
     hw = width//2
 
     ncoef=ycoef.shape[1]
     twave=np.linspace(wavemin, wavemax, n0)
     rwave=legx(twave, wavemin, wavemax)
 
-    ox=np.array([])
-    oy=np.array([])
-    odx=np.array([])
-    oex=np.array([])
-    of=np.array([])
-    ol=np.array([])
-
-    dt=0.
+    # traces of all fibers at once
+    fibers = np.asarray(fibers)
+    ty_of_fiber = legval(rwave, ycoef[fibers].T)/image_rebin
+    tx_of_fiber = legval(rwave, xcoef[fibers].T)
 
+    # offsets of the good fibers, concatenated at the end
+    ox=[]
+    oy=[]
+    odx=[]
+    oex=[]
+    of=[]
+    ol=[]
 
+    wave_of_y = np.zeros((fibers.size,n0))
+    x_of_y    = np.zeros((fibers.size,n0))
+    for f in range(fibers.size) :
+        wave_of_y[f] = np.interp(y,ty_of_fiber[f],twave)
+        x_of_y[f]    = np.interp(y,ty_of_fiber[f],tx_of_fiber[f])
 
+    # profile moments of all fibers in one call
+    all_moments = numba_cross_profiles(pix,ivar,x_of_y,wave_of_y,hw=hw)
 
     for f,fiber in enumerate(fibers) :
         # log.info("computing dx for fiber #%03d"%fiber)
 
-        # the following 5 lines take 0.25 sec for all 500 fibers
-        ty = legval(rwave, ycoef[fiber])/image_rebin
-        tx = legval(rwave, xcoef[fiber])
-        wave_of_y  = np.interp(y,ty,twave)
-        x_of_y     = np.interp(y,ty,tx)
-
-        swdx,sw,svar,swy,swx,swl = numba_cross_profile(pix,ivar,x_of_y,wave_of_y,hw=hw)
+        swdx,sw,svar,swy,swx,swl = [ m[f] for m in all_moments ]
         jj      = np.where(sw>0)[0]
 
         # rebin
@@ -594,17 +627,19 @@ def compute_dx_from_cross_dispersion_profiles(xcoef,ycoef,wavemin,wavemax, image
 
         # we return the original sample of offset values
         if good_fiber :
-            ox  = np.append(ox,fx)
-            oy  = np.append(oy,fy)
-            odx = np.append(odx,fdx)
-            oex = np.append(oex,fex)
-            of = np.append(of,fiber*np.ones(fy.size))
-            ol = np.append(ol,fl)
+            ox.append(fx)
+            oy.append(fy)
+            odx.append(fdx)
+            oex.append(fex)
+            of.append(fiber*np.ones(fy.size))
+            ol.append(fl)
 
     t1=time.time()
     log.info("computing dx for {} fibers in {} sec".format(len(fibers),t1-t0))
 
-    return ox,oy,odx,oex,of,ol
+    if len(ox) == 0 :
+        return tuple(np.array([]) for i in range(6))
+    return np.concatenate(ox),np.concatenate(oy),np.concatenate(odx),np.concatenate(oex),np.concatenate(of),np.concatenate(ol)
 
 
 def shift_ycoef_using_external_spectrum(psf,xytraceset,image,fibers,spectrum_filename,degyy=2,width=7) :
@@ -985,7 +1020,27 @@ def compute_fiber_bundle_trace_shifts_using_psf(fibers,line,psf,image,maxshift=2
 
 
 
-def compute_dx_dy_using_psf(psf,image,fibers,lines) :
+_bundle_fit_psf = None
+_bundle_fit_image = None
+
+def _init_bundle_fit(psf,image) :
+    """
+    Initializer of the processes of compute_dx_dy_using_psf: the psf and image
+    are sent once per process instead of once per (bundle,line) fit
+    """
+    global _bundle_fit_psf, _bundle_fit_image
+    _bundle_fit_psf = psf
+    _bundle_fit_image = image
+
+def _bundle_fit(args) :
+    """
+    Runs compute_fiber_bundle_trace_shifts_using_psf for args = (fibers,line)
+    with the psf and image of _init_bundle_fit
+    """
+    fibers,line = args
+    return compute_fiber_bundle_trace_shifts_using_psf(fibers=fibers,psf=_bundle_fit_psf,image=_bundle_fit_image,line=line)
+
+def compute_dx_dy_using_psf(psf,image,fibers,lines,ncpu=1) :
     """
     Computes trace shifts along x and y from a preprocessed image, a PSF (with trace coords), and a set of emission lines,
     by doing a forward model of the image.
@@ -997,6 +1052,9 @@ def compute_dx_dy_using_psf(psf,image,fibers,lines) :
         fibers : 1D array with list of fibers
         lines : 1D array of wavelength of emission lines (in Angstrom)
 
+    Optional:
+        ncpu : number of processes for the fits of the (bundle,line) pairs
+
     Returns:
         x  : 1D array of x coordinates on CCD (axis=1 in numpy image array, AXIS=0 in FITS, cross-dispersion axis = fiber number direction)
         y  : 1D array of y coordinates on CCD (axis=0 in numpy image array, AXIS=1 in FITS, wavelength dispersion axis)
@@ -1014,63 +1072,67 @@ def compute_dx_dy_using_psf(psf,image,fibers,lines) :
     nfibers=len(fibers)
 
     log.info("computing spots coordinates and define bundles")
-    x=np.zeros((nfibers,nlines))
-    y=np.zeros((nfibers,nlines))
 
-    # load expected spots coordinates
-    for fiber in range(nfibers) :
-        for l,line in enumerate(lines) :
-            x[fiber,l],y[fiber,l] = psf.xy(fiber,line)
+    # load expected spots coordinates, in a single call for all fibers and lines
+    x,y = psf.xy(list(range(nfibers)),np.asarray(lines,dtype=float))
+    x = np.asarray(x).reshape(nfibers,nlines)
+    y = np.asarray(y).reshape(nfibers,nlines)
 
-    bundle_fibers=[]
-    bundle_xmin=[]
-    bundle_xmax=[]
+    # group fibers whose spots overlap at the central line ;
+    # a fiber goes to the first bundle it overlaps
     xwidth=9.
-    bundle_xmin.append(x[0,nlines//2]-xwidth/2)
-    bundle_xmax.append(x[0,nlines//2]+xwidth/2)
-    bundle_fibers.append([0,])
-
-
+    tx=x[:,nlines//2]
+    bundle_fibers=[[0,]]
+    bundle_xmin=np.array([tx[0]-xwidth/2])
+    bundle_xmax=np.array([tx[0]+xwidth/2])
     for fiber in range(1,nfibers) :
-        tx=x[fiber,nlines//2]
-        found=False
-        for b in range(len(bundle_fibers)) :
-            if tx+xwidth/2 >= bundle_xmin[b] and tx-xwidth/2 <= bundle_xmax[b] :
-                found=True
-                bundle_fibers[b].append(fiber)
-                bundle_xmin[b]=min(bundle_xmin[b],tx-xwidth/2)
-                bundle_xmax[b]=max(bundle_xmax[b],tx+xwidth/2)
-                break
-        if not found :
+        overlap=np.where((tx[fiber]+xwidth/2>=bundle_xmin)&(tx[fiber]-xwidth/2<=bundle_xmax))[0]
+        if overlap.size>0 :
+            b=overlap[0]
+            bundle_fibers[b].append(fiber)
+            bundle_xmin[b]=min(bundle_xmin[b],tx[fiber]-xwidth/2)
+            bundle_xmax[b]=max(bundle_xmax[b],tx[fiber]+xwidth/2)
+        else :
             bundle_fibers.append([fiber,])
-            bundle_xmin.append(tx-xwidth/2)
-            bundle_xmax.append(tx+xwidth/2)
-
-    log.info("measure offsets dx dy per bundle ({}) and spectral line ({})".format(len(bundle_fibers),len(lines)))
-
-    wave_xy=np.array([])  # line
-    fiber_xy=np.array([])  # central fiber in bundle
-    x=np.array([])  # central x in bundle at line wavelength
-    y=np.array([])  # central x in bundle at line wavelength
-    dx=np.array([]) # measured offset along x
-    dy=np.array([]) # measured offset along y
-    ex=np.array([]) # measured offset uncertainty along x
-    ey=np.array([]) # measured offset uncertainty along y
-
-    for b in range(len(bundle_fibers)) :
-        for l,line in enumerate(lines) :
-            tx,ty,tdx,tdy,tex,tey = compute_fiber_bundle_trace_shifts_using_psf(fibers=bundle_fibers[b],psf=psf,image=image,line=line)
-            log.info("fibers [%d:%d] %dA dx=%4.3f+-%4.3f dy=%4.3f+-%4.3f"%(bundle_fibers[b][0],bundle_fibers[b][-1]+1,int(line),tdx,tex,tdy,tey))
-            if tex<1. and tey<1. :
-                wave_xy=np.append(wave_xy,line)
-                fiber_xy=np.append(fiber_xy,int(np.median(bundle_fibers[b])))
-                x=np.append(x,tx)
-                y=np.append(y,ty)
-                dx=np.append(dx,tdx)
-                dy=np.append(dy,tdy)
-                ex=np.append(ex,tex)
-                ey=np.append(ey,tey)
-    return x,y,dx,ex,dy,ey,fiber_xy,wave_xy
+            bundle_xmin=np.append(bundle_xmin,tx[fiber]-xwidth/2)
+            bundle_xmax=np.append(bundle_xmax,tx[fiber]+xwidth/2)
+
+    nbundles=len(bundle_fibers)
+    log.info("measure offsets dx dy per bundle ({}) and spectral line ({}) with {} processes".format(nbundles,nlines,ncpu))
+
+    # the fits of the (bundle,line) pairs are independent
+    func_args=[(bundle_fibers[b],line) for b in range(nbundles) for line in lines]
+    if ncpu > 1 :
+        pool = multiprocessing.Pool(min(ncpu,len(func_args)),initializer=_init_bundle_fit,initargs=(psf,image))
+        results = pool.map(_bundle_fit,func_args)
+        pool.close()
+        pool.join()
+    else :
+        results = [compute_fiber_bundle_trace_shifts_using_psf(fibers=fibers,psf=psf,image=image,line=line) for fibers,line in func_args]
+
+    npairs=len(func_args)
+    wave_xy=np.zeros(npairs)  # line
+    fiber_xy=np.zeros(npairs)  # central fiber in bundle
+    x=np.zeros(npairs)  # central x in bundle at line wavelength
+    y=np.zeros(npairs)  # central x in bundle at line wavelength
+    dx=np.zeros(npairs) # measured offset along x
+    dy=np.zeros(npairs) # measured offset along y
+    ex=np.zeros(npairs) # measured offset uncertainty along x
+    ey=np.zeros(npairs) # measured offset uncertainty along y
+
+    for k,((bfibers,line),(tx,ty,tdx,tdy,tex,tey)) in enumerate(zip(func_args,results)) :
+        log.info("fibers [%d:%d] %dA dx=%4.3f+-%4.3f dy=%4.3f+-%4.3f"%(bfibers[0],bfibers[-1]+1,int(line),tdx,tex,tdy,tey))
+        wave_xy[k]=line
+        fiber_xy[k]=int(np.median(bfibers))
+        x[k]=np.ravel(tx)[0]
+        y[k]=np.ravel(ty)[0]
+        dx[k]=tdx
+        dy[k]=tdy
+        ex[k]=tex
+        ey[k]=tey
+
+    ok=(ex<1.)&(ey<1.)
+    return x[ok],y[ok],dx[ok],ex[ok],dy[ok],ey[ok],fiber_xy[ok],wave_xy[ok]
 
 # end of routines for forward model method
 
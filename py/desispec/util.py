@@ -358,3 +358,43 @@ def healpix_degrade_fixed(nside, pixel):
     subnside = 2**subfactor
     subpixel = pixel >> (factor - subfactor)
     return (subnside, subpixel)
+
+
+def default_nthreads():
+    """Default number of threads of the compiled kernels run by
+    :func:`thread_map`: $OMP_NUM_THREADS if set, otherwise the number of
+    cpus.
+    """
+    if "OMP_NUM_THREADS" in os.environ:
+        return max(1, int(os.environ["OMP_NUM_THREADS"]))
+    return os.cpu_count() or 1
+
+
+def thread_map(func, arglist, nthreads=None):
+    """Call func(*args) for each args in arglist in a pool of threads.
+
+    This is meant for compiled functions that release the GIL
+    (e.g. ``numba.njit(nogil=True)``).  The threads are terminated before
+    returning, so that it is still safe to fork the process afterwards,
+    as done by multiprocessing, which is not the case once the numba
+    threading layer (``numba.prange``) has been started.
+
+    Args:
+        func: function to call.
+        arglist (list): list of tuples of arguments.
+        nthreads (int): number of threads, default is
+            :func:`default_nthreads`.
+
+    Returns (list):
+        the results of the calls, in the order of arglist.
+
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if nthreads is None:
+        nthreads = default_nthreads()
+    nthreads = max(1, min(nthreads, len(arglist)))
+    if nthreads == 1:
+        return [func(*args) for args in arglist]
+    with ThreadPoolExecutor(nthreads) as executor:
+        futures = [executor.submit(func, *args) for args in arglist]
+        return [future.result() for future in futures]